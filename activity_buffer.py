@@ -0,0 +1,212 @@
+"""
+Cash Points Activity Buffer
+Write-behind buffer for last_activity / last_active style updates.
+
+- Keeps only the latest pending fields per user document in memory
+- Flushes in bulk batches every N seconds or once M documents are pending
+- Journals every touch to a local append-only file so pending updates
+  survive a process crash; the journal is replayed on the next start. Touches
+  are written to the OS but not fsynced (that would block the event loop per
+  touch), so a host crash can lose those since the last flush, at most
+  ACTIVITY_FLUSH_INTERVAL; segments kept across a failed flush are fsynced
+- One journal per process: each entry point needs its own journal_path, since
+  a journal is replayed and rotated by whoever opens it
+- Reports flushed rows and how many writes were coalesced
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+BATCH_LIMIT = 500  # Firestore max writes per batch
+
+
+def _encode(fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: {'$dt': v.isoformat()} if isinstance(v, datetime) else v for k, v in fields.items()}
+
+
+def _decode(fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: datetime.fromisoformat(v['$dt']) if isinstance(v, dict) and '$dt' in v else v
+            for k, v in fields.items()}
+
+
+class ActivityBuffer:
+    """Coalesces per-document activity writes and flushes them in batches"""
+
+    def __init__(self, db, flush_interval: float = None, max_entries: int = None,
+                 journal_path: str = None):
+        self.db = db
+        self.flush_interval = flush_interval or config.ACTIVITY_FLUSH_INTERVAL
+        self.max_entries = max_entries or config.ACTIVITY_FLUSH_MAX_ENTRIES
+        self.journal_path = journal_path or config.ACTIVITY_JOURNAL_PATH
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._journal = None
+        self._stopped = False
+        self.touches = 0
+        self.coalesced = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_at: Optional[float] = None
+
+        if self.journal_path:
+            os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+            self._replay_journal()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    @property
+    def enabled(self) -> bool:
+        return self.db is not None
+
+    def __len__(self):
+        return len(self._pending)
+
+    # ---- Journal ----------------------------------------------------------
+
+    def _replay_journal(self):
+        """Load updates left behind by a previous run (including a failed final flush)"""
+        recovered = 0
+        for path in (f"{self.journal_path}.flushing", self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write at crash time
+                    self._pending.setdefault(entry['path'], {}).update(_decode(entry['fields']))
+                    recovered += 1
+        if recovered:
+            # Rewrite as a single compact segment, then drop the old ones
+            self._write_segment(f"{self.journal_path}.recovered", self._pending)
+            os.replace(f"{self.journal_path}.recovered", self.journal_path)
+            if os.path.exists(f"{self.journal_path}.flushing"):
+                os.remove(f"{self.journal_path}.flushing")
+            logger.info(f"♻️ Recovered {len(self._pending)} pending activity updates from journal")
+
+    @staticmethod
+    def _write_segment(path: str, pending: Dict[str, Dict[str, Any]]):
+        with open(path, 'w', encoding='utf-8') as f:
+            for doc_path, fields in pending.items():
+                f.write(json.dumps({'path': doc_path, 'fields': _encode(fields)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ---- Buffering --------------------------------------------------------
+
+    def touch(self, doc_ref, fields: Dict[str, Any]):
+        """Queue fields for a user document; later touches overwrite earlier ones"""
+        if not self.enabled:
+            return
+        path = doc_ref.path if hasattr(doc_ref, 'path') else str(doc_ref)
+        with self._lock:
+            existing = self._pending.get(path)
+            if existing is None:
+                self._pending[path] = dict(fields)
+            else:
+                existing.update(fields)
+                self.coalesced += 1
+            self.touches += 1
+            if self._journal:
+                self._journal.write(json.dumps({'path': path, 'fields': _encode(fields)}) + '\n')
+                self._journal.flush()
+            should_flush = len(self._pending) >= self.max_entries
+        if should_flush:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Write all pending updates in batches; returns the number of rows flushed"""
+        if not self.enabled:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+                if self._journal:
+                    # Start a new segment; the old one is kept until the commit succeeds
+                    self._journal.close()
+                    os.replace(self.journal_path, f"{self.journal_path}.flushing")
+                    self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+            written = 0
+            items = list(pending.items())
+            try:
+                for start in range(0, len(items), BATCH_LIMIT):
+                    batch = self.db.batch()
+                    for doc_path, fields in items[start:start + BATCH_LIMIT]:
+                        batch.set(self.db.document(doc_path), fields, merge=True)
+                    batch.commit()
+                    written += len(items[start:start + BATCH_LIMIT])
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.warning(f"Activity flush failed after {written} rows, re-queueing: {e}")
+                with self._lock:
+                    # Newer touches win over the re-queued values
+                    for doc_path, fields in items[written:]:
+                        merged = dict(fields)
+                        merged.update(self._pending.get(doc_path, {}))
+                        self._pending[doc_path] = merged
+                    if self._journal:
+                        # Keep the re-queued updates in the live segment
+                        for doc_path, _ in items[written:]:
+                            self._journal.write(json.dumps({'path': doc_path,
+                                                            'fields': _encode(self._pending[doc_path])}) + '\n')
+                        self._journal.flush()
+                        os.fsync(self._journal.fileno())
+                        os.remove(f"{self.journal_path}.flushing")
+                self.flushed_rows += written
+                return written
+
+            if self.journal_path and os.path.exists(f"{self.journal_path}.flushing"):
+                os.remove(f"{self.journal_path}.flushing")
+            self.flushed_rows += written
+            self.flushes += 1
+            self.last_flush_at = time.time()
+            return written
+
+    async def run(self):
+        """Periodic flush loop; run as a background task"""
+        while not self._stopped:
+            await asyncio.to_thread(self._wakeup.wait, self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.warning(f"Activity flush loop error: {e}")
+
+    def close(self):
+        """Final flush on shutdown; anything unflushed stays in the journal"""
+        self._stopped = True
+        self._wakeup.set()
+        flushed = self.flush()
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+        if self._pending:
+            logger.warning(f"⚠️ {len(self._pending)} activity updates left in journal for next start")
+        return flushed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self._pending),
+            'touches': self.touches,
+            'coalesced': self.coalesced,
+            'flushed_rows': self.flushed_rows,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+        }
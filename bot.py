@@ -10,7 +10,10 @@ Features:
 """
 
 import os
+import time
+import asyncio
 import logging
+import threading
 import requests
 from datetime import datetime
 from typing import Optional, Dict, Any
@@ -19,14 +22,43 @@ from typing import Optional, Dict, Any
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    ContextTypes, MessageHandler, filters
+    ContextTypes, MessageHandler, TypeHandler, BaseUpdateProcessor, SimpleUpdateProcessor, filters
 )
+from telegram.request import BaseRequest
+from telegram.error import RetryAfter
 
 # Firebase imports
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists
 from dotenv import load_dotenv
 
+from config import config
+from activity_buffer import ActivityBuffer
+from outbox import Outbox, ReplayError, USER_UPSERT, REFERRAL, REWARD
+import resilience
+from resilience import with_deadline, is_degraded_error
+from update_recorder import UpdateRecorder
+from tracing import tracer, traced_client, traced_request, update_processor, start_span
+from update_scheduler import PriorityUpdateProcessor
+from bot_transport import BotApiTransport, build_transports
+from fraud_flags import fraud_flags
+from rate_governor import governor
+from membership_sweeper import MembershipStore, MembershipSweeper, membership_status, VERIFIED
+from withdrawals import WithdrawalPipeline
+from session_cache import sessions, SessionPersistence
+from mini_app_api import MiniAppAPI
+import referral_codes
+import energy
+from snapshot_listener import listeners
+import lookup_snapshot
+from models import User, Referral, Earning, Notification
+from earnings_ledger import ledger as earnings_ledger
+from notification_inbox import inbox
+import warm_state
+from warm_state import DrainingApplication, DrainingUpdateProcessor
+from referral_graph import ReferralGraphIndex, LevelCrossing, REFERRAL_LEVELS
+
 # Load environment variables
 load_dotenv()
 
@@ -52,10 +84,6 @@ MINI_APP_URL = "https://helpful-khapse-deec27.netlify.app/"
 # Reward configuration
 REFERRAL_REWARD = 2  # 2 Taka per successful referral
 
-# Initialize Firebase with better error handling
-db = None
-firebase_error_details = None
-
 def check_system_time():
     """Check if system time is reasonable (not too far off)"""
     try:
@@ -78,155 +106,331 @@ def check_system_time():
     
     return True, None
 
-def validate_firebase_connection():
+def _is_retryable_connection_error(error: Exception) -> bool:
+    # JWT errors are often clock skew right after boot, worth another try
+    error_str = str(error)
+    return (resilience.is_transient(error) or "Invalid JWT Signature" in error_str
+            or "invalid_grant" in error_str)
+
+
+def validate_firebase_connection(db):
     """Test Firebase connection with a simple operation"""
     try:
         # Try a simple read operation to test connection
         test_ref = db.collection('_connection_test').limit(1)
-        list(test_ref.stream())
+        resilience.call('connection', lambda: list(test_ref.stream(timeout=config.BACKEND_CALL_TIMEOUT)),
+                        idempotent=True, retryable=_is_retryable_connection_error)
         return True, None
     except Exception as e:
-        error_str = str(e)
-        if "Invalid JWT Signature" in error_str or "invalid_grant" in error_str:
-            # Try to wait and retry once for JWT issues
-            print("⏳ JWT error detected, waiting 2 seconds and retrying...")
-            import time
-            time.sleep(2)
-            try:
-                list(test_ref.stream())
-                return True, None
-            except Exception as retry_e:
-                return False, f"Retry failed: {str(retry_e)}"
-        return False, error_str
-
-try:
-    print("🔧 Initializing Firebase connection...")
-    
-    # Check system time first
-    time_ok, time_msg = check_system_time()
-    if not time_ok:
-        print(f"⚠️ System time issue: {time_msg}")
-        print("🔧 This may cause JWT signature errors")
-    else:
-        print("✅ System time check passed")
+        return False, str(e)
+
+def initialize_firebase():
+    """Initialize Firebase and return (db, error_details); safe to call again to reconnect"""
+    try:
+        print("🔧 Initializing Firebase connection...")
+    
+        # Check system time first
+        time_ok, time_msg = check_system_time()
+        if not time_ok:
+            print(f"⚠️ System time issue: {time_msg}")
+            print("🔧 This may cause JWT signature errors")
+        else:
+            print("✅ System time check passed")
     
-    # Try to load from serviceAccountKey.json first
-    if os.path.exists('serviceAccountKey.json'):
-        print("📄 Loading Firebase credentials from serviceAccountKey.json")
+        if firebase_admin._apps:
+            # Already initialized by an earlier attempt, only the client is missing
+            print("♻️ Reusing existing Firebase app")
+        # Try to load from serviceAccountKey.json first
+        elif os.path.exists('serviceAccountKey.json'):
+            print("📄 Loading Firebase credentials from serviceAccountKey.json")
         
-        # Validate JSON file first
-        try:
-            with open('serviceAccountKey.json', 'r') as f:
-                import json
-                key_data = json.load(f)
-                required_fields = ['type', 'project_id', 'private_key', 'client_email']
-                missing_fields = [field for field in required_fields if not key_data.get(field)]
+            # Validate JSON file first
+            try:
+                with open('serviceAccountKey.json', 'r') as f:
+                    import json
+                    key_data = json.load(f)
+                    required_fields = ['type', 'project_id', 'private_key', 'client_email']
+                    missing_fields = [field for field in required_fields if not key_data.get(field)]
                 
-                if missing_fields:
-                    raise ValueError(f"Missing required fields in serviceAccountKey.json: {missing_fields}")
+                    if missing_fields:
+                        raise ValueError(f"Missing required fields in serviceAccountKey.json: {missing_fields}")
                 
-                print(f"🔑 Service Account: {key_data.get('client_email', 'Unknown')}")
-                print(f"🏗️ Project ID: {key_data.get('project_id', 'Unknown')}")
+                    print(f"🔑 Service Account: {key_data.get('client_email', 'Unknown')}")
+                    print(f"🏗️ Project ID: {key_data.get('project_id', 'Unknown')}")
                 
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Invalid JSON in serviceAccountKey.json: {e}")
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON in serviceAccountKey.json: {e}")
         
-        cred = credentials.Certificate('serviceAccountKey.json')
-        firebase_admin.initialize_app(cred)
+            cred = credentials.Certificate('serviceAccountKey.json')
+            firebase_admin.initialize_app(cred)
         
-    else:
-        # Load from environment variables
-        print("🌍 Loading Firebase credentials from environment variables")
-        firebase_config = {
-            "type": os.getenv('FIREBASE_TYPE', 'service_account'),
-            "project_id": os.getenv('FIREBASE_PROJECT_ID'),
-            "private_key_id": os.getenv('FIREBASE_PRIVATE_KEY_ID'),
-            "private_key": os.getenv('FIREBASE_PRIVATE_KEY', '').replace('\\n', '\n'),
-            "client_email": os.getenv('FIREBASE_CLIENT_EMAIL'),
-            "client_id": os.getenv('FIREBASE_CLIENT_ID'),
-            "auth_uri": os.getenv('FIREBASE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
-            "token_uri": os.getenv('FIREBASE_TOKEN_URI', 'https://oauth2.googleapis.com/token'),
-            "auth_provider_x509_cert_url": os.getenv('FIREBASE_AUTH_PROVIDER_X509_CERT_URL'),
-            "client_x509_cert_url": os.getenv('FIREBASE_CLIENT_X509_CERT_URL'),
-            "universe_domain": os.getenv('FIREBASE_UNIVERSE_DOMAIN', 'googleapis.com')
-        }
+        else:
+            # Load from environment variables
+            print("🌍 Loading Firebase credentials from environment variables")
+            firebase_config = {
+                "type": os.getenv('FIREBASE_TYPE', 'service_account'),
+                "project_id": os.getenv('FIREBASE_PROJECT_ID'),
+                "private_key_id": os.getenv('FIREBASE_PRIVATE_KEY_ID'),
+                "private_key": os.getenv('FIREBASE_PRIVATE_KEY', '').replace('\\n', '\n'),
+                "client_email": os.getenv('FIREBASE_CLIENT_EMAIL'),
+                "client_id": os.getenv('FIREBASE_CLIENT_ID'),
+                "auth_uri": os.getenv('FIREBASE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
+                "token_uri": os.getenv('FIREBASE_TOKEN_URI', 'https://oauth2.googleapis.com/token'),
+                "auth_provider_x509_cert_url": os.getenv('FIREBASE_AUTH_PROVIDER_X509_CERT_URL'),
+                "client_x509_cert_url": os.getenv('FIREBASE_CLIENT_X509_CERT_URL'),
+                "universe_domain": os.getenv('FIREBASE_UNIVERSE_DOMAIN', 'googleapis.com')
+            }
         
-        if not firebase_config['project_id']:
-            raise ValueError("Firebase project_id is required")
+            if not firebase_config['project_id']:
+                raise ValueError("Firebase project_id is required")
             
-        cred = credentials.Certificate(firebase_config)
-        firebase_admin.initialize_app(cred)
+            cred = credentials.Certificate(firebase_config)
+            firebase_admin.initialize_app(cred)
     
-    # Initialize Firestore client
-    db = firestore.client()
-    print(f"✅ Firebase Admin SDK initialized")
-    print(f"🔗 Project ID: {db.project}")
+        # Initialize Firestore client
+        db = firestore.client()
+        print(f"✅ Firebase Admin SDK initialized")
+        print(f"🔗 Project ID: {db.project}")
     
-    # Test the connection with actual database operation
-    print("🧪 Testing Firebase connection...")
-    is_connected, test_error = validate_firebase_connection()
+        # Test the connection with actual database operation
+        print("🧪 Testing Firebase connection...")
+        is_connected, test_error = validate_firebase_connection(db)
     
-    if is_connected:
-        print("✅ Firebase database connection verified")
-    else:
-        print(f"⚠️ Firebase connection test failed: {test_error}")
-        print("🔄 Bot will continue with limited functionality")
-        firebase_error_details = test_error
-        # Don't set db = None here, keep it for basic operations
-    
-except Exception as e:
-    print(f"❌ Firebase initialization failed: {e}")
-    firebase_error_details = str(e)
-    
-    # Check for specific error types
-    if "Invalid JWT Signature" in str(e) or "invalid_grant" in str(e):
-        print("🔧 JWT SIGNATURE ERROR TROUBLESHOOTING:")
-        print("1. ⏰ Check system time synchronization")
-        print("2. 🔑 Regenerate service account key from Firebase Console")
-        print("3. 📄 Verify serviceAccountKey.json is complete and valid")
-        print("4. 🌐 Check internet connectivity")
-        print("5. 🏗️ Verify Firebase project is active and billing enabled")
-        print("6. 🔐 Ensure service account has proper permissions")
-        print("7. 💻 Try restarting the bot after 1-2 minutes")
-    elif "ServiceUnavailable" in str(e):
-        print("🔧 SERVICE UNAVAILABLE ERROR:")
-        print("1. 🌐 Check internet connectivity")
-        print("2. 🔄 Firebase services may be temporarily down")
-        print("3. ⏳ Wait a few minutes and try again")
-    elif "PermissionDenied" in str(e):
-        print("🔧 PERMISSION DENIED ERROR:")
-        print("1. 🔐 Check service account permissions")
-        print("2. 🏗️ Verify Firestore is enabled in Firebase Console")
-        print("3. 📋 Check Firestore security rules")
-    
-    print("⚠️ Bot will continue in offline mode")
-    db = None
+        if is_connected:
+            print("✅ Firebase database connection verified")
+        else:
+            print(f"⚠️ Firebase connection test failed: {test_error}")
+            print("🔄 Bot will continue with limited functionality")
+            # Don't set db = None here, keep it for basic operations
+            return db, test_error
+    
+        return db, None
+    
+    except Exception as e:
+        print(f"❌ Firebase initialization failed: {e}")
+    
+        # Check for specific error types
+        if "Invalid JWT Signature" in str(e) or "invalid_grant" in str(e):
+            print("🔧 JWT SIGNATURE ERROR TROUBLESHOOTING:")
+            print("1. ⏰ Check system time synchronization")
+            print("2. 🔑 Regenerate service account key from Firebase Console")
+            print("3. 📄 Verify serviceAccountKey.json is complete and valid")
+            print("4. 🌐 Check internet connectivity")
+            print("5. 🏗️ Verify Firebase project is active and billing enabled")
+            print("6. 🔐 Ensure service account has proper permissions")
+            print("7. 💻 Try restarting the bot after 1-2 minutes")
+        elif "ServiceUnavailable" in str(e):
+            print("🔧 SERVICE UNAVAILABLE ERROR:")
+            print("1. 🌐 Check internet connectivity")
+            print("2. 🔄 Firebase services may be temporarily down")
+            print("3. ⏳ Wait a few minutes and try again")
+        elif "PermissionDenied" in str(e):
+            print("🔧 PERMISSION DENIED ERROR:")
+            print("1. 🔐 Check service account permissions")
+            print("2. 🏗️ Verify Firestore is enabled in Firebase Console")
+            print("3. 📋 Check Firestore security rules")
+    
+        print("⚠️ Bot will continue in offline mode")
+        return None, str(e)
+
+
+db, firebase_error_details = initialize_firebase()
+
+
+def _session_referral(referral_doc) -> Optional[Dict[str, Any]]:
+    """The parts of a referral doc kept in the referred user's session"""
+    if referral_doc is None:
+        return None
+    referral = Referral.from_firestore(referral_doc.id, referral_doc.to_dict() or {})
+    return {
+        'path': referral_doc.reference.path,
+        'referrer_id': referral.referrer_id,
+        'code': referral.referral_code,
+        'status': referral.status,
+    }
 
 
 class CashPoinntBot:
     def __init__(self):
-        self.db = db
+        self.db = traced_client(db)
         self.firebase_connected = db is not None
         self.fallback_mode = not self.firebase_connected
         self.firebase_error = firebase_error_details
+        self.activity = ActivityBuffer(db)
+        self.outbox = Outbox()
+        self.membership = MembershipStore()
+        self.referral_index = ReferralGraphIndex()
+        self._index_lock = threading.Lock()
+        self._index_backlog = []
         
+    def rebuild_referral_index(self):
+        """Rebuild the referral graph index from Firestore (runs in a background thread)"""
+        if not self.db:
+            return
+        try:
+            started = time.perf_counter()
+            # A warm restart only reads the referrals verified since the last snapshot
+            index = None if self.referral_index.ready else warm_state.load_referral_index(self.db)
+            if index is None:
+                index = ReferralGraphIndex.rebuild_from_firestore(self.db)
+            with self._index_lock:
+                # Referrals verified while the rebuild was streaming
+                for referrer_id, referred_id in self._index_backlog:
+                    index.add_referral(referrer_id, referred_id)
+                self._index_backlog = []
+                self.referral_index = index
+            stats = index.stats()
+            logger.info(f"✅ Referral index ready: {stats['edges']} referrals, {stats['nodes']} users "
+                        f"in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            logger.warning(f"Referral index rebuild failed (using referral counters): {e}")
+    
+    def attach_db(self, client):
+        """Switch from fallback mode to a live Firestore client"""
+        global db
+        db = client
+        self.db = traced_client(client)
+        self.firebase_connected = True
+        self.fallback_mode = False
+        self.firebase_error = None
+        self.activity.db = client
+        threading.Thread(target=self.rebuild_referral_index, daemon=True).start()
+        logger.info("✅ Firebase reconnected, leaving fallback mode")
+    
+    async def outbox_worker(self):
+        """Reconnect to Firebase while offline and replay the outbox once connected"""
+        handlers = {
+            USER_UPSERT: self._replay_user_upsert,
+            REFERRAL: self._replay_referral,
+            REWARD: self._replay_reward,
+        }
+        while True:
+            try:
+                if not self.db:
+                    client, error = await asyncio.to_thread(initialize_firebase)
+                    if client and not error:
+                        self.attach_db(client)
+                    else:
+                        self.firebase_error = error
+                if self.db and self.outbox.stats()['depth']:
+                    await self.outbox.replay(handlers)
+            except Exception as e:
+                logger.warning(f"Outbox worker error: {e}")
+            await asyncio.sleep(config.OUTBOX_RETRY_INTERVAL)
+    
+    async def _replay_user_upsert(self, payload: Dict[str, Any]):
+        if not self.db:
+            raise ReplayError("Database not connected")
+        await resilience.acall('users', self._upsert_user, payload)
+    
+    async def _replay_referral(self, payload: Dict[str, Any]):
+        if not self.db:
+            raise ReplayError("Database not connected")
+        referrer_id = await resilience.acall('users', self.resolve_referral_code,
+                                             payload['referral_code'], idempotent=True)
+        if referrer_id and referrer_id != payload['referred_id']:
+            await resilience.acall('referrals', self._create_referral, referrer_id, payload['referred_id'],
+                                   payload['referral_code'], False)
+            await sessions.ainvalidate(payload['referred_id'])
+    
+    async def _replay_reward(self, payload: Dict[str, Any]):
+        if not self.db:
+            raise ReplayError("Database not connected")
+        # Membership was confirmed when the event was recorded
+        await resilience.acall('rewards', self.apply_referral_reward, payload['user_id'], idempotent=True)
+        await sessions.ainvalidate(payload['user_id'])
+    
+    def record_verified_referral(self, referrer_id: str, referred_id: str,
+                                 referral_count: int) -> Optional[LevelCrossing]:
+        """Add a verified referral to the index and return any level crossing"""
+        with self._index_lock:
+            if self.referral_index.ready:
+                return self.referral_index.add_referral(int(referrer_id), int(referred_id))
+            self._index_backlog.append((int(referrer_id), int(referred_id)))
+        # Index still warming up: fall back to the user's referral counter
+        for level, required, bonus in REFERRAL_LEVELS:
+            if referral_count == required:
+                return LevelCrossing(int(referrer_id), level, referral_count, bonus)
+        return None
+    
+    def pay_level_bonus(self, referrer_ref, crossing: LevelCrossing) -> bool:
+        """Pay a referral level bonus once per referrer and level"""
+        referrer_id = str(crossing.referrer_id)
+        bonus_id = f"level_bonus_{referrer_id}_{crossing.level}"
+        # Earnings record, balance change and notification commit together;
+        # the deterministic earnings doc id makes a second commit fail
+        batch = self.db.batch()
+        earnings_ledger.add(batch, self.db, bonus_id, Earning(
+            referrer_id, crossing.bonus, 'referral_level_bonus',
+            description=f'Referral level {crossing.level} bonus ({crossing.referrals} referrals)',
+            source='bonus', created_at=datetime.now()))
+        batch.update(referrer_ref, {
+            'balance': firestore.Increment(crossing.bonus),
+            'total_earnings': firestore.Increment(crossing.bonus),
+            'referral_level': crossing.level,
+            'updated_at': datetime.now()
+        })
+        batch.set(self.db.collection('notifications').document(bonus_id), Notification(
+            referrer_id, 'reward', f'Referral Level {crossing.level} Reached! 🏆',
+            f'You reached {crossing.referrals} referrals and earned a ৳{crossing.bonus} bonus.',
+            created_at=datetime.now()).to_firestore())
+        try:
+            batch.commit()
+        except AlreadyExists:
+            logger.info(f"Level {crossing.level} bonus already paid to {referrer_id}")
+            return False
+        logger.info(f"🏆 Paid level {crossing.level} bonus ৳{crossing.bonus} to referrer {referrer_id}")
+        return True
+    
+    def pay_missed_level_bonuses(self, referrer_doc, total_referrals: int = None, below_level: int = None) -> int:
+        """Pay every level bonus the referrer has reached but not been paid, e.g.
+        when an attempt failed between its reward and its bonus; safe to repeat.
+        Levels are paid in order, so referral_level ends at the highest"""
+        data = referrer_doc.to_dict() or {}
+        referrer_id = str(data.get('telegram_id') or referrer_doc.id)
+        if total_referrals is None:
+            total_referrals = int(data.get('total_referrals') or 0)
+        paid_level = int(data.get('referral_level') or 0)
+        paid = 0
+        for level, required, bonus in REFERRAL_LEVELS:
+            if below_level is not None and level >= below_level:
+                break
+            if level > paid_level and total_referrals >= required:
+                paid += self.pay_level_bonus(referrer_doc.reference,
+                                             LevelCrossing(int(referrer_id), level, required, bonus))
+        return paid
+    
     async def check_group_membership(self, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
         """Check if user is member of required group"""
+        # A recent positive answer is reused; a negative one never is, so "Verify" always asks
+        session = await sessions.aget(context.user_data, user_id)
+        if time.time() - session.get('member_at', 0) < config.SESSION_MEMBERSHIP_TTL:
+            return True
         try:
+            await governor.acquire()
             chat_member = await context.bot.get_chat_member(REQUIRED_GROUP_ID, user_id)
-            return chat_member.status in ['member', 'administrator', 'creator']
+            # Remembered so the background sweep can skip users who just checked in
+            status = membership_status(chat_member)
+            await asyncio.to_thread(self.membership.record, user_id, status)
+            # Same answer the sweeper and the withdrawal pipeline act on
+            is_member = status == VERIFIED
+            if is_member:
+                session['member_at'] = time.time()
+            return is_member
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            governor.penalize(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds')
+                              else float(retry_after))
+            logger.error(f"Error checking group membership for {user_id}: {e}")
+            return False
         except Exception as e:
             logger.error(f"Error checking group membership for {user_id}: {e}")
             return False
     
     def generate_referral_code(self, user_id: int) -> str:
         """Generate referral code for user"""
-        try:
-            # Use CP + last 6 digits of user ID (matching frontend)
-            return f"CP{str(user_id)[-6:].upper()}"
-        except Exception as e:
-            logger.error(f"Error generating referral code: {e}")
-            return f"CP{str(user_id)[-6:]}"
+        # Self-validating: the code carries the user's ID, see referral_codes.py
+        return referral_codes.encode(user_id)
     
     async def get_user_from_db(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Get user data from Firebase"""
@@ -236,7 +440,7 @@ class CashPoinntBot:
         try:
             users_ref = self.db.collection('users')
             query = users_ref.where('telegram_id', '==', telegram_id).limit(1)
-            docs = list(query.stream())
+            docs = await resilience.acall('users', lambda: list(query.stream()), idempotent=True)
             
             if docs:
                 return docs[0].to_dict()
@@ -245,59 +449,84 @@ class CashPoinntBot:
             logger.warning(f"Database query failed (continuing without DB): {e}")
             return None
     
-    async def create_or_update_user(self, user_data: Dict[str, Any]) -> bool:
+    async def create_or_update_user(self, user_data: Dict[str, Any], session: Dict[str, Any] = None) -> bool:
         """Create or update user in Firebase"""
         if not self.db:
-            logger.info("📝 Database not connected, skipping user creation")
+            # Keep the upsert for replay once the database is back
+            await asyncio.to_thread(self.outbox.append, USER_UPSERT,
+                                    f"user:{user_data['telegram_id']}", user_data)
+            logger.info("📝 Database not connected, user upsert saved to outbox")
             return False
             
         try:
-            users_ref = self.db.collection('users')
-            telegram_id = str(user_data['telegram_id'])
-            
-            # Check if user exists
-            existing_user = await self.get_user_from_db(telegram_id)
-            
-            if existing_user:
-                # Update existing user
-                query = users_ref.where('telegram_id', '==', telegram_id).limit(1)
-                docs = list(query.stream())
-                if docs:
-                    docs[0].reference.update({
-                        'username': user_data.get('username', ''),
-                        'first_name': user_data.get('first_name', ''),
-                        'last_name': user_data.get('last_name', ''),
-                        'last_active': datetime.now(),
-                        'updated_at': datetime.now()
-                    })
-                    logger.info(f"✅ Updated user {telegram_id} in database")
-                    return True
-            else:
-                # Create new user
-                new_user_data = {
-                    'telegram_id': telegram_id,
-                    'username': user_data.get('username', ''),
-                    'first_name': user_data.get('first_name', ''),
-                    'last_name': user_data.get('last_name', ''),
-                    'balance': 0,
-                    'total_earnings': 0,
-                    'total_referrals': 0,
-                    'referral_code': self.generate_referral_code(int(telegram_id)),
-                    'is_verified': False,
-                    'is_banned': False,
-                    'created_at': datetime.now(),
-                    'updated_at': datetime.now(),
-                    'last_active': datetime.now()
-                }
-                
-                users_ref.add(new_user_data)
-                logger.info(f"✅ Created new user {telegram_id} in database")
+            if session and session.get('user_path'):
+                # Known user: no lookup needed, just queue the activity update
+                self._touch_user(self.db.document(session['user_path']), user_data)
                 return True
-                
+            user_path = await resilience.acall('users', self._upsert_user, user_data)
+            if session is not None:
+                session['user_path'] = user_path
+            return True
         except Exception as e:
+            if is_degraded_error(e):
+                await asyncio.to_thread(self.outbox.append, USER_UPSERT,
+                                        f"user:{user_data['telegram_id']}", user_data)
+                logger.warning(f"Database degraded, user upsert saved to outbox: {e}")
+                return False
             logger.warning(f"Database operation failed (continuing without DB): {e}")
             return False
     
+    def _touch_user(self, user_ref, user_data: Dict[str, Any]):
+        """Update an existing user through the write-behind buffer"""
+        self.activity.touch(user_ref, {
+            'username': user_data.get('username', ''),
+            'first_name': user_data.get('first_name', ''),
+            'last_name': user_data.get('last_name', ''),
+            'last_active': datetime.now(),
+            'updated_at': datetime.now()
+        })
+        logger.info(f"✅ Queued activity update for user {user_data['telegram_id']}")
+    
+    def _upsert_user(self, user_data: Dict[str, Any]) -> str:
+        """Create the user if needed; returns the user doc path"""
+        users_ref = self.db.collection('users')
+        telegram_id = str(user_data['telegram_id'])
+        
+        # Check if user exists
+        query = users_ref.where('telegram_id', '==', telegram_id).limit(1)
+        docs = list(query.stream())
+        
+        if docs:
+            self._touch_user(docs[0].reference, user_data)
+            return docs[0].reference.path
+        else:
+            # Create new user
+            now = datetime.now()
+            new_user = User(
+                telegram_id,
+                username=user_data.get('username', ''),
+                first_name=user_data.get('first_name', ''),
+                last_name=user_data.get('last_name', ''),
+                referral_code=self.generate_referral_code(int(telegram_id)),
+                created_at=now,
+                updated_at=now,
+                last_active=now
+            )
+            
+            _, user_ref = users_ref.add(new_user.to_firestore())
+            logger.info(f"✅ Created new user {telegram_id} in database")
+            return user_ref.path
+    
+    def resolve_referral_code(self, referral_code: str) -> Optional[str]:
+        """Return the referrer's Telegram ID for a referral code"""
+        # v1 codes decode locally; legacy codes go through the cached lookup
+        referrer_id = referral_codes.resolve(self.db, referral_code)
+        if referrer_id:
+            logger.info(f"✅ Found referrer {referrer_id} by referral code {referral_code}")
+        else:
+            logger.warning(f"❌ No referrer found for code: {referral_code}")
+        return referrer_id
+    
     async def process_referral(self, referrer_id: str, referred_id: str, referral_code: str) -> bool:
         """Process referral and check for duplicates"""
         if not self.db:
@@ -305,133 +534,209 @@ class CashPoinntBot:
             return False
             
         try:
-            referrals_ref = self.db.collection('referrals')
-            
-            # Check if referral already exists (rejoin detection)
-            # Check for both referrer_id and referred_id combination to prevent duplicates
-            existing_query = referrals_ref.where('referred_id', '==', referred_id).where('referrer_id', '==', referrer_id).limit(1)
-            existing_docs = list(existing_query.stream())
-            
-            if existing_docs:
-                # This is a duplicate referral - update rejoin count but don't give reward
-                existing_referral = existing_docs[0].to_dict()
-                rejoin_count = existing_referral.get('rejoin_count', 0) + 1
-                
-                existing_docs[0].reference.update({
-                    'rejoin_count': rejoin_count,
-                    'last_rejoin_date': datetime.now(),
-                    'updated_at': datetime.now()
-                })
-                
-                logger.info(f"⚠️ Duplicate referral detected for user {referred_id} by referrer {referrer_id}. Count: {rejoin_count}")
-                return False  # No reward for duplicate
-            
-            # Also check if user was referred by someone else before
-            other_referral_query = referrals_ref.where('referred_id', '==', referred_id).limit(1)
-            other_referral_docs = list(other_referral_query.stream())
-            
-            if other_referral_docs:
-                # User was referred by someone else before
-                other_referral = other_referral_docs[0].to_dict()
-                other_referrer = other_referral['referrer_id']
-                logger.warning(f"⚠️ User {referred_id} was already referred by {other_referrer}, ignoring new referral from {referrer_id}")
-                return False  # No reward for second referrer
-            
-            # Create new referral record
-            referral_data = {
-                'referrer_id': referrer_id,
-                'referred_id': referred_id,
-                'referral_code': referral_code,
-                'status': 'pending_group_join',
-                'created_at': datetime.now(),
-                'group_join_verified': False,
-                'rejoin_count': 0,
-                'reward_given': False
-            }
-            
-            referrals_ref.add(referral_data)
-            logger.info(f"✅ Created referral record: {referrer_id} → {referred_id}")
-            return True
-            
+            return await resilience.acall('referrals', self._create_referral,
+                                          referrer_id, referred_id, referral_code)
         except Exception as e:
+            if is_degraded_error(e):
+                await self.record_offline_referral(referred_id, referral_code)
+                logger.warning(f"Database degraded, referral saved to outbox: {e}")
+                return False
             logger.warning(f"Referral processing failed (continuing without DB): {e}")
             return False
     
+    async def record_offline_referral(self, referred_id: str, referral_code: str):
+        """Queue a referral; the code is resolved to a referrer on replay"""
+        # The outbox is SQLite with fsync on commit: keep it off the event loop
+        await asyncio.to_thread(self.outbox.append, REFERRAL, f"referral:{referred_id}", {
+            'referred_id': referred_id,
+            'referral_code': referral_code
+        })
+    
+    async def record_offline_reward(self, user_id: str):
+        """Queue the reward for a referred user whose group membership is confirmed"""
+        await asyncio.to_thread(self.outbox.append, REWARD, f"reward:{user_id}", {'user_id': user_id})
+    
+    def find_referral(self, user_id: str):
+        """The referral that brought this user in, or None"""
+        docs = list(self.db.collection('referrals').where('referred_id', '==', user_id).limit(1).stream())
+        return docs[0] if docs else None
+    
+    def record_rejoin(self, referral_path: str):
+        """Count another /start through the same referral link"""
+        self.db.document(referral_path).update({
+            'rejoin_count': firestore.Increment(1),
+            'last_rejoin_date': datetime.now(),
+            'updated_at': datetime.now()
+        })
+    
+    def _create_referral(self, referrer_id: str, referred_id: str, referral_code: str,
+                         count_rejoin: bool = True) -> bool:
+        referrals_ref = self.db.collection('referrals')
+        
+        # Check if referral already exists (rejoin detection)
+        # Check for both referrer_id and referred_id combination to prevent duplicates
+        existing_query = referrals_ref.where('referred_id', '==', referred_id).where('referrer_id', '==', referrer_id).limit(1)
+        existing_docs = list(existing_query.stream())
+        
+        if existing_docs:
+            if not count_rejoin:
+                # Replayed event that was already applied
+                return False
+            # This is a duplicate referral - update rejoin count but don't give reward
+            existing_referral = existing_docs[0].to_dict()
+            rejoin_count = existing_referral.get('rejoin_count', 0) + 1
+            
+            existing_docs[0].reference.update({
+                'rejoin_count': rejoin_count,
+                'last_rejoin_date': datetime.now(),
+                'updated_at': datetime.now()
+            })
+            
+            logger.info(f"⚠️ Duplicate referral detected for user {referred_id} by referrer {referrer_id}. Count: {rejoin_count}")
+            return False  # No reward for duplicate
+        
+        # Also check if user was referred by someone else before
+        other_referral_query = referrals_ref.where('referred_id', '==', referred_id).limit(1)
+        other_referral_docs = list(other_referral_query.stream())
+        
+        if other_referral_docs:
+            # User was referred by someone else before
+            other_referral = other_referral_docs[0].to_dict()
+            other_referrer = other_referral['referrer_id']
+            logger.warning(f"⚠️ User {referred_id} was already referred by {other_referrer}, ignoring new referral from {referrer_id}")
+            return False  # No reward for second referrer
+        
+        # Create new referral record
+        referral = Referral(referrer_id, referred_id, referral_code, created_at=datetime.now())
+        
+        referrals_ref.add(referral.to_firestore())
+        logger.info(f"✅ Created referral record: {referrer_id} → {referred_id}")
+        return True
+    
     async def verify_group_join_and_reward(self, user_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
         """Verify group join and distribute reward to referrer"""
-        if not self.db:
-            logger.info("📝 Database not connected, skipping reward processing")
-            return False
-            
         try:
             # Check if user is actually a group member
             is_member = await self.check_group_membership(int(user_id), context)
             if not is_member:
                 return False
             
-            referrals_ref = self.db.collection('referrals')
+            if not self.db:
+                # Membership is confirmed; pay the referrer once the database is back
+                await self.record_offline_reward(user_id)
+                logger.info("📝 Database not connected, reward saved to outbox")
+                return False
             
-            # Find pending referral for this user
-            query = referrals_ref.where('referred_id', '==', user_id).where('status', '==', 'pending_group_join').limit(1)
-            docs = list(query.stream())
+            session = await sessions.aget(context.user_data, user_id)
+            referral_doc = None
+            if 'referral' not in session:
+                referral_doc = await resilience.acall('referrals', self.find_referral, user_id, idempotent=True)
+                session['referral'] = _session_referral(referral_doc)
+            referral = session['referral']
+            if not referral or referral['status'] != 'pending_group_join':
+                # Not referred, or the referral was already settled
+                return False
             
-            if not docs:
+            # Safe to retry: the reward batch fails with AlreadyExists once paid
+            rewarded = await resilience.acall('rewards', self.apply_referral_reward, user_id,
+                                              referral_doc, idempotent=True)
+            if rewarded:
+                referral['status'] = 'verified'
+            else:
+                session.pop('referral', None)
+            return rewarded
+        except Exception as e:
+            if is_degraded_error(e):
+                await self.record_offline_reward(user_id)
+                logger.warning(f"Database degraded, reward saved to outbox: {e}")
+                return False
+            logger.warning(f"Reward processing failed (continuing without DB): {e}")
+            return False
+    
+    def apply_referral_reward(self, user_id: str, referral_doc=None) -> bool:
+        """Reward the referrer of a confirmed group member, at most once per referral"""
+        if referral_doc is None:
+            # A verified referral may still owe its referrer a level bonus (see below)
+            referral_doc = self.find_referral(user_id)
+            status = (referral_doc.to_dict() or {}).get('status') if referral_doc else None
+            if status not in ('pending_group_join', 'verified'):
                 logger.info(f"No pending referral found for user {user_id}")
                 return False
-            
-            referral_doc = docs[0]
-            referral_data = referral_doc.to_dict()
-            referrer_id = referral_data['referrer_id']
-            
-            # Update referral status
+        referral_data = referral_doc.to_dict()
+        referrer_id = referral_data['referrer_id']
+        
+        users_ref = self.db.collection('users')
+        if referral_data.get('status') == 'verified':
+            # Rewarded by an earlier attempt; it may have failed before the level bonus
+            referrer_docs = list(users_ref.where('telegram_id', '==', referrer_id).limit(1).stream())
+            if referrer_docs:
+                self.pay_missed_level_bonuses(referrer_docs[0])
+            return False
+        
+        # Hold rewards for referrers flagged by the fraud scoring job or banned
+        if fraud_flags.is_flagged(self.db, referrer_id) or listeners.is_banned(referrer_id):
             referral_doc.reference.update({
-                'status': 'verified',
+                'status': 'held_for_review',
                 'group_join_verified': True,
                 'group_join_date': datetime.now(),
-                'reward_given': True,
                 'updated_at': datetime.now()
             })
-            
-            # Update referrer's balance and stats
-            users_ref = self.db.collection('users')
-            referrer_query = users_ref.where('telegram_id', '==', referrer_id).limit(1)
-            referrer_docs = list(referrer_query.stream())
-            
+            logger.warning(f"🚩 Reward held for flagged referrer {referrer_id} (referred {user_id})")
+            return False
+        
+        referrer_query = users_ref.where('telegram_id', '==', referrer_id).limit(1)
+        referrer_docs = list(referrer_query.stream())
+        
+        # Referral status, earnings record and balance change commit together;
+        # the earnings doc id is derived from the referral so a second commit fails
+        batch = self.db.batch()
+        batch.update(referral_doc.reference, {
+            'status': 'verified',
+            'group_join_verified': True,
+            'group_join_date': datetime.now(),
+            'reward_given': bool(referrer_docs),
+            'updated_at': datetime.now()
+        })
+        if referrer_docs:
+            earnings_ledger.add(batch, self.db, f"referral_{referral_doc.id}", Earning(
+                referrer_id, REFERRAL_REWARD, 'referral', description=f'Referral reward from user {user_id}',
+                referral_id=referral_doc.id, created_at=datetime.now()))
+            inbox_committed = inbox.add_reward(batch, self.db, referrer_id, REFERRAL_REWARD,
+                                               f'User {user_id} joined the group')
+            batch.update(referrer_docs[0].reference, {
+                'balance': firestore.Increment(REFERRAL_REWARD),
+                'total_earnings': firestore.Increment(REFERRAL_REWARD),
+                'total_referrals': firestore.Increment(1),
+                'updated_at': datetime.now()
+            })
+        try:
+            batch.commit()
+        except AlreadyExists:
+            logger.info(f"Referral reward for {referral_doc.id} already paid")
             if referrer_docs:
-                referrer_doc = referrer_docs[0]
-                referrer_data = referrer_doc.to_dict()
-                
-                new_balance = referrer_data.get('balance', 0) + REFERRAL_REWARD
-                new_total_earnings = referrer_data.get('total_earnings', 0) + REFERRAL_REWARD
-                new_total_referrals = referrer_data.get('total_referrals', 0) + 1
-                
-                referrer_doc.reference.update({
-                    'balance': new_balance,
-                    'total_earnings': new_total_earnings,
-                    'total_referrals': new_total_referrals,
-                    'updated_at': datetime.now()
-                })
-                
-                # Create earnings record
-                earnings_ref = self.db.collection('earnings')
-                earnings_data = {
-                    'user_id': referrer_id,
-                    'amount': REFERRAL_REWARD,
-                    'type': 'referral',
-                    'description': f'Referral reward from user {user_id}',
-                    'referral_id': referral_doc.id,
-                    'created_at': datetime.now()
-                }
-                earnings_ref.add(earnings_data)
-                
-                logger.info(f"✅ Rewarded {REFERRAL_REWARD} Taka to referrer {referrer_id}")
-                return True
-            
-        except Exception as e:
-            logger.warning(f"Reward processing failed (continuing without DB): {e}")
+                # The attempt that paid it may have failed before the level bonus; this
+                # snapshot was read after that commit, so its count includes the referral
+                self.pay_missed_level_bonuses(referrer_docs[0])
             return False
+        sessions.invalidate(referrer_id)
+        if referrer_docs:
+            inbox_committed()
+        
+        if not referrer_docs:
+            return False
+        
+        # Referral level bonus when this reward crosses a threshold
+        referrer = User.from_firestore(referrer_docs[0].id, referrer_docs[0].to_dict() or {})
+        new_total_referrals = referrer.total_referrals + 1
+        crossing = self.record_verified_referral(referrer_id, user_id, new_total_referrals)
+        # Lower levels this referrer passed before level bonuses existed, then this one
+        self.pay_missed_level_bonuses(referrer_docs[0], new_total_referrals,
+                                      below_level=crossing.level if crossing else None)
+        if crossing:
+            self.pay_level_bonus(referrer_docs[0].reference, crossing)
         
-        return False
+        logger.info(f"✅ Rewarded {REFERRAL_REWARD} Taka to referrer {referrer_id}")
+        return True
 
 
 # Initialize bot instance
@@ -439,6 +744,7 @@ bot_instance = CashPoinntBot()
 
 
 # Command Handlers
+@with_deadline()
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command with referral detection"""
     user = update.effective_user
@@ -456,7 +762,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     # Try to store user data
-    user_stored = await bot_instance.create_or_update_user(user_data)
+    session = await sessions.aget(context.user_data, user_id)
+    user_stored = await bot_instance.create_or_update_user(user_data, session)
     
     # Add status indicator for database connection
     db_status = "🔥 Database: ✅ Connected" if bot_instance.firebase_connected else "⚠️ Database: ❌ Offline Mode"
@@ -464,56 +771,58 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check for referral parameter
     referral_code = None
     referrer_id = None
+    referral_queued = False
     
     if context.args:
-        referral_code = context.args[0]
-        logger.info(f"🔗 Referral code detected: {referral_code}")
+        parsed_code = referral_codes.parse_start_param(context.args[0])
+        if parsed_code is None:
+            logger.info(f"🚫 Ignoring start parameter that is not a referral code: {context.args[0][:64]!r}")
         
-        # Extract referrer ID from referral code (CP format)
-        if referral_code.startswith('CP') and len(referral_code) >= 3:
+        if parsed_code:
+            referral_code = parsed_code.code
+            logger.info(f"🔗 Referral code detected: {referral_code}")
+            
             # Find referrer by referral code
-            if bot_instance.db:
+            known_referral = session.get('referral')
+            if bot_instance.db and known_referral and known_referral['code'] == referral_code:
+                # Same link again: count the rejoin without looking anything up
                 try:
-                    # First try to find in users collection (primary method)
-                    users_ref = bot_instance.db.collection('users')
-                    user_query = users_ref.where('referral_code', '==', referral_code).limit(1)
-                    user_docs = list(user_query.stream())
-                    
-                    if user_docs:
-                        referrer_id = user_docs[0].to_dict()['telegram_id']
-                        logger.info(f"✅ Found referrer {referrer_id} by referral code {referral_code}")
-                    else:
-                        # Fallback: try referral_codes collection
-                        referral_codes_ref = bot_instance.db.collection('referral_codes')
-                        query = referral_codes_ref.where('referral_code', '==', referral_code).where('is_active', '==', True).limit(1)
-                        docs = list(query.stream())
-                        
-                        if docs:
-                            referrer_id = docs[0].to_dict()['user_id']
-                            logger.info(f"✅ Found referrer {referrer_id} in referral_codes collection")
-                        else:
-                            logger.warning(f"❌ No referrer found for code: {referral_code}")
+                    await resilience.acall('referrals', bot_instance.record_rejoin, known_referral['path'])
+                    referrer_id = known_referral['referrer_id']
+                    logger.info(f"⚠️ Repeat referral link for user {user_id} by referrer {referrer_id}")
+                except Exception as e:
+                    logger.warning(f"Referral rejoin update failed (continuing): {e}")
+            elif bot_instance.db:
+                try:
+                    # v1 codes carry the referrer: no lookup before the reward path
+                    referrer_id = parsed_code.referrer_id or await resilience.acall(
+                        'users', bot_instance.resolve_referral_code, referral_code, idempotent=True)
                     
                     if referrer_id and referrer_id != user_id:
                         # Process referral
                         await bot_instance.process_referral(referrer_id, user_id, referral_code)
+                        session.pop('referral', None)
                         logger.info(f"✅ Processed referral: {referrer_id} → {user_id}")
                     elif referrer_id == user_id:
                         logger.warning(f"⚠️ User {user_id} tried to use their own referral code")
-                    
-                    if referrer_id and referrer_id != user_id:
-                        # Process referral
-                        await bot_instance.process_referral(referrer_id, user_id, referral_code)
-                        logger.info(f"✅ Processed referral: {referrer_id} → {user_id}")
                         
                 except Exception as e:
+                    if is_degraded_error(e):
+                        await bot_instance.record_offline_referral(user_id, referral_code)
+                        referral_queued = True
                     logger.warning(f"Referral code processing failed (continuing): {e}")
+            else:
+                # Resolve the code on replay, once the database is back
+                await bot_instance.record_offline_referral(user_id, referral_code)
+                referral_queued = True
+                logger.info(f"📝 Database not connected, referral saved to outbox")
     
     # Check if user is already a group member
     is_member = await bot_instance.check_group_membership(user.id, context)
     
     if is_member:
         # User is already a member - show mini app directly
+        render = start_span('render', template='welcome_member')
         welcome_text = (
             f"🎉 <b>স্বাগতম {user_name}!</b>\n\n"
             "✅ আপনি ইতিমধ্যে আমাদের গ্রুপের সদস্য!\n\n"
@@ -526,6 +835,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🚀 Open Mini App", url=MINI_APP_URL)]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
+        render.end()
         
         await update.message.reply_photo(
             photo="https://i.postimg.cc/44DtvWyZ/43b0363d-525b-425c-bc02-b66f6d214445-1.jpg",
@@ -535,11 +845,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # If this was a referral, verify and reward
-        if referrer_id:
+        if referral_queued or await asyncio.to_thread(bot_instance.outbox.has, f"referral:{user_id}"):
+            # The referral itself is waiting in the outbox; queue its reward behind it
+            await bot_instance.record_offline_reward(user_id)
+        elif referrer_id:
             await bot_instance.verify_group_join_and_reward(user_id, context)
         
     else:
         # User is not a member - show join requirement
+        render = start_span('render', template='join_required')
         join_text = (
             f"🔒 <b>Group Join Required</b>\n\n"
             f"হ্যালো {user_name}! Mini App access পেতে আমাদের group এ join করতে হবে।\n\n"
@@ -564,6 +878,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("✅ Verify Membership", callback_data="verify_membership")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
+        render.end()
         
         await update.message.reply_photo(
             photo="https://i.postimg.cc/44DtvWyZ/43b0363d-525b-425c-bc02-b66f6d214445-1.jpg",
@@ -573,6 +888,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@with_deadline()
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle callback queries (button clicks)"""
     query = update.callback_query
@@ -588,6 +904,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         if is_member:
             # User joined - show success message and mini app
+            render = start_span('render', template='verify_success')
             success_text = (
                 f"🎉 <b>স্বাগতম {user_name}!</b>\n\n"
                 "✅ আপনি সফলভাবে আমাদের গ্রুপে যোগদান করেছেন!\n\n"
@@ -603,6 +920,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 [InlineKeyboardButton("🚀 Open Mini App", url=MINI_APP_URL)]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
+            render.end()
             
             # Verify group join and reward referrer
             reward_given = await bot_instance.verify_group_join_and_reward(user_id, context)
@@ -631,6 +949,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         
         else:
             # User is still not a member
+            render = start_span('render', template='verify_not_member')
             not_member_text = (
                 f"❌ <b>Group Join Required</b>\n\n"
                 f"হ্যালো {user_name}! আপনি এখনও group এ join করেননি।\n\n"
@@ -649,6 +968,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 [InlineKeyboardButton("✅ Verify Membership", callback_data="verify_membership")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
+            render.end()
             
             try:
                 await query.edit_message_caption(
@@ -673,12 +993,13 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check group membership
     is_member = await bot_instance.check_group_membership(user.id, context)
     
+    render = start_span('render', template='status')
     status_text = (
         f"🤖 <b>Bot Status Report</b>\n\n"
         f"👤 <b>User:</b> {user_name}\n"
         f"🆔 <b>Telegram ID:</b> <code>{user.id}</code>\n"
         f"📱 <b>Group Member:</b> {'✅ Yes' if is_member else '❌ No'}\n\n"
-        f"🔥 <b>Database:</b> {'✅ Connected' if db else '❌ Offline Mode'}\n"
+        f"🔥 <b>Database:</b> {'✅ Connected' if bot_instance.db else '❌ Offline Mode'}\n"
         f"🤖 <b>Bot:</b> ✅ Online\n"
     )
     
@@ -692,7 +1013,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     status_text += f"📊 <b>Features:</b>\n"
     
-    if db:
+    if bot_instance.db:
         status_text += (
             "   ✅ Referral tracking\n"
             "   ✅ Reward distribution\n"
@@ -708,6 +1029,119 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "   ✅ Basic commands\n"
         )
     
+    activity = bot_instance.activity.stats()
+    status_text += (
+        f"\n📝 <b>Activity writes:</b> {activity['flushed_rows']} flushed, "
+        f"{activity['coalesced']} coalesced, {activity['pending']} pending\n"
+    )
+    
+    outbox = bot_instance.outbox.stats()
+    status_text += (
+        f"📤 <b>Outbox:</b> {outbox['depth']} queued, {outbox['replayed']} replayed "
+        f"({outbox['last_replay_rate']:.1f}/sec last run)"
+    )
+    if outbox['dead']:
+        status_text += f", {outbox['dead']} parked"
+    status_text += "\n"
+    
+    cache = sessions.stats()
+    status_text += (
+        f"🗂️ <b>Sessions:</b> {cache['hit_rate']:.0%} hit rate "
+        f"({cache['hits']} hits, {cache['invalidations']} invalidations)\n"
+    )
+    
+    api = context.application.bot_data.get('mini_app_api')
+    if api:
+        api_stats = api.stats()
+        status_text += (
+            f"🌐 <b>Mini app API:</b> {api_stats['requests']} requests, "
+            f"{api_stats['hit_rate']:.0%} cache hit rate, {api_stats['rejected']} rejected\n"
+        )
+    
+    if 'listener_task' in context.application.bot_data:
+        watch = listeners.stats()
+        status_text += (
+            f"📡 <b>Snapshot listeners:</b> {watch['synced']}/{watch['streams']} synced, "
+            f"{watch['events']} changes, lag {watch['max_lag']:.1f}s\n"
+        )
+    
+    code_lookups = referral_codes.lookup_stats()
+    status_text += (
+        f"🔑 <b>Referral code lookups:</b> {code_lookups.get('direct', 0)} direct, "
+        f"{code_lookups['legacy']} legacy, {code_lookups.get('missing', 0)} missing"
+        f"{' (dual read on)' if code_lookups['dual_read'] else ''}\n"
+    )
+    
+    lookups = lookup_snapshot.snapshot.stats()
+    if lookups['available']:
+        status_text += (
+            f"🗺️ <b>Lookup snapshot:</b> {lookups['codes']} codes, {lookups['users']} users, "
+            f"{lookups['age'] / 60:.0f} min old\n"
+        )
+    
+    scheduler = getattr(context.application.update_processor, 'inner', None)
+    if isinstance(scheduler, PriorityUpdateProcessor):
+        scheduled = scheduler.stats()['classes']
+        status_text += "🚦 <b>Scheduler:</b> " + ", ".join(
+            f"{name} {c['queued']} queued / p95 wait {c['wait_p95'] * 1000:.0f}ms / "
+            f"{c['answered'] + c['dropped']} shed" for name, c in scheduled.items()) + "\n"
+    
+    for transport in context.application.bot_data.get('transports', ()):
+        http = transport.stats()
+        status_text += (
+            f"🔗 <b>Bot API ({http['name']}, HTTP/{http['http_version']}):</b> {http['requests']} calls, "
+            f"{http['reuse_rate']:.0%} reused, pool wait p95 {http['pool_wait_p95'] * 1000:.0f}ms, "
+            f"{http['pool_timeouts']} pool timeouts\n"
+        )
+    
+    if earnings_ledger.writes_buckets:
+        ledger = earnings_ledger.stats()
+        status_text += (
+            f"📒 <b>Earnings ledger:</b> {ledger['mode']}, {ledger['appended']} entries appended, "
+            f"{ledger['head_reads']} head reads\n"
+        )
+    
+    notified = inbox.stats()
+    if notified['rewards']:
+        status_text += (
+            f"📨 <b>Reward notifications:</b> {notified['rewards']} rewards in "
+            f"{notified['digests']} digests\n"
+        )
+    
+    sweeper = context.application.bot_data.get('sweeper')
+    if sweeper and sweeper.state:
+        sweep = sweeper.stats()
+        progress = 'done' if sweep['finished_at'] else 'running'
+        status_text += (
+            f"🔎 <b>Membership sweep:</b> {progress}, {sweep['scanned']} scanned, "
+            f"{sweep['checked']} checked, {sweep['left']} not in group\n"
+        )
+    
+    withdrawals = context.application.bot_data.get('withdrawals')
+    if withdrawals and withdrawals.last_run:
+        run = withdrawals.last_run
+        status_text += (
+            f"💸 <b>Withdrawals (last run):</b> {run['approved']} approved, {run['rejected']} rejected, "
+            f"{run['deferred']} deferred, {run['failed']} failed\n"
+        )
+    energy_counts = energy.stats()
+    if energy_counts:
+        status_text += (
+            f"⚡ <b>Energy spends:</b> {energy_counts.get('spent', 0)} spent, "
+            f"{energy_counts.get('refused', 0)} refused, {energy_counts.get('conflicts', 0)} retried, "
+            f"{energy_counts.get('contended', 0)} contended\n"
+        )
+    
+    breakers = resilience.snapshot()
+    if breakers:
+        status_text += "🔌 <b>Circuits:</b>\n"
+        for name, state in sorted(breakers.items()):
+            icon = '✅' if state['state'] == resilience.CLOSED else '⛔'
+            status_text += (
+                f"   {icon} {name}: {state['state']} ({state['total_failures']} failures, "
+                f"{state['retries']} retries, {state['rejected']} rejected)\n"
+            )
+    
     status_text += f"\n⏰ <b>Check Time:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     
     keyboard = [
@@ -715,6 +1149,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("🚀 Open Mini App", url=MINI_APP_URL)]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    render.end()
     
     await update.message.reply_text(
         status_text,
@@ -723,8 +1158,8 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /help command"""
+def help_response() -> Dict[str, Any]:
+    """The /help message; also served as-is when the scheduler sheds /help"""
     help_text = (
         "🤖 <b>Cash Points Bot Commands</b>\n\n"
         "📋 <b>Available Commands:</b>\n"
@@ -741,26 +1176,131 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📱 <b>Group:</b> Bull Trading Community (BD)\n"
         f"🔗 <b>Link:</b> {REQUIRED_GROUP_LINK}\n\n"
         "👉 Use /start to begin your journey!\n\n"
-        f"🔥 Database Status: {'✅ Connected' if db else '❌ Offline Mode'}"
+        f"🔥 Database Status: {'✅ Connected' if bot_instance.db else '❌ Offline Mode'}"
     )
     
     keyboard = [
         [InlineKeyboardButton("📱 Join Group", url=REQUIRED_GROUP_LINK)],
         [InlineKeyboardButton("🚀 Open Mini App", url=MINI_APP_URL)]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return {'text': help_text, 'reply_markup': InlineKeyboardMarkup(keyboard), 'parse_mode': 'HTML'}
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /help command"""
+    render = start_span('render', template='help')
+    response = help_response()
+    render.end()
     
-    await update.message.reply_text(
-        help_text,
-        reply_markup=reply_markup,
-        parse_mode='HTML'
-    )
+    await update.message.reply_text(**response)
 
 
-def main():
-    """Main function to run the bot"""
-    # Create application
-    app = Application.builder().token(BOT_TOKEN).build()
+async def post_init(application: Application):
+    """Start background workers once the application is initialized"""
+    application.bot_data['activity_task'] = asyncio.create_task(bot_instance.activity.run())
+    application.bot_data['outbox_task'] = asyncio.create_task(bot_instance.outbox_worker())
+    if config.MEMBERSHIP_SWEEP_ENABLED and db:
+        sweeper = MembershipSweeper(bot_instance.db, application.bot, store=bot_instance.membership)
+        application.bot_data['sweeper'] = sweeper
+        application.bot_data['sweep_task'] = asyncio.create_task(sweeper.run_forever())
+    if config.WITHDRAWAL_PIPELINE_ENABLED and db:
+        pipeline = WithdrawalPipeline(bot_instance.db, application.bot, store=bot_instance.membership)
+        application.bot_data['withdrawals'] = pipeline
+        application.bot_data['withdrawal_task'] = asyncio.create_task(pipeline.run_forever())
+    if config.SNAPSHOT_LISTENERS_ENABLED:
+        # Streams start once Firebase is connected (db is rebound by attach_db)
+        application.bot_data['listener_task'] = asyncio.create_task(listeners.run_forever(lambda: db))
+    if config.LOOKUP_SNAPSHOT_BUILD_INTERVAL > 0:
+        # One instance publishes the snapshot every worker maps
+        application.bot_data['snapshot_task'] = asyncio.create_task(lookup_snapshot.run_builder(lambda: db))
+    if config.MINI_APP_API_ENABLED:
+        api = MiniAppAPI(bot_instance.db, bot_token=application.bot.token)
+        if await api.start():
+            application.bot_data['mini_app_api'] = api
+    if config.WARM_STATE_INTERVAL > 0:
+        application.bot_data['warm_state_task'] = asyncio.create_task(
+            warm_state.run_saver(lambda: bot_instance.referral_index, bot_instance._index_lock))
+
+
+async def post_shutdown(application: Application):
+    """Flush write-behind buffers and save warm state before the process exits"""
+    tasks = []
+    for name in ('activity_task', 'outbox_task', 'sweep_task', 'withdrawal_task', 'listener_task',
+                 'snapshot_task', 'warm_state_task'):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+            tasks.append(task)
+    if tasks:
+        # Let the workers unwind (and their to_thread calls return) before the
+        # stores they use are flushed and closed below
+        _, pending = await asyncio.wait(tasks, timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning(f"⏱️ {len(pending)} background workers still running at shutdown")
+    api = application.bot_data.pop('mini_app_api', None)
+    if api:
+        await api.stop()
+    flushed = await asyncio.to_thread(bot_instance.activity.close)
+    logger.info(f"📝 Flushed {flushed} pending activity updates on shutdown")
+    try:
+        await asyncio.to_thread(warm_state.save, bot_instance.referral_index, bot_instance._index_lock)
+    except Exception as e:
+        logger.warning(f"Saving warm state failed: {e}")
+    bot_instance.outbox.close()
+    bot_instance.membership.close()
+    sessions.store.close()
+    recorder = application.bot_data.pop('recorder', None)
+    if recorder:
+        recorder.close()
+        logger.info(f"🎙️ Recorded {recorder.recorded} updates to {recorder.path}")
+
+
+def build_application(token: str = BOT_TOKEN, request: Optional[BaseRequest] = None,
+                      concurrent_updates=False) -> Application:
+    """Create the Application with all handlers (also used by replay.py)"""
+    if request is None:
+        # Full keep-alive pool for outbound calls; the long poll gets its own connection
+        request, get_updates_request = build_transports()
+    else:
+        get_updates_request = request
+    transports = [r for r in (request, get_updates_request) if isinstance(r, BotApiTransport)]
+    max_updates = 256 if concurrent_updates is True else int(concurrent_updates) or 1
+    if tracer.enabled:
+        # Root span per update and a client span per Bot API call (the long poll stays untraced)
+        concurrent_updates = update_processor(max_updates)
+        request = traced_request(request)
+    if config.SCHEDULER_ENABLED:
+        # Same number of handler slots, but callbacks and referral /start go first
+        scheduler = PriorityUpdateProcessor(
+            workers=max_updates,
+            inner=concurrent_updates if isinstance(concurrent_updates, BaseUpdateProcessor) else None)
+        scheduler.static_responses['help'] = help_response
+        concurrent_updates = scheduler
+    if not isinstance(concurrent_updates, BaseUpdateProcessor):
+        concurrent_updates = SimpleUpdateProcessor(max_updates)
+    # Tracks in-flight updates so stop() can drain them within SHUTDOWN_DRAIN_TIMEOUT
+    concurrent_updates = DrainingUpdateProcessor(concurrent_updates)
+    
+    builder = (
+        Application.builder()
+        .application_class(DrainingApplication)
+        .token(token)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(concurrent_updates)
+    )
+    if config.SESSION_CACHE_ENABLED:
+        builder = builder.persistence(SessionPersistence())
+    builder = builder.request(request).get_updates_request(get_updates_request)
+    app = builder.build()
+    app.bot_data['transports'] = transports
+    
+    if config.RECORD_UPDATES_PATH:
+        # Record before any handler runs
+        recorder = UpdateRecorder()
+        app.bot_data['recorder'] = recorder
+        app.add_handler(TypeHandler(Update, recorder.record), group=-1)
+        logger.info(f"🎙️ Recording anonymised updates to {recorder.path}")
     
     # Add command handlers
     app.add_handler(CommandHandler("start", start_command))
@@ -769,6 +1309,13 @@ def main():
     
     # Add callback query handler
     app.add_handler(CallbackQueryHandler(handle_callback_query))
+    return app
+
+
+def main():
+    """Main function to run the bot"""
+    # Create application (the scheduler runs SCHEDULER_WORKERS handlers at a time)
+    app = build_application(concurrent_updates=config.SCHEDULER_WORKERS if config.SCHEDULER_ENABLED else False)
     
     # Start the bot
     print("🤖 Cash Points Bot Starting...")
@@ -777,10 +1324,16 @@ def main():
     print(f"💰 Referral Reward: ৳{REFERRAL_REWARD}")
     print(f"🔥 Firebase: {'✅ Connected' if db else '❌ Not Connected'}")
     
-    if not db:
+    # Legacy code and fraud flag caches from the last run
+    warm_state.load()
+    
+    if db:
+        # Build the referral graph index without delaying startup
+        threading.Thread(target=bot_instance.rebuild_referral_index, daemon=True).start()
+    else:
         print("⚠️  FALLBACK MODE: Bot running without database")
         print("📝 Features available: Group verification, basic commands")
-        print("🚫 Features disabled: Referral tracking, reward distribution")
+        print("📤 Referrals, rewards and user updates are queued in the outbox until reconnect")
     
     print("🚀 Bot is ready to receive commands!")
     
@@ -8,6 +8,12 @@ from datetime import datetime, timedelta
 import firebase_admin
 from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
+from activity_buffer import ActivityBuffer
+from fraud_flags import fraud_flags
+from notification_inbox import inbox
+import referral_codes
+import energy
+from config import config
 
 # Load environment variables
 load_dotenv()
@@ -90,6 +96,9 @@ except Exception as e:
     print(f"🔍 Error details: {type(e).__name__}")
     db = None
 
+# Write-behind buffer for last_activity updates
+activity_buffer = ActivityBuffer(db, journal_path=config.ENHANCED_ACTIVITY_JOURNAL_PATH)
+
 # Group configuration
 REQUIRED_GROUP_ID = -1002551110221  # Bull Trading Community (BD) actual group ID
 REQUIRED_GROUP_LINK = "https://t.me/+GOIMwAc_R9RhZGVk"
@@ -108,30 +117,15 @@ async def check_group_membership(user_id: int, context: ContextTypes.DEFAULT_TYP
 def generate_referral_code(user_id: int) -> str:
     try:
         if not db:
-            return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+            return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
             
-        # Check if user already has a referral code
-        referral_codes_ref = db.collection('referral_codes')
-        query = referral_codes_ref.where('user_id', '==', str(user_id)).where('is_active', '==', True).limit(1)
-        docs = list(query.stream())
-        
-        if docs:
-            return docs[0].to_dict()['referral_code']
-        
         # Generate new referral code
-        referral_code = f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        referral_code = referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
         
-        # Insert into referral_codes collection
+        # Insert into referralCodes collection (keyed by the code, see referral_codes.py)
         try:
-            referral_codes_ref.add({
-                'user_id': str(user_id),
-                'referral_code': referral_code,
-                'is_active': True,
-                'created_at': datetime.now(),
-                'total_uses': 0,
-                'total_earnings': 0
-            })
-            print(f"✅ Referral code created: {referral_code} for user {user_id}")
+            if referral_codes.register_code(db, referral_code, user_id):
+                print(f"✅ Referral code created: {referral_code} for user {user_id}")
         except Exception as insert_error:
             print(f"⚠️ Could not insert referral code to database: {insert_error}")
             # Return the generated code anyway
@@ -141,13 +135,13 @@ def generate_referral_code(user_id: int) -> str:
     except Exception as e:
         print(f"❌ Error generating referral code: {e}")
         # Fallback to simple format
-        return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
 
 def ensure_user_referral_code(user_id: int, username: str = None) -> str:
     """Ensure user has a referral code, create if missing"""
     try:
         if not db:
-            return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+            return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
         
         # First check if user exists in users collection
         users_ref = db.collection('users')
@@ -159,21 +153,8 @@ def ensure_user_referral_code(user_id: int, username: str = None) -> str:
             existing_code = user_data.get('referral_code')
             
             if existing_code:
-                # Check if code exists in referral_codes collection
-                referral_codes_ref = db.collection('referral_codes')
-                code_query = referral_codes_ref.where('referral_code', '==', existing_code).limit(1)
-                code_docs = list(code_query.stream())
-                
-                if not code_docs:
-                    # Code missing from referral_codes collection, create it
-                    referral_codes_ref.add({
-                        'user_id': str(user_id),
-                        'referral_code': existing_code,
-                        'is_active': True,
-                        'created_at': datetime.now(),
-                        'total_uses': 0,
-                        'total_earnings': 0
-                    })
+                # Create the referralCodes document if it's missing
+                if referral_codes.register_code(db, existing_code, user_id):
                     print(f"✅ Fixed missing referral code record: {existing_code} for user {user_id}")
                 
                 return existing_code
@@ -194,10 +175,10 @@ def ensure_user_referral_code(user_id: int, username: str = None) -> str:
             
     except Exception as e:
         print(f"❌ Error ensuring referral code: {e}")
-        return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
 
 def sync_all_referral_codes():
-    """Sync all existing users' referral codes with referral_codes collection"""
+    """Sync all existing users' referral codes with referralCodes collection"""
     try:
         if not db:
             print("❌ Firebase not connected")
@@ -228,21 +209,8 @@ def sync_all_referral_codes():
             first_name = user.get('first_name', 'Unknown')
             
             if existing_code:
-                # Check if code exists in referral_codes collection
-                referral_codes_ref = db.collection('referral_codes')
-                code_query = referral_codes_ref.where('referral_code', '==', existing_code).limit(1)
-                code_docs = list(code_query.stream())
-                
-                if not code_docs:
-                    # Create missing referral code record
-                    referral_codes_ref.add({
-                        'user_id': str(user_id),
-                        'referral_code': existing_code,
-                        'is_active': True,
-                        'created_at': datetime.now(),
-                        'total_uses': 0,
-                        'total_earnings': 0
-                    })
+                # Create missing referral code record
+                if referral_codes.register_code(db, existing_code, user_id):
                     print(f"✅ Created missing referral code: {existing_code} for {first_name}")
                     created_count += 1
                 else:
@@ -271,6 +239,113 @@ def sync_all_referral_codes():
     except Exception as e:
         print(f"❌ Error syncing referral codes: {e}")
 
+def reward_referrer(referral_doc, referrer_id, user_id, user_name) -> bool:
+    """Mark a pending referral verified and pay the referrer (+2 taka)"""
+    # Hold rewards for referrers flagged by the fraud scoring job
+    if fraud_flags.is_flagged(db, referrer_id):
+        referral_doc.reference.update({
+            'status': 'held_for_review',
+            'group_join_verified': True,
+            'last_join_date': datetime.now(),
+            'updated_at': datetime.now()
+        })
+        print(f"🚩 Reward held for flagged referrer {referrer_id} (referred {user_id})")
+        return False
+
+    # Update referral status to verified and mark reward as given
+    referral_doc.reference.update({
+        'status': 'verified',
+        'updated_at': datetime.now(),
+        'is_active': True,
+        'group_join_verified': True,
+        'last_join_date': datetime.now(),
+        'reward_given': True,
+        'reward_given_at': datetime.now()
+    })
+
+    # Give reward to referrer (+2 taka)
+    print(f"💰 Processing reward for referrer: {referrer_id}")
+
+    # Get current balance and referral stats
+    users_ref = db.collection('users')
+    user_query = users_ref.where('telegram_id', '==', str(referrer_id)).limit(1)
+    user_docs = list(user_query.stream())
+
+    if user_docs:
+        user_data = user_docs[0].to_dict()
+        current_balance = user_data['balance']
+        current_total_earnings = user_data.get('total_earnings', 0)
+        current_total_referrals = user_data.get('total_referrals', 0)
+
+        print(f"💰 Referrer current stats:")
+        print(f"   Balance: {current_balance}")
+        print(f"   Total Earnings: {current_total_earnings}")
+        print(f"   Total Referrals: {current_total_referrals}")
+
+        # Calculate new values
+        new_balance = current_balance + 2
+        new_total_earnings = current_total_earnings + 2
+        new_total_referrals = current_total_referrals + 1
+
+        print(f"💰 New stats will be:")
+        print(f"   Balance: {current_balance} -> {new_balance}")
+        print(f"   Total Earnings: {current_total_earnings} -> {new_total_earnings}")
+        print(f"   Total Referrals: {current_total_referrals} -> {new_total_referrals}")
+
+        # Update balance, total_earnings, and total_referrals
+        user_docs[0].reference.update({
+            'balance': new_balance,
+            'total_earnings': new_total_earnings,
+            'total_referrals': new_total_referrals
+        })
+
+        # Create earnings record for referral reward
+        earnings_ref = db.collection('earnings')
+        earnings_ref.add({
+            'user_id': referrer_id,
+            'source': 'referral',
+            'amount': 2,
+            'description': f'Referral reward for user {user_name} (ID: {user_id})',
+            'reference_id': referral_doc.id,
+            'reference_type': 'referral',
+            'created_at': datetime.now()
+        })
+
+        print(f"💰 Earnings record created for referral reward")
+
+        # Verify the update
+        updated_user_docs = list(user_query.stream())
+        if updated_user_docs:
+            updated_user_data = updated_user_docs[0].to_dict()
+            actual_balance = updated_user_data['balance']
+            actual_total_earnings = updated_user_data.get('total_earnings', 0)
+            actual_total_referrals = updated_user_data.get('total_referrals', 0)
+
+            print(f"💰 Actual stats after update:")
+            print(f"   Balance: {actual_balance} (expected: {new_balance})")
+            print(f"   Total Earnings: {actual_total_earnings} (expected: {new_total_earnings})")
+            print(f"   Total Referrals: {actual_total_referrals} (expected: {new_total_referrals})")
+
+            if (actual_balance == new_balance and
+                actual_total_earnings == new_total_earnings and
+                actual_total_referrals == new_total_referrals):
+                print(f"✅ All updates successful: {current_balance} → {actual_balance}")
+            else:
+                print(f"❌ Some updates failed! Expected: {new_balance}, Got: {actual_balance}")
+        else:
+            print(f"❌ Could not verify balance update for referrer: {referrer_id}")
+    else:
+        print(f"❌ Could not get current balance for referrer: {referrer_id}")
+
+    # Notify the referrer; rewards close together share one digest notification
+    batch = db.batch()
+    committed = inbox.add_reward(batch, db, str(referrer_id), 2, f'User {user_name} joined the group')
+    batch.commit()
+    committed()
+
+    print(f"💰 Referral reward processed: {referrer_id} got ৳2 for {user_name}")
+    return True
+
 # Enhanced /start command handler with auto-start triggers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -289,24 +364,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if start_param:
         # Handle different referral formats
-        if start_param.startswith('ref_'):
+        if referral_codes.decode(start_param):
+            # Current format: the code carries the referrer's ID
+            referral_code = start_param.upper()
+            referrer_id = referral_codes.decode(referral_code)
+            print(f"🔗 Referral code {referral_code} from user: {referrer_id}")
+        elif start_param.startswith('ref_'):
             # Old format: ref_123456
             referrer_id = start_param.replace('ref_', '')
             print(f"🔗 Old referral format detected from user: {referrer_id}")
-        elif start_param.startswith('BT'):
-            # New format: BT123456789
-            referral_code = start_param
+        elif start_param.startswith('BT') or referral_codes.V1_PATTERN.match(start_param.upper()):
+            # New format: BT123456789, or a current-format code issued under a rotated secret
+            referral_code = start_param.upper() if start_param.upper().startswith(referral_codes.PREFIX) else start_param
             print(f"🔗 New referral code format detected: {referral_code}")
             
-            # Find referrer by referral code
+            # Find referrer by referral code (one get on referralCodes)
             if db:
                 try:
-                    referral_codes_ref = db.collection('referral_codes')
-                    query = referral_codes_ref.where('referral_code', '==', referral_code).where('is_active', '==', True).limit(1)
-                    docs = list(query.stream())
+                    referrer_id = referral_codes.resolve(db, referral_code)
                     
-                    if docs:
-                        referrer_id = docs[0].to_dict()['user_id']
+                    if referrer_id:
                         print(f"🔗 Referrer found: {referrer_id} for code: {referral_code}")
                     else:
                         print(f"❌ Referral code {referral_code} not found in database")
@@ -487,103 +564,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                 )
                                 return
 
-                            # Update referral status to verified and mark reward as given
-                            referral_doc.reference.update({
-                                'status': 'verified',
-                                'updated_at': datetime.now(),
-                                'is_active': True,
-                                'group_join_verified': True,
-                                'last_join_date': datetime.now(),
-                                'reward_given': True,
-                                'reward_given_at': datetime.now()
-                            })
-
-                            # Give reward to referrer (+2 taka)
-                            print(f"💰 Processing reward for referrer: {referrer_id}")
-
-                            # Get current balance and referral stats
-                            users_ref = db.collection('users')
-                            user_query = users_ref.where('telegram_id', '==', str(referrer_id)).limit(1)
-                            user_docs = list(user_query.stream())
-                            
-                            if user_docs:
-                                user_data = user_docs[0].to_dict()
-                                current_balance = user_data['balance']
-                                current_total_earnings = user_data.get('total_earnings', 0)
-                                current_total_referrals = user_data.get('total_referrals', 0)
-
-                                print(f"💰 Referrer current stats:")
-                                print(f"   Balance: {current_balance}")
-                                print(f"   Total Earnings: {current_total_earnings}")
-                                print(f"   Total Referrals: {current_total_referrals}")
-
-                                # Calculate new values
-                                new_balance = current_balance + 2
-                                new_total_earnings = current_total_earnings + 2
-                                new_total_referrals = current_total_referrals + 1
-
-                                print(f"💰 New stats will be:")
-                                print(f"   Balance: {current_balance} -> {new_balance}")
-                                print(f"   Total Earnings: {current_total_earnings} -> {new_total_earnings}")
-                                print(f"   Total Referrals: {current_total_referrals} -> {new_total_referrals}")
-
-                                # Update balance, total_earnings, and total_referrals
-                                user_docs[0].reference.update({
-                                    'balance': new_balance,
-                                    'total_earnings': new_total_earnings,
-                                    'total_referrals': new_total_referrals
-                                })
-
-                                # Create earnings record for referral reward
-                                earnings_ref = db.collection('earnings')
-                                earnings_ref.add({
-                                    'user_id': referrer_id,
-                                    'source': 'referral',
-                                    'amount': 2,
-                                    'description': f'Referral reward for user {user_name} (ID: {user_id})',
-                                    'reference_id': referral_doc.id,
-                                    'reference_type': 'referral',
-                                    'created_at': datetime.now()
-                                })
-
-                                print(f"💰 Earnings record created for referral reward")
-
-                                # Verify the update
-                                updated_user_docs = list(user_query.stream())
-                                if updated_user_docs:
-                                    updated_user_data = updated_user_docs[0].to_dict()
-                                    actual_balance = updated_user_data['balance']
-                                    actual_total_earnings = updated_user_data.get('total_earnings', 0)
-                                    actual_total_referrals = updated_user_data.get('total_referrals', 0)
-
-                                    print(f"💰 Actual stats after update:")
-                                    print(f"   Balance: {actual_balance} (expected: {new_balance})")
-                                    print(f"   Total Earnings: {actual_total_earnings} (expected: {new_total_earnings})")
-                                    print(f"   Total Referrals: {actual_total_referrals} (expected: {new_total_referrals})")
-
-                                    if (actual_balance == new_balance and
-                                        actual_total_earnings == new_total_earnings and
-                                        actual_total_referrals == new_total_referrals):
-                                        print(f"✅ All updates successful: {current_balance} → {actual_balance}")
-                                    else:
-                                        print(f"❌ Some updates failed! Expected: {new_balance}, Got: {actual_balance}")
-                                else:
-                                    print(f"❌ Could not verify balance update for referrer: {referrer_id}")
-                            else:
-                                print(f"❌ Could not get current balance for referrer: {referrer_id}")
-
-                            # Send notification to referrer
-                            notifications_ref = db.collection('notifications')
-                            notifications_ref.add({
-                                'user_id': referrer_id,
-                                'type': 'reward',
-                                'title': 'Referral Reward Earned! 🎉',
-                                'message': f'User {user_name} joined the group! You earned ৳2.',
-                                'read': False,
-                                'created_at': datetime.now()
-                            })
-
-                            print(f"💰 Referral reward processed: {referrer_id} got ৳2 for {user_name}")
+                            reward_referrer(referral_doc, referrer_id, user_id, user_name)
                     
             except Exception as e:
                 print(f"❌ Error processing referral reward: {e}")
@@ -637,26 +618,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 existing_users = list(query.stream())
                 
                 if existing_users:
-                    # Update user data without is_active column to avoid schema issues
-                    update_data = {
-                        'last_activity': datetime.now()
-                    }
-                    
-                    # Only add is_active if the column exists
-                    user_doc = existing_users[0]
-                    try:
-                        user_doc.reference.update({
-                            'last_activity': datetime.now(),
-                            'is_active': True
-                        })
-                    except Exception as schema_error:
-                        if "is_active" in str(schema_error):
-                            # Field doesn't exist, update without it
-                            user_doc.reference.update({
-                                'last_activity': datetime.now()
-                            })
-                        else:
-                            raise schema_error
+                    # Queue the activity update through the write-behind buffer
+                    activity_buffer.touch(existing_users[0].reference, {
+                        'last_activity': datetime.now(),
+                        'is_active': True
+                    })
                 else:
                     # Create new user
                     new_user_data = {
@@ -666,7 +632,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         'last_name': update.message.from_user.last_name or "",
                         'created_at': datetime.now(),
                         'balance': 0,
-                        'energy': 100,
+                        **energy.initial_fields(),  # regenerates on read, see energy.py
                         'level': 1,
                         'experience_points': 0,
                         'referral_code': ensure_user_referral_code(user_id, username)
@@ -844,103 +810,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                                     )
                                     return
 
-                                # Update referral status to verified and mark reward as given
-                                referral_doc.reference.update({
-                                    'status': 'verified',
-                                    'updated_at': datetime.now(),
-                                    'is_active': True,
-                                    'group_join_verified': True,
-                                    'last_join_date': datetime.now(),
-                                    'reward_given': True,
-                                    'reward_given_at': datetime.now()
-                                })
-
-                                # Give reward to referrer (+2 taka)
-                                print(f"💰 Processing reward for referrer via callback: {referrer_id}")
-
-                                # Get current balance and referral stats
-                                users_ref = db.collection('users')
-                                user_query = users_ref.where('telegram_id', '==', str(referrer_id)).limit(1)
-                                user_docs = list(user_query.stream())
-                                
-                                if user_docs:
-                                    user_data = user_docs[0].to_dict()
-                                    current_balance = user_data['balance']
-                                    current_total_earnings = user_data.get('total_earnings', 0)
-                                    current_total_referrals = user_data.get('total_referrals', 0)
-
-                                    print(f"💰 Referrer current stats:")
-                                    print(f"   Balance: {current_balance}")
-                                    print(f"   Total Earnings: {current_total_earnings}")
-                                    print(f"   Total Referrals: {current_total_referrals}")
-
-                                    # Calculate new values
-                                    new_balance = current_balance + 2
-                                    new_total_earnings = current_total_earnings + 2
-                                    new_total_referrals = current_total_referrals + 1
-
-                                    print(f"💰 New stats will be:")
-                                    print(f"   Balance: {current_balance} -> {new_balance}")
-                                    print(f"   Total Earnings: {current_total_earnings} -> {new_total_earnings}")
-                                    print(f"   Total Referrals: {current_total_referrals} -> {new_total_referrals}")
-
-                                    # Update balance, total_earnings, and total_referrals
-                                    user_docs[0].reference.update({
-                                        'balance': new_balance,
-                                        'total_earnings': new_total_earnings,
-                                        'total_referrals': new_total_referrals
-                                    })
-
-                                    # Create earnings record for referral reward
-                                    earnings_ref = db.collection('earnings')
-                                    earnings_ref.add({
-                                        'user_id': referrer_id,
-                                        'source': 'referral',
-                                        'amount': 2,
-                                        'description': f'Referral reward for user {user_name} (ID: {user_id})',
-                                        'reference_id': referral_doc.id,
-                                        'reference_type': 'referral',
-                                        'created_at': datetime.now()
-                                    })
-
-                                    print(f"💰 Earnings record created for referral reward")
-
-                                    # Verify the update
-                                    updated_user_docs = list(user_query.stream())
-                                    if updated_user_docs:
-                                        updated_user_data = updated_user_docs[0].to_dict()
-                                        actual_balance = updated_user_data['balance']
-                                        actual_total_earnings = updated_user_data.get('total_earnings', 0)
-                                        actual_total_referrals = updated_user_data.get('total_referrals', 0)
-
-                                        print(f"💰 Actual stats after update:")
-                                        print(f"   Balance: {actual_balance} (expected: {new_balance})")
-                                        print(f"   Total Earnings: {actual_total_earnings} (expected: {new_total_earnings})")
-                                        print(f"   Total Referrals: {actual_total_referrals} (expected: {new_total_referrals})")
-
-                                        if (actual_balance == new_balance and
-                                            actual_total_earnings == new_total_earnings and
-                                            actual_total_referrals == new_total_referrals):
-                                            print(f"✅ All updates successful via callback: {current_balance} → {actual_balance}")
-                                        else:
-                                            print(f"❌ Some updates failed via callback! Expected: {new_balance}, Got: {actual_balance}")
-                                    else:
-                                        print(f"❌ Could not verify balance update for referrer: {referrer_id}")
-                                else:
-                                    print(f"❌ Could not get current balance for referrer: {referrer_id}")
-
-                                # Send notification to referrer
-                                notifications_ref = db.collection('notifications')
-                                notifications_ref.add({
-                                    'user_id': referrer_id,
-                                    'type': 'reward',
-                                    'title': 'Referral Reward Earned! 🎉',
-                                    'message': f'User {user_name} joined the group! You earned ৳2.',
-                                    'read': False,
-                                    'created_at': datetime.now()
-                                })
-
-                                print(f"💰 Referral reward processed via callback: {referrer_id} got ৳2")
+                                reward_referrer(referral_doc, referrer_id, user_id, user_name)
                         
                         # For callback, we can't send photo, so we'll send a new message
                         success_message = (
@@ -1142,9 +1012,27 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+async def post_init(application: Application):
+    """Start background workers once the application is initialized"""
+    application.bot_data['activity_task'] = asyncio.create_task(activity_buffer.run())
+
+async def post_shutdown(application: Application):
+    """Flush write-behind buffers before the process exits"""
+    task = application.bot_data.pop('activity_task', None)
+    if task:
+        task.cancel()
+    flushed = await asyncio.to_thread(activity_buffer.close)
+    print(f"📝 Flushed {flushed} pending activity updates on shutdown")
+
 def main():
     # Create application
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add command handlers
     app.add_handler(CommandHandler("start", start))
@@ -4,6 +4,12 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from google.api_core.exceptions import AlreadyExists
+from fraud_flags import fraud_flags
+import referral_codes
+from earnings_ledger import ledger as earnings_ledger
+from models import Earning
+
 # Load environment variables
 load_dotenv()
 
@@ -28,7 +34,7 @@ def generate_referral_code(user_id: int) -> str:
     """Generate unique referral code for user"""
     try:
         if not db:
-            return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+            return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
         
         user_id_str = str(user_id)
         
@@ -42,7 +48,7 @@ def generate_referral_code(user_id: int) -> str:
                 return user_data['referral_code']
         
         # Generate new referral code
-        referral_code = f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        referral_code = referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
         
         # Create user document if doesn't exist
         user_data = {
@@ -58,29 +64,20 @@ def generate_referral_code(user_id: int) -> str:
         
         user_ref.set(user_data, merge=True)
         
-        # Create referral code document
-        referral_data = {
-            'user_id': user_id_str,
-            'referral_code': referral_code,
-            'is_active': True,
-            'created_at': datetime.now(),
-            'total_uses': 0,
-            'total_earnings': 0
-        }
-        
-        db.collection('referralCodes').document(referral_code).set(referral_data)
-        print(f"✅ Referral code created: {referral_code} for user {user_id}")
+        # Create referral code document (kept as is if it's already there)
+        if referral_codes.register_code(db, referral_code, user_id_str):
+            print(f"✅ Referral code created: {referral_code} for user {user_id}")
         
         return referral_code
     except Exception as e:
         print(f"❌ Error generating referral code: {e}")
-        return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
 
 def ensure_user_referral_code(user_id: int, username: str = None) -> str:
     """Ensure user has a referral code, create if missing"""
     try:
         if not db:
-            return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+            return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
         
         user_id_str = str(user_id)
         user_ref = db.collection('users').document(user_id_str)
@@ -91,20 +88,8 @@ def ensure_user_referral_code(user_id: int, username: str = None) -> str:
             existing_code = user_data.get('referral_code')
             
             if existing_code:
-                # Check if code exists in referralCodes collection
-                code_doc = db.collection('referralCodes').document(existing_code).get()
-                
-                if not code_doc.exists:
-                    # Code missing from referralCodes collection, create it
-                    referral_data = {
-                        'user_id': user_id_str,
-                        'referral_code': existing_code,
-                        'is_active': True,
-                        'created_at': datetime.now(),
-                        'total_uses': 0,
-                        'total_earnings': 0
-                    }
-                    db.collection('referralCodes').document(existing_code).set(referral_data)
+                # Create the referralCodes document if it's missing
+                if referral_codes.register_code(db, existing_code, user_id_str):
                     print(f"✅ Fixed missing referral code record: {existing_code} for user {user_id}")
                 
                 return existing_code
@@ -113,7 +98,7 @@ def ensure_user_referral_code(user_id: int, username: str = None) -> str:
         return generate_referral_code(user_id)
     except Exception as e:
         print(f"❌ Error ensuring user referral code: {e}")
-        return f"CP{str(user_id)}"  # Use full telegram ID with CP prefix
+        return referral_codes.encode(user_id)  # Self-validating code, see referral_codes.py
 
 def get_user_data(user_id: int):
     """Get user data from Firebase"""
@@ -154,6 +139,11 @@ def process_referral(referrer_id: int, referred_id: int, reward_amount: int = 2)
         referrer_id_str = str(referrer_id)
         referred_id_str = str(referred_id)
         
+        # Hold rewards for referrers flagged by the fraud scoring job
+        if fraud_flags.is_flagged(db, referrer_id_str):
+            print(f"🚩 Reward held for flagged referrer {referrer_id}")
+            return False
+        
         # Get referrer data
         referrer_ref = db.collection('users').document(referrer_id_str)
         referrer_doc = referrer_ref.get()
@@ -163,21 +153,24 @@ def process_referral(referrer_id: int, referred_id: int, reward_amount: int = 2)
             return False
         
         referrer_data = referrer_doc.to_dict()
-        current_balance = referrer_data.get('balance', 0)
-        current_referral_count = referrer_data.get('referral_count', 0)
-        current_total_earnings = referrer_data.get('total_earnings', 0)
         
-        # Update referrer
-        new_balance = current_balance + reward_amount
-        new_referral_count = current_referral_count + 1
-        new_total_earnings = current_total_earnings + reward_amount
-        
-        referrer_ref.update({
-            'balance': new_balance,
-            'referral_count': new_referral_count,
-            'total_earnings': new_total_earnings,
+        # Earnings record and balance change commit together, so the reward is
+        # in the ledger reconcile_balances.py checks; the id makes a repeat fail
+        batch = db.batch()
+        earnings_ledger.add(batch, db, f"referral_{referrer_id_str}_{referred_id_str}", Earning(
+            referrer_id_str, reward_amount, 'referral', description=f'Referral reward from user {referred_id}',
+            created_at=datetime.now()))
+        batch.update(referrer_ref, {
+            'balance': firestore.Increment(reward_amount),
+            'referral_count': firestore.Increment(1),
+            'total_earnings': firestore.Increment(reward_amount),
             'updated_at': datetime.now()
         })
+        try:
+            batch.commit()
+        except AlreadyExists:
+            print(f"⏭️ Referral reward for {referred_id} already paid to {referrer_id}")
+            return False
         
         # Update referral code usage
         referral_code = referrer_data.get('referral_code')
@@ -201,35 +194,27 @@ def process_referral(referrer_id: int, referred_id: int, reward_amount: int = 2)
         print(f"❌ Error processing referral: {e}")
         return False
 
+_task_service = None
+
+def get_task_service():
+    """Shared task completion service (templates and cooldown index cached in memory)"""
+    global _task_service
+    if _task_service is None and db:
+        from task_completions import TaskCompletionService
+        _task_service = TaskCompletionService(db)
+    return _task_service
+
 def add_task_completion(user_id: int, task_type: str, reward_amount: int = 1):
-    """Add task completion record"""
+    """Add task completion record and credit the reward"""
     try:
         if not db:
             return False
         
-        task_data = {
-            'user_id': str(user_id),
-            'task_type': task_type,
-            'completed_at': datetime.now(),
-            'reward_amount': reward_amount
-        }
-        
-        db.collection('taskCompletions').add(task_data)
-        
-        # Update user balance
-        user_ref = db.collection('users').document(str(user_id))
-        user_doc = user_ref.get()
-        
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            current_balance = user_data.get('balance', 0)
-            current_total_earnings = user_data.get('total_earnings', 0)
-            
-            user_ref.update({
-                'balance': current_balance + reward_amount,
-                'total_earnings': current_total_earnings + reward_amount,
-                'updated_at': datetime.now()
-            })
+        # Template reward, cooldown and caps apply when a template exists for task_type
+        result = get_task_service().complete(user_id, task_type, reward=reward_amount)
+        if result.status != 'credited':
+            print(f"⚠️ Task completion rejected: {task_type} for user {user_id} ({result.status})")
+            return False
         
         print(f"✅ Task completion added: {task_type} for user {user_id}")
         return True
@@ -0,0 +1,292 @@
+"""
+Cash Points Bot API Transport
+Tuned, pooled HTTP transport for the Telegram Bot API.
+
+Features:
+- HTTPXRequest with a keep-alive pool as large as the connection pool (httpx
+  otherwise keeps only 20 idle connections and reconnects the rest)
+- HTTP/2 multiplexing (BOT_API_HTTP2, on by default; falls back to HTTP/1.1
+  when the h2 package is missing)
+- Separate transports for the getUpdates long poll and for outbound calls,
+  so sends never queue behind the poll and vice versa
+- Per-method read timeouts (BOT_API_METHOD_TIMEOUTS), e.g. short ones for
+  getChatMember and answerCallbackQuery
+- Metrics per transport: new vs reused connections, pool-wait percentiles,
+  pool timeouts, timeouts and network errors, calls per method
+
+Usage:
+    request, get_updates_request = build_transports()
+    Application.builder().request(request).get_updates_request(get_updates_request)
+    python bot_transport.py --bench --concurrency 50,500
+"""
+
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter, deque
+from typing import Optional, Dict, Any, Tuple
+
+import httpx
+from telegram.error import TimedOut, NetworkError
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+
+from config import config
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+except ImportError:  # h2 is optional, HTTP/1.1 is always available
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+WAIT_SAMPLES = 2000
+_DEFAULT = type(BaseRequest.DEFAULT_NONE)
+
+
+def parse_method_timeouts(spec: str) -> Dict[str, float]:
+    """'getChatMember=3,sendPhoto=20' -> {'getChatMember': 3.0, 'sendPhoto': 20.0}"""
+    timeouts = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            method, seconds = item.split('=', 1)
+            timeouts[method.strip()] = float(seconds)
+    return timeouts
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class BotApiTransport(HTTPXRequest):
+    """HTTPXRequest with a full keep-alive pool, per-method timeouts and connection metrics"""
+
+    def __init__(self, name: str = 'bot', pool_size: int = None, http2: bool = None,
+                 connect_timeout: float = None, read_timeout: float = None, write_timeout: float = None,
+                 pool_timeout: float = None, media_write_timeout: float = None,
+                 keepalive_expiry: float = None, method_timeouts: Dict[str, float] = None,
+                 httpx_kwargs: Dict[str, Any] = None):
+        self.name = name
+        self.pool_size = pool_size or config.BOT_API_POOL_SIZE
+        http2 = config.BOT_API_HTTP2 if http2 is None else http2
+        if http2 and h2 is None:
+            logger.warning("⚠️ BOT_API_HTTP2 needs the h2 package (pip install 'httpx[http2]'), using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.method_timeouts = (method_timeouts if method_timeouts is not None
+                                else parse_method_timeouts(config.BOT_API_METHOD_TIMEOUTS))
+        self.requests = 0
+        self.new_connections = 0
+        self.reused = 0
+        self.pool_timeouts = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.by_method: Counter = Counter()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._max_wait = 0.0
+
+        keepalive_expiry = config.BOT_API_KEEPALIVE_EXPIRY if keepalive_expiry is None else keepalive_expiry
+        kwargs = {
+            'limits': httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size,
+                                   keepalive_expiry=keepalive_expiry),
+            'event_hooks': {'request': [self._on_request]},
+        }
+        kwargs.update(httpx_kwargs or {})
+        super().__init__(
+            connection_pool_size=self.pool_size,
+            connect_timeout=config.BOT_API_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout,
+            read_timeout=config.BOT_API_READ_TIMEOUT if read_timeout is None else read_timeout,
+            write_timeout=config.BOT_API_WRITE_TIMEOUT if write_timeout is None else write_timeout,
+            pool_timeout=config.BOT_API_POOL_TIMEOUT if pool_timeout is None else pool_timeout,
+            media_write_timeout=(config.BOT_API_MEDIA_WRITE_TIMEOUT if media_write_timeout is None
+                                 else media_write_timeout),
+            http_version='2' if http2 else '1.1',
+            httpx_kwargs=kwargs,
+        )
+
+    async def _on_request(self, request: httpx.Request):
+        # httpcore reports the first step it takes once it holds a connection:
+        # connect_tcp for a new one, send_request_headers for a reused one
+        queued_at = time.perf_counter()
+        pending = [True]
+
+        async def trace(event: str, info: Dict[str, Any]):
+            if pending and event.endswith('.started'):
+                pending.clear()
+                wait = time.perf_counter() - queued_at
+                self._waits.append(wait)
+                self._max_wait = max(self._max_wait, wait)
+                if event.startswith('connection.connect_tcp'):
+                    self.new_connections += 1
+                else:
+                    self.reused += 1
+
+        request.extensions['trace'] = trace
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        self.requests += 1
+        self.by_method[api_method] += 1
+        if isinstance(read_timeout, _DEFAULT) and api_method in self.method_timeouts:
+            read_timeout = self.method_timeouts[api_method]
+        try:
+            return await super().do_request(url, method, request_data, read_timeout=read_timeout,
+                                            write_timeout=write_timeout, connect_timeout=connect_timeout,
+                                            pool_timeout=pool_timeout)
+        except TimedOut as e:
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                self.pool_timeouts += 1
+            else:
+                self.timeouts += 1
+            raise
+        except NetworkError:
+            self.errors += 1
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        waits = list(self._waits)
+        acquired = self.new_connections + self.reused
+        return {
+            'name': self.name,
+            'http_version': self.http_version,
+            'pool_size': self.pool_size,
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused': self.reused,
+            'reuse_rate': self.reused / acquired if acquired else 0.0,
+            'pool_wait_p50': _percentile(waits, 50),
+            'pool_wait_p95': _percentile(waits, 95),
+            'pool_wait_max': self._max_wait,
+            'pool_timeouts': self.pool_timeouts,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'by_method': dict(self.by_method),
+        }
+
+
+def build_transports() -> Tuple[BotApiTransport, BotApiTransport]:
+    """(request, get_updates_request) for Application.builder()"""
+    request = BotApiTransport('bot')
+    # The long poll holds its connection for the whole poll timeout; one is all it needs
+    get_updates_request = BotApiTransport('get_updates', pool_size=1, http2=False, method_timeouts={})
+    return request, get_updates_request
+
+
+# ---- Benchmark --------------------------------------------------------------
+
+BENCH_MIX = (('getChatMember', 0.5), ('sendMessage', 0.3), ('answerCallbackQuery', 0.2))
+
+
+def _bench_transports(server, pool_sizes, http2_pool_sizes):
+    verify = server.client_ssl_context
+    yield 'PTB default (HTTP/1.1, 256)', HTTPXRequest(httpx_kwargs={'verify': verify()})
+    for size in pool_sizes:
+        yield f"HTTP/1.1 pool {size}", BotApiTransport('bench', pool_size=size, http2=False,
+                                                       httpx_kwargs={'verify': verify()})
+    for size in http2_pool_sizes:
+        yield f"HTTP/2 pool {size}", BotApiTransport('bench', pool_size=size, http2=True,
+                                                     httpx_kwargs={'verify': verify()})
+
+
+async def _bench_one(transport, base_url: str, concurrency: int, total: int, seed: int) -> Dict[str, Any]:
+    from telegram.request._requestparameter import RequestParameter
+
+    rng = random.Random(seed)
+    methods, weights = zip(*BENCH_MIX)
+    calls = [(m, rng.randrange(10 ** 9)) for m in rng.choices(methods, weights, k=total)]
+    latencies = []
+    failures = Counter()
+
+    async def worker():
+        while calls:
+            api_method, user_id = calls.pop()
+            data = RequestData([RequestParameter.from_input(key, value) for key, value in (
+                ('chat_id', user_id), ('user_id', user_id), ('text', 'Cash Points'),
+                ('callback_query_id', str(user_id)))])
+            started = time.perf_counter()
+            try:
+                await transport.post(f"{base_url}123456:bench/{api_method}", data)
+                latencies.append(time.perf_counter() - started)
+            except TimedOut as e:
+                failures['pool_timeout' if 'Pool timeout' in str(e) else 'timeout'] += 1
+            except NetworkError:
+                failures['network'] += 1
+
+    await transport.initialize()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    result = {
+        'elapsed': elapsed,
+        'rate': len(latencies) / elapsed,
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99),
+        'failures': dict(failures),
+    }
+    stats = await transport.post(f"{base_url}123456:bench/fakeStats")
+    result['server'] = stats
+    if isinstance(transport, BotApiTransport):
+        result['transport'] = transport.stats()
+    await transport.shutdown()
+    return result
+
+
+def run_benchmark(args):
+    from fake_bot_api import FakeBotServer
+
+    server = FakeBotServer(latency=args.latency, handshake_latency=args.handshake)
+    base_url = server.start()
+    print(f"Fake Bot API at {base_url} (latency {args.latency * 1000:.0f} ms, "
+          f"new connection +{args.handshake * 1000:.0f} ms)")
+    try:
+        for concurrency in args.concurrency:
+            total = max(args.requests, concurrency * 4)
+            print(f"\n{concurrency} concurrent callers, {total} calls")
+            print(f"   {'transport':28} {'calls/s':>8} {'p50':>7} {'p95':>7} {'p99':>7} "
+                  f"{'conns':>6} {'wait p95':>9} {'failed':>7}")
+            connections = 0
+            for label, transport in _bench_transports(server, args.pool_sizes, args.http2_pool_sizes):
+                result = asyncio.run(_bench_one(transport, base_url, concurrency, total, args.seed))
+                opened = result['server']['connections'] - connections
+                connections = result['server']['connections']
+                wait = result.get('transport', {}).get('pool_wait_p95')
+                print(f"   {label:28} {result['rate']:8.0f} {result['p50'] * 1000:6.0f}ms "
+                      f"{result['p95'] * 1000:6.0f}ms {result['p99'] * 1000:6.0f}ms {opened:6} "
+                      f"{f'{wait * 1000:.0f}ms' if wait is not None else '-':>9} "
+                      f"{sum(result['failures'].values()):7}")
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bot API transport')
+    parser.add_argument('--bench', action='store_true', help='Benchmark transports against the fake Bot API')
+    parser.add_argument('--concurrency', default='50,500', help='Comma-separated concurrent callers')
+    parser.add_argument('--requests', type=int, default=3000, help='Calls per run (at least 4 per caller)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake API latency per call (seconds)')
+    parser.add_argument('--handshake', type=float, default=0.15,
+                        help='Extra latency of a call on a new connection (TCP + TLS round trips)')
+    parser.add_argument('--pool-sizes', default='64,256,512', help='HTTP/1.1 pool sizes to compare')
+    parser.add_argument('--http2-pool-sizes', default='4,16', help='HTTP/2 pool sizes to compare')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    if args.bench:
+        args.concurrency = [int(c) for c in args.concurrency.split(',') if c]
+        args.pool_sizes = [int(c) for c in args.pool_sizes.split(',') if c]
+        args.http2_pool_sizes = [int(c) for c in args.http2_pool_sizes.split(',') if c]
+        run_benchmark(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
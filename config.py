@@ -34,5 +34,167 @@ class BotConfig:
     # Image settings
     WELCOME_IMAGE_URL: str = "https://i.postimg.cc/44DtvWyZ/43b0363d-525b-425c-bc02-b66f6d214445-1.jpg"
 
+    # Export settings
+    EXPORT_DIR: str = os.getenv('EXPORT_DIR', 'exports')
+    EXPORT_PAGE_SIZE: int = int(os.getenv('EXPORT_PAGE_SIZE', '1000'))
+    EXPORT_ROWS_PER_FILE: int = int(os.getenv('EXPORT_ROWS_PER_FILE', '250000'))
+
+    # Balance reconciliation settings
+    RECONCILE_CHUNK_ROWS: int = int(os.getenv('RECONCILE_CHUNK_ROWS', '1000000'))  # ledger rows per merge
+
+    # Earnings ledger settings (off | dual: also write monthly buckets | ledger: also read them)
+    EARNINGS_LEDGER_MODE: str = os.getenv('EARNINGS_LEDGER_MODE', 'off').lower()
+    EARNINGS_BUCKET_MAX_ENTRIES: int = int(os.getenv('EARNINGS_BUCKET_MAX_ENTRIES', '1000'))
+
+    # Notification inbox settings
+    NOTIFY_DIGEST_WINDOW: int = int(os.getenv('NOTIFY_DIGEST_WINDOW', '3600'))  # seconds per reward digest
+    NOTIFY_COMPACT_WINDOW: int = int(os.getenv('NOTIFY_COMPACT_WINDOW', '86400'))  # seconds per backlog digest
+    NOTIFY_READ_TTL_DAYS: int = int(os.getenv('NOTIFY_READ_TTL_DAYS', '14'))
+
+    # Fraud scoring settings
+    FRAUD_FLAG_CACHE_TTL: int = int(os.getenv('FRAUD_FLAG_CACHE_TTL', '600'))  # seconds
+
+    # Local state directory (journals, outbox, cache snapshots)
+    STATE_DIR: str = os.getenv('STATE_DIR', 'state')
+
+    # Activity write-behind settings
+    ACTIVITY_FLUSH_INTERVAL: float = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '10'))  # seconds
+    ACTIVITY_FLUSH_MAX_ENTRIES: int = int(os.getenv('ACTIVITY_FLUSH_MAX_ENTRIES', '400'))
+    ACTIVITY_JOURNAL_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'activity_journal.jsonl')
+    # bot_enhanced_referral.py keeps its own: a journal is replayed and rotated by its owner only
+    ENHANCED_ACTIVITY_JOURNAL_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'),
+                                                       'activity_journal_enhanced.jsonl')
+
+    # Offline outbox settings
+    OUTBOX_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'outbox.sqlite3')
+    OUTBOX_REPLAY_BATCH: int = int(os.getenv('OUTBOX_REPLAY_BATCH', '200'))
+    OUTBOX_RETRY_INTERVAL: float = float(os.getenv('OUTBOX_RETRY_INTERVAL', '30'))  # seconds
+    OUTBOX_MAX_ATTEMPTS: int = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+
+    # Backend resilience settings
+    HANDLER_DEADLINE: float = float(os.getenv('HANDLER_DEADLINE', '8'))  # seconds per update
+    BACKEND_CALL_TIMEOUT: float = float(os.getenv('BACKEND_CALL_TIMEOUT', '5'))  # seconds per call
+    BACKEND_MAX_RETRIES: int = int(os.getenv('BACKEND_MAX_RETRIES', '3'))
+    BACKEND_RETRY_BASE_DELAY: float = float(os.getenv('BACKEND_RETRY_BASE_DELAY', '0.2'))  # seconds
+    BACKEND_RETRY_MAX_DELAY: float = float(os.getenv('BACKEND_RETRY_MAX_DELAY', '2'))  # seconds
+    BREAKER_FAILURE_THRESHOLD: int = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+    BREAKER_RESET_TIMEOUT: float = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))  # seconds
+
+    # Task completion settings
+    TASK_TEMPLATE_CACHE_TTL: int = int(os.getenv('TASK_TEMPLATE_CACHE_TTL', '300'))  # seconds
+    TASK_DAILY_CAP: int = int(os.getenv('TASK_DAILY_CAP', '50'))  # completions per user per day (0 = no cap)
+    TASK_BATCH_WRITES: int = int(os.getenv('TASK_BATCH_WRITES', '450'))  # writes per commit
+
+    # Bot API rate governor
+    BOT_API_RATE_LIMIT: float = float(os.getenv('BOT_API_RATE_LIMIT', '25'))  # calls/sec
+    BOT_API_INTERACTIVE_RESERVE: float = float(os.getenv('BOT_API_INTERACTIVE_RESERVE', '0.3'))  # bucket share
+
+    # Membership sweep settings
+    MEMBERSHIP_SWEEP_ENABLED: bool = os.getenv('MEMBERSHIP_SWEEP_ENABLED', 'false').lower() == 'true'
+    MEMBERSHIP_STORE_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'membership.sqlite3')
+    MEMBERSHIP_SWEEP_BUDGET: float = float(os.getenv('MEMBERSHIP_SWEEP_BUDGET', '86400'))  # seconds per sweep
+    MEMBERSHIP_SWEEP_INTERVAL: float = float(os.getenv('MEMBERSHIP_SWEEP_INTERVAL', '86400'))  # seconds between starts
+    MEMBERSHIP_SWEEP_CONCURRENCY: int = int(os.getenv('MEMBERSHIP_SWEEP_CONCURRENCY', '16'))
+    MEMBERSHIP_SWEEP_PAGE_SIZE: int = int(os.getenv('MEMBERSHIP_SWEEP_PAGE_SIZE', '300'))
+    MEMBERSHIP_SWEEP_REPORT_INTERVAL: float = float(os.getenv('MEMBERSHIP_SWEEP_REPORT_INTERVAL', '60'))  # seconds
+    MEMBERSHIP_RECHECK_AFTER: float = float(os.getenv('MEMBERSHIP_RECHECK_AFTER', '21600'))  # seconds
+    MEMBERSHIP_REVOKE_LEFT_REFERRALS: bool = os.getenv('MEMBERSHIP_REVOKE_LEFT_REFERRALS', 'false').lower() == 'true'
+
+    # Withdrawal pipeline settings
+    WITHDRAWAL_PIPELINE_ENABLED: bool = os.getenv('WITHDRAWAL_PIPELINE_ENABLED', 'false').lower() == 'true'
+    WITHDRAWAL_INTERVAL: float = float(os.getenv('WITHDRAWAL_INTERVAL', '60'))  # seconds between runs
+    WITHDRAWAL_PAGE_SIZE: int = int(os.getenv('WITHDRAWAL_PAGE_SIZE', '500'))
+    WITHDRAWAL_CONCURRENCY: int = int(os.getenv('WITHDRAWAL_CONCURRENCY', '32'))  # lookups / Bot API calls in flight
+    WITHDRAWAL_BATCH_WRITES: int = int(os.getenv('WITHDRAWAL_BATCH_WRITES', '450'))  # writes per commit
+    WITHDRAWAL_MEMBERSHIP_MAX_AGE: float = float(os.getenv('WITHDRAWAL_MEMBERSHIP_MAX_AGE', '3600'))  # seconds
+    WITHDRAWAL_MIN_AMOUNT: float = float(os.getenv('WITHDRAWAL_MIN_AMOUNT', '100'))  # methods without a config
+    PAYMENT_CONFIG_CACHE_TTL: int = int(os.getenv('PAYMENT_CONFIG_CACHE_TTL', '300'))  # seconds
+
+    # Energy settings (regenerated on read, written only when spent)
+    ENERGY_MAX: int = int(os.getenv('ENERGY_MAX', '100'))
+    ENERGY_REGEN_SECONDS: int = int(os.getenv('ENERGY_REGEN_SECONDS', '36'))  # one point; full in an hour
+    ENERGY_SPEND_RETRIES: int = int(os.getenv('ENERGY_SPEND_RETRIES', '5'))  # compare-and-set attempts
+
+    # Session cache settings
+    SESSION_CACHE_ENABLED: bool = os.getenv('SESSION_CACHE_ENABLED', 'true').lower() == 'true'
+    SESSION_STORE_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'sessions.sqlite3')
+    SESSION_TTL: float = float(os.getenv('SESSION_TTL', '3600'))  # seconds
+    SESSION_MEMBERSHIP_TTL: float = float(os.getenv('SESSION_MEMBERSHIP_TTL', '300'))  # seconds
+    SESSION_FLUSH_INTERVAL: float = float(os.getenv('SESSION_FLUSH_INTERVAL', '30'))  # seconds
+
+    # Mini app API settings
+    MINI_APP_API_ENABLED: bool = os.getenv('MINI_APP_API_ENABLED', 'false').lower() == 'true'
+    MINI_APP_API_HOST: str = os.getenv('MINI_APP_API_HOST', '0.0.0.0')
+    MINI_APP_API_PORT: int = int(os.getenv('MINI_APP_API_PORT', '8080'))
+    MINI_APP_AUTH_MAX_AGE: float = float(os.getenv('MINI_APP_AUTH_MAX_AGE', '86400'))  # seconds
+    MINI_APP_CACHE_TTL: float = float(os.getenv('MINI_APP_CACHE_TTL', '30'))  # seconds
+    MINI_APP_CACHE_MAX_ENTRIES: int = int(os.getenv('MINI_APP_CACHE_MAX_ENTRIES', '50000'))
+    MINI_APP_PAGE_SIZE: int = int(os.getenv('MINI_APP_PAGE_SIZE', '20'))
+
+    # Referral code settings
+    REFERRAL_CODE_SECRET: str = os.getenv('REFERRAL_CODE_SECRET', 'cash-points-referral-v1')
+    # Comma-separated secrets codes were issued with before a rotation (include the
+    # default above when first setting a real secret); their codes still decode
+    REFERRAL_CODE_PREVIOUS_SECRETS: tuple = tuple(
+        s for s in os.getenv('REFERRAL_CODE_PREVIOUS_SECRETS', '').split(',') if s)
+    REFERRAL_LEGACY_CACHE_TTL: float = float(os.getenv('REFERRAL_LEGACY_CACHE_TTL', '3600'))  # seconds
+    REFERRAL_LEGACY_NEGATIVE_TTL: float = float(os.getenv('REFERRAL_LEGACY_NEGATIVE_TTL', '60'))  # seconds
+    REFERRAL_LEGACY_CACHE_SIZE: int = int(os.getenv('REFERRAL_LEGACY_CACHE_SIZE', '100000'))
+    # Fall back to users / referral_codes when referralCodes/{code} is missing; turn off
+    # once `referral_codes.py --migrate` has run and /status shows no legacy hits
+    REFERRAL_CODES_DUAL_READ: bool = os.getenv('REFERRAL_CODES_DUAL_READ', 'true').lower() == 'true'
+
+    # Snapshot listener settings
+    SNAPSHOT_LISTENERS_ENABLED: bool = os.getenv('SNAPSHOT_LISTENERS_ENABLED', 'false').lower() == 'true'
+    SNAPSHOT_CACHE_TTL: float = float(os.getenv('SNAPSHOT_CACHE_TTL', '86400'))  # seconds, while synced
+    SNAPSHOT_CHECK_INTERVAL: float = float(os.getenv('SNAPSHOT_CHECK_INTERVAL', '15'))  # seconds
+
+    # Lookup snapshot settings (build interval 0 = this process doesn't build)
+    LOOKUP_SNAPSHOT_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'lookup.snapshot')
+    LOOKUP_SNAPSHOT_BUILD_INTERVAL: float = float(os.getenv('LOOKUP_SNAPSHOT_BUILD_INTERVAL', '0'))  # seconds
+    LOOKUP_SNAPSHOT_CHECK_INTERVAL: float = float(os.getenv('LOOKUP_SNAPSHOT_CHECK_INTERVAL', '30'))  # seconds
+
+    # Graceful shutdown / warm restart settings (keep the supervisor's stop timeout above the drain timeout)
+    SHUTDOWN_DRAIN_TIMEOUT: float = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '15'))  # seconds
+    WARM_STATE_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'warm_state.json')
+    REFERRAL_GRAPH_SNAPSHOT_PATH: str = os.path.join(os.getenv('STATE_DIR', 'state'), 'referral_graph.snapshot')
+    WARM_STATE_INTERVAL: float = float(os.getenv('WARM_STATE_INTERVAL', '300'))  # seconds
+    WARM_STATE_MAX_AGE: float = float(os.getenv('WARM_STATE_MAX_AGE', '86400'))  # seconds
+
+    # Update scheduler settings (priority classes and load shedding)
+    SCHEDULER_ENABLED: bool = os.getenv('SCHEDULER_ENABLED', 'false').lower() == 'true'
+    SCHEDULER_WORKERS: int = int(os.getenv('SCHEDULER_WORKERS', '64'))
+    SCHEDULER_CRITICAL_QUEUE: int = int(os.getenv('SCHEDULER_CRITICAL_QUEUE', '5000'))
+    SCHEDULER_NORMAL_QUEUE: int = int(os.getenv('SCHEDULER_NORMAL_QUEUE', '1000'))
+    SCHEDULER_LOW_QUEUE: int = int(os.getenv('SCHEDULER_LOW_QUEUE', '100'))
+    SCHEDULER_LOW_MAX_WAIT: float = float(os.getenv('SCHEDULER_LOW_MAX_WAIT', '5'))  # seconds
+    SCHEDULER_LOW_COMMANDS: str = os.getenv('SCHEDULER_LOW_COMMANDS', 'help,status,group')
+    SCHEDULER_SHED_POLICY: str = os.getenv('SCHEDULER_SHED_POLICY', 'respond')  # respond | drop
+
+    # Bot API transport settings (outbound calls; getUpdates has its own connection)
+    BOT_API_POOL_SIZE: int = int(os.getenv('BOT_API_POOL_SIZE', '64'))
+    BOT_API_HTTP2: bool = os.getenv('BOT_API_HTTP2', 'true').lower() == 'true'
+    BOT_API_KEEPALIVE_EXPIRY: float = float(os.getenv('BOT_API_KEEPALIVE_EXPIRY', '60'))  # seconds
+    BOT_API_CONNECT_TIMEOUT: float = float(os.getenv('BOT_API_CONNECT_TIMEOUT', '5'))
+    BOT_API_READ_TIMEOUT: float = float(os.getenv('BOT_API_READ_TIMEOUT', '5'))
+    BOT_API_WRITE_TIMEOUT: float = float(os.getenv('BOT_API_WRITE_TIMEOUT', '5'))
+    BOT_API_POOL_TIMEOUT: float = float(os.getenv('BOT_API_POOL_TIMEOUT', '3'))
+    BOT_API_MEDIA_WRITE_TIMEOUT: float = float(os.getenv('BOT_API_MEDIA_WRITE_TIMEOUT', '20'))
+    BOT_API_METHOD_TIMEOUTS: str = os.getenv('BOT_API_METHOD_TIMEOUTS',
+                                             'getChatMember=3,answerCallbackQuery=3,sendPhoto=15')
+
+    # Update recording (empty path = disabled)
+    RECORD_UPDATES_PATH: str = os.getenv('RECORD_UPDATES_PATH', '')
+    RECORD_SALT: str = os.getenv('RECORD_SALT', '')
+
+    # Tracing settings
+    TRACING_ENABLED: bool = os.getenv('TRACING_ENABLED', 'false').lower() == 'true'
+    TRACE_SAMPLE_RATE: float = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))
+    TRACE_SLOW_MS: float = float(os.getenv('TRACE_SLOW_MS', '1500'))  # always keep slower updates
+    TRACE_FILE: str = os.getenv('TRACE_FILE', os.path.join(os.getenv('STATE_DIR', 'state'), 'traces.jsonl'))
+    TRACE_OTLP_ENDPOINT: str = os.getenv('TRACE_OTLP_ENDPOINT', '')  # e.g. http://localhost:4318/v1/traces
+    TRACE_SERVICE_NAME: str = os.getenv('TRACE_SERVICE_NAME', 'cashpoints-bot')
+    TRACE_SALT: str = os.getenv('TRACE_SALT', '')
+
 # Create global config instance
 config = BotConfig()
@@ -0,0 +1,402 @@
+"""
+Cash Points Earnings Ledger
+Per-user, per-month bucket documents for earnings, with per-user rollups.
+
+Features:
+- Every earning is still created in `earnings`, the flat stream the admin
+  panel, exports and reconciliation read; with EARNINGS_LEDGER_MODE=dual or
+  ledger it is also appended, in the same batch, to
+  earnings_ledger/{user_id}_{YYYY-MM}_{part} (entries array, running total,
+  count and per-type totals) and earnings_rollups/{user_id} (all-time and
+  per-month totals)
+- The flat document is created, not set: a repeated reward fails the whole
+  batch with AlreadyExists, so bucket totals are never counted twice
+- A bucket holds EARNINGS_BUCKET_MAX_ENTRIES entries, later ones go to the
+  next part (part = entries that month // max). Instances size parts from
+  their own counts, so a bucket may overshoot a little; the 1 MiB document
+  limit is several times the default
+- A history page reads one bucket (two when it crosses into the previous
+  part or month); monthly totals are one rollup read
+- backfill() appends flat earnings that are missing from the buckets, matched
+  by earnings doc id, so it can be re-run. It only takes earnings created
+  BACKFILL_SETTLE_SECONDS before the run started: anything newer came from a
+  dual-writing instance, which appends it itself, and one committed between
+  the bucket scan and the flat scan would otherwise be appended twice
+
+Rollout: EARNINGS_LEDGER_MODE=dual on every instance, wait at least
+BACKFILL_SETTLE_SECONDS, run --backfill, then
+EARNINGS_LEDGER_MODE=ledger to serve the mini app from the buckets.
+
+Usage:
+    python earnings_ledger.py --backfill
+    python earnings_ledger.py --backfill --user 123456789
+    python earnings_ledger.py --bench
+"""
+
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from firebase_admin import firestore
+
+from config import config
+from models import Earning
+
+logger = logging.getLogger(__name__)
+
+EARNINGS_COLLECTION = 'earnings'
+LEDGER_COLLECTION = 'earnings_ledger'
+ROLLUP_COLLECTION = 'earnings_rollups'
+
+OFF = 'off'
+DUAL = 'dual'  # write buckets and rollups, read the flat collection
+LEDGER = 'ledger'  # write both, read buckets and rollups
+
+BATCH_LIMIT = 500  # Firestore max writes per batch
+HEAD_CACHE_SIZE = 20000  # (user, month) entry counts kept for choosing parts
+BACKFILL_SETTLE_SECONDS = 300  # margin for rewards stamped before the run but committed after
+
+
+def month_key(value) -> str:
+    """'YYYY-MM' of a Firestore timestamp, datetime or ISO string (now when missing)"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            value = None
+    if not hasattr(value, 'strftime'):
+        value = datetime.now()
+    return value.strftime('%Y-%m')
+
+
+def _epoch(value) -> float:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return 0.0
+    return value.timestamp() if hasattr(value, 'timestamp') else 0.0
+
+
+def bucket_key(month: str, part: int) -> str:
+    return f"{month}_{part:03d}"
+
+
+def _entry(doc_id: str, earning: Earning) -> Dict[str, Any]:
+    return {
+        'id': doc_id,
+        'amount': earning.amount,
+        'type': earning.type or earning.source or 'other',  # legacy rows only carry a source
+        'description': earning.description,
+        'created_at': earning.created_at,
+    }
+
+
+def _newest_first(entries) -> List[Dict[str, Any]]:
+    # Appends arrive in commit order and backfilled rows land after newer ones
+    return sorted(entries or (), key=lambda e: (_epoch(e.get('created_at')), e.get('id', '')), reverse=True)
+
+
+class EarningsLedger:
+    """Writes earnings into monthly buckets and reads history back from them"""
+
+    def __init__(self, mode: str = None, max_entries: int = None):
+        self.mode = mode or config.EARNINGS_LEDGER_MODE
+        self.max_entries = max_entries or config.EARNINGS_BUCKET_MAX_ENTRIES
+        self._heads: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.appended = 0
+        self.head_reads = 0
+
+    @property
+    def writes_buckets(self) -> bool:
+        return self.mode in (DUAL, LEDGER)
+
+    @property
+    def reads_buckets(self) -> bool:
+        return self.mode == LEDGER
+
+    # ---- Writes -----------------------------------------------------------
+
+    def _next_part(self, db, user_id: str, month: str) -> int:
+        head = (user_id, month)
+        with self._lock:
+            count = self._heads.get(head)
+        if count is None:
+            # Seed from the rollup once per (user, month) and process
+            rollup = db.collection(ROLLUP_COLLECTION).document(user_id).get()
+            months = ((rollup.to_dict() or {}).get('months') or {}) if rollup.exists else {}
+            count = (months.get(month) or {}).get('count') or 0
+            self.head_reads += 1
+        with self._lock:
+            count = max(count, self._heads.get(head, 0))
+            self._heads[head] = count + 1
+            self._heads.move_to_end(head)
+            while len(self._heads) > HEAD_CACHE_SIZE:
+                self._heads.popitem(last=False)
+        return count // self.max_entries
+
+    def stage(self, batch, db, user_id: str, month: str, part: int, entries: List[Dict[str, Any]]):
+        """Append entries to one bucket and count them in the user's rollup"""
+        total = sum(e['amount'] for e in entries)
+        by_type: Dict[str, float] = {}
+        for e in entries:
+            by_type[e['type']] = by_type.get(e['type'], 0) + e['amount']
+        key = bucket_key(month, part)
+        now = datetime.now()
+        batch.set(db.collection(LEDGER_COLLECTION).document(f"{user_id}_{key}"), {
+            'user_id': user_id,
+            'month': month,
+            'part': part,
+            'key': key,
+            'entries': firestore.ArrayUnion(entries),
+            'total': firestore.Increment(total),
+            'count': firestore.Increment(len(entries)),
+            'by_type': {t: firestore.Increment(v) for t, v in by_type.items()},
+            'updated_at': now,
+        }, merge=True)
+        batch.set(db.collection(ROLLUP_COLLECTION).document(user_id), {
+            'user_id': user_id,
+            'total': firestore.Increment(total),
+            'count': firestore.Increment(len(entries)),
+            'by_type': {t: firestore.Increment(v) for t, v in by_type.items()},
+            'months': {month: {'total': firestore.Increment(total), 'count': firestore.Increment(len(entries))}},
+            'updated_at': now,
+        }, merge=True)
+
+    def add(self, batch, db, doc_id: str, earning: Earning):
+        """Create the flat earnings doc and, when enabled, its bucket entry and rollup update"""
+        batch.create(db.collection(EARNINGS_COLLECTION).document(doc_id), earning.to_firestore())
+        if not self.writes_buckets:
+            return
+        user_id = str(earning.user_id)
+        month = month_key(earning.created_at)
+        self.stage(batch, db, user_id, month, self._next_part(db, user_id, month), [_entry(doc_id, earning)])
+        self.appended += 1
+
+    # ---- Reads ------------------------------------------------------------
+
+    def history(self, db, user_id: str, cursor: Optional[str] = None,
+                limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Newest-first entries and the next cursor: '{key}:{offset}' resumes inside
+        a bucket, '{key}' continues with the buckets older than it"""
+        bound, op, skip = None, None, 0
+        if cursor:
+            bound, sep, offset = cursor.partition(':')
+            op, skip = ('<=', int(offset) if offset.isdigit() else 0) if sep else ('<', 0)
+        query = db.collection(LEDGER_COLLECTION).where('user_id', '==', user_id)
+        items: List[Dict[str, Any]] = []
+        while len(items) < limit:
+            page = query.where('key', op, bound) if bound else query
+            buckets = list(page.order_by('key', direction='DESCENDING').limit(1).stream())
+            if not buckets:
+                return items, None
+            data = buckets[0].to_dict() or {}
+            key = data.get('key', '')
+            entries = _newest_first(data.get('entries'))
+            start = skip if op == '<=' and key == bound else 0
+            end = min(len(entries), start + limit - len(items))
+            items.extend(entries[start:end])
+            bound, op = key, '<'
+        return items, f"{key}:{end}" if end < len(entries) else key
+
+    def monthly(self, db, user_id: str) -> Dict[str, Any]:
+        """All-time and per-month totals from the rollup (one read)"""
+        doc = db.collection(ROLLUP_COLLECTION).document(user_id).get()
+        data = (doc.to_dict() or {}) if doc.exists else {}
+        months = data.get('months') or {}
+        return {
+            'total': data.get('total') or 0,
+            'count': data.get('count') or 0,
+            'by_type': data.get('by_type') or {},
+            'months': [{'month': month, 'total': (months[month] or {}).get('total') or 0,
+                        'count': (months[month] or {}).get('count') or 0}
+                       for month in sorted(months, reverse=True)],
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {'mode': self.mode, 'appended': self.appended, 'head_reads': self.head_reads,
+                'cached_heads': len(self._heads)}
+
+
+ledger = EarningsLedger()
+
+
+# ---- Flat-collection readers (the layout the buckets replace) -------------
+
+def flat_history(db, user_id: str, cursor: Optional[str] = None,
+                 limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    earnings_ref = db.collection(EARNINGS_COLLECTION)
+    query = earnings_ref.where('user_id', '==', user_id).order_by('created_at', direction='DESCENDING')
+    if cursor:
+        cursor_doc = earnings_ref.document(cursor).get()
+        if not cursor_doc.exists or (cursor_doc.to_dict() or {}).get('user_id') != user_id:
+            return [], None
+        query = query.start_after(cursor_doc)
+    docs = list(query.limit(limit + 1).stream())
+    items = [_entry(doc.id, Earning.from_firestore(doc.id, doc.to_dict() or {})) for doc in docs[:limit]]
+    return items, docs[limit - 1].id if len(docs) > limit else None
+
+
+def flat_monthly(db, user_id: str) -> Dict[str, Any]:
+    total, count, by_type, months = 0, 0, {}, {}
+    for doc in db.collection(EARNINGS_COLLECTION).where('user_id', '==', user_id).stream():
+        e = _entry(doc.id, Earning.from_firestore(doc.id, doc.to_dict() or {}))
+        total += e['amount']
+        count += 1
+        by_type[e['type']] = by_type.get(e['type'], 0) + e['amount']
+        month = months.setdefault(month_key(e['created_at']), {'total': 0, 'count': 0})
+        month['total'] += e['amount']
+        month['count'] += 1
+    return {'total': total, 'count': count, 'by_type': by_type,
+            'months': [{'month': m, **months[m]} for m in sorted(months, reverse=True)]}
+
+
+# ---- Backfill -------------------------------------------------------------
+
+def _user_ids(db, page_size: int):
+    last = None
+    while True:
+        query = db.collection('users').order_by('__name__').limit(page_size)
+        if last is not None:
+            query = query.start_after(last)
+        docs = list(query.stream())
+        for doc in docs:
+            yield str((doc.to_dict() or {}).get('telegram_id') or doc.id)
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def backfill_user(db, user_id: str, max_entries: int = None, before: float = None) -> int:
+    """Append this user's flat earnings created before `before` that no bucket
+    holds yet; returns entries added"""
+    max_entries = max_entries or config.EARNINGS_BUCKET_MAX_ENTRIES
+    before = time.time() - BACKFILL_SETTLE_SECONDS if before is None else before
+    present, counts = set(), {}
+    for doc in db.collection(LEDGER_COLLECTION).where('user_id', '==', user_id).stream():
+        data = doc.to_dict() or {}
+        present.update(e.get('id') for e in data.get('entries') or ())
+        month = data.get('month') or ''
+        counts[month] = counts.get(month, 0) + len(data.get('entries') or ())
+
+    missing: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in db.collection(EARNINGS_COLLECTION).where('user_id', '==', user_id).stream():
+        if doc.id not in present:
+            entry = _entry(doc.id, Earning.from_firestore(doc.id, doc.to_dict() or {}))
+            if _epoch(entry['created_at']) >= before:
+                continue  # dual-written, possibly committed after the bucket scan
+            missing.setdefault(month_key(entry['created_at']), []).append(entry)
+
+    # One bucket write per (month, part) plus a rollup write per batch
+    writes = []
+    for month, entries in missing.items():
+        entries.sort(key=lambda e: (_epoch(e['created_at']), e['id']))
+        index = counts.get(month, 0)
+        while entries:
+            part = index // max_entries
+            room = (part + 1) * max_entries - index  # fill the current part before opening the next
+            writes.append((month, part, entries[:room]))
+            entries = entries[room:]
+            index += room
+    for start in range(0, len(writes), BATCH_LIMIT // 2):
+        batch = db.batch()
+        for month, part, chunk in writes[start:start + BATCH_LIMIT // 2]:
+            ledger.stage(batch, db, user_id, month, part, chunk)
+        batch.commit()
+    return sum(len(chunk) for _, _, chunk in writes)
+
+
+def backfill(db, user_ids=None, page_size: int = None) -> Dict[str, Any]:
+    """Backfill every user (or the given ones) up to the run's start; safe to re-run"""
+    started = time.time()
+    before = started - BACKFILL_SETTLE_SECONDS
+    users = added = 0
+    for user_id in user_ids or _user_ids(db, page_size or config.EXPORT_PAGE_SIZE):
+        added += backfill_user(db, user_id, before=before)
+        users += 1
+        if users % 1000 == 0:
+            logger.info(f"📒 Backfill: {users:,} users, {added:,} entries added")
+    summary = {'users': users, 'entries_added': added, 'seconds': round(time.time() - started, 1)}
+    logger.info(f"📒 Backfill done: {summary}")
+    return summary
+
+
+# ---- Benchmark ------------------------------------------------------------
+
+def run_benchmark(sizes: List[int], months: int, page_size: int):
+    """Read counts of a full history walk and monthly totals, flat vs buckets"""
+    import random
+    from fake_firestore import FakeFirestore
+
+    rng = random.Random(3)
+    db = FakeFirestore()
+    writer = EarningsLedger(mode=DUAL)
+    now = time.time()
+    for n, size in enumerate(sizes):
+        user_id = str(7_000_000 + n)
+        batch, pending = db.batch(), 0
+        for i in range(size):
+            created = datetime.fromtimestamp(now - rng.uniform(0, months * 30 * 86400))
+            writer.add(batch, db, f"referral_{user_id}_{i}", Earning(
+                user_id, rng.choice((2, 2, 2, -2, 50)), rng.choice(('referral', 'referral_reversal')),
+                description='Referral reward', created_at=created))
+            pending += 3
+            if pending >= BATCH_LIMIT - 3:
+                batch.commit()
+                batch, pending = db.batch(), 0
+        batch.commit()
+
+    print(f"{'earnings':>9} {'flat history':>13} {'ledger history':>15} {'flat totals':>12} {'ledger totals':>14}")
+    for n, size in enumerate(sizes):
+        user_id = str(7_000_000 + n)
+        results = []
+        for read_history, read_monthly in ((flat_history, flat_monthly),
+                                           (ledger.history, ledger.monthly)):
+            before = db.call_counts().get('doc_reads', 0)
+            cursor, seen, pages = None, 0, 0
+            while True:
+                items, cursor = read_history(db, user_id, cursor, page_size)
+                seen += len(items)
+                pages += 1
+                if not cursor:
+                    break
+            middle = db.call_counts().get('doc_reads', 0)
+            totals = read_monthly(db, user_id)
+            after = db.call_counts().get('doc_reads', 0)
+            assert seen == size and totals['count'] == size, (seen, totals['count'], size)
+            results.append((middle - before, pages, after - middle))
+        (flat, pages, flat_totals), (bucketed, _, ledger_totals) = results
+        print(f"{size:>9,} {flat:>9,} ({flat / pages:.1f}/pg) {bucketed:>9,} ({bucketed / pages:.1f}/pg) "
+              f"{flat_totals:>12,} {ledger_totals:>14,}")
+    print(f"Bucket writes: {writer.appended:,} entries, {writer.head_reads:,} head reads")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monthly earnings buckets and rollups')
+    parser.add_argument('--backfill', action='store_true', help='Append flat earnings missing from the buckets')
+    parser.add_argument('--user', action='append', help='Backfill only this user (repeatable)')
+    parser.add_argument('--bench', action='store_true', help='Compare read counts against the stand-in backend')
+    parser.add_argument('--sizes', default='50,500,5000,20000', help='Earnings per benchmark user')
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--page-size', type=int, default=config.MINI_APP_PAGE_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.bench:
+        run_benchmark([int(s) for s in args.sizes.split(',')], args.months, args.page_size)
+    elif args.backfill:
+        from bot_firebase import db
+        if db is None:
+            parser.error("Firestore is not configured")
+        backfill(db, args.user)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Cash Points Energy
+Energy computed on read instead of refilled by writes.
+
+Features:
+- A user's energy is derived from what's stored on the user doc: `energy`
+  (the value at `last_energy_refill`), `last_energy_refill` and `max_energy`;
+  a point comes back every ENERGY_REGEN_SECONDS, up to the maximum
+- current() is pure, so showing energy costs no writes and nothing refills
+  energy in bulk
+- spend() writes only when energy is spent, as a compare-and-set on the user
+  doc's update time: if anything else wrote the doc since it was read (another
+  spend, a reward), the precondition fails and the spend is recomputed from a
+  fresh read, so the same points are never spent twice
+- Regen progress towards the next point survives a spend: the refill
+  timestamp only moves by whole points
+- Users without the fields (or without a refill timestamp, from before this
+  model) count as full
+
+Used by the bot and the mini app API (GET /api/energy, POST /api/energy/spend).
+
+Usage:
+    state = energy.current(user_doc.to_dict())
+    result = energy.spend(db, user_doc.reference, 10)
+    python energy.py --bench 20000
+"""
+
+import time
+import logging
+import argparse
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, NamedTuple, Tuple
+
+from google.api_core.exceptions import FailedPrecondition
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_counts: Counter = Counter()
+
+
+class EnergyContention(Exception):
+    """The user doc kept changing between read and write; try again later"""
+
+
+class EnergyState(NamedTuple):
+    energy: int
+    max_energy: int
+    next_in: float  # seconds until the next point (0 when full)
+    full_in: float  # seconds until full
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'energy': self.energy, 'max_energy': self.max_energy,
+                'next_in': round(self.next_in, 1), 'full_in': round(self.full_in, 1)}
+
+
+class SpendResult(NamedTuple):
+    spent: bool
+    state: EnergyState
+    conflicts: int = 0
+
+
+def _epoch(value) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        # Naive datetimes are stored as UTC by the Firestore client
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+    return None
+
+
+def stored_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields current() needs, JSON-friendly (for caching a user's profile)"""
+    return {'energy': data.get('energy'), 'max_energy': data.get('max_energy'),
+            'last_energy_refill': _epoch(data.get('last_energy_refill'))}
+
+
+def _regen(data: Dict[str, Any], now: float) -> Tuple[int, float, int]:
+    """(energy now, refill timestamp to store with it, max energy)"""
+    max_energy = int(data.get('max_energy') or config.ENERGY_MAX)
+    stored = data.get('energy')
+    anchor = _epoch(data.get('last_energy_refill'))
+    if stored is None or anchor is None:
+        return max(int(stored or 0), max_energy), now, max_energy
+    stored = int(stored)
+    if stored >= max_energy:
+        return stored, now, max_energy  # bonuses may go above the maximum; no regen then
+    step = config.ENERGY_REGEN_SECONDS
+    points = int(max(0.0, now - anchor) // step)
+    if stored + points >= max_energy:
+        return max_energy, now, max_energy
+    return stored + points, anchor + points * step, max_energy
+
+
+def current(data: Dict[str, Any], now: float = None) -> EnergyState:
+    """Energy right now, from a user doc (or stored_fields()); never writes"""
+    now = time.time() if now is None else now
+    energy, anchor, max_energy = _regen(data, now)
+    if energy >= max_energy:
+        return EnergyState(energy, max_energy, 0.0, 0.0)
+    next_in = max(0.0, anchor + config.ENERGY_REGEN_SECONDS - now)
+    return EnergyState(energy, max_energy, next_in,
+                       next_in + (max_energy - energy - 1) * config.ENERGY_REGEN_SECONDS)
+
+
+def initial_fields() -> Dict[str, Any]:
+    """Energy fields for a new user doc"""
+    return {'energy': config.ENERGY_MAX, 'max_energy': config.ENERGY_MAX}
+
+
+def spend(db, user_ref, amount: int = 1, retries: int = None) -> SpendResult:
+    """Spend `amount` if available, atomically; a refused spend writes nothing"""
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    retries = retries or config.ENERGY_SPEND_RETRIES
+    conflicts = 0
+    for _ in range(retries):
+        snapshot = user_ref.get()
+        if not snapshot.exists:
+            raise LookupError(f"No user document {user_ref.id}")
+        data = snapshot.to_dict() or {}
+        now = time.time()
+        energy, anchor, _ = _regen(data, now)
+        if energy < amount:
+            _counts['refused'] += 1
+            return SpendResult(False, current(data, now), conflicts)
+        fields = {
+            'energy': energy - amount,
+            'last_energy_refill': datetime.fromtimestamp(anchor, timezone.utc),
+            'updated_at': datetime.now()
+        }
+        try:
+            user_ref.update(fields, option=db.write_option(last_update_time=snapshot.update_time))
+        except FailedPrecondition:
+            conflicts += 1
+            _counts['conflicts'] += 1
+            continue
+        _counts['spent'] += 1
+        return SpendResult(True, current({**data, **fields}, now), conflicts)
+    _counts['contended'] += 1
+    raise EnergyContention(f"User {user_ref.id} changed {conflicts} times while spending energy")
+
+
+def find_user(db, telegram_id: str):
+    """The user doc for a Telegram id, or None"""
+    docs = list(db.collection('users').where('telegram_id', '==', str(telegram_id)).limit(1).stream())
+    return docs[0] if docs else None
+
+
+def spend_for(db, telegram_id: str, amount: int = 1) -> Optional[SpendResult]:
+    """spend() for a Telegram user id; None when the user doesn't exist"""
+    user = find_user(db, telegram_id)
+    return spend(db, user.reference, amount) if user is not None else None
+
+
+def stats() -> Dict[str, int]:
+    return dict(_counts)
+
+
+def run_benchmark(spends: int, users: int, threads: int):
+    """Concurrent spends against the stand-in backend: no overspend, no lost points"""
+    from concurrent.futures import ThreadPoolExecutor
+    from fake_firestore import FakeFirestore
+
+    db = FakeFirestore(latency=0.002)  # so reads and writes of the same user interleave
+    base = 6_000_000_000
+    for i in range(users):
+        db.seed('users', str(base + i), {'telegram_id': str(base + i), **initial_fields()})
+    refs = [db.collection('users').document(str(base + i)) for i in range(users)]
+
+    def one(i):
+        try:
+            return spend(db, refs[(i // threads) % users], 7).spent  # concurrent spends hit one user
+        except EnergyContention:
+            return None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(one, range(spends)))
+    elapsed = time.perf_counter() - started
+    spent = results.count(True)
+    remaining = sum(current(data).energy for data in db.dump('users').values())
+    counts = stats()
+    print(f"⚡ {spends:,} spends of 7 over {users:,} users on {threads} threads in {elapsed:.2f}s")
+    print(f"✅ Spent {spent:,}  🚫 Refused {results.count(False):,}  ⏳ Contended {results.count(None):,}  "
+          f"🔁 Conflicts retried {counts.get('conflicts', 0):,}")
+    expected = users * config.ENERGY_MAX - spent * 7
+    print(f"🔋 Energy left {remaining:,} (expected {expected:,}, regen since start "
+          f"≤ {users * int(elapsed // config.ENERGY_REGEN_SECONDS + 1):,})")
+    updates = db.call_counts().get('update', 0)
+    print(f"✍️ {updates:,} update calls for {spent:,} spends ({updates - spent:,} lost to conflicts, "
+          f"none for refusals or reads)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Energy regeneration tools')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark N concurrent spends')
+    parser.add_argument('--users', type=int, default=200, help='Synthetic users for the benchmark')
+    parser.add_argument('--threads', type=int, default=16, help='Concurrent spenders')
+    args = parser.parse_args()
+
+    if args.bench:
+        run_benchmark(args.bench, args.users, args.threads)
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+Cash Points Data Export
+Features:
+- Page-by-page streaming of Firestore collections (bounded memory)
+- Fixed export schema per collection
+- Parquet output when pyarrow is installed, chunked CSV otherwise
+- Date-range filters and incremental "since last export" watermarks
+- Throughput (rows/sec) and peak RSS reporting
+
+Usage:
+    python export_data.py users referrals --since-last
+    python export_data.py earnings --start 2025-01-01 --end 2025-02-01 --format csv
+    python export_data.py --synthetic 1000000 earnings
+"""
+
+import os
+import csv
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, List, Iterator, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, CSV is always available
+    pa = None
+    pq = None
+
+# Fixed export schema: (column, type). Types: string, int, float, bool, timestamp
+EXPORT_SCHEMAS: Dict[str, List[Tuple[str, str]]] = {
+    'users': [
+        ('doc_id', 'string'),
+        ('telegram_id', 'string'),
+        ('username', 'string'),
+        ('first_name', 'string'),
+        ('last_name', 'string'),
+        ('referral_code', 'string'),
+        ('balance', 'float'),
+        ('total_earnings', 'float'),
+        ('total_referrals', 'int'),
+        ('referral_count', 'int'),
+        ('is_active', 'bool'),
+        ('is_verified', 'bool'),
+        ('is_banned', 'bool'),
+        ('created_at', 'timestamp'),
+        ('updated_at', 'timestamp'),
+    ],
+    'referrals': [
+        ('doc_id', 'string'),
+        ('referrer_id', 'string'),
+        ('referred_id', 'string'),
+        ('referral_code', 'string'),
+        ('status', 'string'),
+        ('group_join_verified', 'bool'),
+        ('reward_given', 'bool'),
+        ('rejoin_count', 'int'),
+        ('is_active', 'bool'),
+        ('created_at', 'timestamp'),
+        ('group_join_date', 'timestamp'),
+        ('last_join_date', 'timestamp'),
+        ('updated_at', 'timestamp'),
+    ],
+    'earnings': [
+        ('doc_id', 'string'),
+        ('user_id', 'string'),
+        ('amount', 'float'),
+        ('source', 'string'),
+        ('type', 'string'),
+        ('description', 'string'),
+        ('reference_id', 'string'),
+        ('referral_id', 'string'),
+        ('created_at', 'timestamp'),
+    ],
+    'notifications': [
+        ('doc_id', 'string'),
+        ('user_id', 'string'),
+        ('type', 'string'),
+        ('title', 'string'),
+        ('message', 'string'),
+        ('read', 'bool'),
+        ('created_at', 'timestamp'),
+    ],
+    'referralCodes': [
+        ('doc_id', 'string'),  # the code itself (referralCodes/{code})
+        ('user_id', 'string'),
+        ('referral_code', 'string'),
+        ('is_active', 'bool'),
+        ('total_uses', 'int'),
+        ('total_earnings', 'float'),
+        ('created_at', 'timestamp'),
+    ],
+}
+
+# Field used for date-range filters and watermarks
+WATERMARK_FIELDS = {
+    'users': 'updated_at',
+    'referrals': 'created_at',
+    'earnings': 'created_at',
+    'notifications': 'created_at',
+    'referralCodes': 'created_at',
+}
+
+STATE_FILE = os.path.join(config.EXPORT_DIR, 'export_state.json')
+
+
+def _to_utc(value) -> Optional[datetime]:
+    """Normalise Firestore/naive datetimes to aware UTC"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _coerce(value, kind: str):
+    """Coerce a raw Firestore value to the column type (None on mismatch)"""
+    if value is None:
+        return None
+    try:
+        if kind == 'string':
+            return str(value)
+        if kind == 'int':
+            return int(value)
+        if kind == 'float':
+            return float(value)
+        if kind == 'bool':
+            return bool(value)
+        if kind == 'timestamp':
+            return _to_utc(value)
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def load_state() -> Dict[str, str]:
+    """Load per-collection export watermarks"""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(state: Dict[str, str]):
+    """Persist watermarks atomically"""
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def stream_pages(db, collection: str, page_size: int,
+                 start: Optional[datetime] = None,
+                 end: Optional[datetime] = None,
+                 equals: Optional[Dict[str, Any]] = None) -> Iterator[List[Dict[str, Any]]]:
+    """Yield a collection page by page using cursor pagination"""
+    field = WATERMARK_FIELDS.get(collection, 'created_at')
+    query = db.collection(collection)
+    for name, value in (equals or {}).items():
+        query = query.where(name, '==', value)
+    if start or end:
+        if start:
+            query = query.where(field, '>=', start)
+        if end:
+            query = query.where(field, '<', end)
+        query = query.order_by(field).order_by('__name__')
+    else:
+        query = query.order_by('__name__')
+
+    last_doc = None
+    while True:
+        page_query = query.limit(page_size)
+        if last_doc is not None:
+            page_query = page_query.start_after(last_doc)
+        docs = list(page_query.stream())
+        if not docs:
+            return
+        rows = []
+        for doc in docs:
+            row = doc.to_dict() or {}
+            row['doc_id'] = doc.id
+            rows.append(row)
+        yield rows
+        if len(docs) < page_size:
+            return
+        last_doc = docs[-1]
+
+
+def synthetic_pages(collection: str, total_rows: int, page_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Generate a synthetic dataset shaped like the real collection"""
+    rng = random.Random(42)
+    base_time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    produced = 0
+    while produced < total_rows:
+        count = min(page_size, total_rows - produced)
+        rows = []
+        for i in range(produced, produced + count):
+            user_id = str(5_000_000_000 + rng.randrange(total_rows // 10 + 1))
+            created_at = base_time + timedelta(seconds=i * 3)
+            if collection == 'users':
+                row = {'telegram_id': user_id, 'username': f'user_{i}', 'first_name': 'User',
+                       'referral_code': f'CP{user_id}', 'balance': rng.randrange(500),
+                       'total_earnings': rng.randrange(1000), 'total_referrals': rng.randrange(50),
+                       'is_active': True, 'created_at': created_at, 'updated_at': created_at}
+            elif collection == 'referrals':
+                row = {'referrer_id': user_id, 'referred_id': str(6_000_000_000 + i),
+                       'referral_code': f'CP{user_id}', 'status': 'verified',
+                       'group_join_verified': True, 'reward_given': True,
+                       'rejoin_count': rng.randrange(3), 'created_at': created_at}
+            elif collection == 'notifications':
+                row = {'user_id': user_id, 'type': 'reward', 'title': 'Referral Reward Earned! 🎉',
+                       'message': 'You earned ৳2.', 'read': rng.random() < 0.5,
+                       'created_at': created_at}
+            elif collection == 'referralCodes':
+                user_id = str(5_000_000_000 + i)  # one code per user, like the real collection
+                row = {'user_id': user_id, 'referral_code': f'CP{user_id}', 'is_active': True,
+                       'total_uses': rng.randrange(50), 'total_earnings': rng.randrange(100),
+                       'created_at': created_at}
+            else:
+                row = {'user_id': user_id, 'amount': 2, 'source': 'referral',
+                       'description': f'Referral reward for user {i}',
+                       'reference_id': f'ref{i}', 'created_at': created_at}
+            row['doc_id'] = row['referral_code'] if collection == 'referralCodes' else f'{collection}-{i}'
+            rows.append(row)
+        produced += count
+        yield rows
+
+
+class ParquetChunkWriter:
+    """Writes one row group per page, rotating files after rows_per_file rows"""
+
+    extension = 'parquet'
+
+    def __init__(self, out_dir: str, schema: List[Tuple[str, str]], rows_per_file: int):
+        self.out_dir = out_dir
+        self.columns = schema
+        self.rows_per_file = rows_per_file
+        self.arrow_schema = pa.schema([(name, self._arrow_type(kind)) for name, kind in schema])
+        self.writer = None
+        self.file_index = 0
+        self.file_rows = 0
+
+    @staticmethod
+    def _arrow_type(kind: str):
+        return {
+            'string': pa.string(),
+            'int': pa.int64(),
+            'float': pa.float64(),
+            'bool': pa.bool_(),
+            'timestamp': pa.timestamp('us', tz='UTC'),
+        }[kind]
+
+    def _open(self):
+        path = os.path.join(self.out_dir, f"part-{self.file_index:05d}.{self.extension}")
+        self.writer = pq.ParquetWriter(path, self.arrow_schema, compression='snappy')
+        self.file_index += 1
+        self.file_rows = 0
+
+    def write_page(self, rows: List[Dict[str, Any]]):
+        if self.writer is None or self.file_rows >= self.rows_per_file:
+            self.close()
+            self._open()
+        columns = {
+            name: [_coerce(row.get(name), kind) for row in rows]
+            for name, kind in self.columns
+        }
+        self.writer.write_table(pa.table(columns, schema=self.arrow_schema))
+        self.file_rows += len(rows)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class CSVChunkWriter:
+    """Writes rows to CSV files, rotating after rows_per_file rows"""
+
+    extension = 'csv'
+
+    def __init__(self, out_dir: str, schema: List[Tuple[str, str]], rows_per_file: int):
+        self.out_dir = out_dir
+        self.columns = schema
+        self.rows_per_file = rows_per_file
+        self.handle = None
+        self.writer = None
+        self.file_index = 0
+        self.file_rows = 0
+
+    def _open(self):
+        path = os.path.join(self.out_dir, f"part-{self.file_index:05d}.{self.extension}")
+        self.handle = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.handle)
+        self.writer.writerow([name for name, _ in self.columns])
+        self.file_index += 1
+        self.file_rows = 0
+
+    def write_page(self, rows: List[Dict[str, Any]]):
+        if self.handle is None or self.file_rows >= self.rows_per_file:
+            self.close()
+            self._open()
+        for row in rows:
+            values = []
+            for name, kind in self.columns:
+                value = _coerce(row.get(name), kind)
+                values.append(value.isoformat() if isinstance(value, datetime) else value)
+            self.writer.writerow(values)
+        self.file_rows += len(rows)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+            self.writer = None
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024 * 1024) if os.uname().sysname == 'Darwin' else peak / 1024
+
+
+def export_collection(pages: Iterator[List[Dict[str, Any]]], collection: str,
+                      fmt: str = 'parquet', out_root: Optional[str] = None,
+                      rows_per_file: Optional[int] = None) -> Dict[str, Any]:
+    """Export pages of a collection and return run statistics"""
+    schema = EXPORT_SCHEMAS[collection]
+    run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    out_dir = os.path.join(out_root or config.EXPORT_DIR, collection, run_id)
+    os.makedirs(out_dir, exist_ok=True)
+
+    writer_cls = ParquetChunkWriter if fmt == 'parquet' else CSVChunkWriter
+    writer = writer_cls(out_dir, schema, rows_per_file or config.EXPORT_ROWS_PER_FILE)
+
+    field = WATERMARK_FIELDS[collection]
+    max_watermark = None
+    rows_written = 0
+    started = time.perf_counter()
+    try:
+        for rows in pages:
+            writer.write_page(rows)
+            rows_written += len(rows)
+            for row in rows:
+                ts = _to_utc(row.get(field))
+                if ts and (max_watermark is None or ts > max_watermark):
+                    max_watermark = ts
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'collection': collection,
+        'rows': rows_written,
+        'files': writer.file_index,
+        'format': fmt,
+        'output': out_dir,
+        'elapsed_seconds': round(elapsed, 3),
+        'rows_per_second': round(rows_written / elapsed, 1) if elapsed > 0 else 0.0,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'watermark': max_watermark.isoformat() if max_watermark else None,
+    }
+
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return _to_utc(datetime.fromisoformat(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Firestore collections to Parquet/CSV')
+    parser.add_argument('collections', nargs='*', default=list(EXPORT_SCHEMAS),
+                        help=f"Collections to export (default: all of {', '.join(EXPORT_SCHEMAS)})")
+    parser.add_argument('--format', choices=['parquet', 'csv'], default=None,
+                        help='Output format (default: parquet if pyarrow is installed)')
+    parser.add_argument('--start', help='Only rows with watermark field >= this ISO date')
+    parser.add_argument('--end', help='Only rows with watermark field < this ISO date')
+    parser.add_argument('--since-last', action='store_true',
+                        help='Start from the watermark recorded by the previous export')
+    parser.add_argument('--page-size', type=int, default=config.EXPORT_PAGE_SIZE)
+    parser.add_argument('--rows-per-file', type=int, default=config.EXPORT_ROWS_PER_FILE)
+    parser.add_argument('--out', default=config.EXPORT_DIR, help='Output directory')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Benchmark against N synthetic rows instead of Firestore')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.collections if name not in EXPORT_SCHEMAS]
+    if unknown:
+        parser.error(f"Unknown collections: {unknown}")
+
+    fmt = args.format or ('parquet' if pa is not None else 'csv')
+    if fmt == 'parquet' and pa is None:
+        parser.error("pyarrow is not installed, use --format csv")
+
+    db = None
+    if not args.synthetic:
+        from bot_firebase import db
+        if not db:
+            print("❌ Firebase not connected")
+            return
+
+    state = load_state()
+    for collection in args.collections:
+        start = _parse_date(args.start)
+        if args.since_last and state.get(collection):
+            # Watermark is inclusive, so rows sharing the boundary timestamp are re-exported
+            start = _to_utc(datetime.fromisoformat(state[collection]))
+        end = _parse_date(args.end)
+
+        if args.synthetic:
+            pages = synthetic_pages(collection, args.synthetic, args.page_size)
+        else:
+            pages = stream_pages(db, collection, args.page_size, start, end)
+
+        print(f"📦 Exporting {collection} ({fmt})...")
+        stats = export_collection(pages, collection, fmt, args.out, args.rows_per_file)
+        print(f"✅ {collection}: {stats['rows']} rows in {stats['elapsed_seconds']}s "
+              f"({stats['rows_per_second']} rows/sec), {stats['files']} files, "
+              f"peak RSS {stats['peak_rss_mb']} MB")
+        print(f"   Output: {stats['output']}")
+
+        if stats['watermark'] and not args.synthetic:
+            state[collection] = stats['watermark']
+            save_state(state)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Cash Points Fake Bot API
+Local stand-in for the Telegram Bot API used by replay.py.
+
+- Plugs into python-telegram-bot as a BaseRequest, so the real Application,
+  handlers and Bot object run unchanged
+- Answers the methods the bot uses (getMe, getChatMember, sendPhoto,
+  sendMessage, editMessageCaption, answerCallbackQuery, ...)
+- Group membership decided per user by a stable hash (or a callable)
+- Optional latency and error injection; counts calls per method
+- FakeBotServer serves the same answers over TLS sockets (HTTP/1.1 and
+  HTTP/2 via ALPN) in a child process, for benchmarking the HTTP transport
+"""
+
+import os
+import ssl
+import json
+import time
+import random
+import asyncio
+import zlib
+import tempfile
+import ipaddress
+import multiprocessing
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl
+from collections import Counter
+from typing import Optional, Callable, Tuple, Dict, Any
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_ID = 8214925584
+
+
+class FakeBotRequest(BaseRequest):
+    """BaseRequest that answers Bot API calls in-process"""
+
+    def __init__(self, latency: float = 0.0, member_ratio: float = 0.8,
+                 is_member: Optional[Callable[[int], bool]] = None,
+                 failure_rate: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.member_ratio = member_ratio
+        self.is_member = is_member or self._hash_member
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._message_id = 0
+        self.counts: Counter = Counter()
+
+    def _hash_member(self, user_id: int) -> bool:
+        return (zlib.crc32(str(user_id).encode()) % 1000) < self.member_ratio * 1000
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        return await self.answer(api_method, params)
+
+    async def answer(self, api_method: str, params: Dict[str, Any]) -> Tuple[int, bytes]:
+        """Status and JSON body for one Bot API call (shared with FakeBotServer)"""
+        self.counts[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self._rng.random() < self.failure_rate:
+            self.counts['injected_failures'] += 1
+            return 500, json.dumps({'ok': False, 'error_code': 500,
+                                    'description': 'Internal Server Error: injected'}).encode()
+        return 200, json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    def _message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        self._message_id += 1
+        chat_id = params.get('chat_id', 0)
+        message = {
+            'message_id': params.get('message_id', self._message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+        }
+        for field in ('text', 'caption'):
+            if field in params:
+                message[field] = params[field]
+        return message
+
+    def _result(self, api_method: str, params: Dict[str, Any]):
+        if api_method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Cash Points',
+                    'username': 'CashPoinntbot', 'can_join_groups': True,
+                    'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if api_method == 'getChatMember':
+            user_id = int(params['user_id'])
+            return {
+                'status': 'member' if self.is_member(user_id) else 'left',
+                'user': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            }
+        if api_method in ('sendMessage', 'sendPhoto', 'editMessageCaption', 'editMessageText'):
+            return self._message(params)
+        if api_method == 'getUpdates':
+            return []
+        return True
+
+
+# ---- Socket server ----------------------------------------------------------
+
+def _self_signed_cert(directory: str) -> Tuple[str, str]:
+    """Write a throwaway certificate for 127.0.0.1; returns (cert, key) paths"""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]), False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def _parse_body(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+    content_type = headers.get('content-type', '')
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(parse_qsl(body.decode()))
+    if content_type.startswith('application/json') and body:
+        return json.loads(body)
+    return {}  # multipart uploads: the fake doesn't need the fields
+
+
+class _ServerProcess:
+    """Runs inside the child process: TLS listener answering with a FakeBotRequest"""
+
+    def __init__(self, api: FakeBotRequest, handshake_latency: float, max_streams: int):
+        self.api = api
+        self.handshake_latency = handshake_latency
+        self.max_streams = max_streams
+        self.connections = 0
+        self.requests = 0
+
+    async def _respond(self, path: str, headers: Dict[str, str], body: bytes, ready_at: float) -> Tuple[int, bytes]:
+        # A new connection pays for the TCP + TLS round trips to the real API once
+        delay = ready_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.requests += 1
+        api_method = path.rsplit('/', 1)[-1]
+        if api_method == 'fakeStats':
+            return 200, json.dumps({'ok': True, 'result': {
+                'connections': self.connections, 'requests': self.requests}}).encode()
+        return await self.api.answer(api_method, _parse_body(headers, body))
+
+    async def on_connection(self, reader, writer):
+        self.connections += 1
+        ready_at = asyncio.get_running_loop().time() + self.handshake_latency
+        ssl_object = writer.get_extra_info('ssl_object')
+        try:
+            if ssl_object is not None and ssl_object.selected_alpn_protocol() == 'h2':
+                await self._serve_h2(reader, writer, ready_at)
+            else:
+                await self._serve_http1(reader, writer, ready_at)
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_http1(self, reader, writer, ready_at: float):
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except asyncio.IncompleteReadError:
+                return  # client closed the keep-alive connection
+            lines = head.decode('latin-1').split('\r\n')
+            path = lines[0].split(' ')[1]
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length') or 0)
+            body = await reader.readexactly(length) if length else b''
+            status, payload = await self._respond(path, headers, body, ready_at)
+            writer.write(b'HTTP/1.1 %d OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\nConnection: keep-alive\r\n\r\n' % (status, len(payload)) + payload)
+            await writer.drain()
+
+    async def _serve_h2(self, reader, writer, ready_at: float):
+        import h2.config
+        import h2.events
+        import h2.connection
+        import h2.exceptions
+        from h2.settings import SettingCodes
+
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        conn.update_settings({SettingCodes.MAX_CONCURRENT_STREAMS: self.max_streams})
+        writer.write(conn.data_to_send())
+        streams: Dict[int, tuple] = {}
+        tasks = set()
+
+        async def respond(stream_id: int, headers: Dict[str, str], body: bytes):
+            status, payload = await self._respond(headers.get(':path', '/'), headers, body, ready_at)
+            try:
+                conn.send_headers(stream_id, [(':status', str(status)), ('content-type', 'application/json'),
+                                              ('content-length', str(len(payload)))])
+                conn.send_data(stream_id, payload, end_stream=True)
+                writer.write(conn.data_to_send())
+            except h2.exceptions.StreamClosedError:
+                pass
+
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        streams[event.stream_id] = (dict(event.headers), bytearray())
+                    elif isinstance(event, h2.events.DataReceived):
+                        streams[event.stream_id][1].extend(event.data)
+                        conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = streams.pop(event.stream_id)
+                        task = asyncio.create_task(respond(event.stream_id, headers, bytes(body)))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                writer.write(conn.data_to_send())
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def _serve(pipe, latency: float, handshake_latency: float, max_streams: int):
+    async def run():
+        directory = tempfile.mkdtemp(prefix='fake-bot-api-')
+        cert_path, key_path = _self_signed_cert(directory)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert_path, key_path)
+        context.set_alpn_protocols(['h2', 'http/1.1'])
+        handler = _ServerProcess(FakeBotRequest(latency=latency), handshake_latency, max_streams)
+        server = await asyncio.start_server(handler.on_connection, '127.0.0.1', 0, ssl=context, backlog=4096)
+        pipe.send((server.sockets[0].getsockname()[1], cert_path))
+        # Runs until the parent asks it to stop
+        await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+        server.close()
+
+    asyncio.run(run())
+
+
+class FakeBotServer:
+    """The fake Bot API behind a real TLS socket, in a child process so it doesn't share the GIL"""
+
+    def __init__(self, latency: float = 0.0, handshake_latency: float = 0.0, max_streams: int = 100):
+        self.latency = latency
+        self.handshake_latency = handshake_latency
+        self.max_streams = max_streams
+        self.base_url = ''
+        self.cert_path = ''
+        self._process = None
+        self._pipe = None
+
+    def start(self) -> str:
+        """Start the server; returns the base URL (https://127.0.0.1:<port>/bot)"""
+        context = multiprocessing.get_context('spawn')
+        self._pipe, child = context.Pipe()
+        self._process = context.Process(
+            target=_serve, args=(child, self.latency, self.handshake_latency, self.max_streams), daemon=True)
+        self._process.start()
+        port, self.cert_path = self._pipe.recv()
+        self.base_url = f"https://127.0.0.1:{port}/bot"
+        return self.base_url
+
+    def client_ssl_context(self) -> ssl.SSLContext:
+        """A client context trusting the server's throwaway certificate"""
+        return ssl.create_default_context(cafile=self.cert_path)
+
+    def stop(self):
+        if self._process is not None:
+            self._pipe.send('stop')
+            self._process.join(timeout=5)
+            self._process = None
@@ -0,0 +1,467 @@
+"""
+Cash Points Fake Firestore
+In-memory stand-in for the Firestore client used by replay.py.
+
+- Covers the calls the bots make: collection/document get, set, update,
+  create, add, where/order_by/limit/start_after queries, batches
+- on_snapshot watches that deliver ADDED / MODIFIED / REMOVED changes
+  synchronously after each write; close() simulates a dropped stream
+- Applies Increment / ArrayUnion / ArrayRemove / DELETE_FIELD transforms,
+  inside nested maps too; set(merge=True) merges maps field by field
+- Document update times and write_option(last_update_time=...) preconditions
+  on update(), alone or in a batch, for compare-and-set writes; batch commits
+  return a write result (with the update time) per write
+- Counts every backend call by operation and collection, and billed document
+  reads (`doc_reads`: one per document returned, at least one per query)
+- Optional per-call latency and transient failure injection for brown-out runs
+"""
+
+import time
+import random
+import threading
+from enum import Enum
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Dict, Any, List, NamedTuple
+
+from google.api_core.exceptions import NotFound, AlreadyExists, ServiceUnavailable, FailedPrecondition
+
+_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _apply_transforms(current: Dict[str, Any], fields: Dict[str, Any], merge: bool = False) -> Dict[str, Any]:
+    data = dict(current)
+    for key, value in fields.items():
+        kind = type(value).__name__
+        if isinstance(value, dict):
+            # Maps replace the field, except under set(merge=True) where they merge
+            existing = data.get(key) if merge and isinstance(data.get(key), dict) else {}
+            data[key] = _apply_transforms(existing, value, merge)
+        elif kind == 'Increment':
+            data[key] = (data.get(key) or 0) + value.value
+        elif kind == 'ArrayUnion':
+            existing = list(data.get(key) or [])
+            data[key] = existing + [v for v in value.values if v not in existing]
+        elif kind == 'ArrayRemove':
+            data[key] = [v for v in (data.get(key) or []) if v not in value.values]
+        elif kind == 'Sentinel' and 'delete' in str(getattr(value, 'description', '')).lower():
+            data.pop(key, None)
+        elif kind == 'Sentinel':
+            data[key] = time.time()  # SERVER_TIMESTAMP
+        else:
+            data[key] = value
+    return data
+
+
+class FakeWriteOption(NamedTuple):
+    last_update_time: Optional[datetime] = None
+
+
+class FakeWriteResult(NamedTuple):
+    update_time: datetime
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: 'FakeDocumentReference', data: Optional[Dict[str, Any]],
+                 update_time: Optional[datetime] = None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class ChangeType(Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class FakeDocumentChange:
+    def __init__(self, type: ChangeType, document: FakeDocumentSnapshot):
+        self.type = type
+        self.document = document
+
+
+class FakeWatch:
+    """Query listener; callbacks run in the writer's thread"""
+
+    def __init__(self, query: 'FakeQuery', callback):
+        self._query = query
+        self._callback = callback
+        self.is_active = True
+
+    def _matches(self, data: Optional[Dict[str, Any]]) -> bool:
+        return data is not None and all(_OPS[op](data.get(field), value)
+                                        for field, op, value in self._query._filters)
+
+    def _change(self, doc_id: str, old: Optional[Dict], new: Optional[Dict]) -> Optional[FakeDocumentChange]:
+        was, now = self._matches(old), self._matches(new)
+        if not was and not now:
+            return None
+        kind = ChangeType.MODIFIED if was and now else ChangeType.ADDED if now else ChangeType.REMOVED
+        ref = FakeDocumentReference(self._query._client, self._query._collection, doc_id)
+        return FakeDocumentChange(kind, FakeDocumentSnapshot(ref, dict(new if now else old)))
+
+    def _deliver(self, changes: List[FakeDocumentChange], initial: bool = False):
+        if self.is_active and (changes or initial):
+            client, collection = self._query._client, self._query._collection
+            docs = [FakeDocumentSnapshot(FakeDocumentReference(client, collection, doc_id), data)
+                    for doc_id, data in client._scan(collection, self._query._filters)]
+            self._callback(docs, changes, datetime.now(timezone.utc))
+
+    def close(self, reason=None):
+        self.unsubscribe()
+
+    def unsubscribe(self):
+        self.is_active = False
+        with self._query._client._lock:
+            watches = self._query._client._watches
+            if self in watches:
+                watches.remove(self)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: 'FakeFirestore', collection: str, doc_id: str):
+        self._client = client
+        self.collection_name = collection
+        self.id = doc_id
+        self.path = f"{collection}/{doc_id}"
+
+    def get(self, **kwargs) -> FakeDocumentSnapshot:
+        self._client._call('get', self.collection_name)
+        self._client._billed(self.collection_name, 1)
+        with self._client._lock:
+            return FakeDocumentSnapshot(self, self._client._read(self.collection_name, self.id),
+                                        self._client._update_times.get((self.collection_name, self.id)))
+
+    def set(self, data: Dict[str, Any], merge: bool = False, **kwargs):
+        self._client._call('set', self.collection_name)
+        self._client._write([('set', self, data, merge)])
+
+    def update(self, data: Dict[str, Any], option: Optional[FakeWriteOption] = None, **kwargs):
+        self._client._call('update', self.collection_name)
+        self._client._write([('update', self, data, False, option)])
+
+    def create(self, data: Dict[str, Any], **kwargs):
+        self._client._call('create', self.collection_name)
+        self._client._write([('create', self, data, False)])
+
+    def delete(self, **kwargs):
+        self._client._call('delete', self.collection_name)
+        self._client._write([('delete', self, None, False)])
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeQuery:
+    def __init__(self, client: 'FakeFirestore', collection: str, filters=(), order=(),
+                 limit_count: Optional[int] = None, cursor: Optional[tuple] = None):
+        self._client = client
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._order = tuple(order)
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> 'FakeQuery':
+        state = {'filters': self._filters, 'order': self._order,
+                 'limit_count': self._limit, 'cursor': self._cursor}
+        state.update(changes)
+        return FakeQuery(self._client, self._collection, **state)
+
+    def where(self, field: str = None, op: str = None, value=None, filter=None) -> 'FakeQuery':
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return self._copy(order=self._order + ((field, str(direction).upper().startswith('DESC')),))
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return self._copy(limit_count=count)
+
+    def start_after(self, document) -> 'FakeQuery':
+        return self._copy(cursor=self._sort_key(document.id, document.to_dict() or {}))
+
+    def _sort_key(self, doc_id: str, data: Dict[str, Any]) -> tuple:
+        return tuple(doc_id if field == '__name__' else data.get(field) for field, _ in self._order)
+
+    def _after_cursor(self, key: tuple) -> bool:
+        # Lexicographic, honouring each field's direction
+        for value, cursor, (_, descending) in zip(key, self._cursor, self._order):
+            if value != cursor:
+                return (value < cursor) if descending else (value > cursor)
+        return False
+
+    def stream(self, **kwargs):
+        self._client._call('query', self._collection)
+        rows = self._client._scan(self._collection, self._filters, with_times=True)
+        if self._order:
+            for index in range(len(self._order) - 1, -1, -1):
+                field, descending = self._order[index]
+                rows.sort(key=lambda item: ((item[0] if field == '__name__' else item[1].get(field)) is None,
+                                            item[0] if field == '__name__' else item[1].get(field)),
+                          reverse=descending)
+            if self._cursor is not None:
+                rows = [r for r in rows if self._after_cursor(self._sort_key(r[0], r[1]))]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        self._client._billed(self._collection, max(1, len(rows)))
+        for doc_id, data, update_time in rows:
+            ref = FakeDocumentReference(self._client, self._collection, doc_id)
+            yield FakeDocumentSnapshot(ref, dict(data), update_time)
+
+    def get(self, **kwargs) -> List[FakeDocumentSnapshot]:
+        return list(self.stream())
+
+    def on_snapshot(self, callback) -> FakeWatch:
+        watch = FakeWatch(self, callback)
+        with self._client._lock:
+            self._client._watches.append(watch)
+        rows = self._client._scan(self._collection, self._filters)
+        watch._deliver([FakeDocumentChange(ChangeType.ADDED, FakeDocumentSnapshot(
+            FakeDocumentReference(self._client, self._collection, doc_id), data)) for doc_id, data in rows],
+            initial=True)
+        return watch
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: 'FakeFirestore', name: str):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, doc_id: str = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self._collection, doc_id or self._client._new_id())
+
+    def add(self, data: Dict[str, Any], **kwargs):
+        ref = self.document()
+        self._client._call('add', self._collection)
+        self._client._write([('create', ref, data, False)])
+        return time.time(), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, client: 'FakeFirestore'):
+        self._client = client
+        self._writes = []
+
+    def set(self, ref: FakeDocumentReference, data: Dict[str, Any], merge: bool = False):
+        self._writes.append(('set', ref, data, merge))
+
+    def update(self, ref: FakeDocumentReference, data: Dict[str, Any], option: Optional[FakeWriteOption] = None):
+        self._writes.append(('update', ref, data, False, option))
+
+    def create(self, ref: FakeDocumentReference, data: Dict[str, Any]):
+        self._writes.append(('create', ref, data, False))
+
+    def delete(self, ref: FakeDocumentReference):
+        self._writes.append(('delete', ref, None, False))
+
+    def commit(self, **kwargs):
+        self._client._call('commit', 'batch')
+        with self._client._lock:
+            self._client.counts['batch_writes'] += len(self._writes)
+        commit_time = self._client._write(self._writes)
+        results = [FakeWriteResult(commit_time) for _ in self._writes]
+        self._writes = []
+        return results
+
+
+class FakeFirestore:
+    """Thread-safe in-memory Firestore with call counting"""
+
+    project = 'fake-project'
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 1):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._data: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._indexes: Dict[tuple, Dict[Any, set]] = {}
+        self._lock = threading.RLock()
+        self._next_id = 0
+        self._watches: List[FakeWatch] = []
+        self._update_times: Dict[tuple, datetime] = {}
+        self._last_commit = datetime.min.replace(tzinfo=timezone.utc)
+        self.counts: Counter = Counter()
+
+    # ---- Client surface ---------------------------------------------------
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def document(self, path: str) -> FakeDocumentReference:
+        collection, doc_id = path.rsplit('/', 1)
+        return FakeDocumentReference(self, collection, doc_id)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    @staticmethod
+    def write_option(last_update_time: Optional[datetime] = None, **kwargs) -> FakeWriteOption:
+        return FakeWriteOption(last_update_time)
+
+    # ---- Seeding / inspection --------------------------------------------
+
+    def seed(self, collection: str, doc_id: str, data: Dict[str, Any]):
+        """Insert a document without counting it as a backend call"""
+        self._write([('set', FakeDocumentReference(self, collection, doc_id), data, False)])
+
+    def dump(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {doc_id: dict(data) for doc_id, data in self._data.get(collection, {}).items()}
+
+    def call_counts(self) -> Dict[str, int]:
+        return dict(self.counts)
+
+    # ---- Internals --------------------------------------------------------
+
+    def _new_id(self) -> str:
+        with self._lock:
+            self._next_id += 1
+            return f"fake{self._next_id:012d}"
+
+    def _call(self, op: str, collection: str):
+        with self._lock:
+            self.counts[op] += 1
+            self.counts[f"{op}:{collection}"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self._rng.random() < self.failure_rate:
+            with self._lock:
+                self.counts['injected_failures'] += 1
+            raise ServiceUnavailable('Injected backend failure')
+
+    def _billed(self, collection: str, reads: int):
+        with self._lock:
+            self.counts['doc_reads'] += reads
+            self.counts[f"doc_reads:{collection}"] += reads
+
+    def _read(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            data = self._data.get(collection, {}).get(doc_id)
+            return dict(data) if data is not None else None
+
+    def _index(self, collection: str, field: str) -> Dict[Any, set]:
+        key = (collection, field)
+        index = self._indexes.get(key)
+        if index is None:
+            index = {}
+            for doc_id, data in self._data.get(collection, {}).items():
+                self._index_add(index, data.get(field), doc_id)
+            self._indexes[key] = index
+        return index
+
+    @staticmethod
+    def _index_add(index: Dict[Any, set], value, doc_id: str):
+        try:
+            index.setdefault(value, set()).add(doc_id)
+        except TypeError:
+            pass  # unhashable values are only found by scanning
+
+    def _reindex(self, collection: str, doc_id: str, old: Optional[Dict], new: Optional[Dict]):
+        for (indexed_collection, field), index in self._indexes.items():
+            if indexed_collection != collection:
+                continue
+            if old is not None:
+                try:
+                    index.get(old.get(field), set()).discard(doc_id)
+                except TypeError:
+                    pass
+            if new is not None:
+                self._index_add(index, new.get(field), doc_id)
+
+    def _scan(self, collection: str, filters, with_times: bool = False) -> List[tuple]:
+        with self._lock:
+            docs = self._data.get(collection, {})
+            candidates = None
+            for field, op, value in filters:
+                if op in ('==', 'in'):
+                    try:
+                        index = self._index(collection, field)
+                        values = value if op == 'in' else [value]
+                        candidates = set().union(*(index.get(v, set()) for v in values))
+                    except TypeError:
+                        continue
+                    break
+            ids = sorted(candidates) if candidates is not None else list(docs)
+            rows = []
+            for doc_id in ids:
+                data = docs.get(doc_id)
+                if data is None:
+                    continue
+                if all(_OPS[op](data.get(field), value) for field, op, value in filters):
+                    if with_times:
+                        rows.append((doc_id, dict(data), self._update_times.get((collection, doc_id))))
+                    else:
+                        rows.append((doc_id, dict(data)))
+            return rows
+
+    def _write(self, writes):
+        """Apply writes atomically: validate everything first, then commit"""
+        with self._lock:
+            staged = {}
+            for kind, ref, data, merge, *option in writes:
+                path = (ref.collection_name, ref.id)
+                if option and option[0] is not None and option[0].last_update_time is not None:
+                    if self._update_times.get(path) != option[0].last_update_time:
+                        raise FailedPrecondition(f"Document changed since it was read: {ref.path}")
+                current = staged[path] if path in staged else self._read(*path)
+                if kind == 'create':
+                    if current is not None:
+                        raise AlreadyExists(f"Document already exists: {ref.path}")
+                    staged[path] = _apply_transforms({}, data)
+                elif kind == 'update':
+                    if current is None:
+                        raise NotFound(f"No document to update: {ref.path}")
+                    staged[path] = _apply_transforms(current, data)
+                elif kind == 'set':
+                    staged[path] = _apply_transforms((current or {}) if merge else {}, data, merge)
+                else:
+                    staged[path] = None
+            notify = {}
+            # Strictly increasing, like the server's commit times
+            commit_time = max(datetime.now(timezone.utc), self._last_commit + timedelta(microseconds=1))
+            self._last_commit = commit_time
+            for (collection, doc_id), data in staged.items():
+                docs = self._data.setdefault(collection, {})
+                old = docs.get(doc_id)
+                if data is None:
+                    docs.pop(doc_id, None)
+                    self._update_times.pop((collection, doc_id), None)
+                else:
+                    docs[doc_id] = data
+                    self._update_times[(collection, doc_id)] = commit_time
+                self._reindex(collection, doc_id, old, data)
+                for watch in self._watches:
+                    if watch._query._collection == collection:
+                        change = watch._change(doc_id, old, data)
+                        if change:
+                            notify.setdefault(watch, []).append(change)
+        for watch, changes in notify.items():
+            watch._deliver(changes)
+        return commit_time
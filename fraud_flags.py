@@ -0,0 +1,72 @@
+"""
+Cash Points Fraud Flags
+Cached lookup of `referral_fraud_flags/{referrer_id}` (written by
+fraud_scoring.py) that the reward paths consult before paying a referral.
+"""
+
+import time
+import logging
+from typing import Optional, Dict
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+FLAGS_COLLECTION = 'referral_fraud_flags'
+
+
+class FraudFlagCache:
+    """TTL cache over `referral_fraud_flags` consulted before paying rewards"""
+
+    def __init__(self, ttl_seconds: int = None):
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else config.FRAUD_FLAG_CACHE_TTL
+        self._entries: Dict[str, tuple] = {}
+
+    def is_flagged(self, db, referrer_id: str) -> bool:
+        """Return True when the referrer is currently flagged (False on lookup errors)"""
+        if not db:
+            return False
+        referrer_id = str(referrer_id)
+        cached = self._entries.get(referrer_id)
+        now = time.monotonic()
+        if cached and now - cached[1] < self.ttl_seconds:
+            return cached[0]
+        try:
+            doc = db.collection(FLAGS_COLLECTION).document(referrer_id).get()
+            flagged = bool(doc.exists and (doc.to_dict() or {}).get('flagged'))
+        except Exception as e:
+            logger.warning(f"Fraud flag lookup failed for {referrer_id} (allowing reward): {e}")
+            return False
+        self._entries[referrer_id] = (flagged, now)
+        return flagged
+
+    def put(self, referrer_id: str, flagged: bool):
+        """Record a flag learned elsewhere (e.g. from a snapshot listener)"""
+        self._entries[str(referrer_id)] = (flagged, time.monotonic())
+
+    def export(self) -> list:
+        """Fresh entries as [referrer_id, flagged, age in seconds] (for warm restarts)"""
+        now = time.monotonic()
+        return [[referrer_id, flagged, now - fetched_at] for referrer_id, (flagged, fetched_at)
+                in list(self._entries.items()) if now - fetched_at < self.ttl_seconds]
+
+    def restore(self, entries: list, elapsed: float = 0.0) -> int:
+        """Load export() output, aged by the time spent down; returns entries kept"""
+        now = time.monotonic()
+        kept = 0
+        for referrer_id, flagged, age in entries:
+            age += elapsed
+            if age < self.ttl_seconds and referrer_id not in self._entries:
+                self._entries[referrer_id] = (flagged, now - age)
+                kept += 1
+        return kept
+
+    def invalidate(self, referrer_id: Optional[str] = None):
+        if referrer_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(referrer_id), None)
+
+
+# Shared cache for the reward paths
+fraud_flags = FraudFlagCache()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Cash Points Referral Fraud Scoring
+Features:
+- Loads the referrals edge list into compact NumPy arrays
+- Vectorized per-referrer features: burst rate, rejoin ratio, leave ratio,
+  referral-ring (cycle) membership and verification latency distribution
+- Writes flags to `referral_fraud_flags/{referrer_id}` for the reward engine
+
+Usage:
+    python fraud_scoring.py              # score Firestore referrals and write flags
+    python fraud_scoring.py --dry-run    # score and print, write nothing
+    python fraud_scoring.py --synthetic 1000000
+"""
+
+import time
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterable, List
+
+import numpy as np
+
+from config import config
+from fraud_flags import FLAGS_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+# Feature thresholds
+BURST_WINDOW_SECONDS = 10        # referred accounts created this close together count as a burst
+FAST_VERIFY_SECONDS = 3          # group join verified faster than a human plausibly can
+MIN_REFERRALS_TO_SCORE = 5       # small referrers are never flagged on ratios alone
+FLAG_THRESHOLD = 0.6
+
+# Feature weights (sum to 1.0); ring membership flags on its own
+WEIGHTS = {
+    'burst_rate': 0.30,
+    'rejoin_ratio': 0.25,
+    'leave_ratio': 0.25,
+    'fast_verify_ratio': 0.20,
+}
+
+
+def _epoch(value) -> float:
+    """Convert a Firestore timestamp to epoch seconds (NaN when missing)"""
+    if value is None:
+        return np.nan
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return np.nan
+
+
+class EdgeArrays:
+    """Referral edge list held as parallel NumPy arrays"""
+
+    def __init__(self, referrer, referred, created_at, verified_at, rejoin_count, left):
+        self.referrer = np.asarray(referrer, dtype=np.int64)
+        self.referred = np.asarray(referred, dtype=np.int64)
+        self.created_at = np.asarray(created_at, dtype=np.float64)
+        self.verified_at = np.asarray(verified_at, dtype=np.float64)
+        self.rejoin_count = np.asarray(rejoin_count, dtype=np.int32)
+        self.left = np.asarray(left, dtype=np.bool_)
+
+    def __len__(self):
+        return len(self.referrer)
+
+    @classmethod
+    def from_rows(cls, pages: Iterable[List[Dict[str, Any]]]) -> 'EdgeArrays':
+        """Build arrays from pages of referral dicts, one page in Python at a time"""
+        chunks = []
+        for rows in pages:
+            referrer = np.empty(len(rows), dtype=np.int64)
+            referred = np.empty(len(rows), dtype=np.int64)
+            created_at = np.empty(len(rows), dtype=np.float64)
+            verified_at = np.empty(len(rows), dtype=np.float64)
+            rejoin_count = np.zeros(len(rows), dtype=np.int32)
+            left = np.zeros(len(rows), dtype=np.bool_)
+            keep = np.ones(len(rows), dtype=np.bool_)
+            for i, row in enumerate(rows):
+                try:
+                    referrer[i] = int(row.get('referrer_id'))
+                    referred[i] = int(row.get('referred_id'))
+                except (TypeError, ValueError):
+                    keep[i] = False
+                    continue
+                created_at[i] = _epoch(row.get('created_at'))
+                verified_at[i] = _epoch(row.get('group_join_date') or row.get('last_join_date'))
+                rejoin_count[i] = row.get('rejoin_count') or 0
+                left[i] = row.get('is_active') is False or row.get('status') == 'left'
+            chunks.append((referrer[keep], referred[keep], created_at[keep],
+                           verified_at[keep], rejoin_count[keep], left[keep]))
+        if not chunks:
+            return cls([], [], [], [], [], [])
+        return cls(*(np.concatenate(parts) for parts in zip(*chunks)))
+
+
+def ring_members(referrer: np.ndarray, referred: np.ndarray) -> np.ndarray:
+    """Return the Telegram IDs that sit on a referral cycle (A→B→…→A)
+
+    Each referred user has at most one effective referrer, so the graph of
+    child→parent pointers is a functional graph. After 2^k ≥ n pointer
+    jumps every node lands on a cycle, and the image of that map is exactly
+    the set of cycle nodes.
+    """
+    if len(referrer) == 0:
+        return np.empty(0, dtype=np.int64)
+    ids, inverse = np.unique(np.concatenate([referrer, referred]), return_inverse=True)
+    n = len(ids)
+    parent_idx = inverse[:len(referrer)]
+    child_idx = inverse[len(referrer):]
+
+    sentinel = n
+    jump = np.full(n + 1, sentinel, dtype=np.int64)
+    jump[child_idx] = parent_idx
+    steps = 1
+    while steps <= n:
+        jump = jump[jump]
+        steps *= 2
+    on_cycle = np.unique(jump[:n])
+    on_cycle = on_cycle[on_cycle != sentinel]
+    return ids[on_cycle]
+
+
+def score_edges(edges: EdgeArrays) -> Dict[str, np.ndarray]:
+    """Compute per-referrer features and scores, fully vectorized"""
+    if len(edges) == 0:
+        empty_f = np.empty(0, dtype=np.float64)
+        return {'referrer_id': np.empty(0, dtype=np.int64), 'referrals': np.empty(0, dtype=np.int64),
+                'burst_rate': empty_f, 'rejoin_ratio': empty_f, 'leave_ratio': empty_f,
+                'fast_verify_ratio': empty_f, 'median_verify_seconds': empty_f,
+                'in_ring': np.empty(0, dtype=np.bool_), 'score': empty_f,
+                'flagged': np.empty(0, dtype=np.bool_)}
+
+    # Group edges by referrer, ordered by creation time within each group
+    order = np.lexsort((edges.created_at, edges.referrer))
+    referrer = edges.referrer[order]
+    created_at = edges.created_at[order]
+    referrer_ids, starts, counts = np.unique(referrer, return_index=True, return_counts=True)
+    group = np.repeat(np.arange(len(referrer_ids)), counts)
+
+    # Burst rate: consecutive referrals of the same referrer within the window
+    gaps = np.diff(created_at)
+    same_group = group[1:] == group[:-1]
+    bursts = same_group & (gaps < BURST_WINDOW_SECONDS)
+    burst_counts = np.bincount(group[1:][bursts], minlength=len(referrer_ids))
+    burst_rate = burst_counts / np.maximum(counts - 1, 1)
+
+    rejoin_ratio = np.bincount(group, weights=(edges.rejoin_count[order] > 0),
+                               minlength=len(referrer_ids)) / counts
+    leave_ratio = np.bincount(group, weights=edges.left[order],
+                              minlength=len(referrer_ids)) / counts
+
+    # Verification latency distribution (verified edges only)
+    latency = edges.verified_at[order] - created_at
+    verified = ~np.isnan(latency)
+    verified_counts = np.bincount(group[verified], minlength=len(referrer_ids))
+    fast_counts = np.bincount(group[verified & (latency < FAST_VERIFY_SECONDS)],
+                              minlength=len(referrer_ids))
+    fast_verify_ratio = fast_counts / np.maximum(verified_counts, 1)
+
+    median_verify = np.full(len(referrer_ids), np.nan)
+    if verified.any():
+        v_group = group[verified]
+        v_latency = latency[verified]
+        v_order = np.lexsort((v_latency, v_group))
+        v_group, v_latency = v_group[v_order], v_latency[v_order]
+        v_ids, v_starts, v_counts = np.unique(v_group, return_index=True, return_counts=True)
+        median_verify[v_ids] = v_latency[v_starts + (v_counts - 1) // 2]
+
+    in_ring = np.isin(referrer_ids, ring_members(edges.referrer, edges.referred))
+
+    # Blend the weighted average with the strongest single signal so one
+    # blatant pattern (e.g. 500 referrals in 500 seconds) is enough to flag
+    features = np.vstack([burst_rate, rejoin_ratio, leave_ratio, fast_verify_ratio])
+    weighted = (WEIGHTS['burst_rate'] * burst_rate
+                + WEIGHTS['rejoin_ratio'] * rejoin_ratio
+                + WEIGHTS['leave_ratio'] * leave_ratio
+                + WEIGHTS['fast_verify_ratio'] * fast_verify_ratio)
+    score = 0.5 * weighted + 0.5 * features.max(axis=0)
+    score = np.where(counts >= MIN_REFERRALS_TO_SCORE, score, 0.0)
+    score = np.where(in_ring, 1.0, score)
+
+    return {
+        'referrer_id': referrer_ids,
+        'referrals': counts,
+        'burst_rate': burst_rate,
+        'rejoin_ratio': rejoin_ratio,
+        'leave_ratio': leave_ratio,
+        'fast_verify_ratio': fast_verify_ratio,
+        'median_verify_seconds': median_verify,
+        'in_ring': in_ring,
+        'score': score,
+        'flagged': score >= FLAG_THRESHOLD,
+    }
+
+
+def write_flags(db, scores: Dict[str, np.ndarray], batch_size: int = 500) -> Dict[str, int]:
+    """Write flag documents for flagged referrers and clear stale ones"""
+    flagged_idx = np.flatnonzero(scores['flagged'])
+    flagged_ids = {str(scores['referrer_id'][i]) for i in flagged_idx}
+    flags_ref = db.collection(FLAGS_COLLECTION)
+    now = datetime.now()
+
+    written = 0
+    batch = db.batch()
+    pending = 0
+    for i in flagged_idx:
+        median = scores['median_verify_seconds'][i]
+        batch.set(flags_ref.document(str(scores['referrer_id'][i])), {
+            'referrer_id': str(scores['referrer_id'][i]),
+            'flagged': True,
+            'score': round(float(scores['score'][i]), 4),
+            'referrals': int(scores['referrals'][i]),
+            'burst_rate': round(float(scores['burst_rate'][i]), 4),
+            'rejoin_ratio': round(float(scores['rejoin_ratio'][i]), 4),
+            'leave_ratio': round(float(scores['leave_ratio'][i]), 4),
+            'fast_verify_ratio': round(float(scores['fast_verify_ratio'][i]), 4),
+            'median_verify_seconds': None if np.isnan(median) else round(float(median), 2),
+            'in_ring': bool(scores['in_ring'][i]),
+            'scored_at': now,
+        })
+        pending += 1
+        written += 1
+        if pending >= batch_size:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    # Referrers that no longer cross the threshold get their flag cleared
+    cleared = 0
+    for doc in flags_ref.where('flagged', '==', True).stream():
+        if doc.id not in flagged_ids:
+            batch.update(doc.reference, {'flagged': False, 'scored_at': now})
+            pending += 1
+            cleared += 1
+            if pending >= batch_size:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+    if pending:
+        batch.commit()
+    return {'flagged': written, 'cleared': cleared}
+
+
+def synthetic_edges(total_edges: int, seed: int = 7) -> EdgeArrays:
+    """Generate a synthetic edge list with a few planted rings and burst referrers"""
+    rng = np.random.default_rng(seed)
+    referrers = total_edges // 20 + 1
+    referrer = 1_000_000_000 + rng.integers(0, referrers, total_edges)
+    referred = 2_000_000_000 + np.arange(total_edges, dtype=np.int64)
+    created_at = 1_735_689_600 + rng.uniform(0, 90 * 86400, total_edges)
+    verified_at = np.where(rng.random(total_edges) < 0.8,
+                           created_at + rng.exponential(600, total_edges), np.nan)
+    rejoin_count = (rng.random(total_edges) < 0.05).astype(np.int32)
+    left = rng.random(total_edges) < 0.1
+
+    # Plant a burst referrer and a three-account ring
+    burst = min(500, total_edges // 4)
+    referrer[:burst] = 999
+    created_at[:burst] = 1_735_689_600 + np.arange(burst)
+    if total_edges > burst + 3:
+        ring = np.array([3_000_000_001, 3_000_000_002, 3_000_000_003])
+        referrer[burst:burst + 3] = ring
+        referred[burst:burst + 3] = np.roll(ring, -1)
+    return EdgeArrays(referrer, referred, created_at, verified_at, rejoin_count, left)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score referrers for referral fraud')
+    parser.add_argument('--dry-run', action='store_true', help='Score only, do not write flags')
+    parser.add_argument('--page-size', type=int, default=config.EXPORT_PAGE_SIZE)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Score N synthetic edges instead of Firestore (implies --dry-run)')
+    parser.add_argument('--top', type=int, default=10, help='How many top scores to print')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    db = None
+    if args.synthetic:
+        edges = synthetic_edges(args.synthetic)
+    else:
+        from bot_firebase import db
+        from export_data import stream_pages
+        if not db:
+            print("❌ Firebase not connected")
+            return
+        edges = EdgeArrays.from_rows(stream_pages(db, 'referrals', args.page_size))
+    loaded = time.perf_counter()
+
+    scores = score_edges(edges)
+    scored = time.perf_counter()
+
+    print(f"📥 Loaded {len(edges)} edges in {loaded - started:.2f}s")
+    print(f"🧮 Scored {len(scores['referrer_id'])} referrers in {scored - loaded:.2f}s")
+    print(f"🚩 Flagged: {int(scores['flagged'].sum())} "
+          f"(ring members: {int(scores['in_ring'].sum())})")
+
+    top = np.argsort(-scores['score'])[:args.top]
+    for i in top:
+        print(f"   {scores['referrer_id'][i]}: score={scores['score'][i]:.2f} "
+              f"refs={scores['referrals'][i]} burst={scores['burst_rate'][i]:.2f} "
+              f"rejoin={scores['rejoin_ratio'][i]:.2f} leave={scores['leave_ratio'][i]:.2f} "
+              f"fast={scores['fast_verify_ratio'][i]:.2f} ring={bool(scores['in_ring'][i])}")
+
+    if args.dry_run or args.synthetic:
+        return
+    result = write_flags(db, scores)
+    print(f"✅ Flags written: {result['flagged']}, cleared: {result['cleared']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Cash Points Lookup Snapshot
+Read-only referral-code and user-flag tables shared by every worker process
+through one memory-mapped file.
+
+Features:
+- Fixed-width sorted arrays: 64-bit code hashes → Telegram IDs, and Telegram
+  IDs → flag bytes (banned / verified)
+- Built from users, referral_codes and referralCodes by a background job and
+  published atomically (write to a temp file, fsync, rename)
+- Workers mmap the file read-only and binary-search it in place: no warm-up
+  reads, and the pages are shared, so memory stays flat as workers are added
+- A newly published file is picked up on the next lookup after
+  LOOKUP_SNAPSHOT_CHECK_INTERVAL; old mappings go away with their last reader
+
+Only legacy codes are stored; v1 codes decode without any table.
+
+Usage:
+    python lookup_snapshot.py --build               # build from the live backend
+    python lookup_snapshot.py --code CP123456       # look up a code in the current file
+    python lookup_snapshot.py --bench 1000000 --workers 4
+"""
+
+import os
+import sys
+import mmap
+import time
+import struct
+import asyncio
+import hashlib
+import logging
+import argparse
+from array import array
+from bisect import bisect_left
+from typing import Optional, Dict, Any, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CPLS'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQQd')  # magic, version, codes, users, built_at
+HEADER_SIZE = 64
+
+BANNED = 1
+VERIFIED = 2
+
+
+def code_hash(code: str) -> int:
+    return int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), 'little')
+
+
+def write_snapshot(path: str, codes: Dict[str, int], users: Dict[int, int], built_at: float = None) -> int:
+    """Write and atomically publish a snapshot; returns its size in bytes"""
+    if sys.byteorder != 'little':
+        raise RuntimeError("Lookup snapshots are little-endian only")
+    by_hash: Dict[int, int] = {}
+    collisions = set()
+    for code, owner in codes.items():
+        h = code_hash(code)
+        if h in by_hash and by_hash[h] != int(owner):
+            collisions.add(h)  # ambiguous: leave those codes to the database
+        by_hash[h] = int(owner)
+    for h in collisions:
+        del by_hash[h]
+    hashes = sorted(by_hash)
+    user_ids = sorted(users)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(hashes), len(user_ids),
+                            built_at or time.time()).ljust(HEADER_SIZE, b'\0'))
+        f.write(array('Q', hashes).tobytes())
+        f.write(array('Q', (by_hash[h] for h in hashes)).tobytes())
+        f.write(array('Q', user_ids).tobytes())
+        f.write(bytes(users[u] for u in user_ids))
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    os.replace(tmp_path, path)
+    return size
+
+
+class _Mapping:
+    """One mapped snapshot file; views index straight into the mapped pages"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key = (stat.st_ino, stat.st_mtime_ns)
+        magic, version, codes, users, self.built_at = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a v{FORMAT_VERSION} lookup snapshot")
+        view = memoryview(self.mm)
+        offset = HEADER_SIZE
+        self.hashes = view[offset:offset + 8 * codes].cast('Q')
+        offset += 8 * codes
+        self.owners = view[offset:offset + 8 * codes].cast('Q')
+        offset += 8 * codes
+        self.user_ids = view[offset:offset + 8 * users].cast('Q')
+        offset += 8 * users
+        self.flags = view[offset:offset + users]
+        self.size = len(self.mm)
+
+
+class LookupSnapshot:
+    """Zero-copy lookups against the published snapshot file"""
+
+    def __init__(self, path: str = None, check_interval: float = None):
+        self.path = path or config.LOOKUP_SNAPSHOT_PATH
+        self.check_interval = check_interval if check_interval is not None else config.LOOKUP_SNAPSHOT_CHECK_INTERVAL
+        self._mapping: Optional[_Mapping] = None
+        self._checked_at = float('-inf')
+        self.reloads = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self) -> Optional[_Mapping]:
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self._mapping
+            if self._mapping is None or self._mapping.key != (stat.st_ino, stat.st_mtime_ns):
+                try:
+                    # Readers still holding the old mapping keep it alive until they finish
+                    self._mapping = _Mapping(self.path)
+                    self.reloads += 1
+                    logger.info(f"🗺️ Mapped lookup snapshot {self.path} "
+                                f"({len(self._mapping.hashes)} codes, {len(self._mapping.user_ids)} users)")
+                except (OSError, ValueError, struct.error) as e:
+                    logger.warning(f"Lookup snapshot {self.path} unusable: {e}")
+        return self._mapping
+
+    @property
+    def available(self) -> bool:
+        return self._current() is not None
+
+    def code_owner(self, code: str) -> Optional[str]:
+        """Telegram ID owning a legacy code, or None if the snapshot doesn't know it"""
+        mapping = self._current()
+        if mapping is None:
+            return None
+        h = code_hash(code)
+        i = bisect_left(mapping.hashes, h)
+        if i < len(mapping.hashes) and mapping.hashes[i] == h:
+            self.hits += 1
+            return str(mapping.owners[i])
+        self.misses += 1
+        return None
+
+    def user_flags(self, user_id) -> Optional[int]:
+        """Flag bits for a user, or None if the user isn't in the snapshot"""
+        mapping = self._current()
+        if mapping is None:
+            return None
+        user_id = int(user_id)
+        i = bisect_left(mapping.user_ids, user_id)
+        if i < len(mapping.user_ids) and mapping.user_ids[i] == user_id:
+            return mapping.flags[i]
+        return None
+
+    def is_banned(self, user_id) -> bool:
+        return bool((self.user_flags(user_id) or 0) & BANNED)
+
+    def is_verified(self, user_id) -> bool:
+        return bool((self.user_flags(user_id) or 0) & VERIFIED)
+
+    def stats(self) -> Dict[str, Any]:
+        mapping = self._mapping
+        return {
+            'available': mapping is not None,
+            'codes': len(mapping.hashes) if mapping else 0,
+            'users': len(mapping.user_ids) if mapping else 0,
+            'bytes': mapping.size if mapping else 0,
+            'age': time.time() - mapping.built_at if mapping else None,
+            'reloads': self.reloads,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+snapshot = LookupSnapshot()
+
+
+def collect_tables(db, page_size: int = 1000) -> Tuple[Dict[str, int], Dict[int, int]]:
+    """Read legacy codes and user flags from Firestore"""
+    import referral_codes
+
+    codes: Dict[str, int] = {}
+    users: Dict[int, int] = {}
+    query = db.collection('users').order_by('__name__').limit(page_size)
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page_query.stream())
+        for doc in docs:
+            data = doc.to_dict() or {}
+            try:
+                user_id = int(data.get('telegram_id') or doc.id)
+            except (TypeError, ValueError):
+                continue
+            users[user_id] = (BANNED if data.get('is_banned') else 0) | (VERIFIED if data.get('is_verified') else 0)
+            for code in [data.get('referral_code')] + list(data.get('legacy_referral_codes') or []):
+                if code and not referral_codes.decode(code):
+                    codes.setdefault(code, user_id)
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+
+    # Users' own codes win over the standalone code collections
+    for collection, code_of in (('referral_codes', lambda doc, data: data.get('referral_code')),
+                                ('referralCodes', lambda doc, data: doc.id)):
+        for doc in db.collection(collection).where('is_active', '==', True).stream():
+            data = doc.to_dict() or {}
+            code = code_of(doc, data)
+            try:
+                owner = int(data.get('user_id'))
+            except (TypeError, ValueError):
+                continue
+            if code and not referral_codes.decode(code):
+                codes.setdefault(code, owner)
+    return codes, users
+
+
+def build_snapshot(db, path: str = None) -> Dict[str, Any]:
+    path = path or config.LOOKUP_SNAPSHOT_PATH
+    started = time.perf_counter()
+    codes, users = collect_tables(db)
+    size = write_snapshot(path, codes, users)
+    elapsed = time.perf_counter() - started
+    logger.info(f"🗺️ Published lookup snapshot {path}: {len(codes)} codes, {len(users)} users, "
+                f"{size / 1e6:.1f} MB in {elapsed:.1f}s")
+    return {'codes': len(codes), 'users': len(users), 'bytes': size, 'seconds': elapsed}
+
+
+async def run_builder(get_db, interval: float = None):
+    """Rebuild the snapshot periodically (run this in one process only)"""
+    interval = interval or config.LOOKUP_SNAPSHOT_BUILD_INTERVAL
+    while True:
+        db = get_db()
+        if db is not None:
+            try:
+                await asyncio.to_thread(build_snapshot, db)
+            except Exception as e:
+                logger.warning(f"Lookup snapshot build failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def _rss_anon_kb() -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _bench_worker(args):
+    mode, path, codes, users, lookups = args
+    import random
+    rng = random.Random(os.getpid())
+    before = _rss_anon_kb()
+    started = time.perf_counter()
+    if mode == 'dict':
+        # What each worker does today: load its own tables
+        table = {f"CP{1000000 + i}": 1000000 + i for i in range(codes)}
+        flags = {1000000 + i: i % 3 for i in range(users)}
+        lookup = table.get
+        flags.get(1000000)
+    else:
+        snap = LookupSnapshot(path, check_interval=3600)
+        lookup = snap.code_owner
+        snap.user_flags(1000000)
+    warmup = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(lookups):
+        lookup(f"CP{1000000 + rng.randrange(codes)}")
+    rate = lookups / (time.perf_counter() - started)
+    return _rss_anon_kb() - before, warmup, rate
+
+
+def run_benchmark(codes: int, workers: int, lookups: int = 200_000):
+    import tempfile
+    from multiprocessing import Pool
+
+    path = os.path.join(tempfile.mkdtemp(), 'lookup.snapshot')
+    started = time.perf_counter()
+    size = write_snapshot(path, {f"CP{1000000 + i}": 1000000 + i for i in range(codes)},
+                          {1000000 + i: i % 3 for i in range(codes)})
+    print(f"Built {codes} codes / users: {size / 1e6:.1f} MB in {time.perf_counter() - started:.1f}s")
+    for mode in ('dict', 'mmap'):
+        with Pool(workers) as pool:
+            results = pool.map(_bench_worker, [(mode, path, codes, codes, lookups)] * workers)
+        private = sum(r[0] for r in results) / 1024
+        print(f"{mode:5} x{workers}: {private:.0f} MB private memory in total, "
+              f"warm-up {max(r[1] for r in results):.2f}s, "
+              f"{sum(r[2] for r in results) / workers:,.0f} lookups/s per worker")
+    os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory-mapped lookup snapshot')
+    parser.add_argument('--build', action='store_true', help='Build and publish from the live backend')
+    parser.add_argument('--code', help='Look up a legacy referral code in the current snapshot')
+    parser.add_argument('--user', help='Print the flags of a Telegram user in the current snapshot')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark N codes across worker processes')
+    parser.add_argument('--workers', type=int, default=4, help='Benchmark worker processes')
+    parser.add_argument('--path', default=None, help='Snapshot file (default LOOKUP_SNAPSHOT_PATH)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.bench:
+        run_benchmark(args.bench, args.workers)
+    elif args.build:
+        from bot_firebase import db
+        build_snapshot(db, args.path)
+    elif args.code or args.user:
+        snap = LookupSnapshot(args.path)
+        if args.code:
+            print(snap.code_owner(args.code) or "not in snapshot")
+        if args.user:
+            flags = snap.user_flags(args.user)
+            print("not in snapshot" if flags is None else
+                  f"banned={bool(flags & BANNED)} verified={bool(flags & VERIFIED)}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
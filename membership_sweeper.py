@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Cash Points Membership Sweeper
+Background re-verification of group membership.
+
+Features:
+- Walks verified referrals, then pending withdrawal requests, in doc-id order
+  with a cursor persisted locally, so a restart resumes where it stopped
+- Checks membership with bounded concurrency under the shared Bot API rate
+  governor (background share only)
+- Skips users confirmed recently, by the sweep or by an interactive check
+- Records status changes in group_membership_verification and flags referrals
+  and withdrawal requests of users who left; optionally reverses the referral
+  reward (MEMBERSHIP_REVOKE_LEFT_REFERRALS)
+- Paces itself to finish within MEMBERSHIP_SWEEP_BUDGET and reports progress
+
+Usage:
+    python membership_sweeper.py --once
+    python membership_sweeper.py --bench 1000000 --budget 600
+"""
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Iterable
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+from telegram.error import RetryAfter, BadRequest, Forbidden, TimedOut, NetworkError
+
+from config import config
+import resilience
+from rate_governor import governor as shared_governor
+from session_cache import sessions
+from models import Earning
+from earnings_ledger import ledger as earnings_ledger
+
+logger = logging.getLogger(__name__)
+
+VERIFICATION_COLLECTION = 'group_membership_verification'
+
+# membership_status values (same as the Supabase schema)
+VERIFIED = 'verified'
+LEFT = 'left'
+BANNED = 'banned'
+
+# getChatMember errors that mean the user is simply not in the group
+NOT_A_MEMBER_ERRORS = ('user not found', 'participant_id_invalid', 'member not found')
+
+# (collection, user id field, status to sweep)
+PHASES = (
+    ('referrals', 'referred_id', 'verified'),
+    ('withdrawal_requests', 'user_id', 'pending'),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS membership (
+    user_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sweep_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def membership_status(member) -> str:
+    """Map a Telegram ChatMember to a membership_status"""
+    if member.status in ('member', 'administrator', 'creator'):
+        return VERIFIED
+    if member.status == 'restricted':
+        # Restricted users may or may not still be in the chat
+        return VERIFIED if getattr(member, 'is_member', False) else LEFT
+    if member.status == 'kicked':
+        return BANNED
+    return LEFT
+
+
+class MembershipStore:
+    """Last known membership per user plus the sweep cursor, in a local SQLite file"""
+
+    def __init__(self, path: str = None):
+        self.path = path or config.MEMBERSHIP_STORE_PATH
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def get_many(self, user_ids: Iterable[str]) -> Dict[str, tuple]:
+        """user_id -> (status, checked_at) for users with a recorded check"""
+        user_ids = list(user_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT user_id, status, checked_at FROM membership WHERE user_id IN "
+                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update((user_id, (status, checked_at)) for user_id, status, checked_at in rows)
+        return found
+
+    def record(self, user_id, status: str, checked_at: float = None):
+        self.record_many({str(user_id): status}, checked_at)
+
+    def record_many(self, statuses: Dict[str, str], checked_at: float = None):
+        checked_at = checked_at or time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                "INSERT INTO membership (user_id, status, checked_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, checked_at = excluded.checked_at",
+                [(user_id, status, checked_at) for user_id, status in statuses.items()])
+            self._conn.execute('COMMIT')
+
+    def load_state(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sweep_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_state(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sweep_state (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+
+    def close(self):
+        # Waits for a check being recorded from a worker thread
+        with self._lock:
+            self._conn.close()
+
+
+class MembershipSweeper:
+    """Incremental sweep over users whose rewards or withdrawals depend on membership"""
+
+    def __init__(self, db, bot, store: MembershipStore = None, governor=None, group_id: int = None,
+                 concurrency: int = None, page_size: int = None, recheck_after: float = None,
+                 budget: float = None):
+        self.db = db
+        self.bot = bot
+        self.store = store or MembershipStore()
+        self.governor = governor or shared_governor
+        self.group_id = group_id or config.REQUIRED_GROUP_ID
+        self.concurrency = concurrency or config.MEMBERSHIP_SWEEP_CONCURRENCY
+        self.page_size = page_size or config.MEMBERSHIP_SWEEP_PAGE_SIZE
+        self.recheck_after = recheck_after if recheck_after is not None else config.MEMBERSHIP_RECHECK_AFTER
+        self.budget = budget or config.MEMBERSHIP_SWEEP_BUDGET
+        self.state: Dict[str, Any] = {}
+        self.last_report = 0.0
+
+    # ---- Checks -----------------------------------------------------------
+
+    async def check(self, user_id: str) -> Optional[str]:
+        """membership_status for one user, or None if Telegram couldn't tell us"""
+        for attempt in range(3):
+            await self.governor.acquire(background=True)
+            try:
+                member = await self.bot.get_chat_member(self.group_id, int(user_id))
+                return membership_status(member)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                self.governor.penalize(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds')
+                                       else float(retry_after))
+            except BadRequest as e:
+                if any(reason in str(e).lower() for reason in NOT_A_MEMBER_ERRORS):
+                    return LEFT
+                # e.g. the bot lost access to the member list: don't guess
+                logger.warning(f"Membership check for {user_id} rejected: {e}")
+                return None
+            except Forbidden as e:
+                logger.warning(f"Membership check for {user_id} rejected: {e}")
+                return None
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(0.5 * (attempt + 1))
+            except Exception as e:
+                logger.warning(f"Membership check for {user_id} failed: {e}")
+                return None
+        return None
+
+    async def _check_many(self, user_ids: List[str]) -> Dict[str, Optional[str]]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(user_id):
+            async with semaphore:
+                return user_id, await self.check(user_id)
+
+        return dict(await asyncio.gather(*(one(u) for u in user_ids)))
+
+    # ---- Writes -----------------------------------------------------------
+
+    def _write_changes(self, collection: str, docs, user_field: str, statuses: Dict[str, str],
+                       previous: Dict[str, tuple]):
+        """Record changed statuses and flag affected referral / withdrawal docs"""
+        now = datetime.now()
+        writes = []
+        for user_id, status in statuses.items():
+            if previous.get(user_id, (None,))[0] == status:
+                continue
+            data = {
+                'user_id': user_id,
+                'group_id': str(self.group_id),
+                'group_name': config.REQUIRED_GROUP_NAME,
+                'membership_status': status,
+                'verification_method': 'sweep',
+                'updated_at': now
+            }
+            data['verified_at' if status == VERIFIED else 'left_at'] = now
+            if user_id not in previous:
+                data['created_at'] = now
+            ref = self.db.collection(VERIFICATION_COLLECTION).document(f"{user_id}_{self.group_id}")
+            writes.append((ref, data))
+
+        revoke = []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            status = statuses.get(str(data.get(user_field)))
+            if status is None:
+                continue
+            is_member = status == VERIFIED
+            # Verified referrals were members when paid; withdrawals carry no flag until checked
+            if data.get('group_member', True if collection == 'referrals' else None) != is_member:
+                writes.append((doc.reference, {'group_member': is_member, 'membership_checked_at': now}))
+            if collection == 'referrals' and not is_member and config.MEMBERSHIP_REVOKE_LEFT_REFERRALS:
+                revoke.append(doc)
+
+        for start in range(0, len(writes), 450):
+            batch = self.db.batch()
+            for ref, data in writes[start:start + 450]:
+                batch.set(ref, data, merge=True)
+            resilience.call('membership', batch.commit)
+        for doc in revoke:
+            self._revoke_referral(doc)
+        return len(writes)
+
+    def _revoke_referral(self, referral_doc) -> bool:
+        """Reverse the reward of a referral whose user left, at most once"""
+        referral = referral_doc.to_dict() or {}
+        referrer_docs = list(self.db.collection('users')
+                             .where('telegram_id', '==', referral.get('referrer_id')).limit(1).stream())
+        batch = self.db.batch()
+        batch.update(referral_doc.reference, {
+            'status': 'left_group',
+            'group_member': False,
+            'updated_at': datetime.now()
+        })
+        if referral.get('reward_given') and referrer_docs:
+            earnings_ledger.add(batch, self.db, f"referral_reversal_{referral_doc.id}", Earning(
+                referral.get('referrer_id'), -config.REFERRAL_REWARD, 'referral_reversal',
+                description=f"Referred user {referral.get('referred_id')} left the group",
+                referral_id=referral_doc.id, created_at=datetime.now()))
+            batch.update(referrer_docs[0].reference, {
+                'balance': firestore.Increment(-config.REFERRAL_REWARD),
+                'total_earnings': firestore.Increment(-config.REFERRAL_REWARD),
+                'total_referrals': firestore.Increment(-1),
+                'updated_at': datetime.now()
+            })
+        try:
+            resilience.call('membership', batch.commit)
+        except AlreadyExists:
+            return False
+        self.state['revoked'] += 1
+        logger.info(f"↩️ Reversed referral {referral_doc.id}: referred user left the group")
+        return True
+
+    # ---- Sweep ------------------------------------------------------------
+
+    def _new_state(self, previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            'phase': 0, 'after': None, 'started_at': time.time(),
+            'scanned': 0, 'checked': 0, 'skipped': 0, 'unknown': 0, 'left': 0, 'written': 0, 'revoked': 0,
+            # Size of the last complete sweep, used to pace this one
+            'expected': (previous or {}).get('last_total') or 0,
+            'last_total': (previous or {}).get('last_total') or 0,
+            'finished_at': None,
+        }
+
+    def _page(self, phase: int, after: Optional[str]):
+        collection, _, status = PHASES[phase]
+        query = (self.db.collection(collection).where('status', '==', status)
+                 .order_by('__name__').limit(self.page_size))
+        if after:
+            query = query.start_after(self.db.collection(collection).document(after).get())
+        return list(query.stream())
+
+    def _report(self, force: bool = False):
+        now = time.time()
+        if not force and now - self.last_report < config.MEMBERSHIP_SWEEP_REPORT_INTERVAL:
+            return
+        self.last_report = now
+        s = self.state
+        elapsed = max(now - s['started_at'], 1e-9)
+        rate = s['scanned'] / elapsed
+        eta = ''
+        if s['expected'] and rate:
+            remaining = max(s['expected'] - s['scanned'], 0) / rate
+            eta = f", ETA {remaining / 60:.1f} min"
+            if elapsed + remaining > self.budget:
+                eta += f" ⚠️ over the {self.budget / 60:.0f} min budget"
+        logger.info(f"🔎 Membership sweep ({PHASES[s['phase']][0] if s['phase'] < len(PHASES) else 'done'}): "
+                    f"{s['scanned']} scanned, {s['checked']} checked, {s['skipped']} recent, "
+                    f"{s['left']} not in group, {rate:.0f}/s{eta}")
+
+    async def _pace(self):
+        """Sleep when ahead of the schedule that spreads the sweep over the budget"""
+        s = self.state
+        if not s['expected']:
+            return
+        target = s['scanned'] / s['expected'] * self.budget * 0.9
+        ahead = target - (time.time() - s['started_at'])
+        if ahead > 0:
+            await asyncio.sleep(min(ahead, 60))
+
+    async def sweep(self) -> Dict[str, Any]:
+        """Run (or resume) one full sweep; returns its counters"""
+        previous = await asyncio.to_thread(self.store.load_state, 'sweep')
+        if previous and previous.get('finished_at') is None:
+            self.state = previous
+            logger.info(f"🔎 Resuming membership sweep at {PHASES[previous['phase']][0]} after {previous['after']}")
+        else:
+            self.state = self._new_state(previous)
+        s = self.state
+
+        while s['phase'] < len(PHASES):
+            collection, user_field, _ = PHASES[s['phase']]
+            docs = await resilience.acall('membership', self._page, s['phase'], s['after'], idempotent=True)
+            if not docs:
+                s['phase'] += 1
+                s['after'] = None
+                await asyncio.to_thread(self.store.save_state, 'sweep', dict(s))
+                continue
+
+            user_ids = list(dict.fromkeys(str((d.to_dict() or {}).get(user_field)) for d in docs))
+            user_ids = [u for u in user_ids if u.lstrip('-').isdigit()]
+            known = await asyncio.to_thread(self.store.get_many, user_ids)
+            # Skip anyone already checked in this sweep and members confirmed recently;
+            # users who left are re-checked every sweep in case they rejoined
+            confirmed_after = time.time() - self.recheck_after
+            due = [u for u in user_ids
+                   if u not in known or not (known[u][1] >= s['started_at'] or
+                                             known[u][0] == VERIFIED and known[u][1] >= confirmed_after)]
+
+            results = await self._check_many(due)
+            checked = {u: status for u, status in results.items() if status is not None}
+            statuses = {u: known[u][0] for u in user_ids if u in known}
+            statuses.update(checked)
+            s['written'] += await asyncio.to_thread(self._write_changes, collection, docs, user_field,
+                                                    statuses, known)
+            revoked = [u for u, status in checked.items()
+                       if status != VERIFIED and known.get(u, (None,))[0] != status]
+            await asyncio.to_thread(self._record, checked, revoked)
+
+            s['scanned'] += len(docs)
+            s['checked'] += len(checked)
+            s['unknown'] += len(results) - len(checked)
+            s['skipped'] += len(user_ids) - len(due)
+            s['left'] += sum(1 for status in checked.values() if status != VERIFIED)
+            s['after'] = docs[-1].id
+            await asyncio.to_thread(self.store.save_state, 'sweep', dict(s))
+            self._report()
+            await self._pace()
+
+        s['finished_at'] = time.time()
+        s['last_total'] = s['scanned']
+        await asyncio.to_thread(self.store.save_state, 'sweep', dict(s))
+        self._report(force=True)
+        return s
+
+    async def run_forever(self):
+        """Background task: sweep, then wait for the next interval"""
+        while True:
+            try:
+                started = time.time()
+                await self.sweep()
+                await asyncio.sleep(max(config.MEMBERSHIP_SWEEP_INTERVAL - (time.time() - started), 60))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Membership sweep failed: {e}")
+                await asyncio.sleep(60)
+
+    def _record(self, checked: Dict[str, str], revoked: List[str]):
+        self.store.record_many(checked)
+        for user_id in revoked:
+            sessions.invalidate(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        # In memory only (called from /status); empty until the first sweep starts
+        s = self.state or {}
+        return {key: s.get(key) for key in ('phase', 'scanned', 'checked', 'skipped', 'left',
+                                            'revoked', 'started_at', 'finished_at')}
+
+
+async def run_benchmark(users: int, budget: float, rate: float, latency: float):
+    """Sweep synthetic referrals against the stand-in backend and Bot API"""
+    import tempfile
+    from telegram import Bot
+    from fake_bot_api import FakeBotRequest
+    from fake_firestore import FakeFirestore
+    from rate_governor import RateGovernor
+
+    db = FakeFirestore()
+    for i in range(users):
+        db.seed('referrals', f"r{i:09d}", {'referrer_id': '1', 'referred_id': str(7_000_000_000 + i),
+                                           'status': 'verified', 'reward_given': True})
+    for i in range(0, users, 50):
+        db.seed('withdrawal_requests', f"w{i:09d}", {'user_id': str(7_000_000_000 + i), 'status': 'pending'})
+
+    bot = Bot('123456:bench', request=FakeBotRequest(latency=latency, member_ratio=0.9))
+    store = MembershipStore(os.path.join(tempfile.mkdtemp(prefix='sweep_'), 'membership.sqlite3'))
+    sweeper = MembershipSweeper(db, bot, store=store, governor=RateGovernor(rate=rate, burst=rate),
+                                budget=budget)
+    await bot.initialize()
+    started = time.perf_counter()
+    result = await sweeper.sweep()
+    elapsed = time.perf_counter() - started
+    print(f"📊 Swept {result['scanned']:,} docs in {elapsed:.1f}s (budget {budget:.0f}s, "
+          f"{result['scanned'] / elapsed:,.0f}/s)")
+    print(f"✅ Checked {result['checked']:,}, recent {result['skipped']:,}, not in group {result['left']:,}, "
+          f"unknown {result['unknown']:,}")
+    print(f"💾 Docs written: {result['written']:,}; getChatMember calls: {bot.request.counts['getChatMember']:,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Group membership re-verification sweep')
+    parser.add_argument('--once', action='store_true', help='Run one sweep against the live backend')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark a sweep over N synthetic referrals')
+    parser.add_argument('--budget', type=float, default=None, help='Sweep time budget in seconds')
+    parser.add_argument('--rate', type=float, default=5000, help='Benchmark Bot API calls/sec')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='Benchmark seconds per Bot API call')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.bench:
+        asyncio.run(run_benchmark(args.bench, args.budget or 600, args.rate, args.api_latency))
+    elif args.once:
+        from telegram import Bot
+        from bot_firebase import db
+
+        async def once():
+            async with Bot(config.TOKEN) as bot:
+                await MembershipSweeper(db, bot, budget=args.budget).sweep()
+
+        asyncio.run(once())
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Cash Points Mini App API
+Small read API served from the bot process for the mini app.
+
+Features:
+- Validates Telegram WebApp initData (HMAC-SHA256 with the bot token) on every
+  request; the user id comes from initData, never from the query
+- GET /api/profile, GET /api/earnings?cursor=&limit=, GET /api/earnings/summary,
+  GET /api/referrals/stats; earnings come from the monthly buckets when
+  EARNINGS_LEDGER_MODE=ledger (earnings_ledger.py)
+- GET /api/energy and POST /api/energy/spend {"amount": n}: energy is worked
+  out at response time from the cached profile (energy.py), so it keeps
+  regenerating without reads or writes; a spend is one compare-and-set write
+  (409 when there isn't enough, 503 when the user doc kept changing)
+- Read-through cache with single-flight loading; keys carry the user's session
+  version, so the reward engine's sessions.invalidate() also drops API entries
+- aiohttp is optional: without it the API simply doesn't start
+
+Usage:
+    MINI_APP_API_ENABLED=true python bot.py
+    python mini_app_api.py --loadtest --users 2000 --requests 20000
+"""
+
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, Awaitable
+from urllib.parse import parse_qsl, urlsplit, urlencode
+
+from config import config
+import resilience
+import energy
+from session_cache import sessions
+from models import User, Referral
+from earnings_ledger import ledger as earnings_ledger, flat_history, flat_monthly
+
+try:
+    from aiohttp import web
+except ImportError:  # aiohttp is optional, the bot runs without the API
+    web = None
+
+logger = logging.getLogger(__name__)
+
+MAX_PAGE_SIZE = 50
+
+
+class InitDataError(Exception):
+    """initData is missing, malformed, expired or not signed by this bot"""
+
+
+def validate_init_data(init_data: str, bot_token: str, max_age: float = None) -> Dict[str, Any]:
+    """Check a WebApp initData string and return its user object"""
+    if not init_data:
+        raise InitDataError("missing initData")
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop('hash', None)
+    if not received_hash:
+        raise InitDataError("initData has no hash")
+    data_check_string = '\n'.join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received_hash):
+        raise InitDataError("bad initData signature")
+
+    max_age = max_age if max_age is not None else config.MINI_APP_AUTH_MAX_AGE
+    try:
+        auth_date = int(fields.get('auth_date', '0'))
+    except ValueError:
+        raise InitDataError("bad auth_date")
+    if max_age and time.time() - auth_date > max_age:
+        raise InitDataError("initData expired")
+    try:
+        user = json.loads(fields.get('user', ''))
+        int(user['id'])
+    except (ValueError, TypeError, KeyError):
+        raise InitDataError("initData has no user")
+    return user
+
+
+def sign_init_data(user: Dict[str, Any], bot_token: str, auth_date: int = None) -> str:
+    """Build a signed initData string (for tests and the load test)"""
+    fields = {'auth_date': str(auth_date or int(time.time())), 'user': json.dumps(user, separators=(',', ':'))}
+    data_check_string = '\n'.join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+class ReadThroughCache:
+    """TTL + LRU cache where concurrent misses for one key share a single load"""
+
+    def __init__(self, ttl: float = None, max_entries: int = None):
+        self.ttl = ttl if ttl is not None else config.MINI_APP_CACHE_TTL
+        self.max_entries = max_entries or config.MINI_APP_CACHE_MAX_ENTRIES
+        self._entries: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key: tuple, loader: Callable[[], Awaitable[Any]]):
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # mark retrieved: with no waiters asyncio would log it
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        if self.ttl > 0:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / total if total else 0.0,
+        }
+
+
+def _jsonable(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class MiniAppAPI:
+    """Read endpoints for the mini app over the bot's Firestore client"""
+
+    def __init__(self, db, bot_token: str = None, cache: ReadThroughCache = None):
+        self.db = db
+        self.bot_token = bot_token or config.TOKEN
+        self.cache = cache or ReadThroughCache()
+        self.requests = 0
+        self.rejected = 0
+        self._runner = None
+
+    # ---- Loaders (worker threads) ----------------------------------------
+
+    def _load_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        docs = list(self.db.collection('users').where('telegram_id', '==', user_id).limit(1).stream())
+        if not docs:
+            return None
+        data = docs[0].to_dict() or {}
+        user = User.from_firestore(docs[0].id, data)
+        return {
+            'telegram_id': user_id,
+            'first_name': user.first_name,
+            'balance': user.balance,
+            'total_earnings': user.total_earnings,
+            'total_referrals': user.total_referrals,
+            'referral_code': user.referral_code,
+            'level': user.referral_level,
+            # Stored energy; what's left right now is worked out per response
+            'energy_fields': energy.stored_fields(data),
+        }
+
+    def _load_earnings(self, user_id: str, cursor: Optional[str], limit: int) -> Dict[str, Any]:
+        read = earnings_ledger.history if earnings_ledger.reads_buckets else flat_history
+        entries, next_cursor = read(self.db, user_id, cursor, limit)
+        items = [{**entry, 'created_at': _jsonable(entry['created_at'])} for entry in entries]
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def _load_earnings_summary(self, user_id: str) -> Dict[str, Any]:
+        read = earnings_ledger.monthly if earnings_ledger.reads_buckets else flat_monthly
+        return read(self.db, user_id)
+
+    def _load_referral_stats(self, user_id: str) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        rewarded = 0
+        for doc in self.db.collection('referrals').where('referrer_id', '==', user_id).stream():
+            referral = Referral.from_firestore(doc.id, doc.to_dict() or {})
+            status = referral.status or 'unknown'
+            counts[status] = counts.get(status, 0) + 1
+            rewarded += 1 if referral.reward_given else 0
+        return {
+            'total': sum(counts.values()),
+            'verified': counts.get('verified', 0),
+            'pending': counts.get('pending_group_join', 0),
+            'by_status': counts,
+            'referral_earnings': rewarded * config.REFERRAL_REWARD,
+        }
+
+    # ---- HTTP -------------------------------------------------------------
+
+    def _user_id(self, request) -> str:
+        header = request.headers.get('Authorization', '')
+        init_data = header[4:] if header.lower().startswith('tma ') else request.headers.get('X-Telegram-Init-Data', '')
+        return str(validate_init_data(init_data, self.bot_token)['id'])
+
+    async def _cached(self, user_id: str, kind: str, arg, loader: Callable, *args):
+        # The session version moves whenever the reward engine touches this user
+        key = (user_id, await sessions.aversion(user_id), kind, arg)
+        return await self.cache.get(key, lambda: resilience.acall('miniapp', loader, *args, idempotent=True))
+
+    def _handler(self, fn):
+        async def handle(request):
+            self.requests += 1
+            try:
+                user_id = self._user_id(request)
+            except InitDataError as e:
+                self.rejected += 1
+                return web.json_response({'error': str(e)}, status=401)
+            try:
+                body = await fn(request, user_id)
+                if isinstance(body, web.StreamResponse):
+                    return body
+                if body is None:
+                    return web.json_response({'error': 'user not found'}, status=404)
+                return web.json_response(body)
+            except resilience.BreakerOpen:
+                return web.json_response({'error': 'temporarily unavailable'}, status=503)
+            except Exception as e:
+                logger.warning(f"Mini app API {request.path} failed: {e}")
+                return web.json_response({'error': 'internal error'}, status=500)
+        return handle
+
+    async def profile(self, request, user_id: str):
+        profile = await self._cached(user_id, 'profile', None, self._load_profile, user_id)
+        if profile is None:
+            return None
+        fields = profile['energy_fields']
+        return {**{k: v for k, v in profile.items() if k != 'energy_fields'}, **energy.current(fields).to_dict()}
+
+    async def energy_state(self, request, user_id: str):
+        profile = await self._cached(user_id, 'profile', None, self._load_profile, user_id)
+        return energy.current(profile['energy_fields']).to_dict() if profile is not None else None
+
+    async def spend_energy(self, request, user_id: str):
+        try:
+            amount = int((await request.json()).get('amount', 1))
+        except (ValueError, TypeError, AttributeError):
+            amount = 0
+        if amount <= 0:
+            return web.json_response({'error': 'amount must be a positive integer'}, status=400)
+        try:
+            result = await resilience.acall('miniapp', energy.spend_for, self.db, user_id, amount)
+        except energy.EnergyContention:
+            return web.json_response({'error': 'busy, try again'}, status=503)
+        if result is None:
+            return None
+        if not result.spent:
+            return web.json_response({'error': 'not enough energy', **result.state.to_dict()}, status=409)
+        await sessions.ainvalidate(user_id)  # cached profiles carry the old stored energy
+        return {'spent': amount, **result.state.to_dict()}
+
+    async def earnings(self, request, user_id: str):
+        cursor = request.query.get('cursor') or None
+        try:
+            limit = max(1, min(int(request.query.get('limit', config.MINI_APP_PAGE_SIZE)), MAX_PAGE_SIZE))
+        except ValueError:
+            limit = config.MINI_APP_PAGE_SIZE
+        return await self._cached(user_id, 'earnings', (cursor, limit), self._load_earnings, user_id, cursor, limit)
+
+    async def earnings_summary(self, request, user_id: str):
+        return await self._cached(user_id, 'earnings_summary', None, self._load_earnings_summary, user_id)
+
+    async def referral_stats(self, request, user_id: str):
+        return await self._cached(user_id, 'referral_stats', None, self._load_referral_stats, user_id)
+
+    def build_app(self):
+        if web is None:
+            raise RuntimeError("aiohttp is not installed")
+        origin = '{0.scheme}://{0.netloc}'.format(urlsplit(config.MINI_APP_URL))
+
+        @web.middleware
+        async def cors(request, handler):
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                response = e
+            response.headers['Access-Control-Allow-Origin'] = origin
+            response.headers['Access-Control-Allow-Headers'] = 'Authorization, X-Telegram-Init-Data, Content-Type'
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            return response
+
+        app = web.Application(middlewares=[cors])
+        app.router.add_get('/api/profile', self._handler(self.profile))
+        app.router.add_get('/api/earnings', self._handler(self.earnings))
+        app.router.add_get('/api/earnings/summary', self._handler(self.earnings_summary))
+        app.router.add_get('/api/referrals/stats', self._handler(self.referral_stats))
+        app.router.add_get('/api/energy', self._handler(self.energy_state))
+        app.router.add_post('/api/energy/spend', self._handler(self.spend_energy))
+        app.router.add_route('OPTIONS', '/api/{tail:.*}', lambda request: web.Response())
+        app.router.add_get('/healthz', lambda request: web.json_response({'ok': True, **self.stats()}))
+        return app
+
+    async def start(self, host: str = None, port: int = None) -> bool:
+        if web is None:
+            logger.error("❌ Mini app API needs aiohttp (pip install aiohttp); not started")
+            return False
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host or config.MINI_APP_API_HOST, port or config.MINI_APP_API_PORT)
+        await site.start()
+        logger.info(f"🌐 Mini app API listening on {host or config.MINI_APP_API_HOST}:{port or config.MINI_APP_API_PORT}")
+        return True
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {'requests': self.requests, 'rejected': self.rejected, **self.cache.stats()}
+
+
+async def run_loadtest(users: int, total: int, concurrency: int, db_latency: float, ttl: float):
+    """Drive the API in-process against the stand-in backend; returns (req/sec, backend reads)"""
+    import random
+    import aiohttp
+    from fake_firestore import FakeFirestore
+
+    token = '123456:loadtest'
+    db = FakeFirestore(latency=db_latency)
+    base = 5_000_000_000
+    rng = random.Random(1)
+    for i in range(users):
+        user_id = str(base + i)
+        db.seed('users', user_id, {'telegram_id': user_id, 'first_name': 'User', 'balance': rng.randint(0, 500),
+                                   'total_earnings': 0, 'total_referrals': 0, 'referral_code': f"CP{user_id[-6:]}"})
+        for j in range(rng.randint(0, 45)):
+            db.seed('earnings', f"e{i}_{j}", {'user_id': user_id, 'type': 'task', 'amount': 1,
+                                              'created_at': datetime.fromtimestamp(1_700_000_000 + j * 60)})
+        for j in range(rng.randint(0, 20)):
+            db.seed('referrals', f"r{i}_{j}", {'referrer_id': user_id, 'referred_id': f"{i}{j}",
+                                               'status': rng.choice(['verified', 'pending_group_join']),
+                                               'reward_given': True})
+
+    api = MiniAppAPI(db, bot_token=token, cache=ReadThroughCache(ttl=ttl))
+    runner = web.AppRunner(api.build_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # Mini app opens: a few users are much more active than the rest
+    auth = {i: 'tma ' + sign_init_data({'id': base + i, 'first_name': 'User'}, token) for i in range(users)}
+    plan = []
+    for _ in range(total):
+        user = min(int(rng.paretovariate(1.1)) - 1, users - 1) if rng.random() < 0.5 else rng.randrange(users)
+        path = rng.choices(['/api/profile', '/api/earnings', '/api/referrals/stats'], [5, 3, 2])[0]
+        plan.append((user, path))
+    latencies = []
+    queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    async def worker(session):
+        while not queue.empty():
+            user, path = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.get(f"http://127.0.0.1:{port}{path}", headers={'Authorization': auth[user]}) as response:
+                body = await response.json()
+                if path == '/api/earnings' and body.get('next_cursor'):
+                    async with session.get(f"http://127.0.0.1:{port}{path}?cursor={body['next_cursor']}",
+                                           headers={'Authorization': auth[user]}) as more:
+                        await more.read()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await runner.cleanup()
+
+    calls = db.call_counts()
+    reads = calls.get('query', 0) + calls.get('get', 0)
+    latencies.sort()
+    label = f"cache ttl={ttl:g}s" if ttl else "no cache"
+    print(f"📊 {label:<16} {total / elapsed:>8,.0f} req/s   p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.1f} ms   Firestore reads {reads:,} "
+          f"({reads / total:.2f}/request)")
+    return total / elapsed, reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mini app read API')
+    parser.add_argument('--loadtest', action='store_true', help='Load test against the stand-in backend')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--db-latency', type=float, default=0.005, help='Seconds per Firestore call')
+    args = parser.parse_args()
+
+    if web is None:
+        parser.error("aiohttp is not installed")
+    if args.loadtest:
+        _, uncached = asyncio.run(run_loadtest(args.users, args.requests, args.concurrency, args.db_latency, 0))
+        _, cached = asyncio.run(run_loadtest(args.users, args.requests, args.concurrency, args.db_latency,
+                                             config.MINI_APP_CACHE_TTL))
+        print(f"🔥 Backend reads reduced by {1 - cached / max(uncached, 1):.0%}")
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Cash Points Models
+Typed, compact domain objects for the documents the bots read and write.
+
+Features:
+- slots dataclasses: User, Referral, Earning, ReferralCode, Notification
+- from_firestore() / to_firestore() converters, written out per field (no
+  dataclasses.asdict / reflection), so converting millions of rows is cheap
+- Schema-version handling in one place: documents without schema_version
+  are v0 and may use legacy names (referral_count, last_activity, is_read,
+  last_join_date); every write is the v1 shape
+- Notification writes both `read` and `is_read` because the mini app
+  still reads `is_read`
+
+Usage:
+    user = User.from_firestore(doc.id, doc.to_dict())
+    db.collection('notifications').add(Notification(user_id, 'reward', title, message).to_firestore())
+    python models.py --bench 100000
+"""
+
+import sys
+import time
+import argparse
+import tracemalloc
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any, Tuple
+
+SCHEMA_VERSION = 1
+
+
+def _first(data: Dict[str, Any], *names, default=None):
+    """Value of the first field present, for names that changed between schema versions"""
+    for name in names:
+        value = data.get(name)
+        if value is not None:
+            return value
+    return default
+
+
+@dataclass(slots=True)
+class User:
+    telegram_id: str
+    username: str = ''
+    first_name: str = ''
+    last_name: str = ''
+    referral_code: str = ''
+    legacy_referral_codes: Tuple[str, ...] = ()
+    balance: float = 0
+    total_earnings: float = 0
+    total_referrals: int = 0
+    referral_level: int = 0
+    is_verified: bool = False
+    is_banned: bool = False
+    is_active: bool = True
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    last_active: Optional[datetime] = None
+    doc_id: str = field(default='', compare=False)
+
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> 'User':
+        g = data.get
+        return cls(
+            str(g('telegram_id') or doc_id),
+            g('username') or '',
+            g('first_name') or '',
+            g('last_name') or '',
+            g('referral_code') or '',
+            tuple(g('legacy_referral_codes') or ()),
+            g('balance') or 0,
+            g('total_earnings') or 0,
+            _first(data, 'total_referrals', 'referral_count', default=0),
+            _first(data, 'referral_level', 'level', default=0),
+            bool(g('is_verified')),
+            bool(g('is_banned')),
+            g('is_active', True) is not False,
+            g('created_at'),
+            g('updated_at'),
+            _first(data, 'last_active', 'last_activity'),
+            doc_id,
+        )
+
+    def to_firestore(self) -> Dict[str, Any]:
+        return {
+            'schema_version': SCHEMA_VERSION,
+            'telegram_id': self.telegram_id,
+            'username': self.username,
+            'first_name': self.first_name,
+            'last_name': self.last_name,
+            'referral_code': self.referral_code,
+            'legacy_referral_codes': list(self.legacy_referral_codes),
+            'balance': self.balance,
+            'total_earnings': self.total_earnings,
+            'total_referrals': self.total_referrals,
+            'referral_level': self.referral_level,
+            'is_verified': self.is_verified,
+            'is_banned': self.is_banned,
+            'is_active': self.is_active,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'last_active': self.last_active,
+        }
+
+
+@dataclass(slots=True)
+class Referral:
+    referrer_id: str
+    referred_id: str
+    referral_code: str = ''
+    status: str = 'pending_group_join'
+    group_join_verified: bool = False
+    reward_given: bool = False
+    rejoin_count: int = 0
+    is_active: bool = True
+    created_at: Optional[datetime] = None
+    group_join_date: Optional[datetime] = None
+    last_rejoin_date: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    doc_id: str = field(default='', compare=False)
+
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> 'Referral':
+        g = data.get
+        return cls(
+            str(g('referrer_id') or ''),
+            str(g('referred_id') or ''),
+            g('referral_code') or '',
+            g('status') or '',
+            bool(g('group_join_verified')),
+            bool(g('reward_given')),
+            g('rejoin_count') or 0,
+            g('is_active', True) is not False,
+            g('created_at'),
+            g('group_join_date'),
+            _first(data, 'last_rejoin_date', 'last_join_date'),
+            g('updated_at'),
+            doc_id,
+        )
+
+    def to_firestore(self) -> Dict[str, Any]:
+        return {
+            'schema_version': SCHEMA_VERSION,
+            'referrer_id': self.referrer_id,
+            'referred_id': self.referred_id,
+            'referral_code': self.referral_code,
+            'status': self.status,
+            'group_join_verified': self.group_join_verified,
+            'reward_given': self.reward_given,
+            'rejoin_count': self.rejoin_count,
+            'is_active': self.is_active,
+            'created_at': self.created_at,
+            'group_join_date': self.group_join_date,
+            'last_rejoin_date': self.last_rejoin_date,
+            'updated_at': self.updated_at,
+        }
+
+
+@dataclass(slots=True)
+class Earning:
+    user_id: str
+    amount: float
+    type: str
+    description: str = ''
+    source: str = ''
+    reference_id: str = ''
+    referral_id: str = ''
+    created_at: Optional[datetime] = None
+    doc_id: str = field(default='', compare=False)
+
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> 'Earning':
+        g = data.get
+        return cls(
+            str(g('user_id') or ''),
+            g('amount') or 0,
+            g('type') or '',
+            g('description') or '',
+            g('source') or '',
+            g('reference_id') or '',
+            g('referral_id') or '',
+            g('created_at'),
+            doc_id,
+        )
+
+    def to_firestore(self) -> Dict[str, Any]:
+        data = {
+            'schema_version': SCHEMA_VERSION,
+            'user_id': self.user_id,
+            'amount': self.amount,
+            'type': self.type,
+            'description': self.description,
+            'created_at': self.created_at,
+        }
+        # Optional links are only written when set, as before
+        if self.source:
+            data['source'] = self.source
+        if self.reference_id:
+            data['reference_id'] = self.reference_id
+        if self.referral_id:
+            data['referral_id'] = self.referral_id
+        return data
+
+
+@dataclass(slots=True)
+class ReferralCode:
+    code: str
+    user_id: str
+    is_active: bool = True
+    total_uses: int = 0
+    total_earnings: float = 0
+    created_at: Optional[datetime] = None
+    doc_id: str = field(default='', compare=False)
+
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> 'ReferralCode':
+        g = data.get
+        return cls(
+            g('referral_code') or doc_id,  # referralCodes documents are keyed by the code
+            str(g('user_id') or ''),
+            g('is_active', True) is not False,
+            g('total_uses') or 0,
+            g('total_earnings') or 0,
+            g('created_at'),
+            doc_id,
+        )
+
+    def to_firestore(self) -> Dict[str, Any]:
+        return {
+            'schema_version': SCHEMA_VERSION,
+            'referral_code': self.code,
+            'user_id': self.user_id,
+            'is_active': self.is_active,
+            'total_uses': self.total_uses,
+            'total_earnings': self.total_earnings,
+            'created_at': self.created_at,
+        }
+
+
+@dataclass(slots=True)
+class Notification:
+    user_id: str
+    type: str
+    title: str
+    message: str
+    read: bool = False
+    created_at: Optional[datetime] = None
+    doc_id: str = field(default='', compare=False)
+
+    @classmethod
+    def from_firestore(cls, doc_id: str, data: Dict[str, Any]) -> 'Notification':
+        g = data.get
+        return cls(
+            str(g('user_id') or ''),
+            g('type') or '',
+            g('title') or '',
+            g('message') or '',
+            bool(g('read') or g('is_read')),  # the mini app marks either one
+            g('created_at'),
+            doc_id,
+        )
+
+    def to_firestore(self) -> Dict[str, Any]:
+        return {
+            'schema_version': SCHEMA_VERSION,
+            'user_id': self.user_id,
+            'type': self.type,
+            'title': self.title,
+            'message': self.message,
+            'read': self.read,
+            'is_read': self.read,
+            'created_at': self.created_at,
+        }
+
+
+def _sample_users(count: int):
+    now = datetime.now()
+    for i in range(count):
+        data = {
+            'telegram_id': str(1000000 + i), 'username': f'user{i}', 'first_name': 'Rahim',
+            'last_name': '', 'referral_code': f'CP{i:06d}', 'balance': i % 500,
+            'total_earnings': i % 900, 'is_verified': i % 2 == 0, 'is_banned': False,
+            'created_at': now, 'updated_at': now,
+        }
+        # Half the documents use the legacy field names
+        if i % 2:
+            data['referral_count'], data['last_activity'] = i % 40, now
+        else:
+            data['total_referrals'], data['last_active'] = i % 40, now
+        yield f"doc{i}", data
+
+
+def run_benchmark(count: int):
+    docs = list(_sample_users(count))
+
+    started = time.perf_counter()
+    users = [User.from_firestore(doc_id, data) for doc_id, data in docs]
+    from_cost = (time.perf_counter() - started) / count
+    started = time.perf_counter()
+    for user in users:
+        user.to_firestore()
+    to_cost = (time.perf_counter() - started) / count
+    print(f"User.from_firestore: {from_cost * 1e6:.2f} µs/doc, to_firestore: {to_cost * 1e6:.2f} µs/doc")
+    del users
+
+    # Memory held by a cache of converted rows (strings/datetimes are shared by both)
+    for label, build in (('dict', lambda: [dict(data) for _, data in docs]),
+                         ('User', lambda: [User.from_firestore(doc_id, data) for doc_id, data in docs])):
+        tracemalloc.start()
+        rows = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:5}: {size / count:.0f} bytes/row ({size / 1e6:.1f} MB for {count} rows, "
+              f"object itself {sys.getsizeof(rows[0])} bytes)")
+        del rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Domain model converters')
+    parser.add_argument('--bench', type=int, default=100_000, help='Documents to convert')
+    args = parser.parse_args()
+    run_benchmark(args.bench)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Cash Points Notification Inbox
+Digest notifications for referral rewards, TTL for read notifications and a
+compaction job for existing backlogs.
+
+Features:
+- Rewards for the same user within NOTIFY_DIGEST_WINDOW share one
+  notification (reward_digest_{user}_{window}_{index}); each reward bumps its
+  count and amount, rewrites the message and marks it unread again. The write
+  goes into the reward's own batch, so it is as idempotent as the reward; the
+  in-process totals only move when the caller confirms that batch committed
+- Read notifications get `expires_at` (NOTIFY_READ_TTL_DAYS after they were
+  read, or created for older ones) and the Firestore TTL policy on
+  notifications.expires_at deletes them; the mini app stamps it when marking
+  a notification read
+- compact() merges a user's unread per-referral reward notifications into one
+  digest per NOTIFY_COMPACT_WINDOW (digest write and deletes in one batch) and
+  stamps expires_at on read notifications that lack it; safe to re-run
+- Reports document counts before/after and the reads the mini app needs to
+  open the inbox (its 50-item query) and to count unread notifications
+
+Usage:
+    python notification_inbox.py                 # report only
+    python notification_inbox.py --apply         # compact and stamp TTLs
+    python notification_inbox.py --synthetic 5000
+"""
+
+import re
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+from firebase_admin import firestore
+
+from config import config
+from models import Notification
+from export_data import stream_pages
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'notifications'
+REWARD_TITLE = 'Referral Reward Earned! 🎉'
+DIGEST_TITLE = 'Referral Rewards Earned! 🎉'
+INBOX_PAGE = 50  # getUserNotifications(userId, 50) in the mini app
+
+BATCH_LIMIT = 500  # Firestore max writes per batch
+DIGEST_CACHE_SIZE = 20000  # open (user, window) digests remembered per process
+
+_AMOUNT = re.compile(r'৳\s*(\d+(?:\.\d+)?)')
+
+
+def digest_id(user_id: str, window: int, index: int) -> str:
+    return f"reward_digest_{user_id}_{window}_{index}"
+
+
+def digest_text(count: int, amount: float, last: str) -> Tuple[str, str]:
+    """(title, message) of a digest; a single reward reads like the old notification"""
+    if count == 1:
+        return REWARD_TITLE, f'{last}! You earned ৳{amount:g}.'
+    return DIGEST_TITLE, f'{count} referred users joined the group! You earned ৳{amount:g}.'
+
+
+def _epoch(value) -> float:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return 0.0
+    return value.timestamp() if hasattr(value, 'timestamp') else 0.0
+
+
+def _is_read(data: Dict[str, Any]) -> bool:
+    return bool(data.get('read') or data.get('is_read'))
+
+
+def _is_reward(data: Dict[str, Any]) -> bool:
+    """A per-referral reward notification (not a digest, not a level bonus)"""
+    return data.get('type') == 'reward' and data.get('title') == REWARD_TITLE and not data.get('digest')
+
+
+def _digest_write(user_id: str, window: int, index: int, count: int, amount: float,
+                  added: int, added_amount: float, last: str, at: datetime) -> Dict[str, Any]:
+    title, message = digest_text(count, amount, last)
+    data = Notification(user_id, 'reward', title, message, created_at=at).to_firestore()
+    data.update({
+        'digest': True,
+        'count': firestore.Increment(added),
+        'amount': firestore.Increment(added_amount),
+        'window_start': datetime.fromtimestamp(index * window),
+        'updated_at': datetime.now(),
+        'expires_at': firestore.DELETE_FIELD,  # unread again, so it no longer expires
+    })
+    return data
+
+
+class NotificationInbox:
+    """Writes reward notifications as per-window digests"""
+
+    def __init__(self, window: int = None):
+        self.window = window or config.NOTIFY_DIGEST_WINDOW
+        self._open: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.rewards = 0
+        self.digests = 0
+        self.seed_reads = 0
+
+    def add_reward(self, batch, db, user_id: str, amount: float, description: str,
+                   now: float = None) -> Callable[[], None]:
+        """Stage the reward's notification in `batch` (the batch that pays the reward)
+
+        Returns a hook to call once `batch` has committed; a batch that fails
+        (a duplicate reward) must not advance the digest's totals.
+        """
+        now = now or time.time()
+        user_id = str(user_id)
+        index = int(now // self.window)
+        ref = db.collection(COLLECTION).document(digest_id(user_id, self.window, index))
+        key = (user_id, index)
+        with self._lock:
+            totals = self._open.get(key)
+        if totals is None:
+            # First reward of this window in this process: pick up what others wrote
+            snapshot = ref.get()
+            data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            totals = (data.get('count') or 0, data.get('amount') or 0)
+            self.seed_reads += 1
+        count, total = totals[0] + 1, totals[1] + amount
+        batch.set(ref, _digest_write(user_id, self.window, index, count, total, 1, amount,
+                                     description, datetime.fromtimestamp(now)), merge=True)
+
+        def committed():
+            with self._lock:
+                current = self._open.get(key)
+                # Another reward may have committed in between; add to what it left
+                self._open[key] = (current[0] + 1, current[1] + amount) if current else (count, total)
+                self._open.move_to_end(key)
+                while len(self._open) > DIGEST_CACHE_SIZE:
+                    self._open.popitem(last=False)
+                self.rewards += 1
+                self.digests += count == 1
+        return committed
+
+    def stats(self) -> Dict[str, Any]:
+        return {'rewards': self.rewards, 'digests': self.digests, 'seed_reads': self.seed_reads}
+
+
+inbox = NotificationInbox()
+
+
+# ---- Compaction -------------------------------------------------------------
+
+def _read_cost(docs: int) -> int:
+    # Firestore bills at least one read per query
+    return max(1, docs)
+
+
+class _Writes:
+    """Groups of writes that must commit together, packed into 500-write batches"""
+
+    def __init__(self, db, apply: bool):
+        self.db = db
+        self.apply = apply
+        self._batch = None
+        self._size = 0
+        self.commits = 0
+
+    def group(self, ops: List[Tuple[str, Any, Optional[Dict[str, Any]]]]):
+        if not self.apply:
+            return
+        if self._batch is not None and self._size + len(ops) > BATCH_LIMIT:
+            self.flush()
+        if self._batch is None:
+            self._batch, self._size = self.db.batch(), 0
+        for kind, ref, data in ops:
+            if kind == 'set':
+                self._batch.set(ref, data, merge=True)
+            elif kind == 'update':
+                self._batch.update(ref, data)
+            else:
+                self._batch.delete(ref)
+        self._size += len(ops)
+
+    def flush(self):
+        if self._batch is not None and self._size:
+            self._batch.commit()
+            self.commits += 1
+        self._batch, self._size = None, 0
+
+
+def compact_user(db, user_id: str, writes: _Writes, stats: Dict[str, int], now: float = None):
+    """Compact one user's inbox and add its numbers to `stats`"""
+    now = now or time.time()
+    window = config.NOTIFY_COMPACT_WINDOW
+    ttl = config.NOTIFY_READ_TTL_DAYS * 86400
+    docs = list(db.collection(COLLECTION).where('user_id', '==', user_id).stream())
+    existing: Dict[str, Tuple[int, float]] = {}
+    groups: Dict[int, List[Tuple[Any, Dict[str, Any]]]] = {}
+    unread = 0
+    for doc in docs:
+        data = doc.to_dict() or {}
+        if data.get('digest'):
+            existing[doc.id] = (data.get('count') or 0, data.get('amount') or 0)
+        if not _is_read(data):
+            unread += 1
+            if _is_reward(data):
+                groups.setdefault(int(_epoch(data.get('created_at')) // window), []).append((doc, data))
+        elif 'expires_at' not in data:
+            expires = datetime.fromtimestamp(max(now, _epoch(data.get('created_at')) + ttl))
+            writes.group([('update', doc.reference, {'expires_at': expires})])
+            stats['expiring'] += 1
+
+    deleted = created = merged_unread = 0
+    for index, members in groups.items():
+        ref = db.collection(COLLECTION).document(digest_id(user_id, window, index))
+        count, amount = existing.get(ref.id, (0, 0))
+        if len(members) < 2 and not count:
+            continue  # a lone reward stays as it is
+        members.sort(key=lambda m: _epoch(m[1].get('created_at')))
+        amounts = [float(m.group(1)) if m else config.REFERRAL_REWARD
+                   for m in (_AMOUNT.search(data.get('message') or '') for _, data in members)]
+        last = (members[-1][1].get('message') or '').split('!')[0]
+        newest = max(_epoch(data.get('created_at')) for _, data in members)
+        total_count, total_amount = count + len(members), amount + sum(amounts)
+        # The digest and the deletes it replaces commit together
+        for start in range(0, len(members), BATCH_LIMIT - 1):
+            chunk = members[start:start + BATCH_LIMIT - 1]
+            chunk_amount = sum(amounts[start:start + BATCH_LIMIT - 1])
+            writes.group([('set', ref, _digest_write(user_id, window, index, total_count, total_amount,
+                                                     len(chunk), chunk_amount, last,
+                                                     datetime.fromtimestamp(newest)))]
+                         + [('delete', doc.reference, None) for doc, _ in chunk])
+        deleted += len(members)
+        merged_unread += len(members) - (0 if count else 1)
+        created += 0 if count else 1
+
+    after = len(docs) - deleted + created
+    stats['users'] += 1
+    stats['docs_before'] += len(docs)
+    stats['docs_after'] += after
+    stats['deleted'] += deleted
+    stats['digests'] += created
+    stats['inbox_reads_before'] += _read_cost(min(INBOX_PAGE, len(docs)))
+    stats['inbox_reads_after'] += _read_cost(min(INBOX_PAGE, after))
+    stats['unread_reads_before'] += _read_cost(unread)
+    stats['unread_reads_after'] += _read_cost(unread - merged_unread)
+    stats['max_docs_before'] = max(stats['max_docs_before'], len(docs))
+    stats['max_docs_after'] = max(stats['max_docs_after'], after)
+
+
+def compact(db, user_ids=None, apply: bool = False, page_size: int = None) -> Dict[str, Any]:
+    """Compact every user's inbox (or the given ones); report only unless apply"""
+    started = time.time()
+    stats = dict.fromkeys(('users', 'docs_before', 'docs_after', 'deleted', 'digests', 'expiring',
+                           'inbox_reads_before', 'inbox_reads_after', 'unread_reads_before',
+                           'unread_reads_after', 'max_docs_before', 'max_docs_after'), 0)
+    writes = _Writes(db, apply)
+    if user_ids is None:
+        user_ids = (str(row.get('telegram_id') or row['doc_id'])
+                    for page in stream_pages(db, 'users', page_size or config.EXPORT_PAGE_SIZE) for row in page)
+    for user_id in user_ids:
+        compact_user(db, user_id, writes, stats, started)
+        if stats['users'] % 1000 == 0:
+            logger.info(f"📨 Compaction: {stats['users']:,} users, {stats['deleted']:,} merged")
+    writes.flush()
+    stats.update({
+        'applied': apply,
+        'commits': writes.commits,
+        'docs_after_ttl': stats['docs_after'] - stats['expiring'],
+        'seconds': round(time.time() - started, 1),
+    })
+    return stats
+
+
+def print_report(stats: Dict[str, Any]):
+    before, after = stats['docs_before'], stats['docs_after']
+    print(f"📨 Users: {stats['users']:,}  notifications: {before:,} → {after:,} "
+          f"({1 - after / max(before, 1):.0%} fewer), {stats['docs_after_ttl']:,} once "
+          f"{stats['expiring']:,} read ones expire")
+    print(f"📦 Merged {stats['deleted']:,} reward notifications into {stats['digests']:,} digests; "
+          f"largest inbox {stats['max_docs_before']:,} → {stats['max_docs_after']:,}")
+    print(f"📖 Reads to open every inbox: {stats['inbox_reads_before']:,} → {stats['inbox_reads_after']:,}; "
+          f"to count unread: {stats['unread_reads_before']:,} → {stats['unread_reads_after']:,}")
+    if not stats['applied']:
+        print("ℹ️ Report only; run with --apply to write")
+
+
+def synthetic_dataset(db, users: int, seed: int = 5):
+    """Pareto-sized inboxes: most users a handful of notifications, a few thousands"""
+    import random
+    rng = random.Random(seed)
+    now = time.time()
+    base = 6_000_000_000
+    for i in range(users):
+        user_id = str(base + i)
+        db.seed('users', user_id, {'telegram_id': user_id})
+        rewards = min(int(rng.paretovariate(0.9)) - 1, 5000)
+        for j in range(rewards):
+            created = now - rng.uniform(0, 120 * 86400)
+            db.seed(COLLECTION, f"n{i}_{j}", {
+                'user_id': user_id, 'type': 'reward', 'title': REWARD_TITLE,
+                'message': f'User Friend{j} joined the group! You earned ৳2.',
+                'read': rng.random() < 0.15, 'created_at': datetime.fromtimestamp(created)})
+        for j in range(rng.randint(0, 3)):
+            db.seed(COLLECTION, f"w{i}_{j}", {
+                'user_id': user_id, 'type': 'success', 'title': 'Withdrawal Approved',
+                'message': 'Your withdrawal was approved.', 'is_read': rng.random() < 0.7,
+                'created_at': datetime.fromtimestamp(now - rng.uniform(0, 60 * 86400))})
+
+
+def run_synthetic(users: int):
+    from fake_firestore import FakeFirestore
+
+    db = FakeFirestore()
+    synthetic_dataset(db, users)
+    stats = compact(db, apply=True)
+    print_report(stats)
+    again = compact(db, apply=True)
+    print(f"🔁 Second run: {again['deleted']:,} merged, {again['expiring']:,} newly expiring")
+
+    # Live: a burst of rewards for one heavy referrer, one notification per window
+    live = NotificationInbox(window=config.NOTIFY_DIGEST_WINDOW)
+    start = time.time()
+    rewards = 1000
+    for n in range(rewards):
+        batch = db.batch()
+        committed = live.add_reward(batch, db, '42', config.REFERRAL_REWARD, f'User Friend{n} joined the group',
+                                    now=start + n * 30)
+        batch.commit()
+        committed()
+    print(f"⚡ Live: {rewards:,} rewards over {rewards * 30 / 3600:.1f}h → {live.digests} notifications "
+          f"({live.seed_reads} seed reads)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notification inbox compaction')
+    parser.add_argument('--apply', action='store_true', help='Write digests, deletes and TTL stamps')
+    parser.add_argument('--user', action='append', help='Compact only this user (repeatable)')
+    parser.add_argument('--synthetic', type=int, default=0, help='Run against N synthetic users in memory')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.synthetic:
+        run_synthetic(args.synthetic)
+        return
+    from bot_firebase import db
+    if db is None:
+        parser.error("Firestore is not configured")
+    stats = compact(db, args.user, apply=args.apply)
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print_report(stats)
+
+
+if __name__ == "__main__":
+    main()
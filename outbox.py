@@ -0,0 +1,210 @@
+"""
+Cash Points Outbox
+Durable local outbox for fallback (offline) mode.
+
+- Records user-upsert, referral and reward events while Firebase is unavailable
+- SQLite in WAL mode with synchronous=FULL: an acknowledged append survives a crash
+- One row per dedupe key, so repeated /start or verify clicks don't pile up
+- Replays events in order through idempotent handlers, in batches, once
+  connectivity returns; a failing event stops the batch and is retried later
+- Only real failures count towards OUTBOX_MAX_ATTEMPTS: an open breaker, a
+  transient backend error or a ReplayError just means "not yet", so a long
+  outage never parks (drops) queued events
+- Reports depth and replay throughput for /status from counts kept by the
+  writes themselves, so stats() never touches SQLite
+"""
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable
+
+from config import config
+from resilience import is_degraded_error
+
+logger = logging.getLogger(__name__)
+
+# Event kinds
+USER_UPSERT = 'user_upsert'
+REFERRAL = 'referral'
+REWARD = 'reward'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class ReplayError(Exception):
+    """Raised by a replay handler when an event should be retried later"""
+
+
+class Outbox:
+    """Append-only event queue backed by a local SQLite file"""
+
+    def __init__(self, path: str = None, max_attempts: int = None):
+        self.path = path or config.OUTBOX_PATH
+        self.max_attempts = max_attempts or config.OUTBOX_MAX_ATTEMPTS
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(SCHEMA)
+        self._depth = 0
+        self._dead = 0
+        with self._lock:
+            self._count()
+        self.appended = 0
+        self.replayed = 0
+        self.replay_failures = 0
+        self.last_replay_rate = 0.0
+        self.last_replay_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    # ---- Recording --------------------------------------------------------
+
+    def append(self, kind: str, dedupe_key: str, payload: Dict[str, Any]) -> bool:
+        """Record an event; a newer event with the same key replaces the payload in place"""
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO outbox (kind, dedupe_key, payload, created_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(dedupe_key) DO UPDATE SET payload = excluded.payload, "
+                    "attempts = 0, dead = 0, last_error = NULL",
+                    (kind, dedupe_key, json.dumps(payload, default=_json_default), time.time())
+                )
+                self._count()
+            self.appended += 1
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"❌ Outbox append failed for {dedupe_key}: {e}")
+            return False
+
+    def pending(self, limit: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, dedupe_key, payload, attempts FROM outbox "
+                "WHERE dead = 0 ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [{'id': row[0], 'kind': row[1], 'dedupe_key': row[2],
+                 'payload': json.loads(row[3]), 'attempts': row[4]} for row in rows]
+
+    def ack(self, ids: List[int]):
+        """Remove replayed events in a single transaction"""
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self._conn.execute('COMMIT')
+            self._count()
+
+    def fail(self, event_id: int, error: str, counted: bool = True):
+        """Record a failed attempt; a counted one parks the event once it runs out of attempts"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = attempts + ?, last_error = ?, "
+                "dead = CASE WHEN attempts + ? >= ? THEN 1 ELSE 0 END WHERE id = ?",
+                (int(counted), error[:500], int(counted), self.max_attempts, event_id)
+            )
+            self._count()
+
+    def _count(self):
+        """Refresh the cached depth and dead counts; call with the lock held"""
+        self._depth, self._dead = self._conn.execute(
+            "SELECT COUNT(*) - COALESCE(SUM(dead), 0), COALESCE(SUM(dead), 0) FROM outbox").fetchone()
+
+    def has(self, dedupe_key: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM outbox WHERE dedupe_key = ? AND dead = 0",
+                                      (dedupe_key,)).fetchone() is not None
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 0").fetchone()[0]
+
+    def dead_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 1").fetchone()[0]
+
+    # ---- Replay -----------------------------------------------------------
+
+    async def replay(self, handlers: Dict[str, Callable], batch_size: int = None) -> int:
+        """Replay pending events in order; returns the number of events applied
+
+        Handlers are async callables taking the event payload. They must be
+        idempotent: an event may be replayed again if the process dies
+        between applying it and acknowledging it.
+        """
+        batch_size = batch_size or config.OUTBOX_REPLAY_BATCH
+        applied = 0
+        started = time.perf_counter()
+        while True:
+            events = await asyncio.to_thread(self.pending, batch_size)
+            if not events:
+                break
+            done = []
+            stopped = False
+            for event in events:
+                handler = handlers.get(event['kind'])
+                try:
+                    if handler is None:
+                        raise LookupError(f"No handler for {event['kind']}")
+                    await handler(event['payload'])
+                    done.append(event['id'])
+                except Exception as e:
+                    self.replay_failures += 1
+                    self.last_error = str(e)
+                    # Still unreachable is not a reason to give up on the event
+                    counted = not (isinstance(e, ReplayError) or is_degraded_error(e))
+                    await asyncio.to_thread(self.fail, event['id'], str(e), counted)
+                    logger.warning(f"Outbox replay stopped at {event['dedupe_key']}: {e}")
+                    stopped = True
+                    break
+            await asyncio.to_thread(self.ack, done)
+            applied += len(done)
+            if stopped or len(events) < batch_size:
+                break
+
+        if applied:
+            elapsed = time.perf_counter() - started
+            self.replayed += applied
+            self.last_replay_rate = applied / elapsed if elapsed > 0 else float(applied)
+            self.last_replay_at = time.time()
+            logger.info(f"📤 Replayed {applied} outbox events ({self.last_replay_rate:.1f}/sec)")
+        return applied
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'depth': self._depth,
+            'dead': self._dead,
+            'appended': self.appended,
+            'replayed': self.replayed,
+            'replay_failures': self.replay_failures,
+            'last_replay_rate': self.last_replay_rate,
+            'last_error': self.last_error,
+        }
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
@@ -0,0 +1,89 @@
+"""
+Cash Points Rate Governor
+Shared budget for Bot API calls.
+
+- Token bucket refilled at BOT_API_RATE_LIMIT calls/sec with a small burst
+- Interactive calls (handlers) are charged but never delayed; background
+  calls (sweeps, broadcasts) only take tokens above a reserve, so they back
+  off while user-facing traffic is busy
+- A RetryAfter from Telegram pauses every caller for the requested time
+"""
+
+import time
+import asyncio
+import logging
+from typing import Dict, Any
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class RateGovernor:
+    """Async token bucket shared by everything that calls the Bot API"""
+
+    def __init__(self, rate: float = None, burst: float = None, reserve: float = None):
+        self.rate = rate or config.BOT_API_RATE_LIMIT
+        self.burst = burst or max(1.0, self.rate)
+        # Share of the bucket background callers leave for interactive calls
+        self.reserve = self.burst * (reserve if reserve is not None else config.BOT_API_INTERACTIVE_RESERVE)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self.granted = 0
+        self.background_granted = 0
+        self.throttled = 0
+        self.penalties = 0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, background: bool = False):
+        """Wait for one call's worth of budget
+
+        Interactive calls are charged without waiting (the bucket may go into
+        debt) so user-facing latency never depends on background load; background
+        calls wait until the bucket is back above the reserve.
+        """
+        waited = False
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                waited = True
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if not background:
+                self._tokens = max(self._tokens - 1.0, -self.burst)
+                break
+            floor = 1.0 + self.reserve
+            if self._tokens >= floor:
+                self._tokens -= 1.0
+                break
+            waited = True
+            await asyncio.sleep((floor - self._tokens) / self.rate)
+        self.granted += 1
+        if background:
+            self.background_granted += 1
+        if waited:
+            self.throttled += 1
+
+    def penalize(self, retry_after: float):
+        """Pause all callers after Telegram answered with RetryAfter"""
+        self.penalties += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._tokens = 0.0
+        logger.warning(f"⏸️ Bot API flood control: pausing calls for {retry_after:.1f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rate': self.rate,
+            'granted': self.granted,
+            'background_granted': self.background_granted,
+            'throttled': self.throttled,
+            'penalties': self.penalties,
+        }
+
+
+governor = RateGovernor()
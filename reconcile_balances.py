@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+"""
+Cash Points Balance Reconciliation
+Features:
+- Streams the ledger page by page: earnings (amount), task_completions
+  (reward_amount, credited without an earnings row), withdrawal_requests, and
+  the credits the admin panel makes without an earnings row: verified
+  special_task_submissions and trading_platform_referrals (reward_amount) and
+  balance edits (user_activities balance_modified, details.change_amount,
+  balance only)
+- Per-user sums kept in sorted NumPy arrays; pages are buffered and merged
+  every RECONCILE_CHUNK_ROWS rows with np.unique + bincount, so memory grows
+  with the number of users, not the number of ledger rows
+- Compares users.balance (earned - withdrawn), total_earnings (earned) and
+  total_referrals (referral rewards - reversals) with the ledger
+- Writes a drift report (CSV + summary JSON) and, with --apply, corrects
+  drifted users in 500-write batches with Increments. Corrections that would
+  lower balance or total_earnings are reported (action `held`) but never
+  applied: referral rewards paid by bot_firebase.process_referral before it
+  wrote earnings rows have no ledger row, so a balance above the ledger is
+  not proof of an overpayment
+- Rows created and users updated after the run started are left out, so
+  concurrent rewards never show up as drift
+
+Withdrawals count against the balance while pending or approved, except
+held requests (balance_debited false), which are only debited when approved.
+A rejected withdrawal is refunded unless the admin marked the rejection
+valid, which is not recorded on the request; a balance short by exactly the
+rejected amount is reported as `unrefunded_rejection` and never corrected.
+
+Usage:
+    python reconcile_balances.py                 # report only
+    python reconcile_balances.py --apply         # report and correct
+    python reconcile_balances.py --synthetic 10000000
+"""
+
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from config import config
+from models import User
+from export_data import stream_pages, peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+# Ledger columns summed per user; ADJUSTED (admin balance edits) counts towards the balance only
+EARNED, WITHDRAWN, REJECTED, REFERRALS, ADJUSTED = range(5)
+COLUMNS = ('earned', 'withdrawn', 'rejected', 'referrals', 'adjusted')
+
+# Rewards credited by the admin panel when it verifies a submission: amount field, credit time field
+VERIFIED_REWARDS = {
+    'special_task_submissions': ('reward_amount', 'verified_at'),
+    'trading_platform_referrals': ('reward_amount', 'verification_date'),
+}
+ADJUSTMENTS = 'user_activities'  # activity_type balance_modified, details.change_amount
+
+DEDUCTED_STATUSES = ('pending', 'processing', 'approved', 'completed', 'paid')
+BATCH_LIMIT = 500  # Firestore max writes per batch
+
+REPORT_FIELDS = ['user_doc_id', 'telegram_id', 'kind', 'balance', 'expected_balance', 'balance_drift',
+                 'total_earnings', 'expected_total_earnings', 'total_earnings_drift',
+                 'total_referrals', 'expected_referrals', 'referrals_drift',
+                 'earned', 'withdrawn', 'rejected', 'adjusted', 'action']
+
+
+def _epoch(value) -> float:
+    """Epoch seconds of a Firestore timestamp or ISO string (NaN when missing)"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return np.nan
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return np.nan
+
+
+def ledger_arrays(collection: str, rows: List[Dict[str, Any]], cutoff: float
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """(user_ids, values, columns, skipped) for one page of a ledger collection"""
+    n = len(rows)
+    # An earnings row can add to two columns (amount and referral count)
+    ids = np.empty(2 * n, dtype=np.int64)
+    values = np.empty(2 * n, dtype=np.float64)
+    columns = np.empty(2 * n, dtype=np.int8)
+    keep = np.zeros(2 * n, dtype=np.bool_)
+    skipped = 0
+    for i, row in enumerate(rows):
+        if collection == ADJUSTMENTS and row.get('activity_type') != 'balance_modified':
+            continue
+        if collection in VERIFIED_REWARDS and row.get('status') != 'verified':
+            continue
+        try:
+            user_id = int(row.get('user_id'))
+            if collection == 'task_completions':
+                amount = float(row.get('reward_amount') or 0)
+            elif collection in VERIFIED_REWARDS:
+                amount = float(row.get(VERIFIED_REWARDS[collection][0]) or 0)
+            elif collection == ADJUSTMENTS:
+                amount = float((row.get('details') or {}).get('change_amount') or 0)
+            else:
+                amount = float(row.get('amount') or 0)
+        except (TypeError, ValueError):
+            skipped += 1
+            continue
+        credited_at = row.get(VERIFIED_REWARDS[collection][1]) if collection in VERIFIED_REWARDS else None
+        if _epoch(credited_at or row.get('created_at')) >= cutoff:
+            skipped += 1  # written after the run started
+            continue
+        ids[2 * i] = ids[2 * i + 1] = user_id
+        values[2 * i] = amount
+        keep[2 * i] = True
+        if collection == ADJUSTMENTS:
+            columns[2 * i] = ADJUSTED
+            continue
+        if collection == 'withdrawal_requests':
+            status = row.get('status') or 'pending'
+            if status == 'rejected':
+                columns[2 * i] = REJECTED
+            elif status in DEDUCTED_STATUSES and row.get('balance_debited') is not False:
+                columns[2 * i] = WITHDRAWN
+            else:
+                keep[2 * i] = False
+            continue
+        columns[2 * i] = EARNED
+        kind = row.get('type')
+        if kind in ('referral', 'referral_reversal'):
+            columns[2 * i + 1] = REFERRALS
+            values[2 * i + 1] = 1 if kind == 'referral' else -1
+            keep[2 * i + 1] = True
+    return ids[keep], values[keep], columns[keep], skipped
+
+
+class LedgerTotals:
+    """Per-user column sums over a stream of ledger rows, kept in sorted NumPy arrays"""
+
+    def __init__(self, chunk_rows: int = None):
+        self.chunk_rows = chunk_rows or config.RECONCILE_CHUNK_ROWS
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.sums = np.zeros((len(COLUMNS), 0), dtype=np.float64)
+        self.rows = 0
+        self.merges = 0
+        self._pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._pending_rows = 0
+
+    def add(self, ids: np.ndarray, values: np.ndarray, columns: np.ndarray):
+        self._pending.append((ids, values, columns))
+        self._pending_rows += len(ids)
+        self.rows += len(ids)
+        if self._pending_rows >= self.chunk_rows:
+            self._merge()
+
+    def _merge(self):
+        if not self._pending:
+            return
+        ids, values, columns = (np.concatenate(parts) for parts in zip(*self._pending))
+        self._pending, self._pending_rows = [], 0
+        known = len(self.user_ids)
+        user_ids, inverse = np.unique(np.concatenate([self.user_ids, ids]), return_inverse=True)
+        sums = np.zeros((len(COLUMNS), len(user_ids)), dtype=np.float64)
+        sums[:, inverse[:known]] = self.sums
+        new = inverse[known:]
+        for column in range(len(COLUMNS)):
+            mask = columns == column
+            sums[column] += np.bincount(new[mask], weights=values[mask], minlength=len(user_ids))
+        self.user_ids, self.sums = user_ids, sums
+        self.merges += 1
+
+    def finish(self) -> 'LedgerTotals':
+        self._merge()
+        return self
+
+    def lookup(self, telegram_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(index into user_ids or -1, sums with zeros for users without ledger rows)"""
+        index = np.full(len(telegram_ids), -1, dtype=np.int64)
+        sums = np.zeros((len(COLUMNS), len(telegram_ids)), dtype=np.float64)
+        if len(self.user_ids):
+            pos = np.minimum(np.searchsorted(self.user_ids, telegram_ids), len(self.user_ids) - 1)
+            found = self.user_ids[pos] == telegram_ids
+            index[found] = pos[found]
+            sums[:, found] = self.sums[:, pos[found]]
+        return index, sums
+
+    @property
+    def nbytes(self) -> int:
+        return self.user_ids.nbytes + self.sums.nbytes
+
+
+def user_arrays(rows: List[Dict[str, Any]], cutoff: float):
+    """Parallel arrays for one page of users; users updated after the cutoff are set aside"""
+    doc_ids, telegram_ids, current, has_total_referrals, changed = [], [], [], [], []
+    for row in rows:
+        user = User.from_firestore(row.get('doc_id', ''), row)
+        try:
+            telegram_id = int(user.telegram_id)
+        except ValueError:
+            continue
+        if _epoch(user.updated_at) >= cutoff:
+            changed.append(telegram_id)
+            continue
+        doc_ids.append(user.doc_id)
+        telegram_ids.append(telegram_id)
+        current.append((user.balance, user.total_earnings, user.total_referrals))
+        has_total_referrals.append('total_referrals' in row)
+    current = np.array(current, dtype=np.float64).reshape(-1, 3).T
+    return (doc_ids, np.array(telegram_ids, dtype=np.int64), current,
+            np.array(has_total_referrals, dtype=np.bool_), np.array(changed, dtype=np.int64))
+
+
+class DriftReport:
+    """Streams drifted users to CSV and keeps the run summary"""
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self.path = os.path.join(out_dir, 'drift.csv')
+        self._file = open(self.path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+        self._writer.writeheader()
+        self.kinds: Dict[str, int] = {}
+        self.balance_drift = 0.0
+        self.total_earnings_drift = 0.0
+
+    def write(self, row: Dict[str, Any]):
+        self._writer.writerow(row)
+        self.kinds[row['kind']] = self.kinds.get(row['kind'], 0) + 1
+        self.balance_drift += abs(row.get('balance_drift') or 0)
+        self.total_earnings_drift += abs(row.get('total_earnings_drift') or 0)
+
+    def close(self, summary: Dict[str, Any]):
+        self._file.close()
+        summary.update({'drifted_by_kind': self.kinds, 'report': self.path,
+                        'abs_balance_drift': round(self.balance_drift, 2),
+                        'abs_total_earnings_drift': round(self.total_earnings_drift, 2)})
+        with open(os.path.join(self.out_dir, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
+
+
+class Corrections:
+    """Increment-based corrections committed BATCH_LIMIT writes at a time"""
+
+    def __init__(self, db):
+        self.db = db
+        self._batch = db.batch()
+        self._pending = 0
+        self.applied = 0
+        self.commits = 0
+
+    def add(self, doc_id: str, update: Dict[str, Any]):
+        self._batch.update(self.db.collection('users').document(doc_id), update)
+        self._pending += 1
+        if self._pending >= BATCH_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._batch.commit()
+            self.applied += self._pending
+            self.commits += 1
+            self._batch = self.db.batch()
+            self._pending = 0
+
+
+def _round(value) -> float:
+    return round(float(value), 2)
+
+
+def reconcile(ledger_pages: Iterable[Tuple[str, List[Dict[str, Any]]]],
+              user_pages: Iterable[List[Dict[str, Any]]], report: DriftReport,
+              started_at: float, tolerance: float = 0.01,
+              corrections: Optional[Corrections] = None) -> Dict[str, Any]:
+    """Aggregate the ledger, compare every user with it and report (and correct) drift"""
+    if corrections is not None:
+        from firebase_admin import firestore
+
+    started = time.perf_counter()
+    totals = LedgerTotals()
+    ledger_rows = skipped = 0
+    for collection, rows in ledger_pages:
+        ledger_rows += len(rows)
+        ids, values, columns, page_skipped = ledger_arrays(collection, rows, started_at)
+        totals.add(ids, values, columns)
+        skipped += page_skipped
+    totals.finish()
+    aggregated = time.perf_counter()
+    logger.info(f"🧮 {ledger_rows} ledger rows for {len(totals.user_ids)} users "
+                f"({totals.nbytes / 1e6:.1f} MB, {totals.merges} merges)")
+
+    seen = np.zeros(len(totals.user_ids), dtype=np.bool_)
+    users = changed = held = 0
+    for rows in user_pages:
+        doc_ids, telegram_ids, current, has_total_referrals, page_changed = user_arrays(rows, started_at)
+        users += len(doc_ids)
+        changed += len(page_changed)
+        index, _ = totals.lookup(page_changed)
+        seen[index[index >= 0]] = True
+        if not doc_ids:
+            continue
+        index, sums = totals.lookup(telegram_ids)
+        seen[index[index >= 0]] = True
+        balance, total_earnings, total_referrals = current
+        expected_balance = sums[EARNED] - sums[WITHDRAWN] + sums[ADJUSTED]
+        balance_drift = balance - expected_balance
+        earnings_drift = total_earnings - sums[EARNED]
+        referrals_drift = total_referrals - sums[REFERRALS]
+        drifted = ((np.abs(balance_drift) > tolerance) | (np.abs(earnings_drift) > tolerance)
+                   | (referrals_drift != 0))
+        # A valid (unrefunded) rejection leaves the balance short by exactly the rejected amount
+        unrefunded = (sums[REJECTED] > 0) & (np.abs(balance_drift + sums[REJECTED]) <= tolerance)
+        for i in np.flatnonzero(drifted):
+            fix_balance = abs(balance_drift[i]) > tolerance and not unrefunded[i]
+            fix_earnings = abs(earnings_drift[i]) > tolerance
+            if unrefunded[i] and not fix_earnings and not referrals_drift[i]:
+                kind = 'unrefunded_rejection'
+            else:
+                kind = '+'.join(name for name, bad in (('balance', fix_balance), ('total_earnings', fix_earnings),
+                                                       ('total_referrals', referrals_drift[i] != 0)) if bad)
+            # A balance above the ledger may be a credit with no ledger row; never take it back
+            lowers = (fix_balance and balance_drift[i] > 0) or (fix_earnings and earnings_drift[i] > 0)
+            if corrections is None or kind == 'unrefunded_rejection':
+                action = ''
+            else:
+                action = 'held' if lowers else 'corrected'
+            report.write({
+                'user_doc_id': doc_ids[i], 'telegram_id': int(telegram_ids[i]), 'kind': kind,
+                'balance': _round(balance[i]), 'expected_balance': _round(expected_balance[i]),
+                'balance_drift': _round(balance_drift[i]),
+                'total_earnings': _round(total_earnings[i]), 'expected_total_earnings': _round(sums[EARNED][i]),
+                'total_earnings_drift': _round(earnings_drift[i]),
+                'total_referrals': int(total_referrals[i]), 'expected_referrals': int(sums[REFERRALS][i]),
+                'referrals_drift': int(referrals_drift[i]),
+                'earned': _round(sums[EARNED][i]), 'withdrawn': _round(sums[WITHDRAWN][i]),
+                'rejected': _round(sums[REJECTED][i]), 'adjusted': _round(sums[ADJUSTED][i]),
+                'action': action,
+            })
+            if action != 'corrected':
+                held += action == 'held'
+                continue
+            # Increments, so a write that lands between our read and the commit is kept
+            update = {'reconciled_at': datetime.now(), 'updated_at': datetime.now()}
+            if fix_balance:
+                update['balance'] = firestore.Increment(-float(balance_drift[i]))
+            if fix_earnings:
+                update['total_earnings'] = firestore.Increment(-float(earnings_drift[i]))
+            if referrals_drift[i]:
+                if has_total_referrals[i]:
+                    update['total_referrals'] = firestore.Increment(-int(referrals_drift[i]))
+                else:
+                    # Only the legacy referral_count was ever written
+                    update['total_referrals'] = int(sums[REFERRALS][i])
+            corrections.add(doc_ids[i], update)
+    if corrections is not None:
+        corrections.flush()
+
+    # Ledger rows whose user document doesn't exist
+    missing = np.flatnonzero(~seen & (np.abs(totals.sums[EARNED]) > tolerance))
+    for i in missing:
+        report.write({'user_doc_id': '', 'telegram_id': int(totals.user_ids[i]), 'kind': 'missing_user',
+                      'earned': _round(totals.sums[EARNED][i]), 'withdrawn': _round(totals.sums[WITHDRAWN][i]),
+                      'rejected': _round(totals.sums[REJECTED][i]), 'adjusted': _round(totals.sums[ADJUSTED][i])})
+
+    elapsed = time.perf_counter() - started
+    return {
+        'started_at': datetime.fromtimestamp(started_at, timezone.utc).isoformat(),
+        'ledger_rows': ledger_rows,
+        'ledger_users': len(totals.user_ids),
+        'ledger_skipped': skipped,
+        'aggregate_mb': round(totals.nbytes / 1e6, 1),
+        'users': users,
+        'users_changed_during_run': changed,
+        'corrected': corrections.applied if corrections is not None else 0,
+        'held': held,
+        'aggregate_seconds': round(aggregated - started, 2),
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(ledger_rows / max(aggregated - started, 1e-9)),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+# Collection -> equality filters for the rows that move a balance
+LEDGER_COLLECTIONS = {
+    'earnings': None,
+    'task_completions': None,
+    'withdrawal_requests': None,
+    'special_task_submissions': {'status': 'verified'},
+    'trading_platform_referrals': {'status': 'verified'},
+    ADJUSTMENTS: {'activity_type': 'balance_modified'},
+}
+
+
+def firestore_ledger(db, page_size: int) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    for collection, equals in LEDGER_COLLECTIONS.items():
+        for rows in stream_pages(db, collection, page_size, equals=equals):
+            yield collection, rows
+
+
+# ---- Synthetic data ---------------------------------------------------------
+
+def _synthetic_rows(total_rows: int, users: int, start: int = 0, stop: int = None):
+    """Vectorized description of earnings rows [start, stop): (owner index, amount, is_referral)"""
+    i = np.arange(start, total_rows if stop is None else stop, dtype=np.int64)
+    owner = (i * 7919) % users
+    bonus = i % 10 == 0
+    return owner, np.where(bonus, 5.0, 2.0), ~bonus
+
+
+def synthetic_dataset(total_rows: int, page_size: int, drift_every: int = 1000):
+    """(ledger pages, user pages, planted drift count) shaped like the real collections"""
+    users = max(total_rows // 20, 1)
+    base_id = 5_000_000_000
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+    earned = np.zeros(users)
+    referrals = np.zeros(users)
+    for start in range(0, total_rows, 1_000_000):
+        owner, amount, is_referral = _synthetic_rows(total_rows, users, start, min(start + 1_000_000, total_rows))
+        earned += np.bincount(owner, weights=amount, minlength=users)
+        referrals += np.bincount(owner, weights=is_referral, minlength=users)
+    withdrawn = np.where(np.arange(users) % 7 == 0, np.minimum(earned, 100), 0)
+    # Admin panel credits with no earnings row: a special task reward and a balance edit
+    special = np.where(np.arange(users) % 11 == 3, 25.0, 0)
+    adjusted = np.where(np.arange(users) % 13 == 4, -10.0, 0)
+
+    def ledger():
+        for start in range(0, total_rows, page_size):
+            owner, amount, is_referral = _synthetic_rows(total_rows, users, start,
+                                                         min(start + page_size, total_rows))
+            yield 'earnings', [{'user_id': str(base_id + o), 'amount': a,
+                                'type': 'referral' if r else 'referral_level_bonus',
+                                'created_at': created_at} for o, a, r in zip(owner.tolist(), amount.tolist(),
+                                                                             is_referral.tolist())]
+        rows = [{'user_id': base_id + u, 'amount': float(withdrawn[u]), 'status': 'approved',
+                 'created_at': created_at.isoformat()} for u in np.flatnonzero(withdrawn).tolist()]
+        for start in range(0, len(rows), page_size):
+            yield 'withdrawal_requests', rows[start:start + page_size]
+        rows = [{'user_id': str(base_id + u), 'reward_amount': 25.0, 'status': 'verified',
+                 'created_at': created_at, 'verified_at': created_at} for u in np.flatnonzero(special).tolist()]
+        for start in range(0, len(rows), page_size):
+            yield 'special_task_submissions', rows[start:start + page_size]
+        rows = [{'user_id': str(base_id + u), 'activity_type': 'balance_modified', 'created_at': created_at,
+                 'details': {'change_amount': -10.0}} for u in np.flatnonzero(adjusted).tolist()]
+        for start in range(0, len(rows), page_size):
+            yield ADJUSTMENTS, rows[start:start + page_size]
+
+    def user_pages():
+        for start in range(0, users, page_size):
+            rows = []
+            for u in range(start, min(start + page_size, users)):
+                balance, total = earned[u] + special[u] - withdrawn[u] + adjusted[u], earned[u] + special[u]
+                row = {'doc_id': str(base_id + u), 'telegram_id': str(base_id + u), 'updated_at': created_at,
+                       'balance': balance, 'total_earnings': total, 'total_referrals': int(referrals[u])}
+                if u % drift_every == 1:
+                    row['balance'] = balance + 2  # lost read-modify-write race
+                elif u % drift_every == 2:
+                    # bot_firebase.process_referral before it wrote earnings rows: reported, held
+                    del row['total_referrals']
+                    row['referral_count'] = int(referrals[u]) + 1
+                    row['balance'], row['total_earnings'] = balance + 2, total + 2
+                rows.append(row)
+            yield rows
+
+    planted = sum(1 for u in range(users) if u % drift_every in (1, 2))
+    return ledger(), user_pages(), planted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile user balances with the earnings ledger')
+    parser.add_argument('--apply', action='store_true', help='Correct drifted users (Increment writes)')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Ignore drift up to this amount')
+    parser.add_argument('--page-size', type=int, default=config.EXPORT_PAGE_SIZE)
+    parser.add_argument('--out', default=os.path.join(config.EXPORT_DIR, 'reconcile'), help='Report directory')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Reconcile N synthetic earnings rows instead of Firestore (no writes)')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    started_at = time.time()
+    out_dir = os.path.join(args.out, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+    report = DriftReport(out_dir)
+    corrections = None
+    if args.synthetic:
+        ledger, users, planted = synthetic_dataset(args.synthetic, args.page_size)
+        print(f"🧪 {args.synthetic} synthetic earnings rows, {planted} drifted users planted")
+    else:
+        from bot_firebase import db
+        if not db:
+            print("❌ Firebase not connected")
+            return
+        ledger = firestore_ledger(db, args.page_size)
+        users = stream_pages(db, 'users', args.page_size)
+        if args.apply:
+            corrections = Corrections(db)
+
+    summary = reconcile(ledger, users, report, started_at, args.tolerance, corrections)
+    report.close(summary)
+    print(f"📥 {summary['ledger_rows']} ledger rows for {summary['ledger_users']} users in "
+          f"{summary['aggregate_seconds']}s ({summary['rows_per_second']} rows/sec, "
+          f"{summary['aggregate_mb']} MB of sums)")
+    print(f"👥 {summary['users']} users compared ({summary['users_changed_during_run']} changed during the run)")
+    print(f"⚖️ Drift: {summary['drifted_by_kind'] or 'none'}; |balance| {summary['abs_balance_drift']}, "
+          f"|total_earnings| {summary['abs_total_earnings_drift']}")
+    if corrections is not None:
+        print(f"✅ Corrected {corrections.applied} users in {corrections.commits} batches; "
+              f"{summary['held']} held (would lower a balance, see the report)")
+    print(f"   Report: {summary['report']} ({summary['elapsed_seconds']}s, peak RSS {summary['peak_rss_mb']} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Cash Points Referral Codes
+Self-validating referral codes that decode to the referrer without a lookup.
+
+Features:
+- Version 1 codes: "C1" + base36 Telegram ID + 5-char keyed checksum
+  (HMAC-SHA256 with REFERRAL_CODE_SECRET), e.g. C121I3V9HH8AW
+- parse_start_param() rejects garbage /start payloads and resolves v1 codes
+  and ref_<id> links with zero I/O
+- Codes issued under REFERRAL_CODE_PREVIOUS_SECRETS still decode after the
+  secret is rotated; a v1-shaped code whose checksum matches no secret is
+  looked up in referralCodes like a legacy code instead of being dropped
+- Legacy codes (CP..., BT...) resolve from a TTL cache that also remembers
+  codes that don't exist, then the shared lookup snapshot, then Firestore
+- In Firestore every code lives in referralCodes/{code}, so a lookup is one
+  document get; register_code() is how writers add one
+- Migration job that copies codes from the old places (the referral_codes
+  collection, users.referral_code, users.legacy_referral_codes) into
+  referralCodes. Until it has run, lookups that miss fall back to the old
+  places (REFERRAL_CODES_DUAL_READ) and copy what they find; lookup_stats() counts
+  those legacy hits so it's visible when the fallback can be switched off
+- Bulk re-issue job that gives every user a v1 code and keeps the old one in
+  legacy_referral_codes, so links already shared keep working
+
+Usage:
+    python referral_codes.py --encode 123456789
+    python referral_codes.py --decode C121I3V9HH8AW
+    python referral_codes.py --reissue [--dry-run]
+    python referral_codes.py --migrate [--dry-run]
+"""
+
+import re
+import hmac
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict, Counter
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, NamedTuple, Tuple, List
+
+from google.api_core.exceptions import AlreadyExists
+
+from config import config
+from lookup_snapshot import snapshot
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+PREFIX = 'C1'
+CHECKSUM_LENGTH = 5
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+V1_PATTERN = re.compile(r'^C1[0-9A-Z]{%d,20}$' % (CHECKSUM_LENGTH + 1))
+LEGACY_PATTERNS = (
+    re.compile(r'^CP[0-9A-Z]{1,20}$'),      # bot.py (last 6 digits) and frontend (full ID)
+    re.compile(r'^BT[0-9A-Za-z]{1,20}$'),   # enhanced referral bot / old frontend
+)
+REF_ID_PATTERN = re.compile(r'^ref_(\d{1,20})$')
+
+CODES_COLLECTION = 'referralCodes'            # one document per code, keyed by the code
+OLD_CODES_COLLECTION = 'referral_codes'       # auto-ID documents with a referral_code field
+BATCH_LIMIT = 500  # Firestore max writes per batch
+
+_lookups: Counter = Counter()
+
+
+class ReferralCode(NamedTuple):
+    code: str
+    version: int                  # 0 = legacy format
+    referrer_id: Optional[str]    # None until a legacy (or unverifiable v1) code is looked up
+
+
+def _base36(number: int) -> str:
+    digits = []
+    while True:
+        number, rem = divmod(number, 36)
+        digits.append(ALPHABET[rem])
+        if not number:
+            return ''.join(reversed(digits))
+
+
+def _checksum(user_id: int, secret: str = None) -> str:
+    key = (secret if secret is not None else config.REFERRAL_CODE_SECRET).encode()
+    digest = hmac.new(key, f"{VERSION}:{user_id}".encode(), hashlib.sha256).digest()
+    return _base36(int.from_bytes(digest[:8], 'big') % 36 ** CHECKSUM_LENGTH).rjust(CHECKSUM_LENGTH, '0')
+
+
+def encode(user_id, secret: str = None) -> str:
+    """The v1 referral code for a Telegram user ID"""
+    user_id = int(user_id)
+    if user_id <= 0:
+        raise ValueError(f"Invalid Telegram user ID: {user_id}")
+    return f"{PREFIX}{_base36(user_id)}{_checksum(user_id, secret)}"
+
+
+def decode(code: str, secret: str = None) -> Optional[str]:
+    """Referrer's Telegram ID for a v1 code, or None if it isn't a valid one
+    (checked against `secret`, or the current and previous secrets)"""
+    code = (code or '').strip().upper()
+    if not V1_PATTERN.match(code):
+        return None
+    body, checksum = code[len(PREFIX):-CHECKSUM_LENGTH], code[-CHECKSUM_LENGTH:]
+    if body.startswith('0'):
+        return None  # not canonical, so not one we issued
+    user_id = int(body, 36)
+    secrets = [secret] if secret is not None else [config.REFERRAL_CODE_SECRET, *config.REFERRAL_CODE_PREVIOUS_SECRETS]
+    if not any(hmac.compare_digest(checksum, _checksum(user_id, s)) for s in secrets):
+        return None
+    return str(user_id)
+
+
+def parse_start_param(param: str) -> Optional[ReferralCode]:
+    """Classify a /start payload; None means it isn't a referral code at all"""
+    param = (param or '').strip()
+    if not param or len(param) > 64:
+        return None
+    referrer_id = decode(param)
+    if referrer_id:
+        return ReferralCode(param.upper(), VERSION, referrer_id)
+    if V1_PATTERN.match(param.upper()):
+        # Issued under a secret we no longer know: its referralCodes doc still resolves it
+        return ReferralCode(param.upper(), VERSION, None)
+    match = REF_ID_PATTERN.match(param)
+    if match:
+        return ReferralCode(param, 0, str(int(match.group(1))))
+    if any(pattern.match(param) for pattern in LEGACY_PATTERNS):
+        return ReferralCode(param, 0, None)
+    return None
+
+
+def code_document(code: str, user_id, **fields) -> Dict[str, Any]:
+    """A referralCodes document"""
+    return {'user_id': str(user_id), 'referral_code': code, 'is_active': True,
+            'created_at': datetime.now(), 'total_uses': 0, 'total_earnings': 0, **fields}
+
+
+def register_code(db, code: str, user_id) -> bool:
+    """Add referralCodes/{code}; False if the code is already there"""
+    try:
+        db.collection(CODES_COLLECTION).document(code).create(code_document(code, user_id))
+        return True
+    except AlreadyExists:
+        return False
+
+
+def _find_in_old_places(db, code: str) -> Tuple[Optional[str], Optional[str]]:
+    """(owner, where it was found) from before codes were unified"""
+    users_ref = db.collection('users')
+    docs = list(users_ref.where('referral_code', '==', code).limit(1).stream())
+    if docs:
+        return str(docs[0].to_dict()['telegram_id']), 'users'
+    # Re-issued users keep their old codes here
+    docs = list(users_ref.where('legacy_referral_codes', 'array_contains', code).limit(1).stream())
+    if docs:
+        return str(docs[0].to_dict()['telegram_id']), 'legacy_referral_codes'
+    query = (db.collection(OLD_CODES_COLLECTION).where('referral_code', '==', code)
+             .where('is_active', '==', True).limit(1))
+    docs = list(query.stream())
+    if docs:
+        return str(docs[0].to_dict()['user_id']), OLD_CODES_COLLECTION
+    return None, None
+
+
+def lookup_legacy_code(db, code: str) -> Optional[str]:
+    """Find the owner of a pre-v1 code in Firestore: one get on referralCodes"""
+    doc = db.collection(CODES_COLLECTION).document(code).get()
+    if doc.exists:
+        _lookups['direct'] += 1
+        data = doc.to_dict() or {}
+        return str(data['user_id']) if data.get('is_active', True) else None
+    if not config.REFERRAL_CODES_DUAL_READ:
+        _lookups['missing'] += 1
+        return None
+
+    owner, source = _find_in_old_places(db, code)
+    if owner is None:
+        _lookups['missing'] += 1
+        return None
+    _lookups[f"legacy:{source}"] += 1
+    logger.info(f"🔑 Referral code {code} found in {source}, not {CODES_COLLECTION}")
+    try:
+        register_code(db, code, owner)  # next time it's a direct hit
+    except Exception as e:
+        logger.warning(f"Could not copy referral code {code} to {CODES_COLLECTION}: {e}")
+    return owner
+
+
+def lookup_stats() -> Dict[str, Any]:
+    """Lookup counts by path; legacy hits should drop to zero after --migrate"""
+    counts = dict(_lookups)
+    counts['legacy'] = sum(n for key, n in _lookups.items() if key.startswith('legacy:'))
+    counts['dual_read'] = config.REFERRAL_CODES_DUAL_READ
+    return counts
+
+
+class LegacyCodeCache:
+    """TTL + LRU cache of legacy code lookups, including misses"""
+
+    def __init__(self, ttl: float = None, negative_ttl: float = None, max_entries: int = None):
+        self.ttl = ttl if ttl is not None else config.REFERRAL_LEGACY_CACHE_TTL
+        self.negative_ttl = negative_ttl if negative_ttl is not None else config.REFERRAL_LEGACY_NEGATIVE_TTL
+        self.max_entries = max_entries or config.REFERRAL_LEGACY_CACHE_SIZE
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, code: str) -> Tuple[bool, Optional[str]]:
+        """(True, owner) for a live entry, (False, None) otherwise; never loads"""
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(code)
+                self.hits += 1
+                return True, entry[0]
+        return False, None
+
+    def get(self, code: str, loader: Callable[[str], Optional[str]]) -> Optional[str]:
+        found, referrer_id = self.peek(code)
+        if found:
+            return referrer_id
+        self.misses += 1
+        referrer_id = loader(code)
+        self.put(code, referrer_id)
+        return referrer_id
+
+    def put(self, code: str, referrer_id: Optional[str]):
+        """Record a code's owner learned elsewhere (e.g. from a snapshot listener)"""
+        ttl = self.ttl if referrer_id else self.negative_ttl
+        with self._lock:
+            self._entries[code] = (referrer_id, time.monotonic() + ttl)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, code: str):
+        with self._lock:
+            self._entries.pop(code, None)
+
+    def export(self) -> list:
+        """Live entries as [code, owner, seconds left], oldest first (for warm restarts)"""
+        now = time.monotonic()
+        with self._lock:
+            return [[code, owner, expires - now] for code, (owner, expires) in self._entries.items()
+                    if expires > now]
+
+    def restore(self, entries: list, elapsed: float = 0.0) -> int:
+        """Load export() output, minus the time spent down; returns entries kept"""
+        now = time.monotonic()
+        kept = 0
+        with self._lock:
+            for code, owner, remaining in entries:
+                if remaining - elapsed > 0 and code not in self._entries:
+                    self._entries[code] = (owner, now + remaining - elapsed)
+                    kept += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return kept
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+legacy_codes = LegacyCodeCache()
+
+
+def resolve(db, code: str) -> Optional[str]:
+    """Referrer's Telegram ID for any code format; only legacy codes touch the database"""
+    parsed = parse_start_param(code)
+    if parsed is None:
+        return None
+    if parsed.referrer_id:
+        return parsed.referrer_id
+    found, referrer_id = legacy_codes.peek(parsed.code)
+    if found:
+        return referrer_id
+    # Snapshot hits aren't cached: the mapped file already is the cache
+    return snapshot.code_owner(parsed.code) or legacy_codes.get(parsed.code, lambda c: lookup_legacy_code(db, c))
+
+
+def reissue_codes(db, page_size: int = 400, dry_run: bool = False) -> Dict[str, int]:
+    """Give every user a v1 code, keeping their previous code resolvable"""
+    from firebase_admin import firestore
+
+    counts = {'scanned': 0, 'reissued': 0, 'current': 0, 'skipped': 0}
+    query = db.collection('users').order_by('__name__').limit(page_size)
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page_query.stream())
+        if not docs:
+            break
+        batch = db.batch()
+        staged = 0
+        for doc in docs:
+            counts['scanned'] += 1
+            data = doc.to_dict() or {}
+            try:
+                code = encode(data.get('telegram_id') or doc.id)
+            except ValueError:
+                counts['skipped'] += 1
+                continue
+            old_code = data.get('referral_code')
+            if old_code == code:
+                counts['current'] += 1
+                continue
+            update = {'referral_code': code, 'referral_code_version': VERSION, 'updated_at': datetime.now()}
+            if old_code:
+                update['legacy_referral_codes'] = firestore.ArrayUnion([old_code])
+            batch.update(doc.reference, update)
+            staged += 1
+        if staged and not dry_run:
+            batch.commit()
+        counts['reissued'] += staged
+        last_doc = docs[-1]
+        logger.info(f"🔁 Referral codes: {counts['scanned']} scanned, {counts['reissued']} re-issued")
+        if len(docs) < page_size:
+            break
+    return counts
+
+
+def _create_codes(db, docs: List[Tuple[str, Dict[str, Any]]], counts: Dict[str, int]):
+    """Create referralCodes docs in one batch; codes already there are left alone"""
+    batch = db.batch()
+    for code, data in docs:
+        batch.create(db.collection(CODES_COLLECTION).document(code), data)
+    try:
+        batch.commit()
+        counts['copied'] += len(docs)
+    except AlreadyExists:
+        if len(docs) == 1:
+            counts['existing'] += 1
+            return
+        # Some of these are there already; isolate them one by one
+        for doc in docs:
+            _create_codes(db, [doc], counts)
+
+
+def _old_code_entries(db, page_size: int):
+    """(code, owner, extra fields) for every code outside referralCodes"""
+    query = db.collection(OLD_CODES_COLLECTION).order_by('__name__').limit(page_size)
+    last_doc = None
+    while True:
+        docs = list((query.start_after(last_doc) if last_doc is not None else query).stream())
+        for doc in docs:
+            data = doc.to_dict() or {}
+            fields = {key: data[key] for key in ('is_active', 'created_at', 'total_uses', 'total_earnings')
+                      if data.get(key) is not None}
+            yield data.get('referral_code'), data.get('user_id'), fields
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+
+    query = db.collection('users').order_by('__name__').limit(page_size)
+    last_doc = None
+    while True:
+        docs = list((query.start_after(last_doc) if last_doc is not None else query).stream())
+        for doc in docs:
+            data = doc.to_dict() or {}
+            owner = data.get('telegram_id') or doc.id
+            for code in [data.get('referral_code')] + list(data.get('legacy_referral_codes') or []):
+                yield code, owner, {}
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+
+
+def migrate_codes(db, page_size: int = 400, dry_run: bool = False) -> Dict[str, int]:
+    """Copy every code into referralCodes/{code}; safe to re-run"""
+    counts = Counter({'scanned': 0, 'copied': 0, 'existing': 0, 'skipped': 0})
+    pending: List[Tuple[str, Dict[str, Any]]] = []
+    seen = set()
+    for code, owner, fields in _old_code_entries(db, page_size):
+        counts['scanned'] += 1
+        if not code or not owner or '/' in str(code) or code in seen:
+            counts['skipped'] += 1
+            continue
+        seen.add(code)
+        pending.append((code, code_document(code, owner, **fields)))
+        if len(pending) >= min(page_size, BATCH_LIMIT):
+            if dry_run:
+                counts['copied'] += len(pending)
+            else:
+                _create_codes(db, pending, counts)
+            pending = []
+            logger.info(f"🔑 Referral codes: {counts['scanned']} scanned, {counts['copied']} copied")
+    if pending:
+        if dry_run:
+            counts['copied'] += len(pending)
+        else:
+            _create_codes(db, pending, counts)
+    return dict(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Referral code tools')
+    parser.add_argument('--encode', type=int, help='Print the v1 code for a Telegram ID')
+    parser.add_argument('--decode', help='Print the Telegram ID a code resolves to without I/O')
+    parser.add_argument('--reissue', action='store_true', help='Re-issue v1 codes to every user')
+    parser.add_argument('--migrate', action='store_true', help=f'Copy every code into {CODES_COLLECTION}')
+    parser.add_argument('--dry-run', action='store_true', help='With --reissue or --migrate, only count')
+    parser.add_argument('--page-size', type=int, default=400, help='Users per batch')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.encode:
+        print(encode(args.encode))
+    elif args.decode:
+        parsed = parse_start_param(args.decode)
+        if parsed is None:
+            print("invalid")
+        else:
+            print(parsed.referrer_id or f"legacy code (v{parsed.version}), needs a lookup")
+    elif args.reissue:
+        from bot_firebase import db
+        counts = reissue_codes(db, args.page_size, args.dry_run)
+        print(f"{'Would re-issue' if args.dry_run else 'Re-issued'} {counts['reissued']} of "
+              f"{counts['scanned']} users ({counts['current']} already current, {counts['skipped']} skipped)")
+    elif args.migrate:
+        from bot_firebase import db
+        counts = migrate_codes(db, args.page_size, args.dry_run)
+        print(f"{'Would copy' if args.dry_run else 'Copied'} {counts['copied']} codes into {CODES_COLLECTION} "
+              f"({counts['existing']} already there, {counts['skipped']} skipped of {counts['scanned']})")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
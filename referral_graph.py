@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Cash Points Referral Graph Index
+Features:
+- Array-backed referral graph: referrer → referred children with depth
+- Compact open-addressing Telegram ID → node table (no per-node Python objects)
+- Incremental updates as referrals are verified
+- O(1) referral level crossing / bonus detection per reward
+- Rebuild from a Firestore snapshot or a local binary snapshot file
+
+Usage:
+    python referral_graph.py --bench 10000000
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+from array import array
+from typing import Optional, Dict, Iterator, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# (level, referrals required, bonus) - matches REFERRAL_LEVELS in src/utils/constants.ts
+REFERRAL_LEVELS = [
+    (1, 100, 200),
+    (2, 1000, 500),
+    (3, 5000, 1500),
+    (4, 10000, 3000),
+]
+
+EMPTY = -1
+NO_NODE = -1
+MAX_LOAD = 0.7
+SNAPSHOT_VERSION = 1
+
+
+class LevelCrossing(NamedTuple):
+    referrer_id: int
+    level: int
+    referrals: int
+    bonus: int
+
+
+class ReferralGraphIndex:
+    """Referral forest stored in parallel arrays indexed by node number"""
+
+    def __init__(self, capacity: int = 1024, levels: Optional[List[tuple]] = None):
+        self.levels = levels or REFERRAL_LEVELS
+        self._crossings = {required: (level, bonus) for level, required, bonus in self.levels}
+        self._alloc_table(max(16, 1 << (capacity - 1).bit_length()))
+
+        self.ids = array('q')           # node -> Telegram ID
+        self.parent = array('i')        # node -> referrer node (NO_NODE for roots)
+        self.depth = array('i')         # node -> distance from the root referrer
+        self.direct = array('i')        # node -> verified direct referrals
+        self.level = array('b')         # node -> referral level reached
+        self.first_child = array('i')   # node -> first referred node
+        self.next_sibling = array('i')  # node -> next node with the same referrer
+        self.edges = 0
+        self.ready = False
+
+    # ---- ID table ---------------------------------------------------------
+
+    def _alloc_table(self, size: int):
+        self._mask = size - 1
+        self._keys = array('q', [EMPTY]) * size
+        self._slots = array('i', [NO_NODE]) * size
+
+    @staticmethod
+    def _hash(key: int) -> int:
+        return ((key * 0x9E3779B97F4A7C15) >> 16) & 0xFFFFFFFFFFFF
+
+    def _probe(self, key: int) -> int:
+        """Return the table slot holding key, or the empty slot where it belongs"""
+        keys = self._keys
+        mask = self._mask
+        slot = self._hash(key) & mask
+        while True:
+            current = keys[slot]
+            if current == key or current == EMPTY:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        old_keys, old_slots = self._keys, self._slots
+        self._alloc_table(len(old_keys) * 2)
+        for key, node in zip(old_keys, old_slots):
+            if key != EMPTY:
+                slot = self._probe(key)
+                self._keys[slot] = key
+                self._slots[slot] = node
+
+    def find(self, telegram_id: int) -> int:
+        """Return the node for a Telegram ID, or NO_NODE"""
+        return self._slots[self._probe(int(telegram_id))]
+
+    def _node(self, telegram_id: int) -> int:
+        telegram_id = int(telegram_id)
+        slot = self._probe(telegram_id)
+        node = self._slots[slot]
+        if node != NO_NODE:
+            return node
+        node = len(self.ids)
+        self._keys[slot] = telegram_id
+        self._slots[slot] = node
+        self.ids.append(telegram_id)
+        self.parent.append(NO_NODE)
+        self.depth.append(0)
+        self.direct.append(0)
+        self.level.append(0)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        if len(self.ids) > len(self._keys) * MAX_LOAD:
+            self._grow()
+        return node
+
+    # ---- Graph updates ----------------------------------------------------
+
+    def _is_ancestor(self, candidate: int, node: int) -> bool:
+        while node != NO_NODE:
+            if node == candidate:
+                return True
+            node = self.parent[node]
+        return False
+
+    def _reset_depths(self, root: int):
+        """Recompute depths below a node that just gained a referrer"""
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            child = self.first_child[node]
+            while child != NO_NODE:
+                self.depth[child] = self.depth[node] + 1
+                stack.append(child)
+                child = self.next_sibling[child]
+
+    def add_referral(self, referrer_id: int, referred_id: int) -> Optional[LevelCrossing]:
+        """Record a verified referral; return a LevelCrossing when a threshold is hit
+
+        The first referrer of a user wins, self-referrals and edges that would
+        close a referral ring are ignored.
+        """
+        if int(referrer_id) == int(referred_id):
+            return None
+        referrer = self._node(referrer_id)
+        referred = self._node(referred_id)
+        if self.parent[referred] != NO_NODE or self._is_ancestor(referred, referrer):
+            return None
+
+        self.parent[referred] = referrer
+        self.next_sibling[referred] = self.first_child[referrer]
+        self.first_child[referrer] = referred
+        self.depth[referred] = self.depth[referrer] + 1
+        if self.first_child[referred] != NO_NODE:
+            self._reset_depths(referred)
+        self.edges += 1
+
+        count = self.direct[referrer] + 1
+        self.direct[referrer] = count
+        crossing = self._crossings.get(count)
+        if crossing is None:
+            return None
+        level, bonus = crossing
+        self.level[referrer] = level
+        return LevelCrossing(self.ids[referrer], level, count, bonus)
+
+    # ---- Queries ----------------------------------------------------------
+
+    def referral_count(self, telegram_id: int) -> int:
+        node = self.find(telegram_id)
+        return self.direct[node] if node != NO_NODE else 0
+
+    def referral_level(self, telegram_id: int) -> int:
+        node = self.find(telegram_id)
+        return self.level[node] if node != NO_NODE else 0
+
+    def referrer_of(self, telegram_id: int) -> Optional[int]:
+        node = self.find(telegram_id)
+        if node == NO_NODE or self.parent[node] == NO_NODE:
+            return None
+        return self.ids[self.parent[node]]
+
+    def depth_of(self, telegram_id: int) -> int:
+        node = self.find(telegram_id)
+        return self.depth[node] if node != NO_NODE else 0
+
+    def children(self, telegram_id: int) -> Iterator[int]:
+        node = self.find(telegram_id)
+        child = self.first_child[node] if node != NO_NODE else NO_NODE
+        while child != NO_NODE:
+            yield self.ids[child]
+            child = self.next_sibling[child]
+
+    def upline(self, telegram_id: int, max_levels: int = 3) -> Iterator[int]:
+        """Yield referrer, referrer's referrer, ... up to max_levels"""
+        node = self.find(telegram_id)
+        while node != NO_NODE and max_levels > 0:
+            node = self.parent[node]
+            if node == NO_NODE:
+                return
+            yield self.ids[node]
+            max_levels -= 1
+
+    def memory_bytes(self) -> int:
+        arrays = (self._keys, self._slots, self.ids, self.parent, self.depth, self.direct,
+                  self.level, self.first_child, self.next_sibling)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'nodes': len(self.ids),
+            'edges': self.edges,
+            'memory_bytes': self.memory_bytes(),
+        }
+
+    # ---- Rebuild / persistence -------------------------------------------
+
+    def _finish_rebuild(self):
+        """Derive levels from direct counts after a bulk load"""
+        thresholds = sorted((required, level) for level, required, _ in self.levels)
+        for node, count in enumerate(self.direct):
+            reached = 0
+            for required, level in thresholds:
+                if count >= required:
+                    reached = level
+            self.level[node] = reached
+        self.ready = True
+
+    @classmethod
+    def rebuild_from_firestore(cls, db, page_size: int = 1000) -> 'ReferralGraphIndex':
+        """Build the index from all verified referrals"""
+        index = cls()
+        query = db.collection('referrals').where('status', '==', 'verified').order_by('__name__')
+        last_doc = None
+        while True:
+            page = query.limit(page_size)
+            if last_doc is not None:
+                page = page.start_after(last_doc)
+            docs = list(page.stream())
+            for doc in docs:
+                data = doc.to_dict() or {}
+                try:
+                    index.add_referral(int(data['referrer_id']), int(data['referred_id']))
+                except (KeyError, TypeError, ValueError):
+                    continue
+            if len(docs) < page_size:
+                break
+            last_doc = docs[-1]
+        index._finish_rebuild()
+        return index
+
+    _ARRAYS = ('ids', 'parent', 'depth', 'direct', 'level', 'first_child', 'next_sibling')
+
+    def save(self, path: str):
+        """Write a binary snapshot (published atomically by rename)"""
+        tmp_path = f"{path}.tmp"
+        header = {'version': SNAPSHOT_VERSION, 'nodes': len(self.ids), 'edges': self.edges}
+        with open(tmp_path, 'wb') as f:
+            encoded = json.dumps(header).encode()
+            f.write(len(encoded).to_bytes(4, 'little'))
+            f.write(encoded)
+            for name in self._ARRAYS:
+                getattr(self, name).tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ReferralGraphIndex':
+        """Load a snapshot written by save()"""
+        with open(path, 'rb') as f:
+            header_len = int.from_bytes(f.read(4), 'little')
+            header = json.loads(f.read(header_len))
+            if header.get('version') != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported referral graph snapshot version: {header.get('version')}")
+            nodes = header['nodes']
+            index = cls(capacity=int(nodes / MAX_LOAD) + 1)
+            for name in cls._ARRAYS:
+                getattr(index, name).fromfile(f, nodes)
+        index.edges = header['edges']
+        for node, telegram_id in enumerate(index.ids):
+            slot = index._probe(telegram_id)
+            index._keys[slot] = telegram_id
+            index._slots[slot] = node
+        index.ready = True
+        return index
+
+
+def run_benchmark(edges: int):
+    """Insert synthetic referrals and report throughput and memory"""
+    import random
+    rng = random.Random(1)
+    index = ReferralGraphIndex()
+    base = 5_000_000_000
+    crossings = 0
+    started = time.perf_counter()
+    for i in range(edges):
+        referred = base + i + 1
+        # Skewed referrer distribution: a few heavy referrers, a long tail
+        if rng.random() < 0.3:
+            referrer = base + rng.randrange(1, 1 + min(i + 1, 50))
+        else:
+            referrer = base + rng.randrange(0, i + 1)
+        if index.add_referral(referrer, referred):
+            crossings += 1
+    elapsed = time.perf_counter() - started
+
+    lookups = min(edges, 1_000_000)
+    started = time.perf_counter()
+    for i in range(lookups):
+        index.referral_level(base + rng.randrange(edges))
+    lookup_elapsed = time.perf_counter() - started
+
+    stats = index.stats()
+    print(f"📊 Edges: {stats['edges']}, nodes: {stats['nodes']}")
+    print(f"⚡ Inserts: {edges / elapsed:,.0f}/sec ({elapsed * 1e6 / edges:.2f} µs each)")
+    print(f"🔎 Level lookups: {lookups / lookup_elapsed:,.0f}/sec")
+    print(f"🏆 Level crossings: {crossings}")
+    print(f"💾 Index memory: {stats['memory_bytes'] / (1024 * 1024):.1f} MB "
+          f"({stats['memory_bytes'] / max(stats['nodes'], 1):.1f} bytes/node)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Referral graph index tools')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark N synthetic edges')
+    parser.add_argument('--snapshot', help='Rebuild from Firestore and save a snapshot to this path')
+    args = parser.parse_args()
+
+    if args.bench:
+        run_benchmark(args.bench)
+        return
+    if args.snapshot:
+        from bot_firebase import db
+        if not db:
+            print("❌ Firebase not connected")
+            return
+        started = time.perf_counter()
+        index = ReferralGraphIndex.rebuild_from_firestore(db)
+        index.save(args.snapshot)
+        stats = index.stats()
+        print(f"✅ Snapshot saved: {stats['edges']} edges, {stats['nodes']} nodes "
+              f"in {time.perf_counter() - started:.1f}s")
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
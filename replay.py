@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Cash Points Traffic Replay
+Feeds recorded or synthetic update traces through the real bot Application
+against a fake Bot API and an in-memory Firestore.
+
+Features:
+- Replays traces written by update_recorder.py at a chosen speed-up factor
+- Synthetic scenarios: campaign bursts, callback double-taps, rejoin storms,
+  informational-command floods (overload)
+- Tunable backend / Bot API latency and failure injection
+- Reports throughput, latency percentiles and errors per handler, plus
+  Firestore and Bot API call counts
+
+Usage:
+    python replay.py --trace updates.jsonl --speedup 20
+    python replay.py --synthetic campaign --users 5000 --rate 100
+    python replay.py --synthetic double_tap --users 500 --db-latency 0.02
+    SCHEDULER_ENABLED=true python replay.py --synthetic overload --concurrent-updates 16
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import defaultdict
+from typing import Dict, Any, List
+
+SCENARIOS = ('campaign', 'double_tap', 'rejoin_storm', 'overload')
+
+
+# ---- Synthetic traces -------------------------------------------------------
+
+def _referral_codes(rng: random.Random, count: int) -> List[str]:
+    return ['CP' + ''.join(rng.choice('0123456789ABCDEF') for _ in range(8)) for _ in range(count)]
+
+
+def synthetic_trace(scenario: str, users: int, rate: float, seed: int = 1) -> List[Dict[str, Any]]:
+    """Build a trace in the recorder's format for a load scenario"""
+    rng = random.Random(seed)
+    codes = _referral_codes(rng, max(1, users // 200))
+    base = 7_000_000_000
+    records = []
+
+    if scenario == 'campaign':
+        # A burst of new users arriving through a few heavy referrers' links
+        for i in range(users):
+            user_id = base + i
+            arrive = i / rate
+            code = codes[min(int(rng.paretovariate(1.2)) - 1, len(codes) - 1)]
+            records.append({'t': arrive, 'k': 'm', 'u': user_id, 'c': user_id, 'x': f'/start {code}'})
+            if rng.random() < 0.7:
+                records.append({'t': arrive + rng.uniform(2, 20), 'k': 'q', 'u': user_id, 'c': user_id,
+                                'd': 'verify_membership'})
+    elif scenario == 'double_tap':
+        # Every user taps "Verify Membership" twice in quick succession
+        for i in range(users):
+            user_id = base + i
+            arrive = i / rate
+            records.append({'t': arrive, 'k': 'm', 'u': user_id, 'c': user_id,
+                            'x': f'/start {rng.choice(codes)}'})
+            tap = arrive + rng.uniform(1, 5)
+            for delay in (0.0, rng.uniform(0.05, 0.3)):
+                records.append({'t': tap + delay, 'k': 'q', 'u': user_id, 'c': user_id,
+                                'd': 'verify_membership'})
+    elif scenario == 'rejoin_storm':
+        # A small group re-entering the same referral link over and over
+        storm_users = max(1, users // 10)
+        code = codes[0]
+        for i in range(users):
+            user_id = base + (i % storm_users)
+            records.append({'t': i / rate, 'k': 'm', 'u': user_id, 'c': user_id, 'x': f'/start {code}'})
+    elif scenario == 'overload':
+        # Referral sign-ups while five times as many users spam /help and /status
+        for i in range(users):
+            user_id = base + i
+            arrive = i / rate
+            records.append({'t': arrive, 'k': 'm', 'u': user_id, 'c': user_id, 'x': f'/start {rng.choice(codes)}'})
+            records.append({'t': arrive + rng.uniform(1, 3), 'k': 'q', 'u': user_id, 'c': user_id,
+                            'd': 'verify_membership'})
+            for _ in range(5):
+                idle = base + users + rng.randrange(users * 5)
+                records.append({'t': arrive + rng.random() / rate, 'k': 'm', 'u': idle, 'c': idle,
+                                'x': rng.choice(('/help', '/status'))})
+    else:
+        raise ValueError(f"Unknown scenario: {scenario}")
+
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+def write_trace(path: str, records: List[Dict[str, Any]]):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def seed_referrers(fake_db, records: List[Dict[str, Any]]):
+    """Create a referrer user for every referral code in the trace"""
+    from datetime import datetime
+    codes = {r['x'].split()[1] for r in records
+             if r.get('k') == 'm' and r.get('x', '').startswith('/start ') and len(r['x'].split()) > 1}
+    for i, code in enumerate(sorted(codes)):
+        telegram_id = str(6_000_000_000 + i)
+        fake_db.seed('users', f"referrer{i}", {
+            'telegram_id': telegram_id,
+            'referral_code': code,
+            'balance': 0,
+            'total_earnings': 0,
+            'total_referrals': 0,
+            'created_at': datetime.now(),
+        })
+    return len(codes)
+
+
+# ---- Replay -----------------------------------------------------------------
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _handler_label(record: Dict[str, Any]) -> str:
+    if record.get('k') == 'q':
+        return f"callback:{record.get('d')}"
+    text = record.get('x') or ''
+    return text.split()[0].lstrip('/') if text.startswith('/') else 'text'
+
+
+async def replay(records: List[Dict[str, Any]], args) -> Dict[str, Any]:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from fake_bot_api import FakeBotRequest
+    from fake_firestore import FakeFirestore
+    from update_recorder import to_update_dict
+    import bot
+
+    fake_db = FakeFirestore(latency=args.db_latency, failure_rate=args.db_failure_rate)
+    referrers = seed_referrers(fake_db, records)
+    bot.bot_instance.attach_db(fake_db)
+    request = FakeBotRequest(latency=args.api_latency, member_ratio=args.member_ratio,
+                             failure_rate=args.api_failure_rate)
+    app = bot.build_application(token='123456:replay', request=request,
+                                concurrent_updates=args.concurrent_updates or False)
+
+    enqueued: Dict[int, tuple] = {}
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    done = asyncio.Event()
+    completed = 0
+    total = 0
+
+    def finish(update, suffix=''):
+        nonlocal completed
+        started, label = enqueued.pop(update.update_id, (None, None))
+        if started is not None:
+            latencies[label + suffix].append(time.perf_counter() - started)
+        completed += 1
+        if completed >= total:
+            done.set()
+
+    async def on_done(update, context):
+        finish(update)
+
+    # Updates shed by the priority scheduler never reach the handlers
+    scheduler = getattr(app.update_processor, 'inner', None)
+    scheduler = scheduler if isinstance(scheduler, bot.PriorityUpdateProcessor) else None
+    if scheduler:
+        scheduler.on_shed.append(lambda update, klass, reason: finish(update, ' (shed)'))
+
+    async def on_error(update, context):
+        if isinstance(update, Update) and update.update_id in enqueued:
+            errors[enqueued[update.update_id][1]] += 1
+
+    app.add_handler(TypeHandler(Update, on_done), group=100)
+    app.add_error_handler(on_error)
+
+    updates = []
+    for update_id, record in enumerate(records, start=1):
+        data = to_update_dict(record, update_id)
+        if data is not None:
+            updates.append((record, data))
+    total = len(updates)
+    if not total:
+        print("❌ Trace has no replayable updates")
+        return {}
+
+    await app.initialize()
+    await app.start()
+    first_t = updates[0][0]['t']
+    print(f"▶️ Replaying {total} updates ({referrers} referrers seeded, {args.speedup}x speed-up)")
+    started = time.perf_counter()
+    for record, data in updates:
+        due = (record['t'] - first_t) / args.speedup
+        delay = due - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(data, app.bot)
+        enqueued[update.update_id] = (time.perf_counter(), _handler_label(record))
+        await app.update_queue.put(update)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Timed out with {total - completed} updates still in flight")
+    elapsed = time.perf_counter() - started
+    await app.stop()
+    await app.shutdown()
+    await asyncio.to_thread(bot.bot_instance.activity.flush)
+
+    return {
+        'updates': total,
+        'completed': completed,
+        'elapsed': elapsed,
+        'latencies': dict(latencies),
+        'errors': dict(errors),
+        'firestore_calls': fake_db.call_counts(),
+        'bot_api_calls': dict(request.counts),
+        'activity': bot.bot_instance.activity.stats(),
+        'sessions': bot.sessions.stats(),
+        'scheduler': scheduler.stats() if scheduler else None,
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    if not result:
+        return
+    print(f"\n📊 Updates: {result['completed']}/{result['updates']} in {result['elapsed']:.1f}s "
+          f"({result['completed'] / max(result['elapsed'], 1e-9):,.1f} updates/sec)")
+    print(f"\n⏱️ Latency per handler (ms):")
+    print(f"   {'handler':<28}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'errors':>8}")
+    for label, values in sorted(result['latencies'].items()):
+        ms = [v * 1000 for v in values]
+        print(f"   {label:<28}{len(ms):>8}{_percentile(ms, 50):>10.1f}{_percentile(ms, 95):>10.1f}"
+              f"{_percentile(ms, 99):>10.1f}{max(ms):>10.1f}{result['errors'].get(label, 0):>8}")
+
+    calls = result['firestore_calls']
+    print(f"\n🔥 Firestore calls:")
+    for op in ('get', 'query', 'add', 'set', 'update', 'create', 'commit', 'batch_writes', 'injected_failures'):
+        if calls.get(op):
+            print(f"   {op:<20}{calls[op]:>10}")
+    per_collection = sorted((k, v) for k, v in calls.items() if ':' in k)
+    for key, value in per_collection:
+        print(f"   {key:<36}{value:>10}")
+
+    print(f"\n🤖 Bot API calls:")
+    for method, count in sorted(result['bot_api_calls'].items()):
+        print(f"   {method:<28}{count:>10}")
+    activity = result['activity']
+    print(f"\n📝 Activity writes: {activity['flushed_rows']} flushed, {activity['coalesced']} coalesced")
+    cache = result['sessions']
+    print(f"🗂️ Sessions: {cache['hit_rate']:.0%} hit rate ({cache['hits']} hits, {cache['misses']} misses, "
+          f"{cache['invalidations']} invalidations)")
+    if result.get('scheduler'):
+        print(f"\n🚦 Scheduler ({result['scheduler']['workers']} workers):")
+        print(f"   {'class':<10}{'admitted':>10}{'answered':>10}{'dropped':>10}{'max queue':>11}"
+              f"{'wait p50':>10}{'wait p95':>10}")
+        for name, c in result['scheduler']['classes'].items():
+            print(f"   {name:<10}{c['admitted']:>10}{c['answered']:>10}{c['dropped']:>10}{c['max_queued']:>11}"
+                  f"{c['wait_p50'] * 1000:>9.0f}ms{c['wait_p95'] * 1000:>8.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay update traces against a fake backend')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', help='Trace file written by update_recorder.py')
+    source.add_argument('--synthetic', choices=SCENARIOS, help='Generate a synthetic scenario')
+    parser.add_argument('--users', type=int, default=1000, help='Synthetic users')
+    parser.add_argument('--rate', type=float, default=50, help='Synthetic arrivals per second')
+    parser.add_argument('--speedup', type=float, default=1.0, help='Replay speed-up factor')
+    parser.add_argument('--write-trace', help='Save the synthetic trace to this path')
+    parser.add_argument('--db-latency', type=float, default=0.005, help='Seconds per Firestore call')
+    parser.add_argument('--db-failure-rate', type=float, default=0.0, help='Injected Firestore failures')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='Seconds per Bot API call')
+    parser.add_argument('--api-failure-rate', type=float, default=0.0, help='Injected Bot API failures')
+    parser.add_argument('--member-ratio', type=float, default=0.8, help='Share of users in the group')
+    parser.add_argument('--concurrent-updates', type=int, default=0, help='Concurrent updates (0 = sequential)')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for in-flight updates')
+    args = parser.parse_args()
+
+    # Keep journals and the outbox of the replayed bot away from real state
+    os.environ['STATE_DIR'] = tempfile.mkdtemp(prefix='replay_state_')
+    os.environ['RECORD_UPDATES_PATH'] = ''
+
+    if args.synthetic:
+        records = synthetic_trace(args.synthetic, args.users, args.rate)
+        if args.write_trace:
+            write_trace(args.write_trace, records)
+            print(f"💾 Synthetic trace written to {args.write_trace}")
+    else:
+        from update_recorder import read_trace
+        records = list(read_trace(args.trace))
+    if not records:
+        print("❌ Empty trace")
+        sys.exit(1)
+
+    print_report(asyncio.run(replay(records, args)))
+
+
+if __name__ == "__main__":
+    main()
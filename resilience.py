@@ -0,0 +1,264 @@
+"""
+Cash Points Resilience
+Deadlines, retries and circuit breakers for backend (Firestore) calls.
+
+- Per-handler deadline budgets carried in a context variable
+- Jittered exponential retry, only for operations marked idempotent
+- One circuit breaker per operation class (e.g. 'users', 'rewards') that
+  fails fast while the backend is browning out
+- Breaker and retry counters for /status and metrics
+"""
+
+import time
+import random
+import asyncio
+import logging
+import functools
+import threading
+import contextvars
+from typing import Optional, Dict, Any, Callable
+
+from google.api_core import exceptions as api_exceptions
+
+from config import config
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors that mean "the backend did not answer in time / is overloaded"
+TRANSIENT_ERRORS = (
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.Aborted,
+    TimeoutError,
+    ConnectionError,
+)
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('backend_deadline', default=None)
+
+
+class BreakerOpen(Exception):
+    """Raised instead of calling the backend while a breaker is open"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit '{name}' is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class BudgetExhausted(TimeoutError):
+    """Raised when the handler's deadline leaves no time for another attempt"""
+
+
+def is_transient(error: Exception) -> bool:
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def is_degraded_error(error: Exception) -> bool:
+    """True when the caller should fall back to the degraded/outbox path"""
+    return isinstance(error, BreakerOpen) or is_transient(error)
+
+
+# ---- Deadlines --------------------------------------------------------------
+
+def remaining() -> float:
+    """Seconds left in the current deadline (the per-call timeout if none is set)"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return config.BACKEND_CALL_TIMEOUT
+    return min(deadline - time.monotonic(), config.BACKEND_CALL_TIMEOUT)
+
+
+def with_deadline(seconds: float = None):
+    """Decorator giving an async handler a total budget for backend calls"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            budget = seconds or config.HANDLER_DEADLINE
+            current = _deadline.get()
+            deadline = time.monotonic() + budget
+            token = _deadline.set(deadline if current is None else min(current, deadline))
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                _deadline.reset(token)
+        return wrapper
+    return decorator
+
+
+# ---- Circuit breaker --------------------------------------------------------
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open probe"""
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or config.BREAKER_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or config.BREAKER_RESET_TIMEOUT
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.total_failures = 0
+        self.retries = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == OPEN:
+                waited = time.monotonic() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.rejected += 1
+                    raise BreakerOpen(self.name, self.reset_timeout - waited)
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    raise BreakerOpen(self.name, self.reset_timeout)
+                self._probe_in_flight = True
+            self.calls += 1
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"✅ Circuit '{self.name}' closed")
+            self.state = CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                    logger.warning(f"🔌 Circuit '{self.name}' opened after {self.failures} failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'calls': self.calls,
+            'total_failures': self.total_failures,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """Breaker state and counters per operation class"""
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {name: b.snapshot() for name, b in items}
+
+
+def any_open() -> bool:
+    return any(s['state'] != CLOSED for s in snapshot().values())
+
+
+# ---- Calls ------------------------------------------------------------------
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    ceiling = min(config.BACKEND_RETRY_MAX_DELAY, config.BACKEND_RETRY_BASE_DELAY * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def _should_retry(circuit: CircuitBreaker, error: Exception, attempt: int,
+                  idempotent: bool, retryable: Optional[Callable]) -> Optional[float]:
+    """Return the delay before the next attempt, or None to give up"""
+    if not idempotent or attempt >= config.BACKEND_MAX_RETRIES:
+        return None
+    if not (retryable(error) if retryable else is_transient(error)):
+        return None
+    delay = _backoff(attempt)
+    if delay >= remaining():
+        return None
+    circuit.retries += 1
+    return delay
+
+
+def _record(circuit: CircuitBreaker, error: Exception):
+    # Application errors (NotFound, AlreadyExists, ...) mean the backend answered
+    if is_transient(error):
+        circuit.record_failure()
+    else:
+        circuit.record_success()
+
+
+async def acall(op_class: str, fn: Callable, *args, idempotent: bool = False,
+                retryable: Callable = None, **kwargs):
+    """Run a blocking backend call in a worker thread under breaker, deadline and retry
+
+    The call is abandoned (not cancelled) when the deadline passes; the
+    breaker counts that as a failure so a brown-out trips it quickly.
+    """
+    circuit = breaker(op_class)
+    attempt = 0
+    with tracer.span('backend.call', **{'backend.op_class': op_class}) as current:
+        while True:
+            current.set_attribute('backend.attempts', attempt + 1)
+            budget = remaining()
+            if budget <= 0:
+                raise BudgetExhausted(f"No deadline budget left for '{op_class}'")
+            circuit.before_call()
+            try:
+                result = await asyncio.wait_for(asyncio.to_thread(fn, *args, **kwargs), timeout=budget)
+            except Exception as e:
+                _record(circuit, e)
+                delay = _should_retry(circuit, e, attempt, idempotent, retryable)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            circuit.record_success()
+            return result
+
+
+def call(op_class: str, fn: Callable, *args, idempotent: bool = False,
+         retryable: Callable = None, **kwargs):
+    """Blocking variant of acall() for background threads and jobs"""
+    circuit = breaker(op_class)
+    attempt = 0
+    while True:
+        circuit.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            _record(circuit, e)
+            delay = _should_retry(circuit, e, attempt, idempotent, retryable)
+            if delay is None:
+                raise
+            attempt += 1
+            time.sleep(delay)
+            continue
+        circuit.record_success()
+        return result
@@ -0,0 +1,220 @@
+"""
+Cash Points Session Cache
+Per-user session state kept between interactions, so repeat /start, /status
+and button presses don't re-read Firestore.
+
+- A session lives in context.user_data['session'] and holds the user doc path
+  and referral code, the user's referral (path, referrer, code, status) and the
+  time of the last positive group-membership check
+- SessionPersistence stores user_data in a local SQLite file (WAL), so a
+  restart keeps the cache warm; PTB flushes it every update_interval
+- Version-based invalidation: writers call sessions.invalidate(user_id) after
+  changing a user's data (rewards, referrals, sweeps); a session whose version
+  is behind, or older than SESSION_TTL, starts over empty
+- Coroutines use aget() / aversion() / ainvalidate(): versions not in memory,
+  and every write, go through SQLite in a worker thread, so the event loop
+  never blocks on the file or on the store lock that worker threads hold
+"""
+
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Optional, Dict, Any
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+MAX_CACHED_VERSIONS = 200_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+
+class SessionStore:
+    """SQLite file shared by the persistence and the version counters"""
+
+    def __init__(self, path: str = None):
+        self.path = path or config.SESSION_STORE_PATH
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def execute(self, sql: str, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SessionCache:
+    """Version-checked access to the session in a user's user_data"""
+
+    def __init__(self, store: SessionStore = None, ttl: float = None):
+        self.store = store or SessionStore()
+        self.ttl = ttl if ttl is not None else config.SESSION_TTL
+        self._versions: Dict[str, int] = {}
+        self._invalidate_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, user_id) -> int:
+        user_id = str(user_id)
+        if user_id not in self._versions:
+            if len(self._versions) >= MAX_CACHED_VERSIONS:
+                self._versions.clear()  # all of them are in SQLite too
+            rows = self.store.execute("SELECT version FROM versions WHERE user_id = ?", (user_id,))
+            self._versions[user_id] = rows[0][0] if rows else 0
+        return self._versions[user_id]
+
+    async def aversion(self, user_id) -> int:
+        """version() for coroutines: SQLite is only read, off the loop, on a memory miss"""
+        version = self._versions.get(str(user_id))
+        return version if version is not None else await asyncio.to_thread(self.version, user_id)
+
+    def get(self, user_data: Optional[dict], user_id) -> Dict[str, Any]:
+        """The user's current session; a stale or expired one is replaced by an empty one"""
+        if user_data is None:
+            return {}
+        return self._session(user_data, self.version(user_id))
+
+    async def aget(self, user_data: Optional[dict], user_id) -> Dict[str, Any]:
+        """get() for coroutines"""
+        if user_data is None:
+            return {}
+        return self._session(user_data, await self.aversion(user_id))
+
+    def _session(self, user_data: dict, version: int) -> Dict[str, Any]:
+        session = user_data.get('session')
+        if session and session.get('v') == version and time.time() - session.get('at', 0) < self.ttl:
+            self.hits += 1
+            return session
+        self.misses += 1
+        session = {'v': version, 'at': time.time()}
+        user_data['session'] = session
+        return session
+
+    def invalidate(self, user_id):
+        """Mark every cached session of this user stale"""
+        user_id = str(user_id)
+        with self._invalidate_lock:
+            version = self.version(user_id) + 1
+            self._versions[user_id] = version
+            self.store.execute(
+                "INSERT INTO versions (user_id, version) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET version = excluded.version", (user_id, version))
+            self.invalidations += 1
+
+    async def ainvalidate(self, user_id):
+        """invalidate() for coroutines"""
+        await asyncio.to_thread(self.invalidate, user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+class SessionPersistence(BasePersistence):
+    """PTB persistence for user_data only, backed by the session store"""
+
+    def __init__(self, store: SessionStore = None, update_interval: float = None):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                                     user_data=True, callback_data=False),
+                         update_interval=update_interval or config.SESSION_FLUSH_INTERVAL)
+        self.store = store or sessions.store
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # Sessions past their TTL would be discarded on first use anyway
+        cutoff = time.time() - config.SESSION_TTL
+        await asyncio.to_thread(self.store.execute, "DELETE FROM user_data WHERE updated_at < ?", (cutoff,))
+        rows = await asyncio.to_thread(self.store.execute, "SELECT user_id, data FROM user_data")
+        logger.info(f"💾 Loaded {len(rows)} user sessions from {self.store.path}")
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        await asyncio.to_thread(
+            self.store.execute,
+            "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, json.dumps(data, default=str), time.time()))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await asyncio.to_thread(self.store.execute, "DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    # Only user_data is persisted
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+
+sessions = SessionCache()
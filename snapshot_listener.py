@@ -0,0 +1,335 @@
+"""
+Cash Points Snapshot Listeners
+Firestore watch streams that keep the bot's local indexes in sync with changes
+made by the mini app, the admin panel or other bot instances.
+
+Features:
+- Streams for referral codes (referral_codes, referralCodes), settings
+  (global_config), banned users (users.is_banned) and referral fraud flags
+- Changes are applied incrementally; the first snapshot after (re)connecting
+  is diffed against the local index, so deletes missed while offline are dropped
+- The Firestore client resumes interrupted streams itself; the supervisor
+  restarts any stream that terminated and tracks lag (now - snapshot read_time)
+- While every stream feeding a cache is synced, that cache switches to
+  SNAPSHOT_CACHE_TTL; if one drops it falls back to its normal TTL
+
+Usage:
+    python snapshot_listener.py --watch        # print stream stats against the live backend
+    python snapshot_listener.py --bench 5000   # cold reads with and without listeners
+"""
+
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from functools import partial
+from typing import Optional, Dict, Any, Callable, List
+
+from config import config
+from fraud_flags import fraud_flags, FLAGS_COLLECTION
+from referral_codes import legacy_codes
+from models import ReferralCode
+from lookup_snapshot import snapshot as lookup_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(value) -> float:
+    if value is None:
+        return time.time()
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return value.seconds + value.nanos / 1e9  # protobuf Timestamp
+
+
+class WatchStream:
+    """One on_snapshot listener mirrored into a small local index
+
+    `extract(doc_id, data)` turns a document into the value kept for it (None
+    to ignore it); `on_set` / `on_remove` push those values into the caches.
+    """
+
+    def __init__(self, name: str, query: Callable[[Any], Any],
+                 extract: Callable[[str, Dict[str, Any]], Any],
+                 on_set: Callable[[Any], None] = None, on_remove: Callable[[Any], None] = None):
+        self.name = name
+        self._query = query
+        self._extract = extract
+        self._on_set = on_set
+        self._on_remove = on_remove
+        self.index: Dict[str, Any] = {}
+        self._watch = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._synced = False
+        self.events = 0
+        self.restarts = 0
+        self.errors = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.last_snapshot_at = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._watch is not None and getattr(self._watch, 'is_active', True)
+
+    @property
+    def synced(self) -> bool:
+        """Initial snapshot received and the stream still running"""
+        return self._synced and self.active
+
+    def start(self, db):
+        self.stop()
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self._watch = self._query(db).on_snapshot(partial(self._on_snapshot, generation))
+
+    def stop(self):
+        watch, self._watch = self._watch, None
+        self._synced = False
+        if watch is not None:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                logger.debug(f"Closing {self.name} stream: {e}")
+
+    def _on_snapshot(self, generation: int, docs, changes, read_time):
+        now = time.time()
+        with self._lock:
+            if generation != self._generation:
+                return  # late callback from a stream we already replaced
+            resync = not self._synced
+            if resync:
+                # Full result set: diff it against what we had before the restart
+                current = {doc.id: doc.to_dict() or {} for doc in docs}
+                for doc_id in [d for d in self.index if d not in current]:
+                    self._apply(doc_id, None)
+                for doc_id, data in current.items():
+                    self._apply(doc_id, data)
+                self._synced = True
+            else:
+                for change in changes:
+                    removed = change.type.name == 'REMOVED'
+                    self._apply(change.document.id, None if removed else change.document.to_dict() or {})
+            self.events += len(changes)
+            self.lag = max(0.0, now - _timestamp(read_time))
+            self.max_lag = max(self.max_lag, self.lag)
+            self.last_snapshot_at = now
+        if resync:
+            logger.info(f"📡 {self.name} stream synced ({len(self.index)} documents)")
+
+    def _apply(self, doc_id: str, data: Optional[Dict[str, Any]]):
+        old = self.index.pop(doc_id, None)
+        new = self._extract(doc_id, data) if data is not None else None
+        if new is not None:
+            self.index[doc_id] = new
+        try:
+            if old is not None and old != new and self._on_remove:
+                self._on_remove(old)
+            if new is not None and self._on_set:
+                self._on_set(new)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Applying {self.name} change to {doc_id} failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'synced': self.synced,
+            'documents': len(self.index),
+            'events': self.events,
+            'restarts': self.restarts,
+            'errors': self.errors,
+            'lag': self.lag,
+            'max_lag': self.max_lag,
+            'idle': time.time() - self.last_snapshot_at if self.last_snapshot_at else None,
+        }
+
+
+def _code_doc(doc_id: str, data: Dict[str, Any]):
+    # referral_codes docs carry the code; referralCodes docs are keyed by it
+    code = ReferralCode.from_firestore(doc_id, data)
+    if code.is_active and code.code and code.user_id:
+        return code.code, code.user_id
+    return None
+
+
+def _setting_doc(doc_id: str, data: Dict[str, Any]):
+    key = data.get('config_key')
+    if not key:
+        return None
+    value = data.get('config_value')
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    return key, value
+
+
+class SnapshotListeners:
+    """The bot's watch streams and the local indexes they maintain"""
+
+    def __init__(self):
+        self.settings: Dict[str, Any] = {}
+        self.banned: set = set()
+        self.streams: List[WatchStream] = [
+            WatchStream('referral_codes',
+                        lambda db: db.collection('referral_codes'), _code_doc,
+                        on_set=lambda v: legacy_codes.put(*v), on_remove=lambda v: legacy_codes.forget(v[0])),
+            WatchStream('referralCodes',
+                        lambda db: db.collection('referralCodes'), _code_doc,
+                        on_set=lambda v: legacy_codes.put(*v), on_remove=lambda v: legacy_codes.forget(v[0])),
+            WatchStream('global_config',
+                        lambda db: db.collection('global_config'), _setting_doc,
+                        on_set=lambda v: self.settings.__setitem__(*v),
+                        on_remove=lambda v: self.settings.pop(v[0], None)),
+            WatchStream('banned_users',
+                        lambda db: db.collection('users').where('is_banned', '==', True),
+                        lambda doc_id, data: str(data.get('telegram_id') or doc_id),
+                        on_set=self.banned.add, on_remove=self.banned.discard),
+            WatchStream('fraud_flags',
+                        lambda db: db.collection(FLAGS_COLLECTION).where('flagged', '==', True),
+                        lambda doc_id, data: doc_id,
+                        on_set=lambda v: fraud_flags.put(v, True), on_remove=lambda v: fraud_flags.put(v, False)),
+        ]
+        # Caches that may keep entries for SNAPSHOT_CACHE_TTL while their streams are synced
+        self._ttl_targets = [
+            (legacy_codes, ('ttl', 'negative_ttl'), ('referral_codes', 'referralCodes')),
+            (fraud_flags, ('ttl_seconds',), ('fraud_flags',)),
+        ]
+        self._default_ttls = {(id(cache), attr): getattr(cache, attr)
+                              for cache, attrs, _ in self._ttl_targets for attr in attrs}
+
+    def stream(self, name: str) -> Optional[WatchStream]:
+        return next((s for s in self.streams if s.name == name), None)
+
+    def setting(self, key: str, default=None):
+        return self.settings.get(key, default)
+
+    def is_banned(self, user_id) -> bool:
+        """True if the user is banned, per the stream or else the shared lookup snapshot"""
+        if self.stream('banned_users').synced:
+            return str(user_id) in self.banned
+        return str(user_id) in self.banned or lookup_snapshot.is_banned(user_id)
+
+    def refresh_ttls(self):
+        for cache, attrs, names in self._ttl_targets:
+            synced = all(self.stream(name).synced for name in names)
+            for attr in attrs:
+                ttl = config.SNAPSHOT_CACHE_TTL if synced else self._default_ttls[(id(cache), attr)]
+                if getattr(cache, attr) != ttl:
+                    setattr(cache, attr, ttl)
+                    logger.info(f"📡 {type(cache).__name__}.{attr} → {ttl:.0f}s")
+
+    def start(self, db):
+        for stream in self.streams:
+            if not stream.active:
+                if stream._watch is not None:
+                    stream.restarts += 1
+                    logger.warning(f"📡 {stream.name} stream terminated, restarting")
+                try:
+                    stream.start(db)
+                except Exception as e:
+                    stream.stop()
+                    logger.warning(f"Starting {stream.name} stream failed: {e}")
+        self.refresh_ttls()
+
+    async def run_forever(self, get_db: Callable[[], Any]):
+        """Keep every stream running; waits for the database to come up"""
+        try:
+            while True:
+                db = get_db()
+                if db is not None:
+                    await asyncio.to_thread(self.start, db)
+                await asyncio.sleep(config.SNAPSHOT_CHECK_INTERVAL)
+        finally:
+            self.stop()
+
+    def stop(self):
+        for stream in self.streams:
+            stream.stop()
+        self.refresh_ttls()
+
+    def stats(self) -> Dict[str, Any]:
+        streams = {stream.name: stream.stats() for stream in self.streams}
+        return {
+            'synced': sum(1 for s in streams.values() if s['synced']),
+            'streams': len(streams),
+            'events': sum(s['events'] for s in streams.values()),
+            'max_lag': max((s['lag'] for s in streams.values()), default=0.0),
+            'by_stream': streams,
+        }
+
+
+listeners = SnapshotListeners()
+
+
+def run_benchmark(codes: int):
+    """Resolve legacy codes changed by 'another instance' with and without listeners"""
+    import random
+    import referral_codes
+    from fake_firestore import FakeFirestore
+
+    rng = random.Random(7)
+    results = {}
+    for enabled in (False, True):
+        db = FakeFirestore()
+        owners = {}
+        for i in range(codes):
+            owners[f"CP{1000000 + i}"] = str(1000000 + i)
+            db.seed('referralCodes', f"CP{1000000 + i}", {'user_id': str(1000000 + i), 'is_active': True})
+        legacy_codes._entries.clear()
+        if enabled:
+            listeners.start(db)
+        lookups = [f"CP{1000000 + rng.randrange(codes)}" for _ in range(codes * 3)]
+        started = time.perf_counter()
+        stale = 0
+        for n, code in enumerate(lookups):
+            if n % 10 == 0:
+                # Another instance (or the admin panel) moves a code to a new owner
+                victim = f"CP{1000000 + rng.randrange(codes)}"
+                owners[victim] = str(rng.randrange(10 ** 9))
+                db.collection('referralCodes').document(victim).update({'user_id': owners[victim]})
+            stale += referral_codes.resolve(db, code) != owners[code]
+        elapsed = time.perf_counter() - started
+        counts = db.call_counts()
+        results[enabled] = (counts.get('query', 0) + counts.get('get', 0), elapsed, stale)
+        listeners.stop()
+    for enabled, (reads, elapsed, stale) in results.items():
+        print(f"{'listeners' if enabled else 'TTL cache'}: {reads} Firestore reads for {codes * 3} "
+              f"lookups, {stale} stale answers, {elapsed:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Firestore snapshot listeners')
+    parser.add_argument('--watch', action='store_true', help='Run the listeners and print stats')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark cold reads over N legacy codes')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.bench:
+        run_benchmark(args.bench)
+    elif args.watch:
+        from bot_firebase import db
+
+        async def watch():
+            task = asyncio.create_task(listeners.run_forever(lambda: db))
+            try:
+                while True:
+                    await asyncio.sleep(config.SNAPSHOT_CHECK_INTERVAL)
+                    for name, s in listeners.stats()['by_stream'].items():
+                        print(f"{name:16} synced={s['synced']} docs={s['documents']} "
+                              f"events={s['events']} lag={s['lag']:.2f}s restarts={s['restarts']}")
+            finally:
+                task.cancel()
+
+        asyncio.run(watch())
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,20 @@
 import { useState, useCallback } from 'react';
+import { useFirebaseUserStore } from '../store/firebaseUserStore';
 
 export function useEnergy(initialEnergy: number = 100, maxEnergy: number = 100) {
   const [energy, setEnergy] = useState(initialEnergy);
+  const spendEnergy = useFirebaseUserStore(state => state.spendEnergy);
 
   const updateEnergy = useCallback((newEnergy: number) => {
     setEnergy(Math.max(0, Math.min(maxEnergy, newEnergy)));
   }, [maxEnergy]);
 
-  const consumeEnergy = useCallback((amount: number = 1) => {
-    if (energy >= amount) {
-      setEnergy(prev => Math.max(0, prev - amount));
-      return true;
-    }
-    return false;
-  }, [energy]);
+  // Spends go through the user doc (lib/energy.ts), never a local countdown
+  const consumeEnergy = useCallback(async (amount: number = 1) => {
+    const spent = await spendEnergy(amount);
+    setEnergy(useFirebaseUserStore.getState().energy);
+    return spent;
+  }, [spendEnergy]);
 
   const addEnergy = useCallback((amount: number) => {
     setEnergy(prev => Math.min(maxEnergy, prev + amount));
@@ -31,4 +32,4 @@ export function useEnergy(initialEnergy: number = 100, maxEnergy: number = 100)
     addEnergy,
     isEnergyAvailable
   };
-}
\ No newline at end of file
+}
@@ -0,0 +1,111 @@
+import { db } from './firebase';
+import { collection, query, where, limit, getDocs, runTransaction, Timestamp } from 'firebase/firestore';
+
+// Mirrors energy.py: stored `energy` is the value at `last_energy_refill`,
+// and a point comes back every ENERGY_REGEN_SECONDS up to max_energy.
+// Keep both in sync with the bot's ENERGY_MAX / ENERGY_REGEN_SECONDS.
+export const ENERGY_MAX = 100;
+export const ENERGY_REGEN_SECONDS = 36;
+
+export interface EnergyState {
+  energy: number;
+  maxEnergy: number;
+  nextIn: number; // seconds until the next point (0 when full)
+  fullIn: number; // seconds until full
+}
+
+const toMillis = (value: any): number | null => {
+  if (value === null || value === undefined) return null;
+  if (typeof value === 'number') return value * 1000; // epoch seconds, as the mini app API sends them
+  if (typeof value.toMillis === 'function') return value.toMillis();
+  const millis = new Date(value).getTime();
+  return Number.isNaN(millis) ? null : millis;
+};
+
+const regen = (data: any, now: number) => {
+  const maxEnergy = data?.max_energy || ENERGY_MAX;
+  const stored = data?.energy;
+  const anchor = toMillis(data?.last_energy_refill);
+  // Users from before on-read regeneration have no refill timestamp: full
+  if (stored === null || stored === undefined || anchor === null) {
+    return { energy: Math.max(stored || 0, maxEnergy), anchor: now, maxEnergy };
+  }
+  if (stored >= maxEnergy) return { energy: stored, anchor: now, maxEnergy };
+  const step = ENERGY_REGEN_SECONDS * 1000;
+  const points = Math.floor(Math.max(0, now - anchor) / step);
+  if (stored + points >= maxEnergy) return { energy: maxEnergy, anchor: now, maxEnergy };
+  return { energy: stored + points, anchor: anchor + points * step, maxEnergy };
+};
+
+/**
+ * Energy right now from a user doc; reads only, never writes
+ * @param data - User document data (energy, max_energy, last_energy_refill)
+ * @param now - Milliseconds since epoch
+ */
+export const currentEnergy = (data: any, now: number = Date.now()): EnergyState => {
+  const { energy, anchor, maxEnergy } = regen(data, now);
+  if (energy >= maxEnergy) return { energy, maxEnergy, nextIn: 0, fullIn: 0 };
+  const nextIn = Math.max(0, anchor + ENERGY_REGEN_SECONDS * 1000 - now) / 1000;
+  return { energy, maxEnergy, nextIn, fullIn: nextIn + (maxEnergy - energy - 1) * ENERGY_REGEN_SECONDS };
+};
+
+const findUserRef = async (telegramId: string) => {
+  const q = query(collection(db, 'users'), where('telegram_id', '==', telegramId), limit(1));
+  const snapshot = await getDocs(q);
+  if (snapshot.empty) throw new Error('User not found');
+  return snapshot.docs[0].ref;
+};
+
+/**
+ * Spend energy if the user has enough, in a transaction so concurrent
+ * spends can't use the same points twice
+ * @param telegramId - The user's telegram ID
+ * @param amount - Points to spend
+ * @returns Whether it was spent, and the energy afterwards
+ */
+export const spendEnergy = async (telegramId: string, amount: number = 1) => {
+  const userRef = await findUserRef(telegramId);
+
+  return runTransaction(db, async (transaction) => {
+    const userDoc = await transaction.get(userRef);
+    const data = userDoc.data();
+    const now = Date.now();
+    const { energy, anchor } = regen(data, now);
+    if (energy < amount) {
+      return { spent: false, state: currentEnergy(data, now) };
+    }
+    const fields = {
+      energy: energy - amount,
+      last_energy_refill: Timestamp.fromMillis(anchor),
+      updated_at: Timestamp.fromMillis(now)
+    };
+    transaction.update(userRef, fields);
+    return { spent: true, state: currentEnergy({ ...data, ...fields }, now) };
+  });
+};
+
+/**
+ * Set energy to a value (capped at max_energy). Like a spend, the refill
+ * timestamp only moves by whole points, so progress towards the next point
+ * is kept instead of restarting the regen clock
+ * @param telegramId - The user's telegram ID
+ * @param value - Energy to store
+ * @returns The energy afterwards
+ */
+export const setEnergy = async (telegramId: string, value: number) => {
+  const userRef = await findUserRef(telegramId);
+
+  return runTransaction(db, async (transaction) => {
+    const userDoc = await transaction.get(userRef);
+    const data = userDoc.data();
+    const now = Date.now();
+    const { anchor, maxEnergy } = regen(data, now);
+    const fields = {
+      energy: Math.max(0, Math.min(maxEnergy, value)),
+      last_energy_refill: Timestamp.fromMillis(anchor),
+      updated_at: Timestamp.fromMillis(now)
+    };
+    transaction.update(userRef, fields);
+    return currentEnergy({ ...data, ...fields }, now);
+  });
+};
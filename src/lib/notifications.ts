@@ -1,5 +1,11 @@
 import { db } from './firebase';
-import { collection, addDoc, updateDoc, doc, query, where, orderBy, limit, getDocs, serverTimestamp } from 'firebase/firestore';
+import { collection, addDoc, updateDoc, doc, query, where, orderBy, limit, getDocs, serverTimestamp, Timestamp } from 'firebase/firestore';
+
+// Read notifications are removed by the Firestore TTL policy on expires_at
+export const READ_NOTIFICATION_TTL_DAYS = 14;
+
+export const readNotificationExpiry = () =>
+  Timestamp.fromMillis(Date.now() + READ_NOTIFICATION_TTL_DAYS * 24 * 60 * 60 * 1000);
 
 export interface NotificationData {
   user_id: string;
@@ -56,6 +62,8 @@ export const markNotificationAsRead = async (notificationId: string): Promise<vo
   try {
     await updateDoc(doc(db, 'notifications', notificationId), { 
       is_read: true,
+      read: true,
+      expires_at: readNotificationExpiry(),
       updated_at: serverTimestamp()
     });
   } catch (error) {
@@ -98,7 +106,8 @@ export const deleteNotification = async (notificationId: string): Promise<void>
   try {
     await updateDoc(doc(db, 'notifications', notificationId), { 
       deleted_at: serverTimestamp(),
-      is_deleted: true
+      is_deleted: true,
+      expires_at: Timestamp.now()
     });
   } catch (error) {
     console.error('Error deleting notification:', error);
@@ -4,7 +4,7 @@ import { useFirebaseUserStore } from '../store/firebaseUserStore';
 import { useRealTimeUpdates } from '../hooks/useRealTimeUpdates';
 import { motion, AnimatePresence } from 'framer-motion';
 import { db } from '../lib/firebase';
-import { collection, addDoc, updateDoc, doc, query, where, orderBy, limit, getDocs, serverTimestamp } from 'firebase/firestore';
+import { collection, addDoc, query, where, orderBy, limit, getDocs } from 'firebase/firestore';
 import { sendUserNotification } from '../lib/notifications';
 
 export default function Wallet() {
@@ -193,6 +193,8 @@ export default function Wallet() {
         method: withdrawMethod,
         account_number: accountNumber,
         status: 'pending',
+        // Held and debited by the withdrawal pipeline when the request is approved
+        balance_debited: false,
         created_at: new Date().toISOString()
       };
 
@@ -228,14 +230,8 @@ export default function Wallet() {
       // Show success immediately for better UX
       setWithdrawalStatus('success');
       
-      // Run database operations in parallel
-      Promise.all([
-        addDoc(collection(db, 'withdrawal_requests'), withdrawalData),
-        updateDoc(doc(db, 'users', userDoc.id), {
-          balance: currentBalance - withdrawalAmount,
-          updated_at: serverTimestamp()
-        })
-      ]).then(([withdrawalRef]) => {
+      // The balance is debited server-side, atomically with the approval
+      addDoc(collection(db, 'withdrawal_requests'), withdrawalData).then((withdrawalRef) => {
         if (!withdrawalRef) {
           console.error('Failed to create withdrawal request');
           setWithdrawalStatus('failed');
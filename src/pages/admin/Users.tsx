@@ -139,7 +139,7 @@ export default function AdminUsers() {
       const referralsData = referralsSnapshot.docs.map(doc => ({ id: doc.id, ...doc.data() }));
 
       // Load referral codes stats
-      const codesSnapshot = await getDocs(collection(db, 'referral_codes'));
+      const codesSnapshot = await getDocs(collection(db, 'referralCodes'));
       const codesData = codesSnapshot.docs.map(doc => ({ id: doc.id, ...doc.data() }));
 
       // Calculate stats
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { DollarSign, Search, Filter, CheckCircle, XCircle, Eye, Clock, AlertCircle, TrendingUp } from 'lucide-react';
 import { db } from '../../lib/firebase';
-import { collection, query, orderBy, limit, getDocs, where, doc, updateDoc, deleteDoc, serverTimestamp, addDoc } from 'firebase/firestore';
+import { collection, query, orderBy, limit, getDocs, where, doc, deleteDoc, serverTimestamp, addDoc, increment, runTransaction } from 'firebase/firestore';
 import { motion } from 'framer-motion';
 import { sendUserNotification } from '../../lib/notifications';
 
@@ -16,6 +16,8 @@ interface WithdrawalRequest {
   crypto_symbol?: string;
   status: 'pending' | 'approved' | 'rejected';
   admin_notes?: string;
+  // false = balance still held, debited on approval (older requests were debited on submit)
+  balance_debited?: boolean;
   created_at: string;
   processed_at: string | null;
   user: {
@@ -143,19 +145,65 @@ export default function AdminWithdrawals() {
         if (!confirmRejection) return;
       }
 
-      // Update withdrawal status in Firebase
-      await updateDoc(doc(db, 'withdrawal_requests', withdrawalId), {
-        status: newStatus,
-        processed_at: new Date().toISOString(),
-        admin_notes: newStatus === 'rejected' ? rejectionReason || 'No reason provided' : null,
-        updated_at: serverTimestamp()
-      });
+      const held = withdrawal.balance_debited === false;
+      const debit = newStatus === 'approved' && held ? withdrawal.amount : 0;
+      const refund = newStatus === 'rejected' && !held && !isValidRejection ? withdrawal.amount : 0;
+
+      const userSnapshot = await getDocs(query(collection(db, 'users'), where('telegram_id', '==', withdrawal.user_id), limit(1)));
+      const userRef = userSnapshot.empty ? null : userSnapshot.docs[0].ref;
+      if ((debit || refund) && !userRef) {
+        alert('User not found for balance update. Please contact support.');
+        return;
+      }
+
+      // Settlement marker, status change and balance change commit together. The
+      // withdrawal pipeline creates the same marker, so a request is settled once.
+      const requestRef = doc(db, 'withdrawal_requests', withdrawalId);
+      const markerRef = doc(db, 'withdrawal_settlements', withdrawalId);
+      try {
+        await runTransaction(db, async (transaction) => {
+          const marker = await transaction.get(markerRef);
+          const request = await transaction.get(requestRef);
+          const user = userRef ? await transaction.get(userRef) : null;
+          if (marker.exists() || request.data()?.status !== 'pending') {
+            throw new Error('This withdrawal has already been processed.');
+          }
+          if (debit && (user?.data()?.balance || 0) < debit) {
+            throw new Error('Insufficient balance: the user no longer has enough to cover this withdrawal.');
+          }
+          transaction.set(markerRef, {
+            request_id: withdrawalId,
+            user_id: withdrawal.user_id,
+            amount: withdrawal.amount,
+            outcome: newStatus,
+            reason: newStatus === 'rejected' ? rejectionReason || 'No reason provided' : '',
+            debited: debit,
+            refunded: refund,
+            settled_by: 'admin',
+            settled_at: serverTimestamp()
+          });
+          transaction.update(requestRef, {
+            status: newStatus,
+            processed_at: new Date().toISOString(),
+            admin_notes: newStatus === 'rejected' ? rejectionReason || 'No reason provided' : null,
+            ...(debit ? { balance_debited: true } : {}),
+            updated_at: serverTimestamp()
+          });
+          if (userRef && (debit || refund)) {
+            transaction.update(userRef, {
+              balance: increment(refund - debit),
+              updated_at: serverTimestamp()
+            });
+          }
+        });
+      } catch (settleError: any) {
+        alert(settleError?.message || 'Error updating withdrawal status. Please try again.');
+        loadWithdrawals();
+        return;
+      }
 
       if (newStatus === 'approved') {
-        // Balance already deducted when user submitted withdrawal
-        // No need to deduct again - just approve the withdrawal
-        
-        console.log(`Withdrawal approved: ${withdrawal.amount} already deducted from user ${withdrawal.user_id}`);
+        console.log(`Withdrawal approved: ${withdrawal.amount} deducted from user ${withdrawal.user_id}`);
         
         // Send notification to user
         await sendUserNotification(
@@ -166,8 +214,8 @@ export default function AdminWithdrawals() {
         );
         
       } else if (newStatus === 'rejected') {
-        if (isValidRejection) {
-          // Valid rejection - NO refund
+        if (!refund) {
+          // Valid rejection (or nothing was debited yet) - NO refund
           console.log(`Withdrawal rejected (valid): ${withdrawal.amount} NOT refunded to user ${withdrawal.user_id}`);
           
           // Send notification to user
@@ -179,31 +227,16 @@ export default function AdminWithdrawals() {
           );
           
         } else {
-          // Standard rejection - WITH refund
-          const usersRef = collection(db, 'users');
-          const userQuery = query(usersRef, where('telegram_id', '==', withdrawal.user_id), limit(1));
-          const userSnapshot = await getDocs(userQuery);
+          // Standard rejection - refunded in the transaction above
+          console.log(`Withdrawal rejected (standard): ${withdrawal.amount} refunded to user ${withdrawal.user_id}`);
           
-          if (!userSnapshot.empty) {
-            const userDoc = userSnapshot.docs[0];
-            const currentBalance = userDoc.data().balance || 0;
-            const newBalance = currentBalance + withdrawal.amount;
-            
-            await updateDoc(userDoc.ref, {
-              balance: newBalance,
-              updated_at: serverTimestamp()
-            });
-            
-            console.log(`Withdrawal rejected (standard): ${withdrawal.amount} refunded to user ${withdrawal.user_id}`);
-            
-            // Send notification to user
-            await sendUserNotification(
-              withdrawal.user_id.toString(),
-              'warning',
-              'Withdrawal Rejected & Refunded ⚠️',
-              `Your withdrawal of ${withdrawal.amount} was rejected but the amount has been refunded to your balance.`
-            );
-          }
+          // Send notification to user
+          await sendUserNotification(
+            withdrawal.user_id.toString(),
+            'warning',
+            'Withdrawal Rejected & Refunded ⚠️',
+            `Your withdrawal of ${withdrawal.amount} was rejected but the amount has been refunded to your balance.`
+          );
         }
       }
       
@@ -215,9 +248,13 @@ export default function AdminWithdrawals() {
       let message = '';
       
       if (newStatus === 'approved') {
-        message = `Withdrawal approved. Amount was already deducted when user submitted.`;
+        message = held
+          ? `Withdrawal approved. Amount deducted from user balance.`
+          : `Withdrawal approved. Amount was already deducted when user submitted.`;
       } else if (newStatus === 'rejected') {
-        if (isValidRejection) {
+        if (held) {
+          message = `Withdrawal rejected. The balance was never debited.`;
+        } else if (isValidRejection) {
           message = `Withdrawal rejected (valid reason). No refund given.`;
         } else {
           message = `Withdrawal rejected. Amount refunded to user balance.`;
@@ -1,6 +1,8 @@
 import { create } from 'zustand';
 import { persist } from 'zustand/middleware';
 import { db } from '../lib/firebase';
+import { readNotificationExpiry } from '../lib/notifications';
+import { currentEnergy, spendEnergy as spendUserEnergy, setEnergy as setUserEnergy } from '../lib/energy';
 import { 
   collection, 
   doc, 
@@ -72,6 +74,7 @@ interface UserState {
   setUser: (user: Partial<UserState>) => void;
   updateBalance: (amount: number) => Promise<void>;
   updateEnergy: (amount: number) => Promise<void>;
+  spendEnergy: (amount?: number) => Promise<boolean>;
   updateExperience: (xp: number) => Promise<void>;
   updateLevel: (level: number) => Promise<void>;
   updateMiningPower: (power: number) => Promise<void>;
@@ -176,25 +179,30 @@ export const useFirebaseUserStore = create<UserState>()(
         if (!telegramId) return;
 
         try {
-          // Query by telegram_id instead of using document ID
-          const usersRef = collection(db, 'users');
-          const q = query(usersRef, where('telegram_id', '==', telegramId), limit(1));
-          const querySnapshot = await getDocs(q);
-          
-          if (!querySnapshot.empty) {
-            const userDoc = querySnapshot.docs[0];
-            await updateDoc(userDoc.ref, { 
-              energy: amount,
-              updated_at: serverTimestamp()
-            });
-            set({ energy: amount });
-          }
+          // Keeps regen progress: last_energy_refill only moves by whole points (see lib/energy.ts)
+          const state = await setUserEnergy(telegramId, amount);
+          set({ energy: state.energy });
         } catch (error) {
           console.error('Error updating energy:', error);
           throw error;
         }
       },
 
+      spendEnergy: async (amount = 1) => {
+        const { telegramId } = get();
+        if (!telegramId) return false;
+
+        try {
+          // Spend-if-available in a transaction, so concurrent spends can't overspend
+          const result = await spendUserEnergy(telegramId, amount);
+          set({ energy: result.state.energy });
+          return result.spent;
+        } catch (error) {
+          console.error('Error spending energy:', error);
+          throw error;
+        }
+      },
+
       updateExperience: async (xp) => {
         const { telegramId } = get();
         if (!telegramId) return;
@@ -378,7 +386,7 @@ export const useFirebaseUserStore = create<UserState>()(
               email: userData.email || '',
               phone: userData.phone || '',
               balance: userData.balance || 0,
-              energy: userData.energy || 100,
+              energy: currentEnergy(userData).energy,
               maxEnergy: userData.max_energy || 100,
               level: userData.level || 1,
               experiencePoints: userData.experience_points || 0,
@@ -451,7 +459,7 @@ export const useFirebaseUserStore = create<UserState>()(
             email: userData.email || '',
             phone: userData.phone || '',
             balance: userData.balance || 0,
-            energy: userData.energy || 100,
+            energy: currentEnergy(userData).energy,
             maxEnergy: userData.max_energy || 100,
             level: userData.level || 1,
             experiencePoints: userData.experience_points || 0,
@@ -535,7 +543,7 @@ export const useFirebaseUserStore = create<UserState>()(
         try {
           // Update in Firestore
           const notificationRef = doc(db, 'notifications', id);
-          await updateDoc(notificationRef, { read: true });
+          await updateDoc(notificationRef, { read: true, is_read: true, expires_at: readNotificationExpiry() });
           
           // Update local state
           set(state => ({
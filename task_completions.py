@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Cash Points Task Completions
+High-throughput task-completion ingestion.
+
+Features:
+- Batch API: submit many completions at once, one result per completion
+- Task templates (reward, cooldown, max_completions, is_active) cached in memory with a TTL
+- Cooldowns, per-task caps and a per-user daily cap enforced from an in-memory index;
+  a user's history is loaded once, for many users per query
+- Credits applied with atomic Increments; completions and credits are committed
+  together in batches (one balance write per user per batch)
+
+Usage:
+    python task_completions.py --bench 100000
+"""
+
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Iterable, NamedTuple
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_COLLECTION = 'task_templates'
+COMPLETIONS_COLLECTION = 'task_completions'
+
+BATCH_LIMIT = 500  # Firestore max writes per batch
+IN_QUERY_LIMIT = 30  # Firestore max values in an 'in' filter
+
+# Result statuses
+CREDITED = 'credited'
+COOLDOWN = 'cooldown'
+CAP_REACHED = 'cap_reached'
+DAILY_CAP = 'daily_cap'
+UNKNOWN_TASK = 'unknown_task'
+INACTIVE = 'inactive'
+UNKNOWN_USER = 'unknown_user'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+
+class Completion(NamedTuple):
+    user_id: str
+    task_id: str
+    completed_at: Optional[float] = None  # unix seconds, defaults to now
+    reward: Optional[int] = None  # only used when no template exists (legacy callers)
+
+
+class CompletionResult(NamedTuple):
+    user_id: str
+    task_id: str
+    status: str
+    reward: int = 0
+    retry_after: float = 0.0
+
+
+def _timestamp(value) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return None
+
+
+class TaskTemplateCache:
+    """All task templates in memory, reloaded after a TTL"""
+
+    def __init__(self, db, ttl_seconds: int = None):
+        self.db = db
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else config.TASK_TEMPLATE_CACHE_TTL
+        self._templates: Dict[str, Dict[str, Any]] = {}
+        self._by_type: Dict[str, str] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _reload(self):
+        templates, by_type = {}, {}
+        for doc in self.db.collection(TEMPLATES_COLLECTION).stream():
+            data = doc.to_dict() or {}
+            templates[doc.id] = data
+            if data.get('type') and data.get('is_active', True):
+                by_type.setdefault(data['type'], doc.id)
+        self._templates, self._by_type = templates, by_type
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Template by id (or by type, for legacy callers); reloads when stale"""
+        with self._lock:
+            if time.monotonic() - self._loaded_at >= self.ttl_seconds:
+                try:
+                    self._reload()
+                except Exception as e:
+                    # Keep serving the previous templates if the reload fails
+                    logger.warning(f"Task template reload failed: {e}")
+                    self._loaded_at = time.monotonic()
+            template_id = task_id if task_id in self._templates else self._by_type.get(task_id)
+            if template_id is None:
+                return None
+            return dict(self._templates[template_id], id=template_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0.0
+
+
+class _UserState:
+    __slots__ = ('ref', 'tasks', 'day', 'day_count')
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.tasks: Dict[str, List[float]] = {}  # task_id -> [count, last_completed_at]
+        self.day = None
+        self.day_count = 0
+
+
+class TaskCompletionService:
+    """Validates and credits task completions in batches"""
+
+    def __init__(self, db, templates: TaskTemplateCache = None, daily_cap: int = None,
+                 batch_writes: int = None):
+        self.db = db
+        self.templates = templates or TaskTemplateCache(db)
+        self.daily_cap = daily_cap if daily_cap is not None else config.TASK_DAILY_CAP
+        self.batch_writes = min(batch_writes or config.TASK_BATCH_WRITES, BATCH_LIMIT)
+        self._users: Dict[str, _UserState] = {}
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.commits = 0
+
+    # ---- Index ------------------------------------------------------------
+
+    def _load_users(self, user_ids: List[str]):
+        """Resolve user docs and completion history for users not yet indexed"""
+        missing = [u for u in dict.fromkeys(user_ids) if u not in self._users]
+        for start in range(0, len(missing), IN_QUERY_LIMIT):
+            chunk = missing[start:start + IN_QUERY_LIMIT]
+            states: Dict[str, Optional[_UserState]] = {u: None for u in chunk}
+            for doc in self.db.collection('users').where('telegram_id', 'in', chunk).stream():
+                telegram_id = str((doc.to_dict() or {}).get('telegram_id'))
+                if telegram_id in states and states[telegram_id] is None:
+                    states[telegram_id] = _UserState(doc.reference)
+            query = self.db.collection(COMPLETIONS_COLLECTION).where('user_id', 'in', chunk)
+            for doc in query.stream():
+                data = doc.to_dict() or {}
+                state = states.get(str(data.get('user_id')))
+                if state is None:
+                    continue
+                completed_at = _timestamp(data.get('completed_at')) or 0.0
+                entry = state.tasks.setdefault(str(data.get('task_id')), [0, 0.0])
+                entry[0] += 1
+                entry[1] = max(entry[1], completed_at)
+                self._count_day(state, completed_at)
+            # Unknown users are not remembered, so they're picked up once they register
+            self._users.update((u, state) for u, state in states.items() if state is not None)
+
+    @staticmethod
+    def _count_day(state: _UserState, completed_at: float):
+        day = datetime.fromtimestamp(completed_at).date()
+        if state.day is None or day > state.day:
+            state.day, state.day_count = day, 1
+        elif day == state.day:
+            state.day_count += 1
+
+    def _check(self, state: _UserState, template: Dict[str, Any], completion: Completion,
+               now: float) -> Optional[CompletionResult]:
+        entry = state.tasks.get(template['id'])
+        cooldown = int(template.get('cooldown') or 0)
+        if entry and cooldown and now - entry[1] < cooldown:
+            return CompletionResult(completion.user_id, completion.task_id, COOLDOWN,
+                                    retry_after=cooldown - (now - entry[1]))
+        max_completions = int(template.get('max_completions') or 0)
+        # With a cooldown the task is repeatable; otherwise max_completions is a lifetime cap
+        if entry and not cooldown and max_completions and entry[0] >= max_completions:
+            return CompletionResult(completion.user_id, completion.task_id, CAP_REACHED)
+        today = datetime.fromtimestamp(now).date()
+        if self.daily_cap and state.day == today and state.day_count >= self.daily_cap:
+            return CompletionResult(completion.user_id, completion.task_id, DAILY_CAP)
+        return None
+
+    # ---- Batch API --------------------------------------------------------
+
+    def submit(self, completions: Iterable[Completion]) -> List[CompletionResult]:
+        """Validate and credit completions; results are returned in input order"""
+        completions = [c if isinstance(c, Completion) else Completion(*c) for c in completions]
+        completions = [c._replace(user_id=str(c.user_id), task_id=str(c.task_id)) for c in completions]
+        results: List[Optional[CompletionResult]] = [None] * len(completions)
+        accepted = []  # (position, completion, template, reward, count, undo)
+
+        with self._lock:
+            self._load_users([c.user_id for c in completions])
+            for position, completion in enumerate(completions):
+                now = completion.completed_at or time.time()
+                template = self.templates.get(completion.task_id)
+                if template is None:
+                    if completion.reward is None:
+                        results[position] = CompletionResult(completion.user_id, completion.task_id, UNKNOWN_TASK)
+                        continue
+                    template = {'id': completion.task_id, 'reward': completion.reward,
+                                'type': completion.task_id, 'title': completion.task_id}
+                elif not template.get('is_active', True):
+                    results[position] = CompletionResult(completion.user_id, completion.task_id, INACTIVE)
+                    continue
+                state = self._users.get(completion.user_id)
+                if state is None:
+                    results[position] = CompletionResult(completion.user_id, completion.task_id, UNKNOWN_USER)
+                    continue
+                rejected = self._check(state, template, completion, now)
+                if rejected:
+                    results[position] = rejected
+                    continue
+
+                # Reserve in the index now; undone below if the commit fails. The
+                # count reserved here is this completion's own, and names its doc
+                entry = state.tasks.setdefault(template['id'], [0, 0.0])
+                undo = (entry[1], datetime.fromtimestamp(now).date())
+                entry[0] += 1
+                entry[1] = now
+                self._count_day(state, now)
+                accepted.append((position, completion._replace(completed_at=now), template,
+                                 int(template.get('reward') or 0), entry[0], undo))
+
+        for position, status in self._commit(accepted).items():
+            completion, reward = accepted[position][1], accepted[position][3]
+            results[accepted[position][0]] = CompletionResult(
+                completion.user_id, completion.task_id, status, reward if status == CREDITED else 0)
+
+        for result in results:
+            self.counts[result.status] = self.counts.get(result.status, 0) + 1
+        return results
+
+    def complete(self, user_id, task_id: str, reward: int = None) -> CompletionResult:
+        return self.submit([Completion(str(user_id), task_id, None, reward)])[0]
+
+    # ---- Writes -----------------------------------------------------------
+
+    def _completion_id(self, completion: Completion, template: Dict[str, Any], count: int) -> str:
+        """Deterministic id: one completion per cooldown window (or per count for one-off tasks)"""
+        cooldown = int(template.get('cooldown') or 0)
+        slot = int(completion.completed_at // cooldown) if cooldown else count
+        return f"{completion.user_id}_{template['id']}_{slot}"
+
+    def _commit(self, accepted) -> Dict[int, str]:
+        """Commit accepted completions in batches; returns index in `accepted` -> status"""
+        statuses: Dict[int, str] = {}
+        chunk: List[int] = []
+        users_in_chunk: set = set()
+
+        def flush():
+            if chunk:
+                statuses.update(self._commit_chunk(accepted, list(chunk)))
+                chunk.clear()
+                users_in_chunk.clear()
+
+        for i, (_, completion, _, _, _, _) in enumerate(accepted):
+            # One completion doc each, plus one balance update per distinct user
+            writes = len(chunk) + len(users_in_chunk | {completion.user_id})
+            if writes > self.batch_writes:
+                flush()
+            chunk.append(i)
+            users_in_chunk.add(completion.user_id)
+        flush()
+        return statuses
+
+    def _commit_chunk(self, accepted, indexes: List[int]) -> Dict[int, str]:
+        batch = self.db.batch()
+        credits: Dict[str, int] = {}
+        for i in indexes:
+            _, completion, template, reward, count, _ = accepted[i]
+            completed_at = datetime.fromtimestamp(completion.completed_at)
+            batch.create(self.db.collection(COMPLETIONS_COLLECTION).document(
+                self._completion_id(completion, template, count)), {
+                'user_id': completion.user_id,
+                'task_id': template['id'],
+                'task_type': template.get('type', ''),
+                'task_title': template.get('title', ''),
+                'reward_amount': reward,
+                'completed_at': completed_at,
+                'created_at': datetime.now()
+            })
+            credits[completion.user_id] = credits.get(completion.user_id, 0) + reward
+        for user_id, amount in credits.items():
+            batch.update(self._users[user_id].ref, {
+                'balance': firestore.Increment(amount),
+                'total_earnings': firestore.Increment(amount),
+                'updated_at': datetime.now()
+            })
+        try:
+            batch.commit()
+            self.commits += 1
+            return {i: CREDITED for i in indexes}
+        except AlreadyExists:
+            if len(indexes) > 1:
+                # Another writer got some of these first; isolate them one by one
+                statuses = {}
+                for i in indexes:
+                    statuses.update(self._commit_chunk(accepted, [i]))
+                return statuses
+            self._undo(accepted, indexes)
+            return {indexes[0]: DUPLICATE}
+        except Exception as e:
+            logger.warning(f"Task completion batch of {len(indexes)} failed: {e}")
+            self._undo(accepted, indexes)
+            return {i: FAILED for i in indexes}
+
+    def _undo(self, accepted, indexes: List[int]):
+        # Take back just these reservations; others made since (and committed) stay
+        with self._lock:
+            for i in reversed(indexes):
+                _, completion, template, _, count, (last_at, day) = accepted[i]
+                state = self._users.get(completion.user_id)
+                entry = state.tasks.get(template['id']) if state else None
+                if entry is None:
+                    continue
+                # Only the latest reservation gives its count back: a later one may
+                # already be committed under count + 1, and ids must not repeat
+                if entry[0] == count:
+                    entry[0] -= 1
+                if entry[1] == completion.completed_at:
+                    entry[1] = last_at
+                if state.day == day and state.day_count:
+                    state.day_count -= 1
+
+    def forget_user(self, user_id):
+        """Drop a user's cached state (e.g. after an admin correction)"""
+        with self._lock:
+            self._users.pop(str(user_id), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'indexed_users': len(self._users),
+            'commits': self.commits,
+            'template_reloads': self.templates.reloads,
+            **self.counts,
+        }
+
+
+def run_benchmark(total: int, users: int, batch_size: int):
+    """Ingest synthetic completions against the in-memory stand-in backend"""
+    import random
+    from fake_firestore import FakeFirestore
+
+    db = FakeFirestore()
+    db.seed(TEMPLATES_COLLECTION, 'checkin', {'title': 'Daily Check-in', 'type': 'checkin',
+                                              'reward': 50, 'cooldown': 86400, 'max_completions': 1,
+                                              'is_active': True})
+    db.seed(TEMPLATES_COLLECTION, 'social', {'title': 'Join channel', 'type': 'social', 'reward': 20,
+                                             'cooldown': 0, 'max_completions': 1, 'is_active': True})
+    for i in range(25):
+        db.seed(TEMPLATES_COLLECTION, f'ad{i}', {'title': f'Watch ad {i}', 'type': 'daily', 'reward': 1,
+                                                 'cooldown': 60, 'max_completions': 0, 'is_active': True})
+    base = 5_000_000_000
+    for i in range(users):
+        db.seed('users', str(base + i), {'telegram_id': str(base + i), 'balance': 0, 'total_earnings': 0})
+
+    service = TaskCompletionService(db)
+    rng = random.Random(1)
+    task_ids = ['checkin', 'social'] + [f'ad{i}' for i in range(25)]
+    now = time.time()
+    completions = [Completion(str(base + rng.randrange(users)), rng.choice(task_ids), now + i * 0.001)
+                   for i in range(total)]
+
+    started = time.perf_counter()
+    for start in range(0, total, batch_size):
+        service.submit(completions[start:start + batch_size])
+    elapsed = time.perf_counter() - started
+
+    stats = service.stats()
+    credited_total = sum(d.get('balance', 0) for d in db.dump('users').values())
+    print(f"📊 Completions: {total:,} from {users:,} users in {elapsed:.2f}s "
+          f"({total / elapsed:,.0f}/sec)")
+    print(f"✅ Credited: {stats.get(CREDITED, 0):,}  ⏳ Cooldown: {stats.get(COOLDOWN, 0):,}  "
+          f"🔒 Capped: {stats.get(CAP_REACHED, 0) + stats.get(DAILY_CAP, 0):,}")
+    calls = db.call_counts()
+    print(f"💾 Commits: {stats['commits']:,}, backend calls: {calls.get('commit', 0) + calls.get('query', 0):,}")
+    print(f"💰 Balance credited: ৳{credited_total:,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Task completion ingestion tools')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark N synthetic completions')
+    parser.add_argument('--users', type=int, default=20000, help='Synthetic users for the benchmark')
+    parser.add_argument('--batch', type=int, default=2000, help='Completions per submit() call')
+    args = parser.parse_args()
+
+    if args.bench:
+        run_benchmark(args.bench, args.users, args.batch)
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
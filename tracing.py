@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+Cash Points Tracing
+Per-update tracing spans with a local OpenTelemetry (OTLP/JSON) exporter.
+
+Features:
+- Root span per update (via a PTB update processor), child spans around every
+  Firestore operation, Bot API call and rendering step
+- Spans carry attributes (collection, method, hashed user id) and are written
+  in OTLP/JSON so they load into any OpenTelemetry collector or backend
+- Head sampling by ratio plus tail keep for slow or failed updates
+- Export to a local JSONL file and/or an OTLP/HTTP collector endpoint
+- CLI that summarises the slowest traces and time per span type
+
+Usage:
+    python tracing.py summarize state/traces.jsonl --top 10
+"""
+
+import os
+import sys
+import json
+import time
+import hmac
+import queue
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import contextvars
+import urllib.request
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Optional, Dict, Any, List
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+
+
+def hash_user_id(user_id) -> str:
+    """Keyed hash so traces never carry raw Telegram ids"""
+    key = (config.TRACE_SALT or 'cashpoints').encode()
+    return hmac.new(key, str(user_id).encode(), hashlib.sha256).hexdigest()[:16]
+
+
+class Trace:
+    __slots__ = ('trace_id', 'spans', 'sampled', 'error', 'closed', 'lock')
+
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List['Span'] = []
+        self.sampled = sampled
+        self.error = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns',
+                 'attributes', 'status', 'message', '_token')
+
+    def __init__(self, trace: Trace, name: str, kind: int, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else ''
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = STATUS_OK
+        self.message = ''
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status = STATUS_ERROR
+        self.message = f"{type(error).__name__}: {error}"[:200]
+        self.trace.error = True
+
+    def end(self):
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                pass  # ended from another context
+            self._token = None
+        with self.trace.lock:
+            if not self.trace.closed:
+                self.trace.spans.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': self.status, 'message': self.message} if self.message else {'code': self.status},
+        }
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_attribute(key: str, value) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+# ---- Export -----------------------------------------------------------------
+
+class SpanExporter:
+    """Background exporter writing OTLP/JSON batches to a file and/or collector"""
+
+    def __init__(self, path: str = None, endpoint: str = None, service_name: str = None,
+                 batch_size: int = 50, interval: float = 5.0):
+        self.path = path
+        self.endpoint = endpoint
+        self.service_name = service_name or config.TRACE_SERVICE_NAME
+        self.batch_size = batch_size
+        self.interval = interval
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+        self._thread.start()
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        batch: List[Trace] = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.05, deadline - time.monotonic()))
+                if item is None:
+                    self._write(batch)
+                    batch = []
+                    self._queue.task_done()
+                    continue
+                batch.append(item)
+                self._queue.task_done()
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + self.interval
+
+    def payload(self, traces: List[Trace]) -> Dict[str, Any]:
+        spans = [span.to_otlp() for trace in traces for span in trace.spans]
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', self.service_name)]},
+                'scopeSpans': [{'scope': {'name': 'cashpoints.tracing'}, 'spans': spans}],
+            }]
+        }
+
+    def _write(self, traces: List[Trace]):
+        if not traces:
+            return
+        body = json.dumps(self.payload(traces), separators=(',', ':'))
+        try:
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(body + '\n')
+            if self.endpoint:
+                request = urllib.request.Request(self.endpoint, data=body.encode(),
+                                                 headers={'Content-Type': 'application/json'})
+                urllib.request.urlopen(request, timeout=5).close()
+            self.exported += len(traces)
+        except Exception as e:
+            self.failed += len(traces)
+            logger.warning(f"Trace export failed: {e}")
+
+    def flush(self, timeout: float = 5.0):
+        """Write everything queued so far"""
+        self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+# ---- Tracer -----------------------------------------------------------------
+
+class Tracer:
+    """Creates spans; a trace is exported when its root span ends"""
+
+    def __init__(self, enabled: bool = None, sample_rate: float = None, slow_ms: float = None,
+                 exporter: Optional[SpanExporter] = None):
+        self.enabled = config.TRACING_ENABLED if enabled is None else enabled
+        self.sample_rate = config.TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.slow_ms = config.TRACE_SLOW_MS if slow_ms is None else slow_ms
+        self._exporter = exporter
+        self.traces = 0
+        self.kept = 0
+
+    @property
+    def exporter(self) -> SpanExporter:
+        if self._exporter is None:
+            self._exporter = SpanExporter(path=config.TRACE_FILE or None,
+                                          endpoint=config.TRACE_OTLP_ENDPOINT or None)
+        return self._exporter
+
+    def start_root(self, name: str, kind: int = KIND_SERVER, **attributes):
+        if not self.enabled:
+            return NOOP_SPAN
+        trace = Trace(sampled=random.random() < self.sample_rate)
+        span = Span(trace, name, kind, None, attributes)
+        span._token = _current.set(span)
+        self.traces += 1
+        return span
+
+    def end_root(self, span):
+        if span is NOOP_SPAN:
+            return
+        span.end()
+        trace = span.trace
+        with trace.lock:
+            trace.closed = True
+        # Tail keep: slow or failed updates are exported even when not sampled
+        if trace.sampled or trace.error or span.duration_ms >= self.slow_ms:
+            self.kept += 1
+            self.exporter.export(trace)
+
+    def start_span(self, name: str, kind: int = KIND_INTERNAL, **attributes):
+        """Start a child of the current span (no-op outside a trace)"""
+        parent = _current.get()
+        if parent is None:
+            return NOOP_SPAN
+        span = Span(parent.trace, name, kind, parent, attributes)
+        span._token = _current.set(span)
+        return span
+
+    @contextmanager
+    def root_span(self, name: str, kind: int = KIND_SERVER, **attributes):
+        span = self.start_root(name, kind, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            self.end_root(span)
+
+    @contextmanager
+    def span(self, name: str, kind: int = KIND_INTERNAL, **attributes):
+        span = self.start_span(name, kind, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            span.end()
+
+    def flush(self):
+        if self._exporter is not None:
+            self._exporter.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        exporter = self._exporter
+        return {
+            'enabled': self.enabled,
+            'traces': self.traces,
+            'kept': self.kept,
+            'exported': exporter.exported if exporter else 0,
+            'dropped': exporter.dropped if exporter else 0,
+        }
+
+
+# Shared tracer for the bot
+tracer = Tracer()
+start_span = tracer.start_span
+span = tracer.span
+
+
+# ---- Firestore instrumentation ---------------------------------------------
+
+_FIRESTORE_OPS = {'get', 'stream', 'set', 'update', 'create', 'delete', 'add', 'commit'}
+_FIRESTORE_CHAIN = {'collection', 'document', 'where', 'order_by', 'limit', 'start_after',
+                    'start_at', 'end_before', 'end_at', 'select', 'offset', 'batch'}
+_BATCH = 'batch'
+
+
+def _unwrap(value):
+    return value._target if isinstance(value, TracedFirestore) else value
+
+
+class TracedFirestore:
+    """Transparent proxy that adds a span around each Firestore round trip"""
+
+    __slots__ = ('_target', '_collection')
+
+    def __init__(self, target, collection: str = ''):
+        self._target = target
+        self._collection = collection
+
+    def __bool__(self):
+        return True
+
+    def __repr__(self):
+        return f"TracedFirestore({self._target!r})"
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name == 'reference':
+            return TracedFirestore(attr, self._collection)
+        if not callable(attr):
+            return attr
+        if name in _FIRESTORE_CHAIN:
+            def chained(*args, **kwargs):
+                result = attr(*[_unwrap(a) for a in args], **{k: _unwrap(v) for k, v in kwargs.items()})
+                collection = self._collection
+                if name == 'batch':
+                    collection = _BATCH
+                elif name == 'collection' and args:
+                    collection = str(args[0]).split('/')[-1]
+                elif name == 'document' and args and not collection:
+                    collection = str(args[0]).split('/')[0]  # client.document('users/123')
+                return TracedFirestore(result, collection)
+            return chained
+        if name in _FIRESTORE_OPS and self._collection == _BATCH and name != 'commit':
+            # Staging a write in a batch is local; only the commit is a round trip
+            def staged(*args, **kwargs):
+                return attr(*[_unwrap(a) for a in args], **{k: _unwrap(v) for k, v in kwargs.items()})
+            return staged
+        if name in _FIRESTORE_OPS:
+            def traced(*args, **kwargs):
+                operation = 'query' if name == 'stream' else name
+                with tracer.span(f"firestore.{operation}", KIND_CLIENT, **{
+                    'db.system': 'firestore',
+                    'db.operation': operation,
+                    'db.collection': self._collection or 'unknown',
+                }) as current:
+                    result = attr(*[_unwrap(a) for a in args], **{k: _unwrap(v) for k, v in kwargs.items()})
+                    if name == 'stream':
+                        docs = [TracedFirestore(doc, self._collection) for doc in result]
+                        current.set_attribute('db.rows', len(docs))
+                        return iter(docs)
+                    if name == 'add' and isinstance(result, tuple):
+                        return result[0], TracedFirestore(result[1], self._collection)
+                    return result
+            return traced
+        return attr
+
+
+def traced_client(client):
+    """Wrap a Firestore client when tracing is enabled"""
+    if client is None or not tracer.enabled or isinstance(client, TracedFirestore):
+        return client
+    return TracedFirestore(client)
+
+
+# ---- python-telegram-bot hooks ----------------------------------------------
+
+def _update_span_name(update) -> tuple:
+    attributes = {}
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        attributes['enduser.id'] = hash_user_id(user.id)
+    callback = getattr(update, 'callback_query', None)
+    message = getattr(update, 'message', None)
+    if callback is not None:
+        attributes['telegram.callback_data'] = str(callback.data)[:64]
+        return f"update.callback.{callback.data}", attributes
+    if message is not None and message.text and message.text.startswith('/'):
+        return f"update.command.{message.text.split()[0].split('@')[0]}", attributes
+    return 'update.other', attributes
+
+
+def update_processor(max_concurrent_updates: int):
+    """BaseUpdateProcessor that opens a root span around each update"""
+    from telegram.ext import BaseUpdateProcessor
+
+    class TracingUpdateProcessor(BaseUpdateProcessor):
+        async def do_process_update(self, update, coroutine):
+            name, attributes = _update_span_name(update)
+            with tracer.root_span(name, **attributes):
+                await coroutine
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            tracer.flush()
+
+    return TracingUpdateProcessor(max_concurrent_updates)
+
+
+def traced_request(inner):
+    """Wrap a PTB BaseRequest so every Bot API call gets a client span"""
+    from telegram.request import BaseRequest
+
+    class TracingRequest(BaseRequest):
+        def __init__(self, wrapped):
+            self._inner = wrapped
+
+        async def initialize(self):
+            await self._inner.initialize()
+
+        async def shutdown(self):
+            await self._inner.shutdown()
+
+        @property
+        def read_timeout(self):
+            return self._inner.read_timeout
+
+        async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                             write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                             pool_timeout=BaseRequest.DEFAULT_NONE):
+            api_method = url.rsplit('/', 1)[-1]
+            with tracer.span(f"telegram.{api_method}", KIND_CLIENT, **{
+                'rpc.system': 'telegram',
+                'rpc.method': api_method,
+            }) as current:
+                status, payload = await self._inner.do_request(
+                    url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                    connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+                current.set_attribute('http.status_code', status)
+                return status, payload
+
+    return TracingRequest(inner)
+
+
+# ---- Summary CLI ------------------------------------------------------------
+
+def _attribute_value(attribute: Dict[str, Any]):
+    value = attribute.get('value', {})
+    for key in ('stringValue', 'intValue', 'doubleValue', 'boolValue'):
+        if key in value:
+            return value[key]
+    return None
+
+
+def load_traces(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                payload = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            for resource in payload.get('resourceSpans', []):
+                for scope in resource.get('scopeSpans', []):
+                    for item in scope.get('spans', []):
+                        item['attrs'] = {a['key']: _attribute_value(a) for a in item.get('attributes', [])}
+                        item['ms'] = (int(item['endTimeUnixNano']) - int(item['startTimeUnixNano'])) / 1e6
+                        traces[item['traceId']].append(item)
+    return traces
+
+
+def span_type(item: Dict[str, Any]) -> str:
+    collection = item['attrs'].get('db.collection')
+    return f"{item['name']} {collection}" if collection else item['name']
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def summarize(path: str, top: int = 10):
+    traces = load_traces(path)
+    roots = []
+    for trace_id, items in traces.items():
+        root = next((i for i in items if not i.get('parentSpanId')), None)
+        if root:
+            roots.append((root, items))
+    if not roots:
+        print("❌ No complete traces found")
+        return
+    roots.sort(key=lambda r: r[0]['ms'], reverse=True)
+
+    print(f"📊 {len(roots)} traces in {path}\n")
+    print(f"🐢 Slowest {min(top, len(roots))} traces:")
+    for root, items in roots[:top]:
+        status = '❌' if any(i.get('status', {}).get('code') == STATUS_ERROR for i in items) else '✅'
+        print(f"\n{status} {root['name']}  {root['ms']:.1f} ms  trace={root['traceId']}")
+        children = defaultdict(list)
+        for item in items:
+            children[item.get('parentSpanId', '')].append(item)
+        stack = [(child, 1) for child in sorted(children[root['spanId']],
+                                                key=lambda i: int(i['startTimeUnixNano']), reverse=True)]
+        while stack:
+            item, depth = stack.pop()
+            offset = (int(item['startTimeUnixNano']) - int(root['startTimeUnixNano'])) / 1e6
+            print(f"   {'  ' * depth}+{offset:7.1f} ms  {span_type(item):<40} {item['ms']:8.1f} ms")
+            stack.extend((child, depth + 1) for child in sorted(
+                children[item['spanId']], key=lambda i: int(i['startTimeUnixNano']), reverse=True))
+
+    by_type: Dict[str, List[float]] = defaultdict(list)
+    root_total = sum(root['ms'] for root, _ in roots)
+    for root, items in roots:
+        by_type[f"(root) {root['name']}"].append(root['ms'])
+        for item in items:
+            if item.get('parentSpanId'):
+                by_type[span_type(item)].append(item['ms'])
+
+    print(f"\n⏱️ Time by span type:")
+    print(f"   {'span type':<44}{'count':>7}{'total ms':>11}{'avg':>9}{'p95':>9}{'share':>8}")
+    for name, values in sorted(by_type.items(), key=lambda kv: sum(kv[1]), reverse=True):
+        total = sum(values)
+        share = '' if name.startswith('(root)') else f"{total / root_total * 100:6.1f}%"
+        print(f"   {name:<44}{len(values):>7}{total:>11.1f}{total / len(values):>9.1f}"
+              f"{_percentile(values, 95):>9.1f}{share:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trace tools')
+    sub = parser.add_subparsers(dest='command')
+    summary = sub.add_parser('summarize', help='Summarise a trace file')
+    summary.add_argument('path', nargs='?', default=config.TRACE_FILE)
+    summary.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'summarize':
+        if not os.path.exists(args.path):
+            print(f"❌ Trace file not found: {args.path}")
+            sys.exit(1)
+        summarize(args.path, args.top)
+        return
+    parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Cash Points Update Recorder
+Captures incoming updates (anonymised) to a compact append-only trace.
+
+- Enabled in production by setting RECORD_UPDATES_PATH
+- One short JSON line per update: timestamp, kind, anonymised user/chat ids,
+  command + anonymised arguments or callback data; names and free text are dropped
+- User ids and referral codes are replaced with keyed hashes, stable within
+  one recording so referral and rejoin patterns survive: v1 codes and ref_<id>
+  links are decoded and re-issued for the anonymised referrer, so a replay
+  credits the same (anonymised) user; legacy codes become hashed CP codes
+- read_trace() turns a trace back into Bot API update dicts for replay.py
+
+Record format:
+    {"t": 1718000000.123, "k": "m", "u": 4821..., "c": 4821..., "x": "/start C11M2X9Q0K7Z4T"}
+    {"t": 1718000004.551, "k": "q", "u": 4821..., "c": 4821..., "d": "verify_membership"}
+"""
+
+import os
+import hmac
+import json
+import time
+import hashlib
+import logging
+from typing import Optional, Dict, Any, Iterator
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+import referral_codes
+from config import config
+
+logger = logging.getLogger(__name__)
+
+MESSAGE = 'm'
+CALLBACK = 'q'
+OTHER = 'o'
+
+
+class UpdateRecorder:
+    """Append-only recorder registered as a TypeHandler in group -1"""
+
+    def __init__(self, path: str = None, salt: str = None):
+        self.path = path or config.RECORD_UPDATES_PATH
+        # A fresh salt per recording unless one is configured, so traces can't be joined
+        self._salt = (salt or config.RECORD_SALT or os.urandom(16).hex()).encode()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8', buffering=1)
+        self.recorded = 0
+
+    def _digest(self, value) -> bytes:
+        return hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+
+    def anon_id(self, value) -> int:
+        """Map a Telegram id to a stable 10-digit id (negative ids stay negative)"""
+        anon = 1_000_000_000 + int.from_bytes(self._digest(value)[:5], 'big') % 9_000_000_000
+        return -anon if int(value) < 0 else anon
+
+    def anon_code(self, code: str) -> str:
+        return 'CP' + self._digest(code).hex()[:8].upper()
+
+    def _anon_arg(self, arg: str) -> str:
+        parsed = referral_codes.parse_start_param(arg)
+        if parsed is None:
+            return '?'
+        if parsed.referrer_id is None:
+            return self.anon_code(parsed.code)
+        anon = self.anon_id(parsed.referrer_id)
+        if parsed.version == referral_codes.VERSION:
+            return referral_codes.encode(anon)
+        return f"ref_{anon}"
+
+    def _anon_text(self, text: str) -> Optional[str]:
+        if not text.startswith('/'):
+            return None  # free text is never stored
+        command, *args = text.split()
+        return ' '.join([command] + [self._anon_arg(arg) for arg in args])
+
+    def to_record(self, update: Update) -> Dict[str, Any]:
+        record: Dict[str, Any] = {'t': round(time.time(), 3)}
+        user = update.effective_user
+        chat = update.effective_chat
+        if user:
+            record['u'] = self.anon_id(user.id)
+        if chat:
+            record['c'] = self.anon_id(chat.id)
+        if update.callback_query:
+            record['k'] = CALLBACK
+            record['d'] = update.callback_query.data
+        elif update.message and update.message.text is not None:
+            record['k'] = MESSAGE
+            text = self._anon_text(update.message.text)
+            if text is None:
+                record['n'] = len(update.message.text)
+            else:
+                record['x'] = text
+        else:
+            record['k'] = OTHER
+        return record
+
+    async def record(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        if not isinstance(update, Update):
+            return
+        try:
+            self._file.write(json.dumps(self.to_record(update), separators=(',', ':')) + '\n')
+            self.recorded += 1
+        except Exception as e:
+            logger.warning(f"Update recording failed: {e}")
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield trace records in file order, skipping torn lines"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def to_update_dict(record: Dict[str, Any], update_id: int) -> Optional[Dict[str, Any]]:
+    """Rebuild a minimal Bot API update for a trace record"""
+    user_id = record.get('u')
+    if user_id is None or record.get('k') not in (MESSAGE, CALLBACK):
+        return None
+    chat_id = record.get('c', user_id)
+    date = int(record.get('t', time.time()))
+    sender = {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+    chat = {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}
+
+    if record['k'] == CALLBACK:
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': sender,
+                'chat_instance': str(chat_id),
+                'data': record.get('d'),
+                'message': {'message_id': update_id, 'date': date, 'chat': chat, 'caption': ''},
+            },
+        }
+
+    text = record.get('x') or 'x' * record.get('n', 1)
+    message = {'message_id': update_id, 'date': date, 'chat': chat, 'from': sender, 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
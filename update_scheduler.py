@@ -0,0 +1,215 @@
+"""
+Cash Points Update Scheduler
+Priority-aware update processor with bounded queues and load shedding.
+
+Features:
+- Priority classes: critical (callback queries, /start with a referral code),
+  normal (plain /start, other messages) and low (informational commands:
+  SCHEDULER_LOW_COMMANDS, /help /status /group by default)
+- A fixed number of handler slots; a freed slot always goes to the oldest
+  update of the highest waiting class
+- Bounded queue per class; an update arriving at a full queue, or a low
+  update still queued after SCHEDULER_LOW_MAX_WAIT, is shed
+- Shedding policy: 'respond' answers shed commands with a cached static
+  response where one is registered (no handler, no database) and drops the
+  rest; 'drop' drops everything it sheds
+- Queue-wait percentiles, depths and shed counts per class
+- Wraps another processor's do_process_update (e.g. tracing) for the
+  updates it admits
+"""
+
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Optional, Dict, Any, Callable, List
+
+from telegram.ext import BaseUpdateProcessor
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CRITICAL = 0
+NORMAL = 1
+LOW = 2
+CLASS_NAMES = ('critical', 'normal', 'low')
+
+RESPOND = 'respond'
+DROP = 'drop'
+
+STATIC_RESPONSE_TTL = 60  # seconds a rendered static response is reused
+WAIT_SAMPLES = 2000
+
+
+def _command(update) -> Optional[str]:
+    message = getattr(update, 'message', None)
+    text = getattr(message, 'text', None) or ''
+    if not text.startswith('/'):
+        return None
+    return text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+
+
+class _ClassStats:
+    __slots__ = ('admitted', 'answered', 'dropped', 'max_depth', 'waits')
+
+    def __init__(self):
+        self.admitted = 0
+        self.answered = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """BaseUpdateProcessor that schedules updates by priority class and sheds under pressure"""
+
+    def __init__(self, workers: int = None, queue_limits=None, policy: str = None,
+                 low_commands=None, low_max_wait: float = None, inner: BaseUpdateProcessor = None):
+        self.workers = workers or config.SCHEDULER_WORKERS
+        self.queue_limits = tuple(queue_limits or (config.SCHEDULER_CRITICAL_QUEUE,
+                                                   config.SCHEDULER_NORMAL_QUEUE,
+                                                   config.SCHEDULER_LOW_QUEUE))
+        # PTB hands over everything that may be running or queued; the real bound is ours
+        super().__init__(self.workers + sum(self.queue_limits))
+        self.policy = policy or config.SCHEDULER_SHED_POLICY
+        self.low_commands = set(low_commands if low_commands is not None else
+                                (c.strip() for c in config.SCHEDULER_LOW_COMMANDS.split(',') if c.strip()))
+        self.low_max_wait = low_max_wait if low_max_wait is not None else config.SCHEDULER_LOW_MAX_WAIT
+        self.inner = inner
+        # command -> callable returning send_message kwargs (text, parse_mode, reply_markup)
+        self.static_responses: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self.on_shed: List[Callable[[object, int, str], None]] = []
+        self._rendered: Dict[str, tuple] = {}
+        self._queues = tuple(deque() for _ in CLASS_NAMES)
+        self._running = 0
+        self._stats = tuple(_ClassStats() for _ in CLASS_NAMES)
+
+    def classify(self, update) -> int:
+        if getattr(update, 'callback_query', None) is not None:
+            return CRITICAL
+        command = _command(update)
+        if command == 'start':
+            # Referral /start carries the code that the reward depends on
+            return CRITICAL if len(update.message.text.split()) > 1 else NORMAL
+        if command in self.low_commands:
+            return LOW
+        return NORMAL
+
+    async def _acquire(self, klass: int) -> Optional[str]:
+        """Wait for a handler slot; returns the shed reason if none was granted"""
+        if self._running < self.workers and not any(self._queues):
+            self._running += 1
+            return None
+        queue = self._queues[klass]
+        if len(queue) >= self.queue_limits[klass]:
+            return 'queue_full'
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        queue.append(waiter)
+        stats = self._stats[klass]
+        stats.max_depth = max(stats.max_depth, len(queue))
+        expiry = loop.call_later(self.low_max_wait, self._expire, queue, waiter) if klass == LOW else None
+        try:
+            granted = await waiter
+        except asyncio.CancelledError:
+            if waiter in queue:
+                queue.remove(waiter)
+            elif waiter.done() and not waiter.cancelled() and waiter.result():
+                self._release()  # the slot was handed to us just before the cancel
+            raise
+        finally:
+            if expiry is not None:
+                expiry.cancel()
+        return None if granted else 'stale'
+
+    @staticmethod
+    def _expire(queue: deque, waiter: asyncio.Future):
+        # A low update that can't start within low_max_wait isn't worth answering late
+        if not waiter.done():
+            queue.remove(waiter)
+            waiter.set_result(False)
+
+    def _release(self):
+        for queue in self._queues:
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(True)  # the slot passes straight to the waiter
+                    return
+        self._running -= 1
+
+    def _static_response(self, command: str) -> Optional[Dict[str, Any]]:
+        render = self.static_responses.get(command)
+        if render is None:
+            return None
+        cached = self._rendered.get(command)
+        if cached is None or time.monotonic() - cached[1] > STATIC_RESPONSE_TTL:
+            cached = (render(), time.monotonic())
+            self._rendered[command] = cached
+        return cached[0]
+
+    async def _shed(self, update, coroutine, klass: int, reason: str):
+        coroutine.close()  # the handlers never run
+        stats = self._stats[klass]
+        response = self._static_response(_command(update)) if self.policy == RESPOND else None
+        chat = getattr(update, 'effective_chat', None)
+        if response is not None and chat is not None:
+            try:
+                await update.get_bot().send_message(chat.id, **response)
+                stats.answered += 1
+            except Exception as e:
+                logger.warning(f"Static response for shed update failed: {e}")
+                stats.dropped += 1
+        else:
+            stats.dropped += 1
+        for hook in self.on_shed:
+            hook(update, klass, reason)
+
+    async def do_process_update(self, update, coroutine):
+        klass = self.classify(update)
+        queued_at = time.monotonic()
+        reason = await self._acquire(klass)
+        stats = self._stats[klass]
+        stats.waits.append(time.monotonic() - queued_at)
+        if reason:
+            await self._shed(update, coroutine, klass, reason)
+            return
+        try:
+            stats.admitted += 1
+            if self.inner is not None:
+                await self.inner.do_process_update(update, coroutine)
+            else:
+                await coroutine
+        finally:
+            self._release()
+
+    async def initialize(self):
+        if self.inner is not None:
+            await self.inner.initialize()
+
+    async def shutdown(self):
+        if self.inner is not None:
+            await self.inner.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        classes = {}
+        for name, queue, stats in zip(CLASS_NAMES, self._queues, self._stats):
+            waits = list(stats.waits)
+            classes[name] = {
+                'queued': len(queue),
+                'max_queued': stats.max_depth,
+                'admitted': stats.admitted,
+                'answered': stats.answered,
+                'dropped': stats.dropped,
+                'wait_p50': _percentile(waits, 50),
+                'wait_p95': _percentile(waits, 95),
+            }
+        return {'running': self._running, 'workers': self.workers, 'classes': classes}
@@ -0,0 +1,245 @@
+"""
+Cash Points Warm State
+Graceful drain on shutdown and warm in-memory caches across restarts.
+
+Features:
+- DrainingUpdateProcessor runs each update's handlers as a tracked task, on
+  top of whatever processor the bot uses (scheduler, tracing or plain)
+- DrainingApplication.stop(): polling has already stopped when PTB calls it,
+  so intake is closed; queued updates and in-flight handlers then get
+  SHUTDOWN_DRAIN_TIMEOUT to finish. Past the deadline the rest is cancelled
+  and the queued updates dropped (logged by update_id), so there is still
+  time to flush buffers before the supervisor kills the process
+- save()/load() keep the legacy referral code and fraud flag caches in
+  WARM_STATE_PATH (remaining TTLs, minus the downtime) and the referral graph
+  index in REFERRAL_GRAPH_SNAPSHOT_PATH; a loaded index is caught up with
+  referrals verified since it was saved instead of re-reading all of them
+- Snapshots are written on shutdown and every WARM_STATE_INTERVAL, so a crash
+  restarts warm too; snapshots older than WARM_STATE_MAX_AGE are ignored
+- Sessions (user_data, flushed by PTB during stop) and membership checks
+  already live in SQLite under STATE_DIR
+
+Keep the supervisor's stop timeout (docker stop -t, systemd TimeoutStopSec)
+a few seconds above SHUTDOWN_DRAIN_TIMEOUT.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional, Dict, Any, Set
+
+from telegram.ext import Application, BaseUpdateProcessor
+
+from config import config
+from fraud_flags import fraud_flags
+from referral_codes import legacy_codes
+from referral_graph import ReferralGraphIndex
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+CANCEL_GRACE = 1.0  # seconds cancelled handlers get to unwind
+
+
+class DrainingUpdateProcessor(BaseUpdateProcessor):
+    """Tracks in-flight updates so shutdown can wait for them, with a deadline"""
+
+    def __init__(self, inner: BaseUpdateProcessor):
+        super().__init__(inner.max_concurrent_updates)
+        self.inner = inner
+        self.in_flight: Set[asyncio.Task] = set()
+        self.cancelled = 0
+
+    async def do_process_update(self, update, coroutine):
+        # Own task per update: with one update at a time PTB awaits this inline
+        # in its fetcher, which must survive a cancel
+        task = asyncio.create_task(self.inner.do_process_update(update, coroutine))
+        self.in_flight.add(task)
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                task.cancel()
+                raise
+            self.cancelled += 1
+            logger.warning(f"⏹️ Update {getattr(update, 'update_id', '?')} cancelled at the drain deadline")
+        finally:
+            self.in_flight.discard(task)
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def drain(self, update_queue: asyncio.Queue, timeout: float) -> Dict[str, Any]:
+        """Wait for queued and running updates; past `timeout` cancel and drop the rest"""
+        started = time.monotonic()
+        deadline = started + timeout
+        while (self.in_flight or not update_queue.empty()) and time.monotonic() < deadline:
+            if self.in_flight:
+                await asyncio.wait(set(self.in_flight), timeout=min(0.1, max(0.0, deadline - time.monotonic())))
+            else:
+                await asyncio.sleep(0.01)  # the fetcher hands the next queued update over
+        running = len(self.in_flight)
+        dropped = []
+        if running or not update_queue.empty():
+            while not update_queue.empty():
+                item = update_queue.get_nowait()
+                update_queue.task_done()
+                dropped.append(getattr(item, 'update_id', None))
+            for task in list(self.in_flight):
+                task.cancel()
+            if self.in_flight:
+                await asyncio.wait(set(self.in_flight), timeout=CANCEL_GRACE)
+            logger.warning(f"⏹️ Drain deadline hit: cancelled {running} running updates, "
+                           f"dropped queued updates {[u for u in dropped if u is not None]}")
+        return {'seconds': time.monotonic() - started, 'cancelled': running, 'dropped': len(dropped)}
+
+
+class DrainingApplication(Application):
+    """Application whose stop() drains in-flight updates within SHUTDOWN_DRAIN_TIMEOUT"""
+
+    async def stop(self) -> None:
+        processor = self.update_processor
+        if self.running and isinstance(processor, DrainingUpdateProcessor):
+            result = await processor.drain(self.update_queue, config.SHUTDOWN_DRAIN_TIMEOUT)
+            self.bot_data['drain'] = result
+            logger.info(f"🛬 Drained updates in {result['seconds']:.1f}s")
+        await super().stop()
+
+
+# ---- Warm caches ------------------------------------------------------------
+
+def _state_path() -> str:
+    return config.WARM_STATE_PATH
+
+
+def _graph_path() -> str:
+    return config.REFERRAL_GRAPH_SNAPSHOT_PATH
+
+
+def save(referral_index: Optional[ReferralGraphIndex] = None, index_lock=None,
+         saved_graph: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Write the caches (and the referral index, if ready) to STATE_DIR
+
+    Without an index to write, `saved_graph` (the 'referral_graph' entry of the
+    last save) is kept, so the graph file already on disk still gets loaded and
+    caught up from the time it was actually written.
+    """
+    os.makedirs(os.path.dirname(_state_path()) or '.', exist_ok=True)
+    started = time.perf_counter()
+    state = {
+        'version': STATE_VERSION,
+        'saved_at': time.time(),
+        'legacy_codes': legacy_codes.export(),
+        'fraud_flags': fraud_flags.export(),
+    }
+    if referral_index is not None and referral_index.ready:
+        if index_lock is not None:
+            with index_lock:
+                referral_index.save(_graph_path())
+        else:
+            referral_index.save(_graph_path())
+        state['referral_graph'] = {'saved_at': state['saved_at'], 'edges': referral_index.edges}
+    elif saved_graph is not None:
+        state['referral_graph'] = saved_graph
+    tmp_path = f"{_state_path()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path())
+    summary = {'codes': len(state['legacy_codes']), 'flags': len(state['fraud_flags']),
+               'edges': state.get('referral_graph', {}).get('edges'), 'seconds': time.perf_counter() - started,
+               'referral_graph': state.get('referral_graph')}
+    logger.info(f"💾 Warm state saved: {summary['codes']} codes, {summary['flags']} fraud flags, "
+                f"{summary['edges'] if summary['edges'] is not None else 'no'} graph edges "
+                f"in {summary['seconds']:.2f}s")
+    return summary
+
+
+def _read_state() -> Optional[Dict[str, Any]]:
+    try:
+        with open(_state_path()) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable warm state {_state_path()}: {e}")
+        return None
+    age = time.time() - state.get('saved_at', 0)
+    if state.get('version') != STATE_VERSION or age > config.WARM_STATE_MAX_AGE:
+        logger.info(f"Ignoring warm state from {age / 60:.0f} min ago")
+        return None
+    return state
+
+
+def load() -> Dict[str, Any]:
+    """Refill the caches from the last snapshot; returns what was restored"""
+    state = _read_state()
+    if state is None:
+        return {'codes': 0, 'flags': 0}
+    elapsed = max(0.0, time.time() - state['saved_at'])
+    restored = {
+        'codes': legacy_codes.restore(state.get('legacy_codes') or [], elapsed),
+        'flags': fraud_flags.restore(state.get('fraud_flags') or [], elapsed),
+    }
+    logger.info(f"♨️ Warm state loaded ({elapsed:.0f}s old): {restored['codes']} codes, "
+                f"{restored['flags']} fraud flags")
+    return restored
+
+
+def load_referral_index(db, page_size: int = 1000) -> Optional[ReferralGraphIndex]:
+    """The saved referral index caught up with referrals verified since, or None"""
+    state = _read_state()
+    graph = (state or {}).get('referral_graph')
+    if not graph or not os.path.exists(_graph_path()):
+        return None
+    try:
+        index = ReferralGraphIndex.load(_graph_path())
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring referral graph snapshot: {e}")
+        return None
+    # Edges are idempotent, so overlapping the save time by a minute is harmless
+    since = datetime.fromtimestamp(graph['saved_at'] - 60)
+    query = (db.collection('referrals').where('status', '==', 'verified')
+             .where('updated_at', '>=', since).order_by('updated_at').order_by('__name__'))
+    caught_up, last_doc = 0, None
+    while True:
+        page = query.limit(page_size)
+        if last_doc is not None:
+            page = page.start_after(last_doc)
+        docs = list(page.stream())
+        for doc in docs:
+            data = doc.to_dict() or {}
+            try:
+                index.add_referral(int(data['referrer_id']), int(data['referred_id']))
+                caught_up += 1
+            except (KeyError, TypeError, ValueError):
+                continue
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+    logger.info(f"♨️ Referral index loaded from snapshot ({graph['edges']} edges) "
+                f"and caught up with {caught_up} referrals")
+    return index
+
+
+async def run_saver(get_index, index_lock=None):
+    """Snapshot the caches every WARM_STATE_INTERVAL so a crash restarts warm"""
+    saved_edges, saved_graph = None, None
+    while True:
+        await asyncio.sleep(config.WARM_STATE_INTERVAL)
+        index = get_index()
+        # The graph file is only rewritten when it changed; otherwise the entry
+        # for the file on disk (and its original saved_at) is carried over
+        graph = index if index is not None and index.edges != saved_edges else None
+        try:
+            summary = await asyncio.to_thread(save, graph, index_lock, saved_graph)
+            if graph is not None:
+                saved_edges = graph.edges
+            saved_graph = summary['referral_graph']
+        except Exception as e:
+            logger.warning(f"Saving warm state failed: {e}")
@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+"""
+Cash Points Withdrawals
+Batch evaluation and settlement of withdrawal requests.
+
+Features:
+- Pulls pending withdrawal_requests oldest first, a page at a time
+- Checks a page's users concurrently: group membership (MembershipStore answers
+  newer than WITHDRAWAL_MEMBERSHIP_MAX_AGE, otherwise getChatMember under the
+  rate governor's background share), fraud flags, balances (30 users per
+  query) and per-method minimums from payment_configs
+- Settles in batches: every request gets a withdrawal_settlements/{request_id}
+  marker created in the same commit as its status change, notification and
+  balance Increment, so a retried page or a second runner never settles a
+  request twice; the status change is conditional on the request's update
+  time from the page, so a request the admin panel settled (or edited) after
+  the page was read is left alone
+- Debits are conditional on the user doc's update time from the balance read:
+  if the balance changed before the commit (an admin approval, a mini app
+  write, another spend), the user is re-read and their request decided again,
+  so the pipeline never overdraws an account
+- A commit that landed but whose response was lost is recognised on retry by
+  the settle_id on its markers, so those users are still notified
+- Notifies users through the rate governor once their batch has committed
+- Requests whose membership can't be determined stay pending for the next run
+
+Held requests (balance_debited false, written by the mini app) are checked
+against the balance and debited when approved. Older requests were debited
+when submitted: they are approved without a debit and refunded when rejected,
+except for fraud, which the admin panel also rejects without a refund.
+
+Usage:
+    python withdrawals.py --once
+    python withdrawals.py --bench 20000
+"""
+
+import time
+import asyncio
+import logging
+import argparse
+import uuid
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+from telegram.error import RetryAfter, BadRequest, Forbidden, TimedOut, NetworkError
+
+from config import config
+import resilience
+from fraud_flags import fraud_flags
+from rate_governor import governor as shared_governor
+from membership_sweeper import MembershipStore, MembershipSweeper, VERIFIED
+from models import Notification
+
+logger = logging.getLogger(__name__)
+
+REQUESTS_COLLECTION = 'withdrawal_requests'
+SETTLEMENTS_COLLECTION = 'withdrawal_settlements'
+PAYMENT_CONFIGS_COLLECTION = 'payment_configs'
+
+BATCH_LIMIT = 500  # Firestore max writes per batch
+IN_QUERY_LIMIT = 30  # Firestore max values in an 'in' filter
+PROCESSED_BY = 'withdrawal_pipeline'
+
+# Minimums the mini app enforces, for methods without a payment config
+DEFAULT_MINIMUMS = {'bkash': 100, 'nagad': 100, 'rocket': 100, 'upay': 100, 'bank': 500, 'crypto': 200}
+
+# Outcomes
+APPROVED = 'approved'
+REJECTED = 'rejected'
+DEFERRED = 'deferred'  # membership unknown, left pending
+DUPLICATE = 'duplicate'  # already settled by an earlier attempt
+FAILED = 'failed'
+
+# Rejection reasons, stored as admin_notes. The mini app shows notes mentioning
+# "fraud" or "invalid" as a valid cause, and the rest as refunded.
+REASONS = {
+    'not_a_member': 'Not a member of the required group',
+    'fraud': 'Account flagged for referral fraud',
+    'below_minimum': 'Amount is below the minimum for this method',
+    'method_disabled': 'This withdrawal method is currently disabled',
+    'insufficient_balance': 'Insufficient balance',
+    'unknown_user': 'User account not found',
+    'invalid_amount': 'Invalid amount',
+}
+NO_REFUND = ('fraud', 'invalid_amount', 'unknown_user')
+
+
+class WithdrawalRequest(NamedTuple):
+    doc_id: str
+    ref: Any
+    user_id: str
+    amount: Optional[float]
+    method: str
+    held: bool  # balance not debited yet
+    update_time: Any = None  # from the page snapshot, the precondition for settling
+
+
+class UserBalance(NamedTuple):
+    ref: Any
+    balance: float
+    update_time: Any = None  # precondition for debiting
+
+
+class Decision(NamedTuple):
+    request: WithdrawalRequest
+    outcome: str
+    reason: str = ''
+
+    @property
+    def debit(self) -> float:
+        return self.request.amount if self.outcome == APPROVED and self.request.held else 0.0
+
+    @property
+    def refund(self) -> float:
+        if self.outcome != REJECTED or self.request.held or self.reason in NO_REFUND:
+            return 0.0
+        return self.request.amount
+
+
+def _parse(doc) -> WithdrawalRequest:
+    data = doc.to_dict() or {}
+    try:
+        amount = float(data.get('amount'))
+    except (TypeError, ValueError):
+        amount = None
+    return WithdrawalRequest(doc.id, doc.reference, str(data.get('user_id') or ''), amount,
+                             str(data.get('method') or '').lower(), data.get('balance_debited') is False,
+                             getattr(doc, 'update_time', None))
+
+
+def _money(amount: float) -> str:
+    return f"৳{amount:,.2f}".rstrip('0').rstrip('.')
+
+
+class PaymentConfigCache:
+    """Withdrawal rules per method from payment_configs, reloaded after a TTL"""
+
+    def __init__(self, db, ttl_seconds: int = None):
+        self.db = db
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else config.PAYMENT_CONFIG_CACHE_TTL
+        self._methods: Dict[str, Dict[str, Any]] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _reload(self):
+        methods = {}
+        for doc in self.db.collection(PAYMENT_CONFIGS_COLLECTION).stream():
+            data = doc.to_dict() or {}
+            # Task reward configs share the collection; only withdrawal configs carry these
+            if 'method' in data or 'min_withdrawal' in data:
+                methods[str(data.get('method') or doc.id).lower()] = data
+        self._methods = methods
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def rule(self, method: str) -> Tuple[bool, float]:
+        """(enabled, minimum amount) for a withdrawal method"""
+        with self._lock:
+            if time.monotonic() - self._loaded_at >= self.ttl_seconds:
+                try:
+                    self._reload()
+                except Exception as e:
+                    # Keep the previous rules if the reload fails
+                    logger.warning(f"Payment config reload failed: {e}")
+                    self._loaded_at = time.monotonic()
+            data = self._methods.get(method, {})
+        minimum = data.get('min_withdrawal', data.get('min_amount'))
+        if minimum is None:
+            minimum = DEFAULT_MINIMUMS.get(method, config.WITHDRAWAL_MIN_AMOUNT)
+        return data.get('is_active', True) is not False, float(minimum)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0.0
+
+
+class WithdrawalPipeline:
+    """Evaluates pending withdrawal requests a page at a time and settles them in batches"""
+
+    def __init__(self, db, bot=None, store: MembershipStore = None, governor=None,
+                 configs: PaymentConfigCache = None, page_size: int = None, concurrency: int = None,
+                 batch_writes: int = None, membership_max_age: float = None):
+        self.db = db
+        self.bot = bot
+        self.store = store or MembershipStore()
+        self.governor = governor or shared_governor
+        # Without a bot only recorded membership answers are used
+        self.sweeper = MembershipSweeper(db, bot, store=self.store, governor=self.governor) if bot else None
+        self.configs = configs or PaymentConfigCache(db)
+        self.page_size = page_size or config.WITHDRAWAL_PAGE_SIZE
+        self.concurrency = concurrency or config.WITHDRAWAL_CONCURRENCY
+        self.batch_writes = min(batch_writes or config.WITHDRAWAL_BATCH_WRITES, BATCH_LIMIT)
+        self.membership_max_age = (membership_max_age if membership_max_age is not None
+                                   else config.WITHDRAWAL_MEMBERSHIP_MAX_AGE)
+        self.counts: Dict[str, int] = {}
+        self.commits = 0
+        self.notified = 0
+        self.last_run: Dict[str, Any] = {}
+
+    # ---- Checks -----------------------------------------------------------
+
+    async def _gather(self, fn, items):
+        """fn(item) for every item, at most `concurrency` at a time"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(item):
+            async with semaphore:
+                return item, await fn(item)
+
+        return dict(await asyncio.gather(*(one(item) for item in items)))
+
+    async def _membership(self, user_ids: List[str]) -> Dict[str, str]:
+        """membership_status per user; users Telegram couldn't answer for are left out"""
+        known = await asyncio.to_thread(self.store.get_many, user_ids)
+        fresh_after = time.time() - self.membership_max_age
+        # Only recent positive answers are reused: someone who left may have rejoined
+        statuses = {u: VERIFIED for u, (status, checked_at) in known.items()
+                    if status == VERIFIED and checked_at >= fresh_after}
+        due = [u for u in user_ids if u not in statuses and u.lstrip('-').isdigit()]
+        if due and self.sweeper:
+            checked = {u: status for u, status in (await self._gather(self.sweeper.check, due)).items()
+                       if status is not None}
+            if checked:
+                await asyncio.to_thread(self.store.record_many, checked)
+            statuses.update(checked)
+        return statuses
+
+    async def _fraud_flags(self, user_ids: List[str]) -> set:
+        flags = await self._gather(lambda u: asyncio.to_thread(fraud_flags.is_flagged, self.db, u), user_ids)
+        return {u for u, flagged in flags.items() if flagged}
+
+    @staticmethod
+    def _user_balance(doc) -> UserBalance:
+        return UserBalance(doc.reference, float((doc.to_dict() or {}).get('balance') or 0),
+                           getattr(doc, 'update_time', None))
+
+    def _load_users(self, chunk: List[str]) -> Dict[str, UserBalance]:
+        users = {}
+        for doc in self.db.collection('users').where('telegram_id', 'in', chunk).stream():
+            telegram_id = str((doc.to_dict() or {}).get('telegram_id'))
+            if telegram_id not in users:
+                users[telegram_id] = self._user_balance(doc)
+        return users
+
+    async def _users(self, user_ids: List[str]) -> Dict[str, UserBalance]:
+        chunks = [user_ids[i:i + IN_QUERY_LIMIT] for i in range(0, len(user_ids), IN_QUERY_LIMIT)]
+        users = {}
+        for found in (await self._gather(
+                lambda chunk: resilience.acall('users', self._load_users, list(chunk), idempotent=True),
+                [tuple(c) for c in chunks])).values():
+            users.update(found)
+        return users
+
+    async def evaluate(self, requests: List[WithdrawalRequest]) -> Tuple[List[Decision], Dict[str, UserBalance]]:
+        """Decide every request of a page; returns (decisions, user balances as read)"""
+        user_ids = list(dict.fromkeys(r.user_id for r in requests if r.user_id))
+        members, flagged, users = await asyncio.gather(
+            self._membership(user_ids), self._fraud_flags(user_ids), self._users(user_ids))
+        available = {u: user.balance for u, user in users.items()}
+        decisions = []
+        for request in requests:  # oldest first, so earlier requests get the balance first
+            decision = self._decide(request, members, flagged, available)
+            if decision.debit:
+                available[request.user_id] -= decision.debit
+            decisions.append(decision)
+        return decisions, users
+
+    def _decide(self, request: WithdrawalRequest, members: Dict[str, str], flagged: set,
+                available: Dict[str, float]) -> Decision:
+        if request.amount is None or request.amount <= 0:
+            return Decision(request, REJECTED, 'invalid_amount')
+        if request.user_id not in available:
+            return Decision(request, REJECTED, 'unknown_user')
+        status = members.get(request.user_id)
+        if status is None:
+            return Decision(request, DEFERRED)
+        if status != VERIFIED:
+            return Decision(request, REJECTED, 'not_a_member')
+        if request.user_id in flagged:
+            return Decision(request, REJECTED, 'fraud')
+        enabled, minimum = self.configs.rule(request.method)
+        if not enabled:
+            return Decision(request, REJECTED, 'method_disabled')
+        if request.amount < minimum:
+            return Decision(request, REJECTED, 'below_minimum')
+        # Held requests need the funds now; older ones only must not have overdrawn
+        needed = request.amount if request.held else 0.0
+        if available[request.user_id] < needed:
+            return Decision(request, REJECTED, 'insufficient_balance')
+        return Decision(request, APPROVED)
+
+    # ---- Writes -----------------------------------------------------------
+
+    @staticmethod
+    def _message(decision: Decision) -> Tuple[str, str]:
+        amount = _money(decision.request.amount or 0)
+        if decision.outcome == APPROVED:
+            return ('Withdrawal Approved! 💰',
+                    f'Your withdrawal of {amount} has been approved and processed successfully.')
+        note = REASONS.get(decision.reason, decision.reason)
+        if decision.refund:
+            return ('Withdrawal Rejected & Refunded ⚠️',
+                    f'Your withdrawal of {amount} was rejected ({note}) but the amount has been '
+                    f'refunded to your balance.')
+        return 'Withdrawal Rejected ❌', f'Your withdrawal of {amount} was rejected: {note}'
+
+    def _commit_chunk(self, decisions: List[Decision], users: Dict[str, UserBalance], settle_id: str,
+                      attempts: int = 3) -> Dict[int, Decision]:
+        """Settle decisions in one batch; returns position in `decisions` -> the decision
+        as settled (its outcome DUPLICATE or FAILED when it wasn't)"""
+        batch = self.db.batch()
+        now = datetime.now()
+        deltas: Dict[str, float] = {}
+        debited = set()
+        decisions = list(decisions)
+        for i, decision in enumerate(decisions):
+            request = decision.request
+            if decision.debit and request.user_id in users:
+                # Decided against the balance the debit's precondition holds it to
+                if users[request.user_id].balance + deltas.get(request.user_id, 0.0) < decision.debit:
+                    decision = decisions[i] = Decision(request, REJECTED, 'insufficient_balance')
+            batch.create(self.db.collection(SETTLEMENTS_COLLECTION).document(request.doc_id), {
+                'request_id': request.doc_id,
+                'user_id': request.user_id,
+                'amount': request.amount,
+                'outcome': decision.outcome,
+                'reason': decision.reason,
+                'debited': decision.debit,
+                'refunded': decision.refund,
+                'settle_id': settle_id,
+                'settled_at': now
+            })
+            update = {
+                'status': decision.outcome,
+                'processed_at': now,
+                'processed_by': PROCESSED_BY,
+                'admin_notes': REASONS.get(decision.reason) if decision.reason else None,
+                'updated_at': now
+            }
+            if decision.debit:
+                update['balance_debited'] = True
+                debited.add(request.user_id)
+            if request.update_time is not None:
+                # Fails the commit if the request changed since the page was read
+                batch.update(request.ref, update,
+                             option=self.db.write_option(last_update_time=request.update_time))
+            else:
+                batch.update(request.ref, update)
+            title, message = self._message(decision)
+            batch.set(self.db.collection('notifications').document(f"withdrawal_{request.doc_id}"),
+                      Notification(request.user_id, 'withdrawal', title, message,
+                                   created_at=now).to_firestore())
+            delta = decision.refund - decision.debit
+            if delta and request.user_id in users:
+                deltas[request.user_id] = deltas.get(request.user_id, 0.0) + delta
+        for user_id, delta in deltas.items():
+            user = users[user_id]
+            if user_id in debited and user.update_time is not None:
+                # Fails the commit if the balance changed since it was read
+                batch.update(user.ref, {'balance': firestore.Increment(delta), 'updated_at': now},
+                             option=self.db.write_option(last_update_time=user.update_time))
+            else:
+                batch.update(user.ref, {'balance': firestore.Increment(delta), 'updated_at': now})
+        try:
+            # Safe to retry: a commit that did land fails the retry on its markers
+            results = resilience.call('withdrawals', batch.commit, idempotent=True)
+            self.commits += 1
+        except (AlreadyExists, FailedPrecondition):
+            if len(decisions) > 1:
+                # Some of these were settled (or changed) since; isolate them one by one
+                settled = {}
+                for i, decision in enumerate(decisions):
+                    settled[i] = self._commit_chunk([decision], users, settle_id)[0]
+                return settled
+            return {0: self._recheck(decisions[0], users, settle_id, attempts)}
+        except Exception as e:
+            logger.warning(f"Withdrawal settlement batch of {len(decisions)} failed: {e}")
+            return {i: d._replace(outcome=FAILED) for i, d in enumerate(decisions)}
+        # Later batches of the page debit these users against their docs as written here
+        first = 3 * len(decisions)
+        for i, (user_id, delta) in enumerate(deltas.items()):
+            update_time = results[first + i].update_time if results else None
+            users[user_id] = users[user_id]._replace(balance=users[user_id].balance + delta,
+                                                     update_time=update_time)
+        return dict(enumerate(decisions))
+
+    def _recheck(self, decision: Decision, users: Dict[str, UserBalance], settle_id: str,
+                 attempts: int) -> Decision:
+        """Why a single settlement failed: settled already, by us or someone else, or
+        the user's balance changed, in which case the request is decided again"""
+        request = decision.request
+        marker = resilience.call('withdrawals', self.db.collection(SETTLEMENTS_COLLECTION)
+                                 .document(request.doc_id).get, idempotent=True)
+        if marker.exists:
+            data = marker.to_dict() or {}
+            if data.get('settle_id') == settle_id:
+                # Our own commit landed; only its response was lost
+                return Decision(request, data.get('outcome'), data.get('reason') or '')
+            return decision._replace(outcome=DUPLICATE)
+        current = resilience.call('withdrawals', request.ref.get, idempotent=True)
+        if (not current.exists or (current.to_dict() or {}).get('status') != 'pending'
+                or (request.update_time is not None and current.update_time != request.update_time)):
+            return decision._replace(outcome=DUPLICATE)  # changed elsewhere; the next run sees it fresh
+        if request.user_id not in users or not attempts:
+            return decision._replace(outcome=FAILED)  # left pending for the next run
+        fresh = resilience.call('users', users[request.user_id].ref.get, idempotent=True)
+        users[request.user_id] = self._user_balance(fresh)
+        return self._commit_chunk([decision], users, settle_id, attempts - 1)[0]
+
+    def settle(self, decisions: List[Decision], users: Dict[str, UserBalance]) -> List[str]:
+        """Commit decisions in batches; returns one outcome per decision. Requests
+        decided again at commit time are replaced in `decisions`"""
+        outcomes = [DEFERRED] * len(decisions)
+        settle_id = uuid.uuid4().hex
+        chunk: List[int] = []
+        users_in_chunk: set = set()
+
+        def flush():
+            if chunk:
+                for i, settled in self._commit_chunk([decisions[i] for i in chunk], users, settle_id).items():
+                    outcomes[chunk[i]] = settled.outcome
+                    if settled.outcome in (APPROVED, REJECTED):
+                        decisions[chunk[i]] = settled
+                chunk.clear()
+                users_in_chunk.clear()
+
+        for i, decision in enumerate(decisions):
+            if decision.outcome == DEFERRED:
+                continue
+            # Marker, request and notification each, plus one balance update per distinct user
+            user = {decision.request.user_id} if decision.debit or decision.refund else set()
+            if 3 * (len(chunk) + 1) + len(users_in_chunk | user) > self.batch_writes:
+                flush()
+            chunk.append(i)
+            users_in_chunk.update(user)
+        flush()
+        return outcomes
+
+    # ---- Notifications ----------------------------------------------------
+
+    async def _send(self, decision: Decision):
+        title, message = self._message(decision)
+        for attempt in range(3):
+            await self.governor.acquire(background=True)
+            try:
+                await self.bot.send_message(int(decision.request.user_id), f"{title}\n\n{message}")
+                self.notified += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                self.governor.penalize(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds')
+                                       else float(retry_after))
+            except (BadRequest, Forbidden):
+                return  # never started the bot, or blocked it: the notification doc remains
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(0.5 * (attempt + 1))
+            except Exception as e:
+                logger.warning(f"Withdrawal message to {decision.request.user_id} failed: {e}")
+                return
+
+    async def _notify(self, decisions: List[Decision]):
+        if self.bot and decisions:
+            await self._gather(self._send, decisions)
+
+    # ---- Runs -------------------------------------------------------------
+
+    def _page(self, after):
+        query = (self.db.collection(REQUESTS_COLLECTION).where('status', '==', 'pending')
+                 .order_by('created_at').order_by('__name__').limit(self.page_size))
+        if after is not None:
+            query = query.start_after(after)
+        return list(query.stream())
+
+    async def run_once(self) -> Dict[str, Any]:
+        """Evaluate and settle every request pending when the run started"""
+        started = time.perf_counter()
+        run = {'scanned': 0, APPROVED: 0, REJECTED: 0, DEFERRED: 0, DUPLICATE: 0, FAILED: 0,
+               'debited': 0.0, 'refunded': 0.0}
+        notify_tasks = []
+        after = None
+        while True:
+            docs = await resilience.acall('withdrawals', self._page, after, idempotent=True)
+            if not docs:
+                break
+            decisions, users = await self.evaluate([_parse(doc) for doc in docs])
+            outcomes = await asyncio.to_thread(self.settle, decisions, users)
+            settled = []
+            for decision, outcome in zip(decisions, outcomes):
+                run[outcome] += 1
+                self.counts[outcome] = self.counts.get(outcome, 0) + 1
+                if outcome in (APPROVED, REJECTED):
+                    settled.append(decision)
+                    run['debited'] += decision.debit
+                    run['refunded'] += decision.refund
+                    if outcome == REJECTED:
+                        self.counts[decision.reason] = self.counts.get(decision.reason, 0) + 1
+            run['scanned'] += len(docs)
+            # Messages go out while the next page is evaluated
+            notify_tasks.append(asyncio.create_task(self._notify(settled)))
+            if len(docs) < self.page_size:
+                break
+            after = docs[-1]
+        await asyncio.gather(*notify_tasks)
+        run['seconds'] = time.perf_counter() - started
+        run['finished_at'] = time.time()
+        self.last_run = run
+        if run['scanned']:
+            logger.info(f"💸 Withdrawals: {run[APPROVED]} approved, {run[REJECTED]} rejected, "
+                        f"{run[DEFERRED]} deferred, {run[DUPLICATE]} already settled, {run[FAILED]} failed "
+                        f"of {run['scanned']} in {run['seconds']:.1f}s")
+        return run
+
+    async def run_forever(self):
+        """Background task: a run every WITHDRAWAL_INTERVAL"""
+        while True:
+            try:
+                started = time.time()
+                await self.run_once()
+                await asyncio.sleep(max(config.WITHDRAWAL_INTERVAL - (time.time() - started), 1))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Withdrawal run failed: {e}")
+                await asyncio.sleep(config.WITHDRAWAL_INTERVAL)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'commits': self.commits,
+            'notified': self.notified,
+            'last_run': self.last_run,
+            **self.counts,
+        }
+
+
+async def run_benchmark(total: int, users: int, rate: float, latency: float):
+    """Settle synthetic withdrawal requests against the stand-in backend and Bot API"""
+    import os
+    import random
+    import tempfile
+    from telegram import Bot
+    from fake_bot_api import FakeBotRequest
+    from fake_firestore import FakeFirestore
+    from rate_governor import RateGovernor
+
+    db = FakeFirestore()
+    rng = random.Random(1)
+    base = 7_000_000_000
+    for i in range(users):
+        db.seed('users', str(base + i), {'telegram_id': str(base + i), 'balance': rng.choice([0, 150, 600, 2000])})
+    for i in range(0, users, 40):
+        db.seed('referral_fraud_flags', str(base + i), {'flagged': True})
+    db.seed(PAYMENT_CONFIGS_COLLECTION, 'rocket', {'method': 'rocket', 'is_active': False})
+    methods = ['bkash', 'nagad', 'rocket', 'bank', 'crypto']
+    created = datetime(2026, 1, 1).timestamp()
+    for i in range(total):
+        request = {'user_id': str(base + rng.randrange(users)), 'amount': rng.choice([50, 100, 200, 500, 1000]),
+                   'method': rng.choice(methods), 'status': 'pending',
+                   'created_at': datetime.fromtimestamp(created + i)}
+        if rng.random() < 0.7:
+            request['balance_debited'] = False  # held by the mini app; the rest were debited on submit
+        db.seed(REQUESTS_COLLECTION, f"w{i:09d}", request)
+
+    bot = Bot('123456:bench', request=FakeBotRequest(latency=latency, member_ratio=0.9))
+    store = MembershipStore(os.path.join(tempfile.mkdtemp(prefix='withdrawals_'), 'membership.sqlite3'))
+    pipeline = WithdrawalPipeline(db, bot, store=store, governor=RateGovernor(rate=rate, burst=rate))
+    await bot.initialize()
+    result = await pipeline.run_once()
+    print(f"📊 Settled {result['scanned']:,} requests in {result['seconds']:.1f}s "
+          f"({result['scanned'] / result['seconds'] * 60:,.0f}/min)")
+    print(f"✅ Approved {result[APPROVED]:,}  ❌ Rejected {result[REJECTED]:,}  ⏸️ Deferred {result[DEFERRED]:,}")
+    print("   " + ", ".join(f"{reason} {pipeline.counts.get(reason, 0):,}" for reason in REASONS))
+    print(f"💰 Debited ৳{result['debited']:,.0f}, refunded ৳{result['refunded']:,.0f}; "
+          f"lowest balance ৳{min(d['balance'] for d in db.dump('users').values()):,.0f}")
+    print(f"💾 Commits: {pipeline.commits:,}; getChatMember {bot.request.counts['getChatMember']:,}, "
+          f"sendMessage {bot.request.counts['sendMessage']:,}")
+
+    # A retried page finds its markers and changes nothing
+    retried = await asyncio.to_thread(pipeline.settle, *await pipeline.evaluate(
+        [_parse(doc) for doc in db.collection(REQUESTS_COLLECTION).limit(500).stream()]))
+    print(f"🔁 Retried 500 settled requests: {retried.count(DUPLICATE)} already settled, "
+          f"{sum(1 for o in retried if o in (APPROVED, REJECTED))} settled again")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Withdrawal request evaluation and settlement')
+    parser.add_argument('--once', action='store_true', help='Settle pending requests against the live backend')
+    parser.add_argument('--bench', type=int, default=0, help='Benchmark N synthetic withdrawal requests')
+    parser.add_argument('--users', type=int, default=5000, help='Synthetic users for the benchmark')
+    parser.add_argument('--rate', type=float, default=5000, help='Benchmark Bot API calls/sec')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='Benchmark seconds per Bot API call')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.bench:
+        asyncio.run(run_benchmark(args.bench, args.users, args.rate, args.api_latency))
+    elif args.once:
+        from telegram import Bot
+        from bot_firebase import db
+
+        async def once():
+            async with Bot(config.TOKEN) as bot:
+                await WithdrawalPipeline(db, bot).run_once()
+
+        asyncio.run(once())
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()